@@ -0,0 +1,117 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Script to benchmark the committing of batch uploads against SQL databases.
+
+This script takes one or more database URIs and times the application of
+batches of BSOs of various sizes to each.  Half of the items in each batch
+replace existing items and half of them are new, so that both the update
+and insert parts of the commit are exercised.  For PostgreSQL it also times
+the generic two-query commit, for comparison with the single-query upsert.
+The items are written for a dedicated userid, and are deleted once the
+benchmark has finished.
+
+It's intended for comparing the performance of different database drivers,
+and should not be pointed at a production database.
+
+"""
+
+import time
+import logging
+import optparse
+
+import syncstorage.scripts
+from syncstorage.storage.sql import SQLStorage
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZES = (10, 100, 1000, 4000)
+
+
+def bench_batch(sqluri, batch_sizes=DEFAULT_BATCH_SIZES, repeat=5,
+                userid=999999999):
+    """Benchmark the committing of batch uploads into the given database.
+
+    This function returns a list of (driver, method, batch_size, commit_time)
+    tuples, with times in seconds averaged over the given number of
+    repetitions.
+    """
+    storage = SQLStorage(sqluri, create_tables=True)
+    dbconnector = storage.dbconnector
+    methods = ["native"]
+    if storage._can_upsert_batch():
+        methods.append("generic")
+    payload = "x" * 500
+
+    results = []
+    try:
+        for method in methods:
+            if method == "generic":
+                dbconnector._supports_on_conflict = False
+            for batch_size in batch_sizes:
+                logger.debug("Timing %s commit of %d items",
+                             method, batch_size)
+                commit_time = 0
+                for _ in xrange(repeat):
+                    storage.delete_storage(userid)
+                    storage.set_items(userid, "bench", [{
+                        "id": "bench%d" % (i,),
+                        "payload": payload,
+                    } for i in xrange(0, batch_size, 2)])
+                    batchid = storage.create_batch(userid, "bench")
+                    storage.append_items_to_batch(userid, "bench", batchid, [{
+                        "id": "bench%d" % (i,),
+                        "payload": payload,
+                        "sortindex": i,
+                    } for i in xrange(batch_size)])
+                    t_start = time.time()
+                    storage.apply_batch(userid, "bench", batchid)
+                    commit_time += time.time() - t_start
+                    storage.close_batch(userid, "bench", batchid)
+                results.append((dbconnector.driver, method, batch_size,
+                                commit_time / repeat))
+    finally:
+        storage.delete_storage(userid)
+    return results
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the bench_batch() function for each database.
+    """
+    usage = "usage: %prog [options] sqluri [sqluri...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--batch-sizes", default="10,100,1000,4000",
+                      help="Comma-separated list of batch sizes to time")
+    parser.add_option("", "--repeat", type="int", default=5,
+                      help="Number of times to repeat each measurement")
+    parser.add_option("", "--userid", type="int", default=999999999,
+                      help="Userid under which to write the test items")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) < 1:
+        parser.print_usage()
+        return 1
+
+    syncstorage.scripts.configure_script_logging(opts)
+
+    batch_sizes = [int(size) for size in opts.batch_sizes.split(",")]
+
+    print "%-10s %-8s %6s %12s" % ("driver", "method", "items", "commit (ms)")
+    for sqluri in args:
+        results = bench_batch(sqluri, batch_sizes, opts.repeat, opts.userid)
+        for driver, method, batch_size, commit_time in results:
+            print "%-10s %-8s %6d %12.2f" % (driver, method, batch_size,
+                                             commit_time * 1000)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
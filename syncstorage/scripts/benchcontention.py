@@ -0,0 +1,126 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Script to benchmark concurrent single-item writes to a single collection.
+
+This script takes one or more database URIs and, for each, runs several
+threads that repeatedly write individual items into the same collection of
+a dedicated userid, as concurrent clients of a single user would.  It does
+this first with the usual collection locking and then with optimistic
+writes, and for each reports the rate of successful writes, the proportion
+that failed with a conflict, and the median and 99th percentile time taken
+by each write.  The items are deleted once the benchmark has finished.
+
+It's intended for comparing the two locking modes under contention, and
+should not be pointed at a production database.
+
+"""
+
+import time
+import random
+import logging
+import optparse
+import threading
+
+import syncstorage.scripts
+from syncstorage.storage import ConflictError
+from syncstorage.storage.sql import SQLStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+def bench_contention(sqluri, num_threads=10, num_writes=100,
+                     payload_size=500, userid=999999999):
+    """Benchmark concurrent single-item writes to the given database.
+
+    This function returns a list of (driver, mode, writes_per_second,
+    conflict_rate, median_time, p99_time) tuples, with times in seconds.
+    """
+    payload = "x" * payload_size
+    results = []
+    for mode in ("locking", "optimistic"):
+        storage = SQLStorage(sqluri, create_tables=True,
+                             optimistic_writes=(mode == "optimistic"))
+        timings = []
+        conflicts = []
+
+        def write_items():
+            for _ in xrange(num_writes):
+                item = "item%d" % (random.randrange(num_threads),)
+                t_start = time.time()
+                try:
+                    with storage.lock_for_write(userid, "bench"):
+                        storage.set_item(userid, "bench", item, {
+                            "payload": payload,
+                        })
+                except ConflictError:
+                    conflicts.append(1)
+                else:
+                    timings.append(time.time() - t_start)
+
+        try:
+            storage.delete_storage(userid)
+            logger.debug("Timing %s writes from %d threads",
+                         mode, num_threads)
+            threads = [threading.Thread(target=write_items)
+                       for _ in xrange(num_threads)]
+            t_start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            duration = time.time() - t_start
+        finally:
+            storage.delete_storage(userid)
+        rate = len(timings) / duration
+        conflict_rate = float(len(conflicts)) / (num_threads * num_writes)
+        timings = sorted(timings) or [0]
+        results.append((storage.dbconnector.driver, mode, rate,
+                        conflict_rate, timings[len(timings) // 2],
+                        timings[int(len(timings) * 0.99)]))
+    return results
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the bench_contention() function for each database.
+    """
+    usage = "usage: %prog [options] sqluri [sqluri...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--num-threads", type="int", default=10,
+                      help="Number of threads writing concurrently")
+    parser.add_option("", "--num-writes", type="int", default=100,
+                      help="Number of items written by each thread")
+    parser.add_option("", "--payload-size", type="int", default=500,
+                      help="Size of each item's payload, in bytes")
+    parser.add_option("", "--userid", type="int", default=999999999,
+                      help="Userid under which to write the test items")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) < 1:
+        parser.print_usage()
+        return 1
+
+    syncstorage.scripts.configure_script_logging(opts)
+
+    print "%-10s %-10s %10s %10s %12s %10s" % (
+        "driver", "mode", "writes/s", "conflicts", "median (ms)", "p99 (ms)")
+    for sqluri in args:
+        results = bench_contention(sqluri, opts.num_threads, opts.num_writes,
+                                   opts.payload_size, opts.userid)
+        for driver, mode, rate, conflict_rate, median, p99 in results:
+            print "%-10s %-10s %10.1f %9.1f%% %12.2f %10.2f" % (
+                driver, mode, rate, conflict_rate * 100,
+                median * 1000, p99 * 1000)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
@@ -0,0 +1,154 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Script to benchmark the encodings available for values in memcache.
+
+This script builds some typical values of the kinds that MemcachedStorage
+keeps in memcache: a user's metadata, a "tabs" collection holding the open
+tabs of several devices, and a "clients" collection holding a record for
+each device.  The payloads are random, base64-encoded ciphertext shaped like
+that uploaded by real clients, so they compress about as well as real data.
+Each value is encoded and decoded repeatedly with each combination of value
+format and compression, reporting the encoded size and the mean time taken
+to encode and to decode it.  No memcache server is needed.
+
+"""
+
+import os
+import time
+import base64
+import logging
+import optparse
+
+import syncstorage.scripts
+from syncstorage.util import get_timestamp, json_dumps
+from syncstorage.storage.memcached import CacheValueCodec, lz4
+
+
+logger = logging.getLogger(__name__)
+
+
+def make_payload(size):
+    """Make a BSO payload with about the given size of random ciphertext."""
+    return json_dumps({
+        "ciphertext": base64.b64encode(os.urandom(size * 3 // 4)),
+        "IV": base64.b64encode(os.urandom(16)),
+        "hmac": os.urandom(32).encode("hex"),
+    })
+
+
+def make_collection(num_items, payload_size):
+    """Make the cached data for a collection of the given number of items."""
+    modified = get_timestamp()
+    items = {}
+    for i in xrange(num_items):
+        id = base64.urlsafe_b64encode(os.urandom(9))
+        items[id] = {
+            "id": id,
+            "modified": get_timestamp(time.time() - i * 60),
+            "payload": make_payload(payload_size),
+            "ttl": int(modified) + 21 * 24 * 60 * 60,
+        }
+    return {"modified": modified, "items": items}
+
+
+def make_values(num_devices=5, tabs_size=4000, clients_size=500):
+    """Make a list of (name, value) pairs of typical cached values."""
+    modified = get_timestamp()
+    collections = ("clients", "crypto", "forms", "history", "keys", "meta",
+                   "bookmarks", "prefs", "tabs", "passwords", "addons")
+    metadata = {
+        "size": 1234567,
+        "last_size_recalc": int(time.time()),
+        "modified": modified,
+        "collections": dict((name, get_timestamp(time.time() - i * 3600))
+                            for (i, name) in enumerate(collections)),
+    }
+    return [
+        ("metadata", metadata),
+        ("tabs", make_collection(num_devices, tabs_size)),
+        ("clients", make_collection(num_devices, clients_size)),
+    ]
+
+
+def bench_mccodec(num_devices=5, tabs_size=4000, clients_size=500,
+                  num_loops=1000, compression_threshold=1024):
+    """Benchmark encoding and decoding of typical cached values.
+
+    This function returns a list of (value_name, encoding, size,
+    encode_time, decode_time) tuples, with times in seconds.
+    """
+    values = make_values(num_devices, tabs_size, clients_size)
+    encodings = [("json", None), ("json", "zlib"),
+                 ("binary", None), ("binary", "zlib")]
+    if lz4 is not None:
+        encodings.extend([("json", "lz4"), ("binary", "lz4")])
+    results = []
+    for name, value in values:
+        for value_format, compression in encodings:
+            if compression is None:
+                codec = CacheValueCodec(value_format)
+                encoding = value_format
+            else:
+                codec = CacheValueCodec(value_format, compression,
+                                        compression_threshold)
+                encoding = "%s+%s" % (value_format, compression)
+            logger.debug("Timing %s values as %s", name, encoding)
+            t_start = time.time()
+            for _ in xrange(num_loops):
+                data, flags = codec.encode(value)
+            encode_time = (time.time() - t_start) / num_loops
+            t_start = time.time()
+            for _ in xrange(num_loops):
+                codec.decode(data, flags)
+            decode_time = (time.time() - t_start) / num_loops
+            results.append((name, encoding, len(data),
+                            encode_time, decode_time))
+    return results
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the bench_mccodec() function.
+    """
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--num-devices", type="int", default=5,
+                      help="Number of items in each collection")
+    parser.add_option("", "--tabs-size", type="int", default=4000,
+                      help="Size of each tabs payload, in bytes")
+    parser.add_option("", "--clients-size", type="int", default=500,
+                      help="Size of each clients payload, in bytes")
+    parser.add_option("", "--num-loops", type="int", default=1000,
+                      help="Number of times to encode and decode each value")
+    parser.add_option("", "--compression-threshold", type="int",
+                      default=1024,
+                      help="Compress values of at least this many bytes")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+
+    syncstorage.scripts.configure_script_logging(opts)
+
+    print "%-10s %-12s %10s %12s %12s" % ("value", "encoding", "bytes",
+                                          "encode (us)", "decode (us)")
+    results = bench_mccodec(opts.num_devices, opts.tabs_size,
+                            opts.clients_size, opts.num_loops,
+                            opts.compression_threshold)
+    for name, encoding, size, encode_time, decode_time in results:
+        print "%-10s %-12s %10d %12.1f %12.1f" % (
+            name, encoding, size, encode_time * 1000000,
+            decode_time * 1000000)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
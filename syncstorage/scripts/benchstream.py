@@ -0,0 +1,155 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Script to benchmark the memory usage of large collection reads.
+
+This script takes one or more database URIs, writes a large collection of
+BSOs into each, and then reads the whole collection back both with and
+without streaming from the database.  For each read it reports the time to
+the first item, the total time, and the growth in peak memory usage of the
+reading process.  Each read is done in a freshly-forked child process, so
+that the peak memory measurements are not affected by earlier reads.
+The items are written for a dedicated userid, and are deleted once the
+benchmark has finished.
+
+It's intended for comparing the performance of different database drivers,
+and should not be pointed at a production database.
+
+"""
+
+import os
+import time
+import logging
+import optparse
+import resource
+import cPickle as pickle
+
+import syncstorage.scripts
+from syncstorage.storage.sql import SQLStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+def bench_stream(sqluri, num_items=100000, payload_size=500,
+                 userid=999999999):
+    """Benchmark the reading of a large collection from the given database.
+
+    This function returns a list of (driver, method, first_item_time,
+    total_time, peak_memory) tuples, with times in seconds and memory
+    in kilobytes.
+    """
+    storage = SQLStorage(sqluri, create_tables=True)
+    driver = storage.dbconnector.driver
+    payload = "x" * payload_size
+    results = []
+    try:
+        logger.debug("Writing %d items", num_items)
+        storage.delete_storage(userid)
+        for start in xrange(0, num_items, 1000):
+            end = min(start + 1000, num_items)
+            storage.set_items(userid, "bench", [{
+                "id": "bench%d" % (i,),
+                "payload": payload,
+            } for i in xrange(start, end)])
+        # Make sure the child processes don't share any pooled connections.
+        storage.dbconnector.engine.dispose()
+        for method in ("buffered", "streamed"):
+            logger.debug("Timing %s read of %d items", method, num_items)
+            res = _run_in_child(_read_collection, storage, userid,
+                                method == "streamed")
+            if res["count"] != num_items:
+                msg = "%s read returned %d items, expected %d"
+                logger.warn(msg, method, res["count"], num_items)
+            results.append((driver, method, res["first_item_time"],
+                            res["total_time"], res["peak_memory"]))
+    finally:
+        storage.delete_storage(userid)
+    return results
+
+
+def _read_collection(storage, userid, stream):
+    """Read every item in the benchmark collection, measuring resources."""
+    base_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    first_item_time = None
+    count = 0
+    t_start = time.time()
+    with storage.lock_for_read(userid, "bench"):
+        res = storage.get_items(userid, "bench", stream=stream)
+    for item in res["items"]:
+        if first_item_time is None:
+            first_item_time = time.time() - t_start
+        count += 1
+    total_time = time.time() - t_start
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "count": count,
+        "first_item_time": first_item_time or total_time,
+        "total_time": total_time,
+        "peak_memory": peak_memory - base_memory,
+    }
+
+
+def _run_in_child(func, *args):
+    """Run a function in a forked child process, returning its result."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            with os.fdopen(write_fd, "wb") as output:
+                pickle.dump(func(*args), output)
+        except BaseException:
+            logger.exception("Error in benchmark process")
+            os._exit(1)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as input:
+        data = input.read()
+    _, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError("Benchmark process failed")
+    return pickle.loads(data)
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the bench_stream() function for each database.
+    """
+    usage = "usage: %prog [options] sqluri [sqluri...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--num-items", type="int", default=100000,
+                      help="Number of items to write into the collection")
+    parser.add_option("", "--payload-size", type="int", default=500,
+                      help="Size of each item's payload, in bytes")
+    parser.add_option("", "--userid", type="int", default=999999999,
+                      help="Userid under which to write the test items")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) < 1:
+        parser.print_usage()
+        return 1
+
+    syncstorage.scripts.configure_script_logging(opts)
+
+    print "%-10s %-9s %15s %12s %14s" % ("driver", "method", "first item (ms)",
+                                         "total (ms)", "peak mem (KB)")
+    for sqluri in args:
+        results = bench_stream(sqluri, opts.num_items, opts.payload_size,
+                               opts.userid)
+        for driver, method, first_time, total_time, memory in results:
+            print "%-10s %-9s %15.2f %12.2f %14d" % (driver, method,
+                                                     first_time * 1000,
+                                                     total_time * 1000,
+                                                     memory)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
@@ -0,0 +1,127 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Script to benchmark batch upserts of BSOs against SQL databases.
+
+This script takes one or more database URIs and times the writing of batches
+of BSOs of various sizes to each, first as freshly-inserted items and then
+as updates to existing items.  For SQLite and PostgreSQL it also times the
+generic one-item-at-a-time upsert, for comparison with the native batch
+upsert.  The items are written for a dedicated userid, and are deleted once
+the benchmark has finished.
+
+It's intended for comparing the performance of different database drivers,
+and should not be pointed at a production database.
+
+"""
+
+import time
+import logging
+import optparse
+
+import syncstorage.scripts
+from syncstorage.storage.sql.dbconnect import DBConnector
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZES = (1, 10, 100, 1000)
+
+
+def bench_upsert(sqluri, batch_sizes=DEFAULT_BATCH_SIZES, repeat=5,
+                 userid=999999999):
+    """Benchmark batch upserts of BSOs into the given database.
+
+    This function returns a list of (driver, method, batch_size, insert_time,
+    update_time) tuples, with times in seconds averaged over the given
+    number of repetitions.
+    """
+    dbconnector = DBConnector(sqluri, create_tables=True)
+    methods = ["native"]
+    if dbconnector.driver != "mysql" and dbconnector.supports_on_conflict():
+        methods.append("generic")
+    defaults = {"modified": 0, "payload": "", "payload_size": 0}
+    payload = "x" * 500
+
+    def upsert(items):
+        with dbconnector.connect() as c:
+            c.insert_or_update("bso", items, defaults, count_created=False)
+
+    def delete_items():
+        with dbconnector.connect() as c:
+            c.query("DELETE_ALL_BSOS", {"userid": userid})
+
+    results = []
+    try:
+        for method in methods:
+            if method == "generic":
+                dbconnector._supports_on_conflict = False
+            for batch_size in batch_sizes:
+                logger.debug("Timing %s upsert of %d items",
+                             method, batch_size)
+                insert_time = update_time = 0
+                for _ in xrange(repeat):
+                    items = [{
+                        "userid": userid,
+                        "collection": 1,
+                        "id": "bench%d" % (i,),
+                        "payload": payload,
+                        "payload_size": len(payload),
+                        "modified": int(time.time() * 1000),
+                    } for i in xrange(batch_size)]
+                    delete_items()
+                    t_start = time.time()
+                    upsert(items)
+                    insert_time += time.time() - t_start
+                    t_start = time.time()
+                    upsert(items)
+                    update_time += time.time() - t_start
+                results.append((dbconnector.driver, method, batch_size,
+                                insert_time / repeat, update_time / repeat))
+    finally:
+        delete_items()
+    return results
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the bench_upsert() function for each database.
+    """
+    usage = "usage: %prog [options] sqluri [sqluri...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--batch-sizes", default="1,10,100,1000",
+                      help="Comma-separated list of batch sizes to time")
+    parser.add_option("", "--repeat", type="int", default=5,
+                      help="Number of times to repeat each measurement")
+    parser.add_option("", "--userid", type="int", default=999999999,
+                      help="Userid under which to write the test items")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) < 1:
+        parser.print_usage()
+        return 1
+
+    syncstorage.scripts.configure_script_logging(opts)
+
+    batch_sizes = [int(size) for size in opts.batch_sizes.split(",")]
+
+    print "%-10s %-8s %6s %12s %12s" % ("driver", "method", "items",
+                                        "insert (ms)", "update (ms)")
+    for sqluri in args:
+        results = bench_upsert(sqluri, batch_sizes, opts.repeat, opts.userid)
+        for driver, method, batch_size, insert_time, update_time in results:
+            print "%-10s %-8s %6d %12.2f %12.2f" % (driver, method,
+                                                    batch_size,
+                                                    insert_time * 1000,
+                                                    update_time * 1000)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
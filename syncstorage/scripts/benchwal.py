@@ -0,0 +1,157 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Script to benchmark SQLite read throughput alongside a concurrent writer.
+
+This script creates a scratch SQLite database in the given directory, writes
+a collection of BSOs into it, and then runs several reader threads that
+repeatedly fetch the collection while a single writer thread keeps updating
+items in it.  It does this first with SQLite's default rollback journal and
+then in WAL mode, and for each reports the rate of successful reads, the
+median and 99th percentile time taken by each read, the rate of successful
+writes, and the number of operations that failed.  The database files are
+deleted once the benchmark has finished.
+
+"""
+
+import os
+import time
+import random
+import logging
+import optparse
+import tempfile
+import threading
+
+from mozsvc.exceptions import BackendError
+
+import syncstorage.scripts
+from syncstorage.storage import ConflictError
+from syncstorage.storage.sql import SQLStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+def bench_wal(dirname, num_readers=10, duration=10, num_items=100,
+              payload_size=500, userid=999999999):
+    """Benchmark concurrent reads and writes to an SQLite database.
+
+    This function returns a list of (mode, reads_per_second, median_time,
+    p99_time, writes_per_second, num_errors) tuples, with times in seconds.
+    """
+    payload = "x" * payload_size
+    results = []
+    for mode in ("rollback", "wal"):
+        path = os.path.join(dirname, "benchwal-%s.db" % (mode,))
+        storage = SQLStorage("sqlite:///" + path, create_tables=True,
+                             pool_size=num_readers + 1,
+                             sqlite_wal=(mode == "wal"))
+        stopping = threading.Event()
+        timings = []
+        writes = []
+        errors = []
+
+        def read_items():
+            while not stopping.is_set():
+                t_start = time.time()
+                try:
+                    with storage.lock_for_read(userid, "bench"):
+                        storage.get_items(userid, "bench")
+                except BackendError:
+                    errors.append(1)
+                else:
+                    timings.append(time.time() - t_start)
+
+        def write_items():
+            while not stopping.is_set():
+                item = "item%d" % (random.randrange(num_items),)
+                try:
+                    with storage.lock_for_write(userid, "bench"):
+                        storage.set_item(userid, "bench", item, {
+                            "payload": payload,
+                        })
+                except ConflictError:
+                    # Writes within the same tick of the clock conflict.
+                    continue
+                except BackendError:
+                    errors.append(1)
+                else:
+                    writes.append(1)
+
+        try:
+            storage.set_items(userid, "bench", [{
+                "id": "item%d" % (i,),
+                "payload": payload,
+            } for i in xrange(num_items)])
+            logger.debug("Timing %s reads from %d threads",
+                         mode, num_readers)
+            threads = [threading.Thread(target=read_items)
+                       for _ in xrange(num_readers)]
+            threads.append(threading.Thread(target=write_items))
+            for thread in threads:
+                thread.start()
+            time.sleep(duration)
+            stopping.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            storage.dbconnector.engine.dispose()
+            if storage.dbconnector.reader_engine is not None:
+                storage.dbconnector.reader_engine.dispose()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.isfile(path + suffix):
+                    os.remove(path + suffix)
+        read_rate = len(timings) / float(duration)
+        write_rate = len(writes) / float(duration)
+        timings = sorted(timings) or [0]
+        results.append((mode, read_rate, timings[len(timings) // 2],
+                        timings[int(len(timings) * 0.99)], write_rate,
+                        len(errors)))
+    return results
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the bench_wal() function.
+    """
+    usage = "usage: %prog [options] [directory]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--num-readers", type="int", default=10,
+                      help="Number of threads reading concurrently")
+    parser.add_option("", "--duration", type="float", default=10,
+                      help="Number of seconds to run each mode for")
+    parser.add_option("", "--num-items", type="int", default=100,
+                      help="Number of items in the collection")
+    parser.add_option("", "--payload-size", type="int", default=500,
+                      help="Size of each item's payload, in bytes")
+    parser.add_option("", "--userid", type="int", default=999999999,
+                      help="Userid under which to write the test items")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) > 1:
+        parser.print_usage()
+        return 1
+    dirname = args[0] if args else tempfile.gettempdir()
+
+    syncstorage.scripts.configure_script_logging(opts)
+
+    print "%-10s %10s %12s %10s %10s %8s" % ("mode", "reads/s",
+                                             "median (ms)", "p99 (ms)",
+                                             "writes/s", "errors")
+    results = bench_wal(dirname, opts.num_readers, opts.duration,
+                        opts.num_items, opts.payload_size, opts.userid)
+    for mode, read_rate, median, p99, write_rate, num_errors in results:
+        print "%-10s %10.1f %12.2f %10.2f %10.1f %8d" % (
+            mode, read_rate, median * 1000, p99 * 1000, write_rate,
+            num_errors)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
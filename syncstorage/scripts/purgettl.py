@@ -11,14 +11,21 @@ is a purely optional administrative task, since expired items are not actually
 returned in queries.  But it should help reduce overheads, improve performance
 etc if run regularly.
 
+For backends configured with async_deletes, this script also removes the items
+of deleted collections.  In that case it must be run regularly, since they are
+only removed from the database here.
+
 """
 
 import os
 import time
 import logging
 import optparse
+import functools
+import threading
 
 import syncstorage.scripts
+from syncstorage.util import run_concurrently
 from syncstorage.storage import get_all_storages
 
 
@@ -26,34 +33,60 @@ logger = logging.getLogger(__name__)
 
 
 def purge_expired_items(config_file, grace_period=0, max_per_loop=1000,
-                        backend_interval=0):
+                        backend_interval=0, max_concurrency=1,
+                        max_rows_per_second=0, target_latency=0,
+                        max_iters=100):
     """Purge expired BSOs from all storage backends in the given config file.
 
     This function iterates through each storage backend in the given config
     file and calls its purge_expired_items() method.  The result is a
     gradual pruning of expired items from each database.
+
+    Up to max_concurrency backends are purged at once, and a single pool of
+    max_concurrency worker slots caps the total number of tables that are
+    being purged at any time across all backends.  The max_rows_per_second
+    budget applies to each backend separately.
+
+    If target_latency is given then each backend will adjust the number of
+    items deleted in one go, starting from max_per_loop, so that each delete
+    takes roughly that many seconds.
     """
     logger.info("Purging expired items")
     logger.debug("Using config file %r", config_file)
     config = syncstorage.scripts.load_configurator(config_file)
+    worker_slots = threading.BoundedSemaphore(max_concurrency)
 
-    for hostname, backend in get_all_storages(config):
+    def purge_backend(hostname, backend):
         logger.debug("Purging backend for %s", hostname)
         config.begin()
         t_start = time.time()
         try:
-            backend.purge_expired_items(grace_period, max_per_loop)
+            res = backend.purge_expired_items(
+                grace_period, max_per_loop,
+                max_concurrency=max_concurrency,
+                max_rows_per_second=max_rows_per_second,
+                worker_slots=worker_slots,
+                target_latency=target_latency,
+                max_iters=max_iters)
         except Exception:
             logger.exception("Error while purging backend for %s", hostname)
         else:
+            for table, stats in sorted(res.get("tables", {}).iteritems()):
+                logger.debug("  %s: purged %d items in %.4f seconds, "
+                             "next chunk size %d", table, stats["num_purged"],
+                             stats["duration"], stats["chunk_size"])
             logger.debug("Purged backend for %s", hostname)
         finally:
-            t_duration = min(0, time.time() - t_start)
-            logger.debug("Purge took %.4f seconds", t_duration)
+            t_duration = max(0, time.time() - t_start)
+            logger.debug("Purge of %s took %.4f seconds", hostname, t_duration)
             config.end()
         logger.debug("Sleeping for %d seconds", backend_interval)
         time.sleep(backend_interval)
 
+    tasks = [functools.partial(purge_backend, hostname, backend)
+             for (hostname, backend) in get_all_storages(config)]
+    run_concurrently(tasks, max_concurrency)
+
     logger.info("Finished purging expired items")
 
 
@@ -73,6 +106,14 @@ def main(args=None):
                       help="Number of seconds grace to allow after expiry")
     parser.add_option("", "--max-per-loop", type="int", default=1000,
                       help="Maximum number of items to delete in one go")
+    parser.add_option("", "--max-concurrency", type="int", default=1,
+                      help="Maximum number of tables to purge at once")
+    parser.add_option("", "--max-rows-per-second", type="int", default=0,
+                      help="Maximum rate of deletion from each database")
+    parser.add_option("", "--target-latency", type="float", default=0,
+                      help="Target seconds per delete, to tune max-per-loop")
+    parser.add_option("", "--max-iterations", type="int", default=100,
+                      help="Maximum number of deletes from each table")
     parser.add_option("", "--oneshot", action="store_true",
                       help="Do a single purge run and then exit")
     parser.add_option("-v", "--verbose", action="count", dest="verbosity",
@@ -90,14 +131,23 @@ def main(args=None):
     purge_expired_items(config_file,
                         grace_period=opts.grace_period,
                         max_per_loop=opts.max_per_loop,
-                        backend_interval=opts.backend_interval)
+                        backend_interval=opts.backend_interval,
+                        max_concurrency=opts.max_concurrency,
+                        max_rows_per_second=opts.max_rows_per_second,
+                        target_latency=opts.target_latency,
+                        max_iters=opts.max_iterations)
     if not opts.oneshot:
         while True:
             logger.debug("Sleeping for %d seconds", opts.purge_interval)
             time.sleep(opts.purge_interval)
             purge_expired_items(config_file,
                                 grace_period=opts.grace_period,
-                                backend_interval=opts.backend_interval)
+                                max_per_loop=opts.max_per_loop,
+                                backend_interval=opts.backend_interval,
+                                max_concurrency=opts.max_concurrency,
+                                max_rows_per_second=opts.max_rows_per_second,
+                                target_latency=opts.target_latency,
+                                max_iters=opts.max_iterations)
     return 0
 
 
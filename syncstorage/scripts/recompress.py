@@ -0,0 +1,102 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Script to recompress the stored payloads of existing BSOs.
+
+This script takes a syncstorage config file and loops through each SQL
+storage backend therein, re-encoding the stored payload of every BSO to match
+that backend's payload_compression_threshold setting.  It should be run after
+enabling payload compression to compress existing items, or with the threshold
+set to zero before removing the setting, to return the items to their
+uncompressed form.  Backends without the setting are skipped.
+
+"""
+
+import os
+import time
+import logging
+import optparse
+
+import syncstorage.scripts
+from syncstorage.storage import get_all_storages
+from syncstorage.storage.sql import SQLStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+def recompress_payloads(config_file, max_per_loop=1000, backend_interval=0):
+    """Recompress BSO payloads in all storage backends in the given config.
+
+    This function iterates through each storage backend in the given config
+    file and calls its recompress_payloads() method.  Any backends that are
+    not SQL-based, after unwrapping any caching layers, are skipped.
+    """
+    logger.info("Recompressing payloads")
+    logger.debug("Using config file %r", config_file)
+    config = syncstorage.scripts.load_configurator(config_file)
+    for hostname, backend in get_all_storages(config):
+        while hasattr(backend, "storage"):
+            backend = backend.storage
+        if not isinstance(backend, SQLStorage):
+            logger.debug("Skipping non-SQL backend for %s", hostname)
+            continue
+        if not backend.dbconnector.compressed_payloads:
+            logger.debug("Skipping uncompressed backend for %s", hostname)
+            continue
+        logger.debug("Recompressing payloads for %s", hostname)
+        config.begin()
+        t_start = time.time()
+        try:
+            res = backend.recompress_payloads(max_per_loop)
+        except Exception:
+            logger.exception("Error while recompressing payloads for %s",
+                             hostname)
+        else:
+            logger.debug("Recompressed %d of %d payloads for %s",
+                         res["num_recompressed"], res["num_checked"],
+                         hostname)
+        finally:
+            t_duration = time.time() - t_start
+            logger.debug("Recompressing %s took %.4f seconds",
+                         hostname, t_duration)
+            config.end()
+        logger.debug("Sleeping for %d seconds", backend_interval)
+        time.sleep(backend_interval)
+    logger.info("Finished recompressing payloads")
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the recompress_payloads() function.
+    """
+    usage = "usage: %prog [options] config_file"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--backend-interval", type="int", default=0,
+                      help="Interval to sleep between processing each backend")
+    parser.add_option("", "--max-per-loop", type="int", default=1000,
+                      help="Maximum number of items to process in one go")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.print_usage()
+        return 1
+
+    syncstorage.scripts.configure_script_logging(opts)
+
+    config_file = os.path.abspath(args[0])
+
+    recompress_payloads(config_file,
+                        max_per_loop=opts.max_per_loop,
+                        backend_interval=opts.backend_interval)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
@@ -0,0 +1,139 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Script to inspect and rebalance sharded BSO tables.
+
+This script takes a syncstorage config file and loops through each sharded
+SQL storage backend therein.  With --stats it reports the number of rows,
+users and payload bytes in each shard, along with the heaviest users if
+--top-users is given.  With --move it moves the given users into the given
+shards, which requires the backend to have per-user shard lookups enabled.
+
+Moves copy the user's items in chunks while they remain available, and only
+lock the user out for a short final catch-up step.  An interrupted move can
+safely be re-run.
+
+"""
+
+import os
+import time
+import logging
+import optparse
+
+import syncstorage.scripts
+from syncstorage.storage import get_all_storages
+from syncstorage.storage.sql import SQLStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+def reshard(config_file, moves=(), show_stats=False, num_top_users=0,
+            max_per_loop=1000):
+    """Report on and rebalance the shards of all backends in the given config.
+
+    This function iterates through each storage backend in the given config
+    file, printing the output of its get_shard_stats() method if requested
+    and then calling its move_user() method for each (userid, shard) pair in
+    the given list of moves.  Any backends that are not sharded SQL backends,
+    after unwrapping any caching layers, are skipped.
+    """
+    logger.debug("Using config file %r", config_file)
+    config = syncstorage.scripts.load_configurator(config_file)
+    for hostname, backend in get_all_storages(config):
+        while hasattr(backend, "storage"):
+            backend = backend.storage
+        if not isinstance(backend, SQLStorage):
+            logger.debug("Skipping non-SQL backend for %s", hostname)
+            continue
+        if not backend.dbconnector.shard:
+            logger.debug("Skipping non-sharded backend for %s", hostname)
+            continue
+        config.begin()
+        try:
+            if show_stats:
+                _print_shard_stats(hostname,
+                                   backend.get_shard_stats(num_top_users))
+            for userid, shard in moves:
+                logger.info("Moving user %d to shard %d on %s",
+                            userid, shard, hostname)
+                t_start = time.time()
+                try:
+                    res = backend.move_user(userid, shard, max_per_loop)
+                except Exception:
+                    logger.exception("Error while moving user %d on %s",
+                                     userid, hostname)
+                else:
+                    logger.info("Moved %d items for user %d from shard %d "
+                                "to shard %d in %.4f seconds",
+                                res["num_copied"], userid, res["from_shard"],
+                                res["to_shard"], time.time() - t_start)
+        finally:
+            config.end()
+
+
+def _print_shard_stats(hostname, stats):
+    """Print a table of the given per-shard statistics."""
+    print hostname
+    print "%-9s %-10s %12s %10s %14s" % ("partition", "table", "rows",
+                                         "users", "bytes")
+    for table_stats in stats:
+        print "%-9d %-10s %12d %10d %14d" % (table_stats["partition"],
+                                             table_stats["table"],
+                                             table_stats["num_rows"],
+                                             table_stats["num_users"],
+                                             table_stats["num_bytes"])
+        for userid, num_rows, num_bytes in table_stats.get("top_users", ()):
+            print "  user %-14s %12d %14d" % (userid, num_rows, num_bytes)
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the reshard() function.
+    """
+    usage = "usage: %prog [options] config_file"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--stats", action="store_true", default=False,
+                      help="Print the size of each shard")
+    parser.add_option("", "--top-users", type="int", default=0,
+                      help="Number of heaviest users to list for each shard")
+    parser.add_option("", "--move", action="append", default=[],
+                      metavar="USERID:SHARD",
+                      help="Move a user to the given shard; may be repeated")
+    parser.add_option("", "--max-per-loop", type="int", default=1000,
+                      help="Maximum number of items to copy in one go")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.print_usage()
+        return 1
+
+    moves = []
+    for move in opts.move:
+        try:
+            userid, shard = move.split(":")
+            moves.append((int(userid), int(shard)))
+        except ValueError:
+            parser.error("Invalid --move argument: %r" % (move,))
+    if not moves and not opts.stats:
+        parser.error("Nothing to do; use --stats and/or --move")
+
+    syncstorage.scripts.configure_script_logging(opts)
+
+    config_file = os.path.abspath(args[0])
+
+    reshard(config_file, moves,
+            show_stats=opts.stats,
+            num_top_users=opts.top_users,
+            max_per_loop=opts.max_per_loop)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
@@ -9,8 +9,11 @@ Abstract interface definition for storage backends.
 
 import sys
 import abc
+import base64
 import logging
 
+from pyramid.threadlocal import get_current_request
+
 from mozsvc.plugin import resolve_name
 
 
@@ -50,6 +53,11 @@ class InvalidOffsetError(StorageError, ValueError):
     pass
 
 
+class DeadlineExceededError(StorageError):
+    """Exception raised when a request runs out of time to access storage."""
+    pass
+
+
 class InvalidBatch(StorageError, ValueError):
     """Exception raised when a request contains an invalid batch
        identifier"""
@@ -221,7 +229,8 @@ class SyncStorage(object):
 
     @abc.abstractmethod
     def get_items(self, userid, collection, items=None, newer=None,
-                  older=None, limit=None, offset=None, sort=None):
+                  older=None, limit=None, offset=None, sort=None,
+                  stream=False):
         """Returns items from a collection
 
         Args:
@@ -233,10 +242,15 @@ class SyncStorage(object):
             limit: integer; return at most this many items.
             offset: string; an offset vale previously returned as next_offset.
             sort: sort order for results; one of "newest", "oldest" or "index".
+            stream: boolean; if True, the backend may return the items as
+                    a lazily-produced iterable rather than a list.
 
         Returns:
             A dict with the following keys:
               items: a list of BSO objects matching the given filters.
+                     If stream is True this may instead be an iterable with
+                     a close() method, which must be called if the items are
+                     not consumed in full.
               next_offset: a string giving next offset token, if any.
 
         Raises:
@@ -464,6 +478,21 @@ class SyncStorage(object):
             ItemNotFoundError: the collection contains no such item.
         """
 
+    #
+    # APIs for monitoring the backend.
+    #
+
+    def get_load(self):
+        """Get an estimate of how heavily loaded the backend currently is.
+
+        This lets expensive requests scale back their use of the backend when
+        it's busy.  Backends that have no way to tell report zero.
+
+        Returns:
+            A number from 0, meaning idle, to 1, meaning fully loaded.
+        """
+        return 0
+
     #
     # Administrative/maintenance methods.
     #
@@ -471,7 +500,10 @@ class SyncStorage(object):
     # would be used by stand-alone maintenance scripts.
     #
 
-    def purge_expired_items(self, grace_period=0, max_per_loop=1000):
+    def purge_expired_items(self, grace_period=0, max_per_loop=1000,
+                            max_concurrency=1, max_rows_per_second=0,
+                            worker_slots=None, target_latency=0,
+                            max_iters=100):
         """Purges items with an expired TTL from the database.
 
         This method attempts to delete any items with an expired TTL from
@@ -483,6 +515,17 @@ class SyncStorage(object):
             grace_period: number of seconds grace to allow after expiry
             max_per_loop: number of records to delete per loop iteration
                           (if supported by the backend)
+            max_concurrency: number of tables to purge in parallel
+                             (if supported by the backend)
+            max_rows_per_second: limit on the rate of deletion, or zero
+                                 for no limit (if supported by the backend)
+            worker_slots: semaphore to hold while purging each table, for
+                          limiting concurrency across several storages
+            target_latency: number of seconds that each delete should take,
+                            with max_per_loop adjusted to match, or zero
+                            for a fixed max_per_loop (if supported)
+            max_iters: maximum number of loop iterations for each table
+                       (if supported by the backend)
 
         Returns:
             A dict with the following keys:
@@ -505,6 +548,60 @@ class SyncStorage(object):
         return True
 
 
+def encode_sortindex_offset(sortindex, item_id):
+    """Encode an opaque keyset token for resuming a sort=index query.
+
+    The token records the (sortindex, id) pair of the last item returned,
+    so that the next page can seek directly to the following item rather
+    than skipping over a numeric offset.  Item ids may contain arbitrary
+    printable characters, so they are base64-encoded to keep the token
+    safe for use in a query string.  A null sortindex is encoded as the
+    empty string.
+    """
+    if sortindex is None:
+        sortindex = ""
+    item_id = base64.urlsafe_b64encode(str(item_id)).rstrip("=")
+    return "%s:%s" % (sortindex, item_id)
+
+
+def decode_sortindex_offset(offset):
+    """Decode a keyset token produced by encode_sortindex_offset().
+
+    Returns a (sortindex, id) pair, or raises InvalidOffsetError if the
+    token is malformed.  Callers should check for the presence of a colon
+    to distinguish keyset tokens from legacy numeric offsets.
+    """
+    try:
+        sortindex, item_id = str(offset).split(":", 1)
+        sortindex = int(sortindex) if sortindex else None
+        padding = "=" * (-len(item_id) % 4)
+        item_id = base64.urlsafe_b64decode(item_id + padding)
+    except (TypeError, ValueError):
+        raise InvalidOffsetError(offset)
+    if not item_id:
+        raise InvalidOffsetError(offset)
+    return sortindex, item_id
+
+
+def get_client_known_timestamp():
+    """Get the newest timestamp that the current client is known to have seen.
+
+    This looks at the validated X-If-Modified-Since, X-If-Unmodified-Since
+    and "newer" values of the active request, if any, and returns the largest
+    of them.  If there is no such timestamp then None is returned.
+    """
+    request = get_current_request()
+    validated = getattr(request, "validated", None)
+    if not validated:
+        return None
+    timestamps = [validated.get(key) for key in
+                  ("if_modified_since", "if_unmodified_since", "newer")]
+    timestamps = [ts for ts in timestamps if ts is not None]
+    if not timestamps:
+        return None
+    return max(timestamps)
+
+
 def get_all_storages(config):
     """Iterator over all (hostname, storage) pairs for a config."""
     for key in config.registry:
@@ -0,0 +1,272 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Read-coalescing backend wrapper for syncstorage.
+
+Clients tend to fetch info/collections, meta/global and crypto/keys in a
+quick burst, and retries can send the same request several times over.
+This module implements a layer for the SyncStorage backend API that lets
+concurrent identical reads within a process share a single call to the
+underlying backend, be that memcache or the database.  The reads that can
+be shared are:
+
+    * get_collection_timestamps
+    * get_item
+    * get_items, unless the items are to be streamed
+
+All other operations are passed straight through.  Reads are identical if
+they call the same method with the same arguments, and the client has seen
+the same latest timestamp, since that decides whether a read replica may be
+used.  They must also find the same timestamp for the collection they read,
+or for the whole storage when reading the collection timestamps, so that a
+result is never given out alongside a newer timestamp than it reflects; this
+covers writes made through other processes.  When a result is shared, every
+caller gets its own copy of it, while a result that isn't shared is returned
+as it is.  A read that fails because its own deadline was exceeded is not
+shared, and anyone waiting on it makes the read for themselves.
+
+Reads made while holding a write lock are never shared, since they may see
+the lock holder's uncommitted changes.  Once a write to a user's storage has
+finished, any reads of that user's data that are already in progress are no
+longer shared with new callers, so that a client never gets a result that
+predates its own write.  This only covers writes made through the same
+process.
+
+The number of reads that shared another call's result is reported in the
+"syncstorage.storage.coalescing.shared" metric.
+"""
+
+import copy
+import functools
+import threading
+import contextlib
+
+from mozsvc.metrics import annotate_request
+
+from syncstorage.util import SingleFlight
+from syncstorage.storage import (SyncStorage,
+                                 NotFoundError,
+                                 DeadlineExceededError,
+                                 get_client_known_timestamp)
+
+
+SHARED_METRIC = __name__ + ".shared"
+
+
+def forgets_reads(func):
+    """Method decorator to stop sharing reads for the user once it's done."""
+    @functools.wraps(func)
+    def forgets_reads_wrapper(self, userid, *args, **kwds):
+        try:
+            return func(self, userid, *args, **kwds)
+        finally:
+            self._forget_reads(userid)
+    return forgets_reads_wrapper
+
+
+def _freeze(value):
+    """Convert any list argument into a tuple, so that it can be hashed."""
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+class CoalescingStorage(SyncStorage):
+    """Read-coalescing wrapper for SyncStorage backends.
+
+    The SyncStorage implementation wraps another storage backend, sharing
+    the results of concurrent identical reads.  You may specify the
+    following arguments:
+
+        * storage:  the underlying SyncStorage object that is to be wrapped.
+
+    """
+
+    def __init__(self, storage, **kwds):
+        self.storage = storage
+        self.flights = SingleFlight(private_errors=(DeadlineExceededError,))
+        # Keep a threadlocal count of the write locks held by each thread,
+        # as reads made while holding one cannot be shared.
+        self._tldata = threading.local()
+
+    def _coalesce(self, func, userid, *args, **kwds):
+        """Call the given read method, sharing any identical call.
+
+        The first positional argument after the userid, if any, must be the
+        name of the collection being read.
+        """
+        if getattr(self._tldata, "write_locks", 0):
+            return func(userid, *args, **kwds)
+        if args:
+            try:
+                ts = self.storage.get_collection_timestamp(userid, args[0])
+            except NotFoundError:
+                ts = None
+        else:
+            ts = self.storage.get_storage_timestamp(userid)
+        key = (func.__name__, userid, tuple(_freeze(v) for v in args),
+               tuple(sorted((k, _freeze(v)) for (k, v) in kwds.iteritems())),
+               get_client_known_timestamp(), ts)
+        called = []
+
+        def call():
+            called.append(True)
+            return func(userid, *args, **kwds)
+
+        result, shared = self.flights.do(key, call)
+        if shared:
+            # Nobody changes the shared result, since they all get a copy.
+            if not called:
+                annotate_request(None, SHARED_METRIC, 1)
+            result = copy.deepcopy(result)
+        return result
+
+    def _forget_reads(self, userid):
+        """Stop sharing any reads of the given user's data in progress."""
+        self.flights.forget(lambda key: key[1] == userid)
+
+    #
+    # APIs for collection-level locking.
+    #
+
+    def lock_for_read(self, userid, collection):
+        """Acquire a shared read lock on the named collection."""
+        return self.storage.lock_for_read(userid, collection)
+
+    @contextlib.contextmanager
+    def lock_for_write(self, userid, collection):
+        """Acquire an exclusive write lock on the named collection."""
+        with self.storage.lock_for_write(userid, collection) as lock:
+            self._tldata.write_locks = getattr(self._tldata,
+                                               "write_locks", 0) + 1
+            try:
+                yield lock
+            finally:
+                self._tldata.write_locks -= 1
+        self._forget_reads(userid)
+
+    #
+    # APIs to operate on the entire storage.
+    #
+
+    def get_storage_timestamp(self, userid):
+        """Returns the last-modified timestamp for the entire storage."""
+        return self.storage.get_storage_timestamp(userid)
+
+    def get_collection_timestamps(self, userid):
+        """Returns the collection timestamps for a user."""
+        return self._coalesce(self.storage.get_collection_timestamps, userid)
+
+    def get_collection_counts(self, userid):
+        """Returns the collection counts."""
+        return self.storage.get_collection_counts(userid)
+
+    def get_collection_sizes(self, userid):
+        """Returns the total size for each collection."""
+        return self.storage.get_collection_sizes(userid)
+
+    def get_total_size(self, userid, recalculate=False):
+        """Returns the total size of a user's storage data."""
+        return self.storage.get_total_size(userid, recalculate)
+
+    @forgets_reads
+    def delete_storage(self, userid):
+        """Removes all data for the user."""
+        return self.storage.delete_storage(userid)
+
+    #
+    # APIs to operate on an individual collection
+    #
+
+    def get_collection_timestamp(self, userid, collection):
+        """Returns the last-modified timestamp for the named collection."""
+        return self.storage.get_collection_timestamp(userid, collection)
+
+    def get_items(self, userid, collection, **kwds):
+        """Returns items from a collection"""
+        if kwds.get("stream"):
+            return self.storage.get_items(userid, collection, **kwds)
+        return self._coalesce(self.storage.get_items, userid, collection,
+                              **kwds)
+
+    def get_item_ids(self, userid, collection, **kwds):
+        """Returns item ids from a collection"""
+        return self.storage.get_item_ids(userid, collection, **kwds)
+
+    @forgets_reads
+    def set_items(self, userid, collection, items):
+        """Creates or updates multiple items in a collection."""
+        return self.storage.set_items(userid, collection, items)
+
+    @forgets_reads
+    def delete_collection(self, userid, collection):
+        """Deletes an entire collection."""
+        return self.storage.delete_collection(userid, collection)
+
+    @forgets_reads
+    def delete_items(self, userid, collection, items):
+        """Deletes multiple items from a collection."""
+        return self.storage.delete_items(userid, collection, items)
+
+    def create_batch(self, userid, collection):
+        """Creates batch for a give user's collection."""
+        return self.storage.create_batch(userid, collection)
+
+    def valid_batch(self, userid, collection, batchid):
+        """Checks to see if the batch ID is valid and still open"""
+        return self.storage.valid_batch(userid, collection, batchid)
+
+    def append_items_to_batch(self, userid, collection, batchid, items):
+        """Appends items to the pending batch."""
+        return self.storage.append_items_to_batch(userid, collection,
+                                                  batchid, items)
+
+    @forgets_reads
+    def apply_batch(self, userid, collection, batchid):
+        """Applies the batch"""
+        return self.storage.apply_batch(userid, collection, batchid)
+
+    def close_batch(self, userid, collection, batchid):
+        """Closes the batch"""
+        return self.storage.close_batch(userid, collection, batchid)
+
+    #
+    # Items APIs
+    #
+
+    def get_item_timestamp(self, userid, collection, item):
+        """Returns the last-modified timestamp for the named item."""
+        return self.storage.get_item_timestamp(userid, collection, item)
+
+    def get_item(self, userid, collection, item):
+        """Returns one item from a collection."""
+        return self._coalesce(self.storage.get_item, userid, collection, item)
+
+    @forgets_reads
+    def set_item(self, userid, collection, item, data):
+        """Creates or updates a single item in a collection."""
+        return self.storage.set_item(userid, collection, item, data)
+
+    @forgets_reads
+    def delete_item(self, userid, collection, item):
+        """Deletes a single item from a collection."""
+        return self.storage.delete_item(userid, collection, item)
+
+    #
+    # APIs for monitoring the backend.
+    #
+
+    def get_load(self):
+        """Get the load of the underlying storage backend."""
+        return self.storage.get_load()
+
+    #
+    # Administrative/maintenance methods.
+    #
+
+    def purge_expired_items(self, grace_period=0, max_per_loop=1000,
+                            **kwds):
+        """Purges items with an expired TTL from the database."""
+        return self.storage.purge_expired_items(grace_period, max_per_loop,
+                                                **kwds)
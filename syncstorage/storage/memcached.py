@@ -14,6 +14,13 @@ The following memcached keys are used:
     * userid:metadata         metadata about the storage and collections
     * userid:c:<collection>   cached data for a particular collection
 
+If the "cache_layout" setting is "items" then each cached collection is
+instead split across several keys, so that writing one item doesn't mean
+rewriting the whole collection:
+
+    * userid:c:<collection>:index               index of the collection
+    * userid:c:<collection>:i:<id>:<modified>   payload of an item
+
 A key prefix can also be defined to avoid clobbering unrelated data in a
 shared memcached setup.  It defaults to the empty string.
 
@@ -41,6 +48,33 @@ modified timestamp for that collection:
       }
     }
 
+In the "items" layout the index key has the same structure, but the BSO
+objects have no payload.  Each payload is stored under a key named for the
+item's id, encoded in urlsafe base64, and the time the payload was written.
+Payload keys are therefore never overwritten: a write stores the payloads
+of the changed items under new keys and then swaps in the new index with
+CAS.  The keys of replaced payloads are not deleted, but left for memcache
+to evict, since a concurrent reader may still hold an index that refers to
+them.  Payloads can still be evicted out from under a reader, in which case
+write-through collections re-populate the cache from the underlying store
+and cache-only collections lose the affected items.  The payloads needed
+for a read are fetched with a single multi-get, after the filters and limit
+have been applied to the index.  A collection still cached as a single key
+is converted to the "items" layout the first time it's read, so that no
+cache-only data is lost when switching layouts.  The two layouts don't see
+each other's writes, so all processes sharing the cache should be switched
+over at the same time.
+
+Values are stored as JSON by default.  If the "cache_value_format" setting is
+"binary" they are instead stored in Python's marshal format, with decimal
+timestamps as integer centiseconds, which is quicker to handle.
+Values of at least "cache_compression_threshold" bytes can also be stored
+compressed, with zlib or, if installed, lz4.  The memcache flags of each
+value record how it was encoded, and values with no flags are JSON, so
+existing values can still be read after changing these settings.  Processes
+running earlier versions can only read JSON, so they must all be upgraded
+before switching to the binary format or enabling compression.
+
 To avoid the cached data getting out of sync with the underlying storage, we
 explicitly mark the cache as dirty before performing any write operations.
 In the unlikely event of a mid-operation crash, we'll notice the dirty cache
@@ -49,6 +83,10 @@ data from memcache.
 """
 
 import time
+import zlib
+import base64
+import decimal
+import marshal
 import threading
 import contextlib
 
@@ -59,6 +97,8 @@ from syncstorage.storage import (SyncStorage,
                                  CollectionNotFoundError,
                                  ItemNotFoundError,
                                  InvalidOffsetError,
+                                 encode_sortindex_offset,
+                                 decode_sortindex_offset,
                                  InvalidBatch,
                                  BATCH_LIFETIME)
 
@@ -66,6 +106,11 @@ from pyramid.settings import aslist
 
 from mozsvc.storage.mcclient import MemcachedClient
 
+try:
+    import lz4.block as lz4
+except ImportError:
+    lz4 = None  # NOQA
+
 
 # Recalculate quota at most once per hour.
 SIZE_RECALCULATION_PERIOD = 60 * 60
@@ -76,30 +121,179 @@ DEFAULT_CACHE_LOCK_TTL = 5 * 60
 # Grace period to allow between expiring of ttl's items, and deletion.
 TTL_EXPIRY_GRACE_PERIOD = 60 * 60 * 24  # 1 day, in seconds
 
+# Available layouts for the data of cached collections.
+CACHE_LAYOUTS = ("collection", "items")
+
+# Memcache flags recording how a value was encoded.  A value with no flags
+# set is uncompressed JSON, as written by earlier versions.
+FLAG_BINARY = 1
+FLAG_ZLIB = 2
+FLAG_LZ4 = 4
+
+# Available formats for values in memcache.
+CACHE_VALUE_FORMATS = ("json", "binary")
+
+# Available compression for values in memcache, and the flag for each.
+CACHE_COMPRESSIONS = {"zlib": FLAG_ZLIB, "lz4": FLAG_LZ4}
+
+# Values are read far more often than written, but must still be written
+# quickly, so favour speed over size when compressing with zlib.
+ZLIB_COMPRESSION_LEVEL = 1
+
+# Version of the marshal format used for binary values.
+MARSHAL_VERSION = 2
+
 
 def _key(*names):
     return ":".join(map(str, names))
 
 
 def bso_sort_key_index(bso):
-    return (bso["sortindex"], bso["id"])
+    return (bso.get("sortindex"), bso["id"])
 
 
 def bso_sort_key_modified(bso):
     return (bso["modified"], bso["id"])
 
 
+# Types of value that the binary format stores unchanged.
+_PLAIN_TYPES = frozenset((unicode, str, int, long, bool, type(None)))
+
+
+def _pack_value(value):
+    """Convert a JSON-compatible value into the form stored as binary.
+
+    Decimals with two decimal places, i.e. timestamps, become a tuple of
+    their integer centiseconds.  Other decimals become a tuple of their
+    string form.  A float is treated like the decimal that JSON would have
+    decoded it to.
+    """
+    t = type(value)
+    if t in _PLAIN_TYPES:
+        return value
+    if t is dict:
+        return dict((k, _pack_value(v)) for (k, v) in value.iteritems())
+    if t is decimal.Decimal:
+        return _pack_decimal(str(value))
+    if t is list or t is tuple:
+        return [_pack_value(v) for v in value]
+    if t is float:
+        return _pack_decimal(repr(value))
+    # Fall back to slower checks for any subclasses of the above.
+    if isinstance(value, dict):
+        return dict((k, _pack_value(v)) for (k, v) in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_pack_value(v) for v in value]
+    if isinstance(value, decimal.Decimal):
+        return _pack_decimal(str(value))
+    return value
+
+
+def _pack_decimal(text):
+    # The decimal module is slow, so this works on the string form.
+    whole, _, fraction = text.partition(".")
+    if len(fraction) == 2 and fraction.isdigit():
+        return (int(whole + fraction),)
+    return (text,)
+
+
+def _unpack_value(value):
+    """Convert a value stored as binary back into its original form."""
+    t = type(value)
+    if t is dict:
+        return dict((k, _unpack_value(v)) for (k, v) in value.iteritems())
+    if t is tuple:
+        value = value[0]
+        if isinstance(value, basestring):
+            return decimal.Decimal(value)
+        whole, fraction = divmod(abs(value), 100)
+        sign = "-" if value < 0 else ""
+        return decimal.Decimal("%s%d.%02d" % (sign, whole, fraction))
+    if t is list:
+        return [_unpack_value(v) for v in value]
+    return value
+
+
+class CacheValueCodec(object):
+    """Encoder for the values stored in memcache.
+
+    This class converts values to and from the strings stored in memcache,
+    along with the flags recording how each was encoded.  You may specify
+    the following arguments:
+
+        * value_format:  "json" or "binary".
+        * compression:  "zlib" or "lz4".
+        * compression_threshold:  compress any values of at least this
+                                  many bytes; zero to never compress.
+
+    Values in any format can be decoded, whatever the arguments, except
+    for lz4-compressed ones when lz4 isn't installed.
+    """
+
+    def __init__(self, value_format="json", compression="zlib",
+                 compression_threshold=0):
+        if value_format not in CACHE_VALUE_FORMATS:
+            raise ValueError("Unknown value format: %r" % (value_format,))
+        if compression not in CACHE_COMPRESSIONS:
+            raise ValueError("Unknown compression: %r" % (compression,))
+        if compression == "lz4" and lz4 is None:
+            raise ValueError("lz4 compression requires the lz4 module")
+        self.value_format = value_format
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+
+    def encode(self, value):
+        """Encode a value for memcache, returning a (data, flags) tuple."""
+        if self.value_format == "binary":
+            data = marshal.dumps(_pack_value(value), MARSHAL_VERSION)
+            flags = FLAG_BINARY
+        else:
+            data = json_dumps(value)
+            flags = 0
+        threshold = self.compression_threshold
+        if threshold and len(data) >= threshold:
+            # Only use the compressed form if it's actually smaller.
+            if self.compression == "lz4":
+                compressed = lz4.compress(data)
+            else:
+                compressed = zlib.compress(data, ZLIB_COMPRESSION_LEVEL)
+            if len(compressed) < len(data):
+                data = compressed
+                flags |= CACHE_COMPRESSIONS[self.compression]
+        return data, flags
+
+    def decode(self, data, flags):
+        """Decode a value read from memcache, given its flags."""
+        if flags & FLAG_ZLIB:
+            data = zlib.decompress(data)
+        elif flags & FLAG_LZ4:
+            if lz4 is None:
+                raise ValueError("lz4 compression requires the lz4 module")
+            data = lz4.decompress(data)
+        if flags & FLAG_BINARY:
+            return _unpack_value(marshal.loads(data))
+        return json_loads(data)
+
+
 class MemcachedClient(MemcachedClient):
-    """MemcachedClient that can handle decimal.Decimal instances."""
+    """MemcachedClient that can handle decimal.Decimal instances.
+
+    Values are encoded by the CacheValueCodec given as the "codec" keyword
+    argument, which defaults to uncompressed JSON.
+    """
+
+    def __init__(self, *args, **kwds):
+        self.codec = kwds.pop("codec", None) or CacheValueCodec()
+        super(MemcachedClient, self).__init__(*args, **kwds)
 
     def _encode_value(self, value):
-        value = json_dumps(value)
+        value, flags = self.codec.encode(value)
         if len(value) > self.max_value_size:
             raise ValueError("value too long")
-        return value, 0
+        return value, flags
 
     def _decode_value(self, value, flags):
-        return json_loads(value)
+        return self.codec.decode(value, flags)
 
 
 class MemcachedStorage(SyncStorage):
@@ -119,16 +313,32 @@ class MemcachedStorage(SyncStorage):
                              useful for namespacing in shared cache setups.
         * cache_pool_size:  the maximum number of active memcache clients.
         * cache_pool_timeout:  the maximum lifetime of each memcache client.
+        * cache_layout:  "collection" to cache each collection under a
+                         single key, or "items" to cache an index plus one
+                         key per item.
+        * cache_value_format:  "json" or "binary" encoding of cached values.
+        * cache_compression:  "zlib" or "lz4" compression of cached values.
+        * cache_compression_threshold:  compress any cached values of at
+                                        least this many bytes.
 
     """
 
     def __init__(self, storage, cache_servers=None, cache_key_prefix="",
                  cache_pool_size=None, cache_pool_timeout=60,
                  cached_collections=(), cache_only_collections=(),
-                 cache_lock=False, cache_lock_ttl=None, **kwds):
+                 cache_lock=False, cache_lock_ttl=None,
+                 cache_layout="collection", cache_value_format="json",
+                 cache_compression="zlib", cache_compression_threshold=0,
+                 **kwds):
+        if cache_layout not in CACHE_LAYOUTS:
+            raise ValueError("Unknown cache_layout: %r" % (cache_layout,))
+        self.cache_layout = cache_layout
         self.storage = storage
+        codec = CacheValueCodec(cache_value_format, cache_compression,
+                                cache_compression_threshold)
         self.cache = MemcachedClient(cache_servers, cache_key_prefix,
-                                     cache_pool_size, cache_pool_timeout)
+                                     cache_pool_size, cache_pool_timeout,
+                                     codec=codec)
         self.cached_collections = {}
         for collection in aslist(cached_collections):
             colmgr = CachedManager(self, collection)
@@ -421,18 +631,28 @@ class MemcachedStorage(SyncStorage):
             update(ts, ts)
             return ts
 
+    #
+    # APIs for monitoring the backend.
+    #
+
+    def get_load(self):
+        """Get the load of the underlying storage backend."""
+        return self.storage.get_load()
+
     #
     # Administrative/maintenance methods.
     #
 
-    def purge_expired_items(self, grace_period=0, max_per_loop=1000):
+    def purge_expired_items(self, grace_period=0, max_per_loop=1000,
+                            **kwds):
         """Purges items with an expired TTL from the database."""
         # We have no way to purge expired items from memcached, as
         # there's no way to enumerate all the userids.  Purging is
         # instead done on each write for cached collections, with the
         # expectation that this will be cheap due to low item count.
         # Therefore, the only thing we can do here is pass on the call.
-        return self.storage.purge_expired_items(grace_period, max_per_loop)
+        return self.storage.purge_expired_items(grace_period, max_per_loop,
+                                                **kwds)
 
     #
     #  Private APIs for managing the cached metadata
@@ -685,8 +905,33 @@ class _CachedManagerBase(object):
     def get_key(self, userid):
         return _key(userid, "c", self.collection)
 
+    def get_index_key(self, userid):
+        return _key(userid, "c", self.collection, "index")
+
+    def get_payload_key(self, userid, bso):
+        item_id = base64.urlsafe_b64encode(str(bso["id"]))
+        return _key(userid, "c", self.collection, "i", item_id,
+                    bso["modified"])
+
+    def get_data_key(self, userid):
+        """Get the key holding the collection data, or its index."""
+        if self.per_item:
+            return self.get_index_key(userid)
+        return self.get_key(userid)
+
     def iter_cache_keys(self, userid):
+        return self._iter_data_keys(userid)
+
+    def _iter_data_keys(self, userid):
         yield self.get_key(userid)
+        if self.per_item:
+            # The index is read before its own key is yielded, in case the
+            # caller is deleting the keys as it goes.
+            index = self.cache.get(self.get_index_key(userid))
+            if index is not None:
+                for bso in index["items"].itervalues():
+                    yield self.get_payload_key(userid, bso)
+            yield self.get_index_key(userid)
 
     @property
     def storage(self):
@@ -696,6 +941,10 @@ class _CachedManagerBase(object):
     def cache(self):
         return self.owner.cache
 
+    @property
+    def per_item(self):
+        return self.owner.cache_layout == "items"
+
     #
     # Methods that need to be implemented by subclasses.
     # All the rest of the functionality is implemented in terms of these.
@@ -719,6 +968,86 @@ class _CachedManagerBase(object):
     def del_item(self, userid, item):
         raise NotImplementedError
 
+    def _handle_missing_payloads(self, userid, bsos):
+        raise NotImplementedError
+
+    #
+    # Helper methods for reading and writing the cached data in either
+    # layout.  In the "items" layout, the data is the index and its items
+    # don't have their payloads until loaded by _load_payloads().
+    #
+
+    def _gets_data(self, userid):
+        """Get the cached collection data and its casid.
+
+        In the "items" layout, a collection that's still cached under a
+        single key is converted to an index and payload keys.
+        """
+        if not self.per_item:
+            return self.cache.gets(self.get_key(userid))
+        data, casid = self.cache.gets(self.get_index_key(userid))
+        if data is None:
+            old_data = self.cache.get(self.get_key(userid))
+            if old_data is not None:
+                # If another process converts it first, we'll use theirs.
+                self._store_data(userid, old_data, None)
+                self.cache.delete(self.get_key(userid))
+                data, casid = self.cache.gets(self.get_index_key(userid))
+        return data, casid
+
+    def _store_data(self, userid, data, casid):
+        """Store the cached collection data, unless changed since read.
+
+        A casid of None stores the data only if none is cached.  In the
+        "items" layout, any items with a payload have it stored under its
+        own key before the index is stored.  The payload keys of replaced
+        or removed items are left for memcache to evict.  This returns
+        whether the data was stored.
+        """
+        if not self.per_item:
+            return self.cache.cas(self.get_key(userid), data, casid)
+        index = {"modified": data["modified"], "items": {}}
+        for id, bso in data["items"].iteritems():
+            if "payload" in bso:
+                bso = bso.copy()
+                payload = bso.pop("payload")
+                self.cache.set(self.get_payload_key(userid, bso), payload)
+            index["items"][id] = bso
+        return self.cache.cas(self.get_index_key(userid), index, casid)
+
+    def _delete_data(self, userid):
+        """Delete the cached collection data, returning whether there was any.
+        """
+        deleted = False
+        for key in self._iter_data_keys(userid):
+            if self.cache.delete(key):
+                deleted = True
+        return deleted
+
+    def _load_payloads(self, userid, bsos):
+        """Fill in the payloads of the given items from their own keys.
+
+        This is a no-op unless using the "items" layout.  Any items whose
+        payloads have been evicted from the cache are left out of the list
+        returned, and passed on to _handle_missing_payloads().
+        """
+        if not self.per_item or not bsos:
+            return bsos
+        keys = [self.get_payload_key(userid, bso) for bso in bsos]
+        payloads = self.cache.get_multi(keys)
+        loaded = []
+        missing = []
+        for key, bso in zip(keys, bsos):
+            try:
+                bso["payload"] = payloads[key]
+            except KeyError:
+                missing.append(bso)
+            else:
+                loaded.append(bso)
+        if missing:
+            self._handle_missing_payloads(userid, missing)
+        return loaded
+
     #
     # Helper methods for updating cached collection data.
     # Subclasses use this common logic for updating the cache, but
@@ -759,7 +1088,7 @@ class _CachedManagerBase(object):
                     bso["ttl"] = int(modified) + item["ttl"]
             # Update it in-place, or create if it doesn't exist.
             try:
-                data["items"][bso["id"]].update(bso)
+                existing = data["items"][bso["id"]]
             except KeyError:
                 num_created += 1
                 # Set default payload on newly-created items.
@@ -767,6 +1096,8 @@ class _CachedManagerBase(object):
                 if "payload" not in bso:
                     bso["payload"] = ""
                 data["items"][bso["id"]] = bso
+            else:
+                existing.update(bso)
             data["modified"] = modified
         # Purge any items that have expired.
         # We can't do this as part of the purge_expired_items()
@@ -779,8 +1110,7 @@ class _CachedManagerBase(object):
                 expired_ids.add(id)
         for id in expired_ids:
             del data["items"][id]
-        key = self.get_key(userid)
-        if not self.cache.cas(key, data, casid):
+        if not self._store_data(userid, data, casid):
             raise ConflictError
         return num_created
 
@@ -804,8 +1134,7 @@ class _CachedManagerBase(object):
                 num_deleted += 1
         if num_deleted > 0:
             data["modified"] = modified
-        key = self.get_key(userid)
-        if not self.cache.cas(key, data, casid):
+        if not self._store_data(userid, data, casid):
             raise ConflictError
         return num_deleted
 
@@ -820,6 +1149,16 @@ class _CachedManagerBase(object):
         return data["modified"]
 
     def get_items(self, userid, **kwds):
+        res = self._find_items(userid, **kwds)
+        res["items"] = self._load_payloads(userid, res["items"])
+        return res
+
+    def _find_items(self, userid, **kwds):
+        """Find the items matching the given filters, without payloads.
+
+        This works like get_items(), but in the "items" layout the items
+        don't have their payloads loaded.
+        """
         # Decode kwds into individual filter values.
         newer = kwds.pop("newer", None)
         older = kwds.pop("older", None)
@@ -827,9 +1166,11 @@ class _CachedManagerBase(object):
         offset = kwds.pop("offset", None)
         sort = kwds.pop("sort", None)
         ids = kwds.pop("ids", None)
+        # Cached data is already in memory, so there's nothing to stream.
+        kwds.pop("stream", None)
         for unknown_kwd in kwds:
             raise TypeError("Unknown keyword argument: %s" % (unknown_kwd,))
-        # Read all the items out of the cache.
+        # Read all the items, or just their index, out of the cache.
         data, _ = self.get_cached_data(userid)
         if data is None:
             raise CollectionNotFoundError
@@ -858,19 +1199,29 @@ class _CachedManagerBase(object):
             key = bso_sort_key_modified
         bsos.sort(key=key, reverse=reverse)
         # Trim to the specified offset, if any.
-        # Note that we defaulted it to zero above.
+        # For sortindex ordering this may be a (sortindex, id) keyset token
+        # as produced by the SQL backend, which sorts null values last.
         if offset is not None:
-            try:
-                offset = int(offset)
-            except ValueError:
-                raise InvalidOffsetError(offset)
-            bsos = bsos[offset:]
+            if sort == "index" and ":" in offset:
+                bound = decode_sortindex_offset(offset)
+                bsos = [bso for bso in bsos if key(bso) < bound]
+                offset = None
+            else:
+                try:
+                    offset = int(offset)
+                except ValueError:
+                    raise InvalidOffsetError(offset)
+                bsos = bsos[offset:]
         # Trim to the specified limit, if any.
         next_offset = None
         if limit is not None:
             if limit < len(bsos):
                 bsos = bsos[:limit]
-                next_offset = (offset or 0) + limit
+                if sort == "index":
+                    sortindex, item_id = key(bsos[-1])
+                    next_offset = encode_sortindex_offset(sortindex, item_id)
+                else:
+                    next_offset = (offset or 0) + limit
         # Return the necessary information.
         return {
             "items": bsos,
@@ -885,7 +1236,7 @@ class _CachedManagerBase(object):
                 yield bso
 
     def get_item_ids(self, userid, **kwds):
-        res = self.get_items(userid, **kwds)
+        res = self._find_items(userid, **kwds)
         res["items"] = [bso["id"] for bso in res["items"]]
         return res
 
@@ -896,7 +1247,10 @@ class _CachedManagerBase(object):
         return items[0]
 
     def get_item_timestamp(self, userid, item):
-        return self.get_item(userid, item)["modified"]
+        items = self._find_items(userid, ids=[item])["items"]
+        if not items:
+            raise ItemNotFoundError
+        return items[0]["modified"]
 
 
 class CacheOnlyManager(_CachedManagerBase):
@@ -916,7 +1270,7 @@ class CacheOnlyManager(_CachedManagerBase):
         yield self.get_batches_key(userid)
 
     def get_cached_data(self, userid):
-        return self.cache.gets(self.get_key(userid))
+        return self._gets_data(userid)
 
     def set_items(self, userid, items):
         modified = get_timestamp()
@@ -925,7 +1279,7 @@ class CacheOnlyManager(_CachedManagerBase):
         return modified
 
     def del_collection(self, userid):
-        if not self.cache.delete(self.get_key(userid)):
+        if not self._delete_data(userid):
             raise CollectionNotFoundError
         return get_timestamp()
 
@@ -953,6 +1307,18 @@ class CacheOnlyManager(_CachedManagerBase):
             raise ItemNotFoundError
         return modified
 
+    def _handle_missing_payloads(self, userid, bsos):
+        # The items are lost, so remove them from the index.  If this
+        # conflicts with a concurrent write then a later read can retry.
+        data, casid = self.get_cached_data(userid)
+        if data is None:
+            return
+        for bso in bsos:
+            current = data["items"].get(bso["id"])
+            if current is not None and current["modified"] == bso["modified"]:
+                del data["items"][bso["id"]]
+        self._store_data(userid, data, casid)
+
     def get_cached_batches(self, userid, ts=None):
         if ts is None:
             ts = get_timestamp()
@@ -1050,8 +1416,7 @@ class CachedManager(_CachedManagerBase):
         This method returns the cached collection data, populating it from
         the underlying store if it is not cached.
         """
-        key = self.get_key(userid)
-        data, casid = self.cache.gets(key)
+        data, casid = self._gets_data(userid)
         if data is None and refresh_if_missing:
             data = {}
             try:
@@ -1066,12 +1431,25 @@ class CachedManager(_CachedManagerBase):
                         if bso.get("ttl") is not None:
                             bso["ttl"] = ttl_base + bso["ttl"]
                         data["items"][bso["id"]] = bso
-                self.cache.add(key, data)
-                data, casid = self.cache.gets(key)
+                self._store_data(userid, data, None)
+                data, casid = self._gets_data(userid)
             except CollectionNotFoundError:
                 data = None
         return data, casid
 
+    def get_items(self, userid, **kwds):
+        try:
+            return super(CachedManager, self).get_items(userid, **kwds)
+        except _IncompleteCacheError:
+            # The cached data has been cleared, so this re-populates it.
+            return super(CachedManager, self).get_items(userid, **kwds)
+
+    def _handle_missing_payloads(self, userid, bsos):
+        # The items can be read back from the underlying store, so clear
+        # the cached data to have it re-populated.
+        self.cache.delete(self.get_index_key(userid))
+        raise _IncompleteCacheError
+
     def set_items(self, userid, items):
         storage = self.storage
         # Leave the cache empty if any of posted bsos were missing a payload.
@@ -1089,7 +1467,7 @@ class CachedManager(_CachedManagerBase):
         return ts
 
     def del_collection(self, userid):
-        self.cache.delete(self.get_key(userid))
+        self._delete_data(userid)
         return self.storage.delete_collection(userid, self.collection)
 
     def del_items(self, userid, items):
@@ -1162,7 +1540,7 @@ class CachedManager(_CachedManagerBase):
         should update the cache with the new data.
         """
         # Grab the current cache state so we can pass it to calling function.
-        key = self.get_key(userid)
+        key = self.get_data_key(userid)
         data, casid = self.get_cached_data(userid, refresh_if_missing)
         # Remove it from the cache so that we don't serve stale data.
         # A CAS-DELETE here would be nice, but memcached doesn't have one.
@@ -1176,7 +1554,7 @@ class CachedManager(_CachedManagerBase):
             # If they get a storage-related error, it's safe to rollback
             # the cache. For any other sort of error we leave the cache clear.
             if data is not None:
-                self.cache.add(key, data)
+                self._store_data(userid, data, None)
             raise
 
     def _set_items(self, userid, *args):
@@ -1191,7 +1569,7 @@ class CachedManager(_CachedManagerBase):
         try:
             return super(CachedManager, self)._set_items(userid, *args)
         except StorageError:
-            self.cache.delete(self.get_key(userid))
+            self.cache.delete(self.get_data_key(userid))
 
     def _del_items(self, userid, *args):
         """Update cached data with deleted items, or clear it on conflict.
@@ -1205,4 +1583,9 @@ class CachedManager(_CachedManagerBase):
         try:
             return super(CachedManager, self)._del_items(userid, *args)
         except StorageError:
-            self.cache.delete(self.get_key(userid))
+            self.cache.delete(self.get_data_key(userid))
+
+
+class _IncompleteCacheError(Exception):
+    """Exception raised when some of the cached items have been evicted."""
+    pass
@@ -16,6 +16,10 @@ sharding of the BSO items into multiple tables named "bso0" through "bsoN".
 This behaviour is off by default; pass shard=True to enable it.
 """
 
+import sys
+import time
+import zlib
+import itertools
 import logging
 import functools
 import threading
@@ -24,19 +28,26 @@ from collections import defaultdict
 
 from sqlalchemy.exc import IntegrityError
 
+from pyramid.threadlocal import get_current_request
+
 from syncstorage.bso import BSO
-from syncstorage.util import get_timestamp
+from syncstorage.util import (get_timestamp, run_concurrently, RateLimiter,
+                              LRUCache)
 from syncstorage.storage import (SyncStorage,
                                  ConflictError,
                                  CollectionNotFoundError,
                                  ItemNotFoundError,
                                  InvalidOffsetError,
+                                 encode_sortindex_offset,
+                                 decode_sortindex_offset,
+                                 get_client_known_timestamp,
                                  BATCH_LIFETIME)
 
 from syncstorage.storage.sql.dbconnect import (DBConnector, MAX_TTL,
-                                               BackendError)
+                                               BackendError,
+                                               get_sharded_table)
 
-from mozsvc.metrics import metrics_timer
+from mozsvc.metrics import metrics_timer, annotate_request
 
 
 logger = logging.getLogger(__name__)
@@ -52,7 +63,32 @@ STANDARD_COLLECTIONS = {1: "clients", 2: "crypto", 3: "forms", 4: "history",
 
 FIRST_CUSTOM_COLLECTION_ID = 100
 
+# Default number of custom collection names to cache in memory, and number
+# of seconds for which to remember that a collection name does not exist.
 MAX_COLLECTIONS_CACHE_SIZE = 1000
+MISSING_COLLECTIONS_CACHE_TTL = 5
+
+# Default number of seconds after a user's write during which their reads
+# stick to the primary database, and the number of such users to remember.
+REPLICA_STICKINESS = 30
+MAX_RECENT_WRITERS = 10000
+
+# Prefix for the metrics reporting the hit rate of the collection name cache.
+COLLECTIONS_CACHE_METRIC = "syncstorage.storage.sql.collections_cache"
+
+# Maximum number of chunks of expired items to purge from a table in one go,
+# and limits on the size of each chunk if it's being tuned automatically.
+MAX_PURGE_ITERS = 100
+MIN_PURGE_CHUNK_SIZE = 10
+MAX_PURGE_CHUNK_SIZE = 100000
+
+# Number of rows that must be purged from a table before it's worth running
+# an `OPTIMIZE TABLE` to clean up after them.
+OPTIMIZE_TABLE_MIN_ROWS = 10000
+
+# Fields to read for each item when its payload may be stored compressed.
+COMPRESSED_ITEM_FIELDS = ["id", "sortindex", "modified", "payload",
+                          "payload_compressed", "ttl"]
 
 
 assert FIRST_CUSTOM_COLLECTION_ID > len(STANDARD_COLLECTIONS)
@@ -67,6 +103,16 @@ def bigint2ts(bigint):
     return get_timestamp(bigint / 1000.0)
 
 
+def compress_payload(payload):
+    """Compress a payload into the bytes used for storing it."""
+    return zlib.compress(payload.encode("utf8"), 9)
+
+
+def decompress_payload(data):
+    """Get the original payload from its stored, compressed bytes."""
+    return zlib.decompress(data).decode("utf8")
+
+
 def convert_db_errors(func):
     """Method decorator to convert db errors into app-level errors.
 
@@ -109,6 +155,50 @@ def with_session(func):
     return with_session_wrapper
 
 
+def with_read_session(func):
+    """Method decorator to magic a read-only "session" object into existence.
+
+    This works like the @with_session decorator, except that if a new session
+    must be created then it may be connected to a read replica.  The first
+    argument to the underlying method must be the target userid.
+    """
+    @functools.wraps(func)
+    def with_read_session_wrapper(self, *args, **kwds):
+        # If the first argument is already a session object, just use that.
+        if args and isinstance(args[0], SQLStorageSession):
+            return func(self, *args, **kwds)
+        # Otherwise, magic one into existence using threadlocals.
+        userid = args[0] if args else kwds["userid"]
+        with self._get_or_create_session(read_only=True,
+                                         userid=userid) as session:
+            return func(self, session, *args, **kwds)
+    return with_read_session_wrapper
+
+
+def get_client_unmodified_since():
+    """Get the X-If-Unmodified-Since timestamp of the active request, if any.
+
+    This is the validated value of the header, or None if there is no active
+    request or it doesn't have the header.
+    """
+    request = get_current_request()
+    validated = getattr(request, "validated", None)
+    if not validated:
+        return None
+    return validated.get("if_unmodified_since")
+
+
+def get_request_deadline():
+    """Get the time by which the current request must be finished, if any.
+
+    This is the "deadline" attribute set on the active request by the
+    set_request_deadline tween, as a time.time() value.  If there is no
+    active request, or it has no deadline, then None is returned.
+    """
+    request = get_current_request()
+    return getattr(request, "deadline", None)
+
+
 class SQLStorage(SyncStorage):
     """Storage plugin implemented using an SQL database.
 
@@ -121,7 +211,91 @@ class SQLStorage(SyncStorage):
         * create_tables:         create the database tables if they don't
                                  exist at startup
         * shard/shardsize:       enable sharding of the BSO table
-
+        * shard_map:             how to assign users to BSO table shards,
+                                 "modulo", "consistent_hash", or "range"
+                                 with "shard_boundaries"
+        * shard_lookup:          look up each user's shard in a table of
+                                 overrides, so that users can be moved
+        * track_collection_usage:  maintain running totals of the number
+                                   and size of items in each collection,
+                                   rather than calculating them on demand
+        * replica_sqluris:       database URIs of read replicas, to be used
+                                 for read-locked and /info/* reads
+        * replica_stickiness:    seconds after a user's write during which
+                                 this process sends their reads to the
+                                 primary, defaulting to replica_max_lag
+        * payload_compression_threshold:  compress any payloads of at least
+                                          this many characters, if it makes
+                                          them smaller when stored; zero
+                                          reads compressed payloads but
+                                          doesn't compress new ones
+        * partition_sqluris:     database URIs of additional servers across
+                                 which to partition users
+        * partition_map:         how to assign users to partitions, e.g.
+                                 "range" with "partition_boundaries"
+        * partition_lookup:      look up each user's partition in a table
+                                 of overrides in the main database
+        * collections_cache_size:  number of custom collection names to
+                                   keep in the in-memory LRU cache
+        * collections_cache_preload:  prime the collection name cache with
+                                      the most-used collections at startup
+        * missing_collections_cache_ttl:  seconds for which reads remember
+                                          that a collection doesn't exist
+        * async_deletes:         delete collections and storage by leaving
+                                 a tombstone, and purge their items later
+        * optimistic_writes:     write single items without holding a lock
+                                 on the collection, detecting conflicts at
+                                 the end of the write instead
+
+    When tracking collection usage, the running totals are updated in the
+    same transaction as each write.  Items that expire are only removed from
+    the totals when they are purged by purge_expired_items(), or when the
+    totals are explicitly recalculated.  Existing deployments must populate
+    the totals for existing data, e.g. via get_total_size(recalculate=True).
+
+    Compressed payloads are stored as raw bytes in the payload_compressed
+    column, leaving the payload column empty.  Uncompressed payloads leave
+    payload_compressed null, so the two can coexist, and reads decompress
+    any payload that's stored compressed.  The payload_size of each item is
+    that of the original payload.  Existing deployments must add the column
+    to each bso and batch_upload_items table before setting the threshold,
+    and must decompress everything with recompress_payloads() under a zero
+    threshold before removing the setting.
+
+    With async deletes, deleting a collection or the entire storage removes
+    only its rows in user_collections and records a tombstone, so that it
+    takes the same small amount of time however many items there are.  Reads
+    ignore any items covered by a tombstone, as do recalculations of tracked
+    usage, and writes remove any such items that they would otherwise update.
+    The items themselves are removed in chunks by purge_expired_items().
+    Existing deployments must create the collection_tombstones table before
+    enabling it.
+
+    With optimistic writes, a write lock on a collection doesn't lock its row
+    in user_collections.  Writes of a single item only update the collection
+    timestamp if it's still older than that of the write, and otherwise fail
+    with a ConflictError.  Other writes take the row lock when they start,
+    and conflict if the collection was modified after the write lock was
+    taken.  Requests with X-If-Unmodified-Since always take the row lock,
+    since their precondition must hold until the write is committed, as do
+    all writes when tracking collection usage.
+
+    When read replicas are configured, a replica is only used to serve a
+    read if it has caught up with the newest timestamp that the client is
+    known to have seen, as reported by get_client_known_timestamp().  If the
+    replica can't prove this then the read goes to the primary database.
+    Reads that don't say what the client has seen are sent to the primary
+    for "replica_stickiness" seconds after a write by the same user through
+    this storage object.  Writes made through other processes aren't known
+    about, so a client that sends none of the X-If-Modified-Since,
+    X-If-Unmodified-Since or "newer" values may briefly read stale data.
+
+    When users are partitioned across several databases, each session talks
+    to the partition of whichever user it's accessing, plus the main database
+    for the names of custom collections.  Maintenance operations such as
+    purge_expired_items() fan out to every partition in turn.  Writes to
+    several partitions in one session are committed separately, not
+    atomically, so each request should stick to a single user.
     """
 
     def __init__(self, sqluri, standard_collections=False, **dbkwds):
@@ -132,6 +306,15 @@ class SQLStorage(SyncStorage):
             dbkwds.get("optimize_table_before_purge", True)
         self._optimize_table_after_purge = \
             dbkwds.get("optimize_table_after_purge", True)
+        self._optimize_table_min_rows = \
+            int(dbkwds.get("optimize_table_min_rows",
+                           OPTIMIZE_TABLE_MIN_ROWS))
+        self._track_collection_usage = \
+            dbkwds.get("track_collection_usage", False)
+        self._payload_compression_threshold = \
+            int(dbkwds.get("payload_compression_threshold") or 0)
+        self._async_deletes = dbkwds.get("async_deletes", False)
+        self._optimistic_writes = dbkwds.get("optimistic_writes", False)
 
         # There doesn't seem to be a reliable cross-database way to set the
         # initial value of an autoincrement column.
@@ -145,23 +328,111 @@ class SQLStorage(SyncStorage):
                     if self.dbconnector.driver == "postgres":
                         raise
 
-        # A local in-memory cache for the name => collectionid mapping.
-        self._collections_by_name = {}
-        self._collections_by_id = {}
+        # A local in-memory LRU cache for the name <=> collectionid mapping.
+        # The standard collections are not in the database, so they must be
+        # kept in the cache permanently.
+        standard_by_name = {}
+        standard_by_id = {}
         if self.standard_collections:
             for id, name in STANDARD_COLLECTIONS.iteritems():
-                self._collections_by_name[name] = id
-                self._collections_by_id[id] = name
+                standard_by_name[name] = id
+                standard_by_id[id] = name
+        cache_size = int(dbkwds.get("collections_cache_size",
+                                    MAX_COLLECTIONS_CACHE_SIZE))
+        self._collections_by_name = LRUCache(cache_size, standard_by_name)
+        self._collections_by_id = LRUCache(cache_size, standard_by_id)
+        # Names that were recently found not to exist, mapped to the time
+        # at which that knowledge expires.
+        self._missing_collections = LRUCache(cache_size)
+        self._missing_collections_ttl = \
+            float(dbkwds.get("missing_collections_cache_ttl",
+                             MISSING_COLLECTIONS_CACHE_TTL))
+
+        # Users who recently wrote through this process, mapped to the time
+        # until which their reads should not be served from a replica.
+        self._recent_writers = LRUCache(MAX_RECENT_WRITERS)
+        self._replica_stickiness = \
+            float(dbkwds.get("replica_stickiness",
+                             dbkwds.get("replica_max_lag",
+                                        REPLICA_STICKINESS)))
 
         # A thread-local to track active sessions.
         self._tldata = threading.local()
 
-    def _get_or_create_session(self):
-        """Get an existing session if one exists, or start a new one if not."""
+        if dbkwds.get("collections_cache_preload", False):
+            self._preload_collections_cache()
+
+    def _note_recent_writers(self, userids):
+        """Record that the given users have just committed writes.
+
+        Their reads without a known timestamp will then stick to the primary
+        database for the next replica_stickiness seconds.
+        """
+        if not self.dbconnector.replicas or not self._replica_stickiness:
+            return
+        sticky_until = time.time() + self._replica_stickiness
+        for userid in userids:
+            self._recent_writers[userid] = sticky_until
+
+    def _get_or_create_session(self, read_only=False, userid=None):
+        """Get an existing session if one exists, or start a new one if not.
+
+        If read_only is True then any new session may be connected to a read
+        replica, provided that the replica is up-to-date enough to serve
+        reads of the given userid's data.  In SQLite WAL mode it is instead
+        taken from the pool of readers, which are always up-to-date.
+        """
         try:
             return self._tldata.session
         except AttributeError:
-            return SQLStorageSession(self)
+            pass
+        partition = getattr(self._tldata, "partition", None)
+        if partition is not None:
+            return SQLStorageSession(self, partition=partition)
+        if read_only and self.dbconnector.reader_engine is not None:
+            return SQLStorageSession(self, read_only=True)
+        if read_only and self.dbconnector.replicas:
+            session = SQLStorageSession(self, read_only=True)
+            if not session.connection.is_replica:
+                return session
+            if self._replica_is_fresh(session, userid):
+                annotate_request(None, "syncstorage.storage.sql.replica.read",
+                                 1)
+                return session
+            annotate_request(None, "syncstorage.storage.sql.replica.stale", 1)
+        return SQLStorageSession(self)
+
+    def _replica_is_fresh(self, session, userid):
+        """Check whether a replica session can serve reads for the given user.
+
+        The replica is considered fresh if it has applied all writes up to
+        the newest timestamp that the client is known to have seen.  If the
+        client doesn't say, it's only considered fresh once the user's most
+        recent write through this process is older than replica_stickiness.
+        """
+        known_ts = get_client_known_timestamp()
+        if known_ts is None:
+            sticky_until = self._recent_writers.get(userid)
+            return sticky_until is None or sticky_until <= time.time()
+        with session:
+            ts = session.query_scalar("STORAGE_TIMESTAMP", params={
+                "userid": userid,
+            }, default=0)
+        return bigint2ts(ts) >= known_ts
+
+    def _run_in_partition(self, partition, func, *args, **kwds):
+        """Call the given function with its sessions bound to a partition.
+
+        Any sessions created by the function on the current thread will send
+        all of their queries to the given partition, regardless of userid.
+        This is used to fan out maintenance tasks across all partitions.
+        """
+        old_partition = getattr(self._tldata, "partition", None)
+        self._tldata.partition = partition
+        try:
+            return func(*args, **kwds)
+        finally:
+            self._tldata.partition = old_partition
 
     #
     # APIs for collection-level locking.
@@ -179,15 +450,19 @@ class SQLStorage(SyncStorage):
     # than explicit locking, but our ops team have expressed concerns about
     # the efficiency of that approach at scale.
     #
+    # Read locks may be served from a read replica.  No writes happen on a
+    # replica, so there we just read the timestamp without locking the row.
+    #
 
     # Note: you can't use the @with_session decorator here.
     # It doesn't work right because of the generator-contextmanager thing.
     @contextlib.contextmanager
     def lock_for_read(self, userid, collection):
         """Acquire a shared read lock on the named collection."""
-        with self._get_or_create_session() as session:
+        with self._get_or_create_session(True, userid) as session:
             try:
-                collectionid = self._get_collection_id(session, collection)
+                collectionid = self._get_collection_id(session, collection,
+                                                       read=True)
             except CollectionNotFoundError:
                 # If the collection doesn't exist, we still want to start
                 # a transaction so it will continue to not exist.
@@ -199,11 +474,15 @@ class SQLStorage(SyncStorage):
                 return
             # Begin a transaction and take a lock in the database.
             params = {"userid": userid, "collectionid": collectionid}
-            session.query("BEGIN_TRANSACTION_READ")
-            ts = session.query_scalar("LOCK_COLLECTION_READ", params)
+            session.query("BEGIN_TRANSACTION_READ", params)
+            if session.connection.is_replica:
+                ts = session.query_scalar("COLLECTION_TIMESTAMP", params)
+            else:
+                ts = session.query_scalar("LOCK_COLLECTION_READ", params)
+            cached = session.cache[(userid, collectionid)]
+            cached.exists = ts is not None
             if ts is not None:
-                ts = bigint2ts(ts)
-                session.cache[(userid, collectionid)].last_modified = ts
+                cached.last_modified = bigint2ts(ts)
             session.locked_collections[(userid, collectionid)] = 0
             try:
                 # Yield context back to the calling code.
@@ -218,19 +497,32 @@ class SQLStorage(SyncStorage):
     def lock_for_write(self, userid, collection):
         """Acquire an exclusive write lock on the named collection."""
         with self._get_or_create_session() as session:
+            if session.connection.is_replica:
+                raise RuntimeError("Can't write-lock in a read-only session")
             collectionid = self._get_collection_id(session, collection, True)
             locked = session.locked_collections.get((userid, collectionid))
             if locked == 0:
                 raise RuntimeError("Can't escalate read-lock to write-lock")
             params = {"userid": userid, "collectionid": collectionid}
-            session.query("BEGIN_TRANSACTION_WRITE")
-            ts = session.query_scalar("LOCK_COLLECTION_WRITE", params)
+            session.query("BEGIN_TRANSACTION_WRITE", params)
+            # An optimistic lock just notes the current timestamp, so that
+            # conflicting writes can be detected later on.
+            optimistic = self._optimistic_writes and \
+                not self._track_collection_usage and \
+                get_client_unmodified_since() is None
+            if optimistic:
+                ts = session.query_scalar("COLLECTION_TIMESTAMP", params)
+                session.optimistic_locks[(userid, collectionid)] = ts
+            else:
+                ts = session.query_scalar("LOCK_COLLECTION_WRITE", params)
+            cached = session.cache[(userid, collectionid)]
+            cached.exists = ts is not None
             if ts is not None:
                 ts = bigint2ts(ts)
                 # Forbid the write if it would not properly incr the timestamp.
                 if ts >= session.timestamp:
                     raise ConflictError
-                session.cache[(userid, collectionid)].last_modified = ts
+                cached.last_modified = ts
             session.locked_collections[(userid, collectionid)] = 1
             try:
                 # Yield context back to the calling code.
@@ -238,12 +530,30 @@ class SQLStorage(SyncStorage):
                 yield None
             finally:
                 session.locked_collections.pop((userid, collectionid))
+                session.optimistic_locks.pop((userid, collectionid), None)
+
+    def _lock_optimistic_collection(self, session, userid, collectionid):
+        """Take the row lock put off by an optimistic write lock, if any.
+
+        Writes other than those of a single item hold the lock as usual, so
+        this takes it at the start of the write.  If the collection has been
+        modified since the optimistic lock was taken, the write conflicts.
+        """
+        if (userid, collectionid) not in session.optimistic_locks:
+            return
+        expected = session.optimistic_locks.pop((userid, collectionid))
+        ts = session.query_scalar("LOCK_COLLECTION_WRITE", {
+            "userid": userid,
+            "collectionid": collectionid,
+        })
+        if ts != expected:
+            raise ConflictError
 
     #
     # APIs to operate on the entire storage.
     #
 
-    @with_session
+    @with_read_session
     def get_storage_timestamp(self, session, userid):
         """Returns the last-modified timestamp for the entire storage."""
         ts = session.query_scalar("STORAGE_TIMESTAMP", params={
@@ -251,7 +561,7 @@ class SQLStorage(SyncStorage):
         }, default=0)
         return bigint2ts(ts)
 
-    @with_session
+    @with_read_session
     def get_collection_timestamps(self, session, userid):
         """Returns the collection timestamps for a user."""
         res = session.query_fetchall("COLLECTIONS_TIMESTAMPS", {
@@ -262,19 +572,31 @@ class SQLStorage(SyncStorage):
             res[collection] = bigint2ts(res[collection])
         return res
 
-    @with_session
+    @with_read_session
     def get_collection_counts(self, session, userid):
         """Returns the collection counts."""
-        res = session.query_fetchall("COLLECTIONS_COUNTS", {
+        if self._track_collection_usage:
+            query = "TRACKED_COLLECTIONS_COUNTS"
+        elif self._async_deletes:
+            query = "LIVE_COLLECTIONS_COUNTS"
+        else:
+            query = "COLLECTIONS_COUNTS"
+        res = session.query_fetchall(query, {
             "userid": userid,
             "ttl": int(session.timestamp),
         })
         return self._map_collection_names(session, res)
 
-    @with_session
+    @with_read_session
     def get_collection_sizes(self, session, userid):
         """Returns the total size for each collection."""
-        res = session.query_fetchall("COLLECTIONS_SIZES", {
+        if self._track_collection_usage:
+            query = "TRACKED_COLLECTIONS_SIZES"
+        elif self._async_deletes:
+            query = "LIVE_COLLECTIONS_SIZES"
+        else:
+            query = "COLLECTIONS_SIZES"
+        res = session.query_fetchall(query, {
             "userid": userid,
             "ttl": int(session.timestamp),
         })
@@ -283,10 +605,34 @@ class SQLStorage(SyncStorage):
         rows = ((row[0], int(row[1])) for row in res)
         return self._map_collection_names(session, rows)
 
+    def get_total_size(self, userid, recalculate=False):
+        """Returns the total size a user's stored data."""
+        if recalculate and self._track_collection_usage:
+            return self._recalculate_total_size(userid)
+        return self._get_total_size(userid)
+
     @with_session
-    def get_total_size(self, session, userid, recalculate=False):
+    def _recalculate_total_size(self, session, userid):
+        """Recalculate the tracked usage totals, returning the total size."""
+        if self._async_deletes:
+            query = "LIVE_RECALCULATE_ALL_COLLECTIONS_USAGE"
+        else:
+            query = "RECALCULATE_ALL_COLLECTIONS_USAGE"
+        session.query(query, {
+            "userid": userid,
+        })
+        return self._get_total_size(session, userid)
+
+    @with_read_session
+    def _get_total_size(self, session, userid):
         """Returns the total size a user's stored data."""
-        size = session.query_scalar("STORAGE_SIZE", {
+        if self._track_collection_usage:
+            query = "TRACKED_STORAGE_SIZE"
+        elif self._async_deletes:
+            query = "LIVE_STORAGE_SIZE"
+        else:
+            query = "STORAGE_SIZE"
+        size = session.query_scalar(query, {
             "userid": userid,
             "ttl": int(session.timestamp),
         }, default=0)
@@ -297,6 +643,13 @@ class SQLStorage(SyncStorage):
     @with_session
     def delete_storage(self, session, userid):
         """Removes all data for the user."""
+        session.written_userids.add(userid)
+        if self._async_deletes:
+            session.query("DELETE_ALL_COLLECTIONS", {
+                "userid": userid,
+            })
+            self._set_tombstone(session, userid, 0)
+            return
         session.query("DELETE_ALL_BSOS", {
             "userid": userid,
         })
@@ -311,11 +664,14 @@ class SQLStorage(SyncStorage):
     @with_session
     def get_collection_timestamp(self, session, userid, collection):
         """Returns the last-modified timestamp of a collection."""
-        collectionid = self._get_collection_id(session, collection)
-        # The last-modified timestamp may be cached on the session.
-        cached_ts = session.cache[(userid, collectionid)].last_modified
-        if cached_ts is not None:
-            return cached_ts
+        collectionid = self._get_collection_id(session, collection, read=True)
+        # The last-modified timestamp may be cached on the session, or we
+        # may already know that the collection doesn't exist.
+        cached = session.cache[(userid, collectionid)]
+        if cached.last_modified is not None:
+            return cached.last_modified
+        if cached.exists is False:
+            raise CollectionNotFoundError
         # Otherwise we need to look it up in the database.
         ts = session.query_scalar("COLLECTION_TIMESTAMP", {
             "userid": userid,
@@ -343,7 +699,10 @@ class SQLStorage(SyncStorage):
     def _find_items(self, session, userid, collection, **params):
         """Find items matching the given search parameters."""
         params["userid"] = userid
-        params["collectionid"] = self._get_collection_id(session, collection)
+        params["collectionid"] = self._get_collection_id(session, collection,
+                                                         read=True)
+        if "fields" not in params and self.dbconnector.compressed_payloads:
+            params["fields"] = COMPRESSED_ITEM_FIELDS
         if "ttl" not in params:
             params["ttl"] = int(session.timestamp)
         if "newer" in params:
@@ -358,6 +717,26 @@ class SQLStorage(SyncStorage):
         offset = params.pop("offset", None)
         if offset is not None:
             self.decode_offset(params, offset)
+        # With async deletes, any items covered by a tombstone must be left
+        # out.  There's no need to look if the collection doesn't exist.
+        if self._async_deletes:
+            cached = session.cache[(userid, params["collectionid"])]
+            if cached.exists is False:
+                self.get_collection_timestamp(session, userid, collection)
+                return {
+                    "items": [],
+                    "next_offset": None,
+                }
+            tombstone = self._get_tombstone(session, userid,
+                                            params["collectionid"])
+            if tombstone:
+                params["newer"] = max(params.get("newer", 0), tombstone)
+        # Unlimited reads can be streamed from the database, unless doing so
+        # would tie up the only connection that's available.
+        stream = params.pop("stream", False)
+        if stream and limit is None:
+            if not self.dbconnector.single_connection:
+                return self._stream_items(session, userid, collection, params)
         rows = session.query_fetchall("FIND_ITEMS", params)
         items = [self._row_to_bso(row, int(session.timestamp)) for row in rows]
         # If the query returned no results, we don't know whether that's
@@ -375,11 +754,51 @@ class SQLStorage(SyncStorage):
             "next_offset": next_offset,
         }
 
+    def _stream_items(self, session, userid, collection, params):
+        """Find items using a streaming query on a dedicated connection.
+
+        The query is started immediately, while any collection lock held by
+        the given session is still in place, so that it sees a consistent
+        snapshot of the collection.  But the rows are only fetched from the
+        database and converted into BSOs as the results are iterated, which
+        is not limited by any deadline on the session.
+        """
+        params = session.resolve_tables("FIND_ITEMS", params)
+        connection = session.get_connection(userid).clone()
+        try:
+            rows = connection.query_fetchall("FIND_ITEMS", params,
+                                             stream=True)
+            first_row = next(rows, None)
+        except BaseException:
+            connection.rollback()
+            raise
+        # The rest of the rows are read as the response is sent, so they
+        # can't be held to the request deadline.
+        connection.clear_deadline()
+        # As in _find_items, an empty result might mean that the collection
+        # doesn't exist, so check for that and raise if necessary.
+        if first_row is None:
+            connection.commit()
+            self.get_collection_timestamp(session, userid, collection)
+            return {
+                "items": [],
+                "next_offset": None,
+            }
+        rows = itertools.chain((first_row,), rows)
+        items = SQLItemStream(self, connection, rows, int(session.timestamp))
+        return {
+            "items": items,
+            "next_offset": None,
+        }
+
     def _row_to_bso(self, row, timestamp):
         """Convert a database table row into a BSO object."""
         item = dict(row)
         for key in ("userid", "collection", "payload_size",):
             item.pop(key, None)
+        compressed = item.pop("payload_compressed", None)
+        if compressed is not None:
+            item["payload"] = decompress_payload(compressed)
         ts = item.get("modified")
         if ts is not None:
             item["modified"] = bigint2ts(ts)
@@ -399,15 +818,16 @@ class SQLStorage(SyncStorage):
         encoded as "bound:offset" with efficient pagination granularity
         limited by the number of items with the same timestamp.
 
-        When sorting by sortindex, we cannot use an index anyway, and we have
-        no bound on the number of items that might share a single sortindex.
-        There's therefore not much to be gained by trying to be clever, and
-        we just use a simple numeric offset.
+        When sorting by sortindex, we have no bound on the number of items
+        that might share a single sortindex, so instead we record the
+        (sortindex, id) pair of the last item as a keyset token.  The query
+        can then seek directly to the next item using the sortindex index.
         """
         sort = params.get("sort", None)
-        # Use a simple numeric offset for sortindex ordering.
+        # Use a (sortindex, id) keyset token for sortindex ordering.
         if sort == "index":
-            return str(params.get("offset", 0) + len(items))
+            last = items[-1]
+            return encode_sortindex_offset(last.get("sortindex"), last["id"])
         # Find an appropriate upper bound for faster timestamp ordering.
         bound = items[-1]["modified"]
         bound_as_bigint = ts2bigint(bound)
@@ -442,8 +862,15 @@ class SQLStorage(SyncStorage):
         sort = params.get("sort", None)
         try:
             if sort == "index":
-                # When sorting by sortindex, it's just a numeric offset.
-                params["offset"] = int(offset)
+                # When sorting by sortindex, it's a (sortindex, id) keyset
+                # token.  Tokens issued by previous versions of the server
+                # were a plain numeric offset, so continue to accept those.
+                if ":" not in offset:
+                    params["offset"] = int(offset)
+                else:
+                    sortindex, item_id = decode_sortindex_offset(offset)
+                    params["sortindex_bound"] = sortindex
+                    params["id_bound"] = item_id
             else:
                 # When sorting by timestamp, it's a (bound, offset) pair.
                 bound, offset = map(int, offset.split(":", 1))
@@ -466,19 +893,24 @@ class SQLStorage(SyncStorage):
     def set_items(self, session, userid, collection, items):
         """Creates or updates multiple items in a collection."""
         collectionid = self._get_collection_id(session, collection, create=1)
+        self._lock_optimistic_collection(session, userid, collectionid)
+        self._delete_tombstoned_items(session, userid, collectionid,
+                                      [data["id"] for data in items])
         rows = []
         for data in items:
             id = data["id"]
             row = self._prepare_bso_row(session, userid, collectionid,
                                         id, data)
             rows.append(row)
+        usage = self._get_usage_delta_for_rows(session, userid,
+                                               collectionid, rows)
         defaults = {
             "modified": ts2bigint(session.timestamp),
             "payload": "",
             "payload_size": 0,
         }
-        session.insert_or_update("bso", rows, defaults)
-        return self._touch_collection(session, userid, collectionid)
+        session.insert_or_update("bso", rows, defaults, count_created=False)
+        return self._touch_collection(session, userid, collectionid, usage)
 
     @with_session
     def create_batch(self, session, userid, collection):
@@ -535,7 +967,8 @@ class SQLStorage(SyncStorage):
             id_ = data["id"]
             row = self._prepare_bui_row(session, batchid, userid, id_, data)
             rows.append(row)
-        session.insert_or_update("batch_upload_items", rows)
+        session.insert_or_update("batch_upload_items", rows,
+                                 count_created=False)
         return session.timestamp
 
     @metrics_timer("syncstorage.storage.sql.apply_batch")
@@ -550,9 +983,31 @@ class SQLStorage(SyncStorage):
             "ttl_base": int(session.timestamp),
             "modified": ts2bigint(session.timestamp)
         }
-        session.query("APPLY_BATCH_UPDATE", params)
-        session.query("APPLY_BATCH_INSERT", params)
-        return self._touch_collection(session, userid, collectionid)
+        self._lock_optimistic_collection(session, userid, collectionid)
+        self._delete_tombstoned_items(session, userid, collectionid,
+                                      batchid=batchid)
+        usage = None
+        if self._track_collection_usage:
+            usage = session.query_fetchone("APPLY_BATCH_USAGE", params)
+            usage = (int(usage[0]), int(usage[1]))
+        if self._can_upsert_batch():
+            session.query("APPLY_BATCH_UPSERT", params)
+        else:
+            session.query("APPLY_BATCH_UPDATE", params)
+            session.query("APPLY_BATCH_INSERT", params)
+        return self._touch_collection(session, userid, collectionid, usage)
+
+    def _can_upsert_batch(self):
+        """Check whether a batch can be applied with APPLY_BATCH_UPSERT.
+
+        This single-query version is only available for PostgreSQL, and only
+        for server versions that support INSERT ... ON CONFLICT.  Other
+        databases apply the batch with APPLY_BATCH_UPDATE followed by
+        APPLY_BATCH_INSERT, one or both of which may be a no-op.
+        """
+        if self.dbconnector.driver != "postgres":
+            return False
+        return self.dbconnector.supports_on_conflict()
 
     @metrics_timer("syncstorage.storage.sql.close_batch")
     @with_session
@@ -569,49 +1024,228 @@ class SQLStorage(SyncStorage):
     @with_session
     def delete_collection(self, session, userid, collection):
         """Deletes an entire collection."""
+        session.written_userids.add(userid)
         collectionid = self._get_collection_id(session, collection)
-        count = session.query("DELETE_COLLECTION_ITEMS", {
-            "userid": userid,
-            "collectionid": collectionid,
-        })
-        count += session.query("DELETE_COLLECTION", {
+        self._lock_optimistic_collection(session, userid, collectionid)
+        params = {
             "userid": userid,
             "collectionid": collectionid,
-        })
+        }
+        # With async deletes, the items are left for purge_expired_items().
+        if self._async_deletes:
+            if session.query("DELETE_COLLECTION", params) == 0:
+                raise CollectionNotFoundError
+            self._set_tombstone(session, userid, collectionid)
+            return self.get_storage_timestamp(userid)
+        # Some databases can do everything in a single query.
+        res = session.query_fetchone("DELETE_COLLECTION_AND_ITEMS", params)
+        if res is not None:
+            count, ts = res
+        else:
+            count = session.query("DELETE_COLLECTION_ITEMS", params)
+            count += session.query("DELETE_COLLECTION", params)
         if count == 0:
             raise CollectionNotFoundError
+        cached = session.cache[(userid, collectionid)]
+        cached.last_modified = None
+        cached.exists = False
+        if res is not None:
+            return bigint2ts(ts or 0)
         return self.get_storage_timestamp(userid)
 
     @with_session
     def delete_items(self, session, userid, collection, items):
         """Deletes multiple items from a collection."""
         collectionid = self._get_collection_id(session, collection)
+        self._lock_optimistic_collection(session, userid, collectionid)
+        self._delete_tombstoned_items(session, userid, collectionid, items)
+        usage = None
+        if self._track_collection_usage:
+            sizes = self._get_item_sizes(session, userid, collectionid, items)
+            usage = (-len(sizes), -sum(sizes.itervalues()))
         session.query("DELETE_ITEMS", {
             "userid": userid,
             "collectionid": collectionid,
             "ids": items,
         })
-        return self._touch_collection(session, userid, collectionid)
+        return self._touch_collection(session, userid, collectionid, usage)
+
+    def _touch_collection(self, session, userid, collectionid, usage=None):
+        """Update the last-modified timestamp of the given collection.
 
-    def _touch_collection(self, session, userid, collectionid):
-        """Update the last-modified timestamp of the given collection."""
+        If collection usage is being tracked, the change in the number and
+        total size of its items can be given as a (count, bytes) pair, and
+        the running totals will be updated at the same time.
+        """
+        session.written_userids.add(userid)
         params = {
             "userid": userid,
             "collectionid": collectionid,
             "modified": ts2bigint(session.timestamp),
         }
-        # The common case will be an UPDATE, so try that first.
-        # If it doesn't update any rows then do an INSERT.
-        rowcount = session.query("TOUCH_COLLECTION", params)
-        if rowcount != 1:
-            try:
-                session.query("INIT_COLLECTION", params)
-            except IntegrityError:
-                # Someone else inserted it at the same time.
-                if self.dbconnector.driver == "postgres":
-                    raise
+        suffix = ""
+        if self._track_collection_usage:
+            suffix = "_AND_USAGE"
+            params["count_delta"], params["bytes_delta"] = usage or (0, 0)
+        cached = session.cache[(userid, collectionid)]
+        if (userid, collectionid) in session.optimistic_locks:
+            # Without the row lock, the collection may have been written since
+            # we read its timestamp.  Only update it if it's still older than
+            # this write, or if it doesn't exist yet, and conflict otherwise.
+            # Either way the row is then locked for the rest of the session.
+            rowcount = 0
+            if cached.exists is not False:
+                rowcount = session.query("TOUCH_COLLECTION_IF_OLDER", params)
+            if rowcount != 1:
+                try:
+                    rowcount = session.query("INIT_COLLECTION", params)
+                except IntegrityError:
+                    rowcount = 0
+                if rowcount != 1:
+                    raise ConflictError
+            del session.optimistic_locks[(userid, collectionid)]
+        elif self._can_upsert_collection():
+            session.query("UPSERT_COLLECTION" + suffix, params)
+        else:
+            # The common case will be an UPDATE, so try that first unless
+            # we already know the collection doesn't exist.  If it doesn't
+            # update any rows then do an INSERT.
+            rowcount = 0
+            if cached.exists is not False:
+                rowcount = session.query("TOUCH_COLLECTION" + suffix, params)
+            if rowcount != 1:
+                try:
+                    rowcount = session.query("INIT_COLLECTION" + suffix,
+                                             params)
+                except IntegrityError:
+                    if self.dbconnector.driver == "postgres":
+                        raise
+                    rowcount = 0
+                # If someone else inserted it at the same time, update it.
+                if rowcount != 1:
+                    session.query("TOUCH_COLLECTION" + suffix, params)
+        cached.exists = True
         return session.timestamp
 
+    def _can_upsert_collection(self):
+        """Check whether a collection can be touched with UPSERT_COLLECTION.
+
+        This single-query version is available for MySQL, and for other
+        databases that support INSERT ... ON CONFLICT.  Otherwise we do an
+        UPDATE and, if the collection doesn't exist yet, an INSERT.
+        """
+        if self.dbconnector.driver == "mysql":
+            return True
+        return self.dbconnector.supports_on_conflict()
+
+    def _get_tombstone(self, session, userid, collectionid):
+        """Get the tombstone covering a collection, as a bigint timestamp.
+
+        Items modified at or before this time have been deleted, but may not
+        yet have been removed from the database.  It's zero if there's no
+        tombstone, which is always the case unless async_deletes is enabled.
+        """
+        if not self._async_deletes:
+            return 0
+        cached = session.cache[(userid, collectionid)]
+        if cached.tombstone is None:
+            cached.tombstone = session.query_scalar("COLLECTION_TOMBSTONE", {
+                "userid": userid,
+                "collectionid": collectionid,
+            }, default=0)
+        return cached.tombstone
+
+    def _set_tombstone(self, session, userid, collectionid):
+        """Record the deletion of a collection, or of the whole storage.
+
+        A collectionid of zero covers all of the user's collections.  Any
+        cached information about the affected collections is updated to
+        match, so that the rest of the session sees them as deleted.
+        """
+        tombstone = ts2bigint(session.timestamp)
+        session.insert_or_update("collection_tombstones", [{
+            "userid": userid,
+            "collection": collectionid,
+            "modified": tombstone,
+        }], count_created=False)
+        if collectionid:
+            session.cache[(userid, collectionid)].exists = False
+        for (cached_userid, cached_id), cached in session.cache.iteritems():
+            if cached_userid == userid and collectionid in (0, cached_id):
+                cached.last_modified = None
+                cached.exists = False
+                cached.tombstone = tombstone
+
+    def _delete_tombstoned_items(self, session, userid, collectionid,
+                                 items=(), batchid=None):
+        """Remove any deleted items that are about to be written.
+
+        Before writing to a collection with a tombstone, any items covered by
+        it that have the given ids, or the ids of those in the given batch,
+        are removed so that the write can't bring them back to life.
+        """
+        tombstone = self._get_tombstone(session, userid, collectionid)
+        if not tombstone:
+            return
+        params = {
+            "userid": userid,
+            "tombstone": tombstone,
+        }
+        # Anything written now would itself be covered by the tombstone,
+        # so if it's the collection's own then finish the delete right away.
+        # A deleted storage has too many items for that to be a good idea.
+        if tombstone >= ts2bigint(session.timestamp):
+            params["collectionid"] = collectionid
+            if not session.query("DELETE_TOMBSTONE", params):
+                raise ConflictError
+            session.query("DELETE_TOMBSTONED_COLLECTION", params)
+            session.cache[(userid, collectionid)].tombstone = 0
+            return
+        if batchid is not None:
+            params["collection"] = collectionid
+            params["batch"] = batchid
+            session.query("DELETE_TOMBSTONED_BATCH_ITEMS", params)
+        elif items:
+            params["collectionid"] = collectionid
+            params["ids"] = list(set(items))
+            session.query("DELETE_TOMBSTONED_ITEMS", params)
+
+    def _get_item_sizes(self, session, userid, collectionid, items):
+        """Get the sizes of any stored items with the given ids.
+
+        Expired items are included, since they stay in the running totals
+        of collection usage until they are purged.
+        """
+        if not items:
+            return {}
+        res = session.query_fetchall("ITEMS_SIZES", {
+            "userid": userid,
+            "collectionid": collectionid,
+            "ids": list(set(items)),
+        })
+        return dict((row[0], row[1]) for row in res)
+
+    def _get_usage_delta_for_rows(self, session, userid, collectionid, rows):
+        """Calculate how writing the given rows will change collection usage.
+
+        This returns a (count, bytes) pair giving the change in the number
+        and total size of stored items in the collection, or None if
+        collection usage is not being tracked.
+        """
+        if not self._track_collection_usage:
+            return None
+        old_sizes = self._get_item_sizes(session, userid, collectionid,
+                                         [row["id"] for row in rows])
+        new_sizes = old_sizes.copy()
+        for row in rows:
+            if "payload_size" in row:
+                new_sizes[row["id"]] = row["payload_size"]
+            else:
+                new_sizes.setdefault(row["id"], 0)
+        count = len(new_sizes) - len(old_sizes)
+        size = sum(new_sizes.itervalues()) - sum(old_sizes.itervalues())
+        return (count, size)
+
     #
     # Items APIs
     #
@@ -619,7 +1253,7 @@ class SQLStorage(SyncStorage):
     @with_session
     def get_item_timestamp(self, session, userid, collection, item):
         """Returns the last-modified timestamp for the named item."""
-        collectionid = self._get_collection_id(session, collection)
+        collectionid = self._get_collection_id(session, collection, read=True)
         ts = session.query_scalar("ITEM_TIMESTAMP", {
             "userid": userid,
             "collectionid": collectionid,
@@ -628,12 +1262,14 @@ class SQLStorage(SyncStorage):
         })
         if ts is None:
             raise ItemNotFoundError
+        if ts <= self._get_tombstone(session, userid, collectionid):
+            raise ItemNotFoundError
         return bigint2ts(ts)
 
     @with_session
     def get_item(self, session, userid, collection, item):
         """Returns one item from a collection."""
-        collectionid = self._get_collection_id(session, collection)
+        collectionid = self._get_collection_id(session, collection, read=True)
         row = session.query_fetchone("ITEM_DETAILS", {
             "userid": userid,
             "collectionid": collectionid,
@@ -642,13 +1278,19 @@ class SQLStorage(SyncStorage):
         })
         if row is None:
             raise ItemNotFoundError
+        if row["modified"] <= self._get_tombstone(session, userid,
+                                                  collectionid):
+            raise ItemNotFoundError
         return self._row_to_bso(row, int(session.timestamp))
 
     @with_session
     def set_item(self, session, userid, collection, item, data):
         """Creates or updates a single item in a collection."""
         collectionid = self._get_collection_id(session, collection, create=1)
+        self._delete_tombstoned_items(session, userid, collectionid, [item])
         row = self._prepare_bso_row(session, userid, collectionid, item, data)
+        usage = self._get_usage_delta_for_rows(session, userid,
+                                               collectionid, [row])
         defaults = {
             "modified": ts2bigint(session.timestamp),
             "payload": "",
@@ -657,7 +1299,8 @@ class SQLStorage(SyncStorage):
         num_created = session.insert_or_update("bso", [row], defaults)
         return {
             "created": bool(num_created),
-            "modified": self._touch_collection(session, userid, collectionid)
+            "modified": self._touch_collection(session, userid, collectionid,
+                                               usage)
         }
 
     def _prepare_bso_row(self, session, userid, collectionid, item, data):
@@ -671,7 +1314,7 @@ class SQLStorage(SyncStorage):
         # If a payload is provided, make sure to update dependent fields.
         if "payload" in data:
             row["modified"] = ts2bigint(session.timestamp)
-            row["payload"] = data["payload"]
+            self._encode_payload(row, data["payload"])
             row["payload_size"] = len(data["payload"])
         # If provided, ttl will be an offset in seconds.
         # Add it to the current timestamp to get an absolute time.
@@ -692,7 +1335,7 @@ class SQLStorage(SyncStorage):
             row["sortindex"] = data["sortindex"]
         # If a payload is provided, make sure to update dependent fields.
         if "payload" in data:
-            row["payload"] = data["payload"]
+            self._encode_payload(row, data["payload"])
             row["payload_size"] = len(data["payload"])
         # If provided, ttl will be an offset in seconds.
         # Store the raw offset, we'll add it to the commit time
@@ -701,10 +1344,29 @@ class SQLStorage(SyncStorage):
             row["ttl_offset"] = data["ttl"]
         return row
 
+    def _encode_payload(self, row, payload):
+        """Store a payload in row data, compressing it if configured to."""
+        row["payload"] = payload
+        if not self.dbconnector.compressed_payloads:
+            return
+        row["payload_compressed"] = None
+        threshold = self._payload_compression_threshold
+        if threshold and len(payload) >= threshold:
+            data = compress_payload(payload)
+            if len(data) < len(payload.encode("utf8")):
+                binary = self.dbconnector.engine.dialect.dbapi.Binary
+                row["payload"] = ""
+                row["payload_compressed"] = binary(data)
+
     @with_session
     def delete_item(self, session, userid, collection, item):
         """Deletes a single item from a collection."""
         collectionid = self._get_collection_id(session, collection)
+        self._delete_tombstoned_items(session, userid, collectionid, [item])
+        usage = None
+        if self._track_collection_usage:
+            sizes = self._get_item_sizes(session, userid, collectionid, [item])
+            usage = (-len(sizes), -sum(sizes.itervalues()))
         rowcount = session.query("DELETE_ITEM", {
             "userid": userid,
             "collectionid": collectionid,
@@ -713,138 +1375,616 @@ class SQLStorage(SyncStorage):
         })
         if rowcount == 0:
             raise ItemNotFoundError
-        return self._touch_collection(session, userid, collectionid)
+        return self._touch_collection(session, userid, collectionid, usage)
 
     #
     # Administrative/maintenance methods.
     #
-    def purge_expired_items(self, grace_period=0, max_per_loop=1000):
-        """Purges expired items from the bso and batch-related tables."""
-        res = self._purge_expired_bsos(grace_period, max_per_loop)
-        num_bso_rows_purged = res["num_purged"]
-        is_complete = res["is_complete"]
+    def purge_expired_items(self, grace_period=0, max_per_loop=1000,
+                            max_concurrency=1, max_rows_per_second=0,
+                            worker_slots=None, target_latency=0,
+                            max_iters=MAX_PURGE_ITERS):
+        """Purges expired items from the bso and batch-related tables.
+
+        Each table is purged as a separate task, with up to max_concurrency
+        tasks running at once.  If max_rows_per_second is given then the
+        tasks will pause between deletes so that the total rate of deletion
+        from this database stays within that budget.  If worker_slots is
+        given, it should be a semaphore that each task will hold while running
+        so that concurrency can be capped across several storages.
+
+        The progress of each task is checkpointed in the database, so that
+        a purge which is cut short by max_iters will be continued by the
+        next purge rather than starting again from scratch.
+
+        If users are partitioned across several databases, the tables in
+        each partition are purged as separate tasks with their own rate
+        limit, and are reported with names of the form "<partition>/<table>".
+
+        With async deletes, the items of deleted collections are purged by
+        a further task in each partition, reported as collection_tombstones.
+        """
+        tasks = []
+        for partition in xrange(self.dbconnector.num_partitions):
+            throttle = None
+            if max_rows_per_second:
+                throttle = RateLimiter(max_rows_per_second)
+            kwds = {
+                "max_per_loop": max_per_loop,
+                "throttle": throttle,
+                "target_latency": target_latency,
+                "max_iters": max_iters,
+            }
+            partition_tasks = []
+            for table in self._get_sharded_table_names("bso"):
+                task = functools.partial(self._purge_expired_bsos, table,
+                                         grace_period, **kwds)
+                partition_tasks.append(("num_bso_rows_purged", task))
+            task = functools.partial(self._purge_expired_batches,
+                                     grace_period, **kwds)
+            partition_tasks.append(("num_batches_purged", task))
+            for table in self._get_sharded_table_names("batch_upload_items"):
+                task = functools.partial(self._purge_expired_batch_items,
+                                         table, grace_period, **kwds)
+                partition_tasks.append(("num_bui_rows_purged", task))
+            if self._async_deletes:
+                task = functools.partial(self._purge_tombstoned_items, **kwds)
+                partition_tasks.append(("num_tombstoned_rows_purged", task))
+            for key, task in partition_tasks:
+                task = functools.partial(self._run_in_partition, partition,
+                                         task)
+                tasks.append((key, partition, task))
+
+        results = run_concurrently((task for (_, _, task) in tasks),
+                                   max_concurrency, worker_slots)
+
+        summary = {
+            "num_batches_purged": 0,
+            "num_bso_rows_purged": 0,
+            "num_bui_rows_purged": 0,
+            "num_tombstoned_rows_purged": 0,
+            "is_complete": True,
+            "tables": {},
+        }
+        for (key, partition, _), res in zip(tasks, results):
+            summary[key] += res["num_purged"]
+            summary["is_complete"] = summary["is_complete"] and \
+                res["is_complete"]
+            table = self._get_partition_table_name(partition, res["table"])
+            summary["tables"][table] = res
+        return summary
+
+    def _get_sharded_table_names(self, which):
+        """Get the names of all the bso or batch_upload_items tables.
+
+        This will be different depending on whether sharding is done.
+        """
+        if not self.dbconnector.shard:
+            return [which]
+        tables = set(get_sharded_table(i, which).name
+                     for i in xrange(self.dbconnector.shardsize))
+        assert len(tables) == self.dbconnector.shardsize
+        return sorted(tables)
+
+    def _get_partition_table_name(self, partition, table):
+        """Qualify a table name with its partition, for progress reporting.
 
-        res = self._purge_expired_batches(grace_period, max_per_loop)
-        num_batches_purged = res["num_purged"]
-        is_complete = is_complete and res["is_complete"]
+        The name is left as-is if users are not partitioned.
+        """
+        if self.dbconnector.num_partitions == 1:
+            return table
+        return "%d/%s" % (partition, table)
+
+    def _purge_expired_bsos(self, table, grace_period=0, **kwds):
+        """Purges BSOs with an expired TTL from the given table."""
+        end = int(get_timestamp()) - grace_period
+        checkpoint = self._get_purge_checkpoint(table, kwds)
+        # Reconcile the running totals of the collections in each chunk.
+        affected_query = None
+        if self._track_collection_usage:
+            affected_query = "EXPIRED_ITEMS_COLLECTIONS"
+        return self._purge_items_loop(checkpoint, end,
+                                      "PURGE_SOME_EXPIRED_ITEMS",
+                                      "NEXT_EXPIRED_ITEM",
+                                      {"bso": table},
+                                      affected_query=affected_query, **kwds)
+
+    def _purge_expired_batches(self, grace_period=0, **kwds):
+        end = int(get_timestamp()) - BATCH_LIFETIME - grace_period
+        checkpoint = self._get_purge_checkpoint("batch_uploads", kwds)
+        self._maybe_optimize_table_before_purge(checkpoint,
+                                                "OPTIMIZE_BATCHES_TABLE")
+        res = self._purge_items_loop(checkpoint, end * 1000,
+                                     "PURGE_BATCHES",
+                                     "NEXT_EXPIRED_BATCH",
+                                     {}, **kwds)
+        self._maybe_optimize_table_after_purge(checkpoint,
+                                               "OPTIMIZE_BATCHES_TABLE")
+        return res
 
-        res = self._purge_expired_batch_items(grace_period, max_per_loop)
-        num_bui_rows_purged = res["num_purged"]
-        is_complete = is_complete and res["is_complete"]
+    def _purge_expired_batch_items(self, table, grace_period=0, **kwds):
+        end = int(get_timestamp()) - BATCH_LIFETIME - grace_period
+        checkpoint = self._get_purge_checkpoint(table, kwds)
+        self._maybe_optimize_table_before_purge(checkpoint,
+                                                "OPTIMIZE_BUI_TABLE", {
+                                                    "bui": table
+                                                })
+        res = self._purge_items_loop(checkpoint, end * 1000,
+                                     "PURGE_BATCH_CONTENTS",
+                                     "NEXT_EXPIRED_BATCH_CONTENTS",
+                                     {"bui": table}, **kwds)
+        self._maybe_optimize_table_after_purge(checkpoint,
+                                               "OPTIMIZE_BUI_TABLE", {
+                                                   "bui": table
+                                               })
+        return res
 
-        return {
-            "num_batches_purged": num_batches_purged,
-            "num_bso_rows_purged": num_bso_rows_purged,
-            "num_bui_rows_purged": num_bui_rows_purged,
-            "is_complete": is_complete,
-        }
+    def _purge_tombstoned_items(self, max_per_loop=1000, throttle=None,
+                                target_latency=0, max_iters=MAX_PURGE_ITERS):
+        """Purges the items covered by tombstones, then the tombstones.
 
-    def _purge_expired_bsos(self, grace_period=0, max_per_loop=1000):
-        """Purges BSOs with an expired TTL from the database."""
-        # Get the set of all BSO tables in the database.
-        # This will be different depending on whether sharding is done.
-        if not self.dbconnector.shard:
-            tables = set(("bso",))
-        else:
-            tables = set(self.dbconnector.get_bso_table(i).name
-                         for i in xrange(self.dbconnector.shardsize))
-            assert len(tables) == self.dbconnector.shardsize
-        # Purge each table in turn, summing rowcounts.
+        The items for each tombstone are deleted max_per_loop at a time, with
+        a new session for each chunk, so that no lock is held for long however
+        many items there are.  Once they're all gone the tombstone is removed,
+        unless it has been replaced by a newer one in the meantime.
+        """
+        table = "collection_tombstones"
+        logger.info("Purging deleted items from %s", table)
+        t_start = time.time()
+        num_iters = 0
         num_purged = 0
         is_incomplete = False
-        for table in sorted(tables):
-            res = self._purge_items_loop(table, "PURGE_SOME_EXPIRED_ITEMS", {
-                "bso": table,
-                "grace": grace_period,
+        with self._get_or_create_session() as session:
+            tombstones = list(session.query_fetchall("TOMBSTONES", {
+                "maxitems": max_iters,
+            }))
+        for userid, collectionid, tombstone in tombstones:
+            if collectionid == 0:
+                query = "PURGE_TOMBSTONED_STORAGE"
+            else:
+                query = "PURGE_TOMBSTONED_ITEMS"
+            params = {
+                "userid": userid,
+                "collectionid": collectionid,
+                "tombstone": tombstone,
                 "maxitems": max_per_loop,
-            })
-            num_purged += res["num_purged"]
-            is_incomplete = is_incomplete or not res["is_complete"]
+            }
+            # If we got fewer items than we asked for, there are none left.
+            rowcount = max_per_loop
+            while rowcount >= max_per_loop:
+                if num_iters >= max_iters:
+                    logger.debug("Too many iterations, bailing out.")
+                    is_incomplete = True
+                    break
+                num_iters += 1
+                with self._get_or_create_session() as session:
+                    rowcount = session.query(query, params)
+                num_purged += rowcount
+                if throttle is not None:
+                    throttle.consume(rowcount)
+            if is_incomplete:
+                break
+            with self._get_or_create_session() as session:
+                session.query("DELETE_TOMBSTONE", params)
+            # Purging expired items may have counted the deleted ones in
+            # the running totals, so bring them back into line.
+            if self._track_collection_usage:
+                if collectionid == 0:
+                    self._recalculate_total_size(userid)
+                else:
+                    self._recalculate_collection_usage(userid, collectionid)
+        duration = time.time() - t_start
+        logger.info("Purged %d deleted items from %s in %.2f seconds",
+                    num_purged, table, duration)
         return {
+            "table": table,
             "num_purged": num_purged,
             "is_complete": not is_incomplete,
+            "duration": duration,
+            "chunk_size": max_per_loop,
         }
 
-    def _purge_expired_batches(self, grace_period=0, max_per_loop=1000):
-        self._maybe_optimize_table_before_purge("OPTIMIZE_BATCHES_TABLE")
-        res = self._purge_items_loop("batch_uploads", "PURGE_BATCHES", {
-            "lifetime": BATCH_LIFETIME,
-            "grace": grace_period,
-            "maxitems": max_per_loop,
-        })
-        self._maybe_optimize_table_after_purge("OPTIMIZE_BATCHES_TABLE")
-        return res
+    def _get_purge_checkpoint(self, table, kwds):
+        """Get the saved progress of purging expired items from a table.
 
-    def _purge_expired_batch_items(self, grace_period=0, max_per_loop=1000):
-        # Get the set of all BUI tables in the database.
-        # This will be different depending on whether sharding is done.
-        if not self.dbconnector.shard:
-            tables = set(("batch_upload_items",))
-        else:
-            tables = set(self.dbconnector.get_batch_item_table(i).name
-                         for i in xrange(self.dbconnector.shardsize))
-            assert len(tables) == self.dbconnector.shardsize
-        # Purge each table in turn, summing rowcounts.
-        num_purged = 0
-        is_incomplete = False
-        for table in sorted(tables):
-            self._maybe_optimize_table_before_purge("OPTIMIZE_BUI_TABLE", {
-                "bui": table
-            })
-            res = self._purge_items_loop(table, "PURGE_BATCH_CONTENTS", {
-                "bui": table,
-                "lifetime": BATCH_LIFETIME,
-                "grace": grace_period,
-                "maxitems": max_per_loop,
-            })
-            num_purged += res["num_purged"]
-            is_incomplete = is_incomplete or not res["is_complete"]
-            self._maybe_optimize_table_after_purge("OPTIMIZE_BUI_TABLE", {
-                "bui": table
+        The checkpoint records a "watermark" key below which all expired items
+        have already been purged, the chunk size reached by the previous purge
+        and the number of rows purged since the table was last optimized.
+        If the chunk size is not being tuned then it's taken from kwds.
+        """
+        with self._get_or_create_session() as session:
+            row = session.query_fetchone("GET_PURGE_CHECKPOINT", {
+                "tablename": table,
             })
-        return {
-            "num_purged": num_purged,
-            "is_complete": not is_incomplete,
+        checkpoint = {
+            "tablename": table,
+            "watermark": 0,
+            "chunk_size": kwds["max_per_loop"],
+            "num_unoptimized": 0,
         }
-
-    def _purge_items_loop(self, table, query, params):
-        """Helper function to incrementally purge items in a loop."""
+        if row is not None:
+            checkpoint["watermark"] = row[0]
+            checkpoint["num_unoptimized"] = row[2]
+            if kwds.get("target_latency"):
+                checkpoint["chunk_size"] = row[1]
+        return checkpoint
+
+    def _save_purge_checkpoint(self, session, checkpoint):
+        """Save the progress of purging expired items from a table."""
+        session.insert_or_update("purge_checkpoints", [checkpoint],
+                                 count_created=False)
+
+    def _purge_items_loop(self, checkpoint, end, query, next_query, params,
+                          affected_query=None, max_per_loop=1000,
+                          throttle=None, target_latency=0,
+                          max_iters=MAX_PURGE_ITERS):
+        """Helper function to incrementally purge items in a loop.
+
+        Items are purged in chunks, in order of increasing key, from the
+        watermark in the given checkpoint up to the given end key.  The key
+        of the first item remaining after each chunk is found by next_query,
+        and becomes the new watermark.  The checkpoint is saved along with
+        each chunk, so that the next purge can continue from where this one
+        left off if it's cut short.
+
+        If target_latency is given then each chunk is resized, within limits,
+        to make its queries take roughly that many seconds.  If a RateLimiter
+        is given as "throttle" then it will be used to pace the successive
+        deletes.  The result includes the name of the table and the time
+        taken to purge it, for progress reporting.
+
+        If affected_query is given then it is run before deleting each chunk,
+        to find the (userid, collection) pairs whose running totals should be
+        recalculated once the chunk has been deleted.
+        """
         # Purge some items, a few at a time, in a loop.
         # We set an upper limit on the number of iterations, to avoid
         # getting stuck indefinitely on a single table.
+        table = checkpoint["tablename"]
         logger.info("Purging expired items from %s", table)
-        MAX_ITERS = 100
-        num_iters = 1
+        t_start = time.time()
+        params = dict(params, end=end)
+        num_iters = 0
         num_purged = 0
         is_incomplete = False
-        # Note that we take a new session for each run of the query.
-        # This avoids holding open a long-running transaction, so
-        # the incrementality can let other jobs run properly.
-        with self._get_or_create_session() as session:
-            params["now"] = int(session.timestamp)
-            rowcount = session.query(query, params)
-        while rowcount > 0:
-            num_purged += rowcount
-            logger.debug("After %d iterations, %s items purged",
-                         num_iters, num_purged)
-            num_iters += 1
-            if num_iters > MAX_ITERS:
+        while checkpoint["watermark"] < end:
+            if num_iters >= max_iters:
                 logger.debug("Too many iterations, bailing out.")
                 is_incomplete = True
                 break
+            num_iters += 1
+            params["start"] = checkpoint["watermark"]
+            params["maxitems"] = checkpoint["chunk_size"]
+            # Note that we take a new session for each chunk.
+            # This avoids holding open a long-running transaction, so
+            # the incrementality can let other jobs run properly.
+            t_chunk = time.time()
+            affected = ()
             with self._get_or_create_session() as session:
+                if affected_query is not None:
+                    affected = list(session.query_fetchall(affected_query,
+                                                           params))
                 rowcount = session.query(query, params)
-        logger.info("Purged %d expired items from %s", num_purged, table)
+                # If we got fewer items than we asked for, there are none
+                # left before the end key.  Otherwise there might be more.
+                watermark = None
+                if rowcount >= params["maxitems"]:
+                    watermark = session.query_scalar(next_query, params)
+                if watermark is None:
+                    watermark = end
+                checkpoint["watermark"] = watermark
+                checkpoint["num_unoptimized"] += rowcount
+                if target_latency and rowcount >= params["maxitems"]:
+                    t_chunk = time.time() - t_chunk
+                    checkpoint["chunk_size"] = self._get_purge_chunk_size(
+                        params["maxitems"], t_chunk, target_latency)
+                self._save_purge_checkpoint(session, checkpoint)
+            for userid, collectionid in affected:
+                self._recalculate_collection_usage(userid, collectionid)
+            num_purged += rowcount
+            logger.debug("After %d iterations, %s items purged from %s",
+                         num_iters, num_purged, table)
+            if throttle is not None:
+                throttle.consume(rowcount)
+        duration = time.time() - t_start
+        logger.info("Purged %d expired items from %s in %.2f seconds",
+                    num_purged, table, duration)
         # We use "is_incomplete" rather than "is_complete" in the code above
         # because we expect that, most of the time, the purge will complete.
         # So it's more efficient to flag the case when it doesn't.
         # But the caller really wants to know is_complete.
         return {
+            "table": table,
             "num_purged": num_purged,
             "is_complete": not is_incomplete,
+            "duration": duration,
+            "chunk_size": checkpoint["chunk_size"],
+        }
+
+    def _get_purge_chunk_size(self, chunk_size, duration, target_latency):
+        """Get the size of the next chunk of items to purge.
+
+        The size is scaled so that the chunk should take target_latency
+        seconds, assuming that time is proportional to the number of items.
+        It's not allowed to change by more than a factor of two at a time,
+        to damp out the effect of any one unusually fast or slow query.
+        """
+        scale = target_latency / max(duration, 0.001)
+        scale = min(max(scale, 0.5), 2.0)
+        chunk_size = int(chunk_size * scale)
+        return min(max(chunk_size, MIN_PURGE_CHUNK_SIZE), MAX_PURGE_CHUNK_SIZE)
+
+    def recompress_payloads(self, max_per_loop=1000):
+        """Re-encode all stored payloads to match the compression setting.
+
+        This compresses the payloads of existing items that would have been
+        compressed if they were written now, and decompresses any that would
+        not.  Items are processed a chunk of max_per_loop at a time, with a
+        separate transaction for each chunk.  Batch uploads are not touched,
+        since they are short-lived.
+        """
+        if not self.dbconnector.compressed_payloads:
+            msg = "payload_compression_threshold is not set"
+            raise ValueError(msg)
+        summary = {
+            "num_checked": 0,
+            "num_recompressed": 0,
+            "tables": {},
+        }
+        for partition in xrange(self.dbconnector.num_partitions):
+            for table in self._get_sharded_table_names("bso"):
+                res = self._run_in_partition(
+                    partition, self._recompress_payloads_in_table,
+                    table, max_per_loop)
+                summary["num_checked"] += res["num_checked"]
+                summary["num_recompressed"] += res["num_recompressed"]
+                table = self._get_partition_table_name(partition, table)
+                summary["tables"][table] = res
+        return summary
+
+    def _recompress_payloads_in_table(self, table, max_per_loop):
+        """Re-encode the stored payloads of all items in the given table."""
+        logger.info("Recompressing payloads in %s", table)
+        t_start = time.time()
+        params = {
+            "bso": table,
+            "userid": -1,
+            "collection": -1,
+            "id": "",
+            "maxitems": max_per_loop,
+        }
+        num_checked = 0
+        num_recompressed = 0
+        while True:
+            with self._get_or_create_session() as session:
+                rows = list(session.query_fetchall("ITEM_PAYLOADS_PAGE",
+                                                   params))
+                for row in rows:
+                    was_compressed = row["payload_compressed"] is not None
+                    if was_compressed:
+                        payload = decompress_payload(row["payload_compressed"])
+                    else:
+                        payload = row["payload"]
+                    encoded = {}
+                    self._encode_payload(encoded, payload)
+                    if (encoded["payload_compressed"] is not None) == \
+                            was_compressed:
+                        continue
+                    num_recompressed += session.query("SET_ITEM_PAYLOAD", {
+                        "bso": table,
+                        "userid": row["userid"],
+                        "collection": row["collection"],
+                        "id": row["id"],
+                        "modified": row["modified"],
+                        "payload": encoded["payload"],
+                        "payload_compressed": encoded["payload_compressed"],
+                    })
+            num_checked += len(rows)
+            logger.debug("Checked %d items in %s, recompressed %d",
+                         num_checked, table, num_recompressed)
+            if len(rows) < max_per_loop:
+                break
+            params["userid"] = rows[-1]["userid"]
+            params["collection"] = rows[-1]["collection"]
+            params["id"] = rows[-1]["id"]
+        duration = time.time() - t_start
+        logger.info("Recompressed %d of %d payloads in %s in %.2f seconds",
+                    num_recompressed, num_checked, table, duration)
+        return {
+            "table": table,
+            "num_checked": num_checked,
+            "num_recompressed": num_recompressed,
+            "duration": duration,
+        }
+
+    def get_load(self):
+        """Get the fraction of pooled database connections in use.
+
+        If users are partitioned, this is the figure for the busiest one.
+        """
+        return self.dbconnector.get_pool_load()
+
+    def get_shard_stats(self, num_top_users=0):
+        """Get per-shard statistics, for deciding how to rebalance them.
+
+        This returns a list with a dict for each BSO table, giving the number
+        of rows, users and payload bytes that it holds.  If num_top_users is
+        given, each dict also lists the (userid, rows, bytes) of the users
+        storing the most bytes in that table.  Every table is scanned in full,
+        so this can be slow on a large database.
+
+        If users are partitioned across several databases, there is a dict
+        for each table in each partition, ordered by partition.
+        """
+        if not self.dbconnector.shard:
+            tables = ["bso"]
+        else:
+            tables = [get_sharded_table(i, "bso").name
+                      for i in xrange(self.dbconnector.shardsize)]
+        stats = []
+        for partition in xrange(self.dbconnector.num_partitions):
+            for shard, table in enumerate(tables):
+                table_stats = self._run_in_partition(
+                    partition, self._get_table_stats, table, num_top_users)
+                table_stats["partition"] = partition
+                table_stats["shard"] = shard
+                stats.append(table_stats)
+        return stats
+
+    def _get_table_stats(self, table, num_top_users=0):
+        """Get the statistics for a single BSO table."""
+        with self._get_or_create_session() as session:
+            row = session.query_fetchone("SHARD_STATS", {"bso": table})
+            table_stats = {
+                "table": table,
+                "num_rows": int(row[0]),
+                "num_users": int(row[1]),
+                "num_bytes": int(row[2]),
+            }
+            if num_top_users:
+                rows = session.query_fetchall("SHARD_TOP_USERS", {
+                    "bso": table,
+                    "limit": num_top_users,
+                })
+                table_stats["top_users"] = [
+                    (user[0], int(user[1]), int(user[2])) for user in rows
+                ]
+        return table_stats
+
+    def get_user_shard(self, userid):
+        """Get the index of the BSO table shard holding the user's items."""
+        if not self.dbconnector.shard:
+            raise RuntimeError("Sharding is not enabled")
+        with self._get_or_create_session() as session:
+            return session.get_user_shard(userid)
+
+    def move_user(self, userid, shard, max_per_loop=1000):
+        """Move the user's items into the given BSO table shard.
+
+        This requires per-user shard lookups to be enabled.  The user's items
+        are copied into the new table in chunks of max_per_loop, each in its
+        own transaction, while the user remains free to read and write them
+        in the old table.  Then all of the user's collections are locked for
+        writing, as by lock_for_write(), to copy over any changes made in the
+        meantime and switch the user's entry in the shard map.  Finally the
+        items are deleted from the old table, one collection at a time.
+
+        Every write to a collection moves its timestamp forward, so the
+        timestamps are recorded before the copy begins.  Only collections
+        whose timestamps have changed since then, or that have been created
+        or deleted, need to be brought up to date while the lock is held.
+
+        If interrupted, the move can safely be restarted from the beginning;
+        items that were already copied will not be copied again.
+        """
+        if not self.dbconnector.shard_lookup:
+            raise RuntimeError("Per-user shard lookups are not enabled")
+        if not 0 <= shard < self.dbconnector.shardsize:
+            raise ValueError("Invalid shard: %r" % (shard,))
+        # Ensure the user has an entry in the shard map.  This gives any
+        # concurrent lookups a row to wait on while we switch shards.
+        with self._get_or_create_session() as session:
+            src_shard = session.get_user_shard(userid)
+            session.insert_or_update("user_shards", [{
+                "userid": userid,
+                "shard": src_shard,
+            }], count_created=False)
+        summary = {
+            "userid": userid,
+            "from_shard": src_shard,
+            "to_shard": shard,
+            "num_copied": 0,
+            "num_deleted": 0,
+        }
+        if src_shard == shard:
+            return summary
+        params = {
+            "userid": userid,
+            "bso": get_sharded_table(src_shard, "bso").name,
+            "dst": get_sharded_table(shard, "bso").name,
+            "start_collection": -1,
+            "start_id": "",
         }
+        # Note the collection timestamps, then clear out anything left behind
+        # by an earlier move that has since changed.
+        with self._get_or_create_session() as session:
+            timestamps = dict(session.query_fetchall("COLLECTIONS_TIMESTAMPS",
+                                                     params))
+            session.query("DELETE_STALE_USER_ITEMS", params)
+        # Copy the items across in chunks, while the user remains active.
+        while True:
+            with self._get_or_create_session() as session:
+                end = session.query_fetchone("NEXT_USER_ITEM_KEY", dict(
+                    params, offset=max_per_loop - 1))
+                if end is None:
+                    query = "COPY_REMAINING_USER_ITEMS"
+                    copy_params = params
+                else:
+                    query = "COPY_USER_ITEMS"
+                    copy_params = dict(params, end_collection=end[0],
+                                       end_id=end[1])
+                summary["num_copied"] += session.query(query, copy_params)
+            if end is None:
+                break
+            params["start_collection"], params["start_id"] = end
+            logger.debug("Copied %d items for user %d",
+                         summary["num_copied"], userid)
+        # Lock the user, catch up with any concurrent changes, and switch.
+        with self._get_or_create_session() as session:
+            session.query("BEGIN_TRANSACTION_WRITE", params)
+            locked_timestamps = dict(session.query_fetchall(
+                "LOCK_USER_COLLECTIONS_WRITE", params))
+            if session.query_scalar("LOCK_USER_SHARD_WRITE",
+                                    params) != src_shard:
+                raise ConflictError
+            seen_collectionids = set(timestamps) | set(locked_timestamps)
+            for collectionid in sorted(seen_collectionids):
+                if timestamps.get(collectionid) == \
+                        locked_timestamps.get(collectionid):
+                    continue
+                collection_params = dict(params, collectionid=collectionid)
+                session.query("DELETE_STALE_COLLECTION_ITEMS",
+                              collection_params)
+                summary["num_copied"] += session.query(
+                    "COPY_COLLECTION_ITEMS", collection_params)
+            session.insert_or_update("user_shards", [{
+                "userid": userid,
+                "shard": shard,
+            }], count_created=False)
+        logger.debug("Switched user %d from shard %d to shard %d",
+                     userid, src_shard, shard)
+        # Clean up the items left in the old table.
+        with self._get_or_create_session() as session:
+            collectionids = [row[0] for row in session.query_fetchall(
+                "USER_COLLECTIONS_IN_TABLE", params)]
+        for collectionid in collectionids:
+            with self._get_or_create_session() as session:
+                summary["num_deleted"] += session.query(
+                    "DELETE_COLLECTION_ITEMS", {
+                        "bso": params["bso"],
+                        "userid": userid,
+                        "collectionid": collectionid,
+                    })
+        return summary
+
+    def _recalculate_collection_usage(self, userid, collectionid):
+        """Recalculate the running totals of items in a collection.
+
+        This takes the same lock as a write to the collection, so that the
+        recalculation can't race with concurrent updates to the totals.
+        """
+        params = {"userid": userid, "collectionid": collectionid}
+        with self._get_or_create_session() as session:
+            session.query("BEGIN_TRANSACTION_WRITE", params)
+            session.query_scalar("LOCK_COLLECTION_WRITE", params)
+            if self._async_deletes:
+                query = "LIVE_RECALCULATE_COLLECTION_USAGE"
+            else:
+                query = "RECALCULATE_COLLECTION_USAGE"
+            session.query(query, params)
 
-    def _maybe_optimize_table_before_purge(self, query, params={}):
+    def _maybe_optimize_table_before_purge(self, checkpoint, query,
+                                           params={}):
         """Run an `OPTIMIZE TABLE` if configured to do so before purge.
 
         Purging expired items involves doing a bunch of in-order deletes,
@@ -853,16 +1993,17 @@ class SQLStorage(SyncStorage):
 
           https://www.percona.com/blog/2015/02/11/tokudb-table-optimization-improvements/
 
-        We run an `OPTIMIZE TABLE` before each purge so that the purge will
-        not get stuck churning on already-deleted garbage, but we allow it to
-        be preffed off if necessary for operational reasons.
+        We run an `OPTIMIZE TABLE` before a purge so that the purge will
+        not get stuck churning on already-deleted garbage, but only if enough
+        rows have been purged since it was last optimized to make it worth
+        the cost.  We allow it to be preffed off if necessary for operational
+        reasons.
         """
         if self._optimize_table_before_purge:
-            if self.dbconnector.driver == "mysql":
-                with self._get_or_create_session() as session:
-                    session.query(query, params)
+            self._maybe_optimize_table(checkpoint, query, params)
 
-    def _maybe_optimize_table_after_purge(self, query, params={}):
+    def _maybe_optimize_table_after_purge(self, checkpoint, query,
+                                          params={}):
         """Run an `OPTIMIZE TABLE` if configured to do so after purge.
 
         Purging expired items involves doing a bunch of in-order deletes,
@@ -871,30 +2012,57 @@ class SQLStorage(SyncStorage):
 
           https://www.percona.com/blog/2015/02/11/tokudb-table-optimization-improvements/
 
-        We run an `OPTIMIZE TABLE` after each purge to keep this in check,
-        but allow it to be preffed off if necessary for operational reasons.
+        We run an `OPTIMIZE TABLE` after a purge that has deleted enough rows
+        to keep this in check, but allow it to be preffed off if necessary
+        for operational reasons.
         """
         if self._optimize_table_after_purge:
-            if self.dbconnector.driver == "mysql":
-                with self._get_or_create_session() as session:
-                    session.query(query, params)
+            self._maybe_optimize_table(checkpoint, query, params)
+
+    def _maybe_optimize_table(self, checkpoint, query, params):
+        """Run an `OPTIMIZE TABLE` if enough rows have been purged from it.
+
+        The count of rows purged since the last optimization is kept in the
+        table's purge checkpoint, and is reset once it has been optimized.
+        """
+        if self.dbconnector.driver != "mysql":
+            return
+        if checkpoint["num_unoptimized"] < self._optimize_table_min_rows:
+            return
+        with self._get_or_create_session() as session:
+            session.query(query, params)
+            checkpoint["num_unoptimized"] = 0
+            self._save_purge_checkpoint(session, checkpoint)
 
     #
     # Private methods for manipulating collections.
     #
 
-    def _get_collection_id(self, session, collection, create=False):
+    def _get_collection_id(self, session, collection, create=False,
+                           read=False):
         """Returns a collection id, given the name.
 
         If the named collection does not exist then CollectionNotFoundError
         will be raised.  To automatically create collections on demand, pass
-        create=True.
+        create=True.  Pure reads should pass read=True, which lets them use
+        and update the short-lived cache of missing collection names; writes
+        always check the database.
         """
         # Grab it from the cache if we can.
         try:
-            return self._collections_by_name[collection]
+            collectionid = self._collections_by_name[collection]
         except KeyError:
             pass
+        else:
+            annotate_request(None, COLLECTIONS_CACHE_METRIC + ".hit", 1)
+            return collectionid
+
+        # Reads can also skip the database if we recently found that
+        # the collection doesn't exist.
+        if read and self._is_missing_collection(collection):
+            annotate_request(None, COLLECTIONS_CACHE_METRIC + ".missing", 1)
+            raise CollectionNotFoundError
+        annotate_request(None, COLLECTIONS_CACHE_METRIC + ".miss", 1)
 
         # Try to look it up in the database.
         collectionid = session.query_scalar("COLLECTION_ID", {
@@ -903,6 +2071,8 @@ class SQLStorage(SyncStorage):
         if collectionid is None:
             # Shall we auto-create it?
             if not create:
+                if read:
+                    self._cache_missing_collection(collection)
                 raise CollectionNotFoundError
             # Insert it into the database.  This might raise a conflict
             # if it was inserted concurrently by someone else.
@@ -914,6 +2084,7 @@ class SQLStorage(SyncStorage):
                 if self.dbconnector.driver == "postgres":
                     raise
             # Read the id that was created concurrently.
+            self._missing_collections.pop(collection)
             collectionid = self._get_collection_id(session, collection)
 
         # Sanity-check that we"re not trampling standard collection ids.
@@ -930,10 +2101,14 @@ class SQLStorage(SyncStorage):
         will be raised.
         """
         try:
-            return self._collections_by_id[collectionid]
+            collection = self._collections_by_id[collectionid]
         except KeyError:
             pass
+        else:
+            annotate_request(None, COLLECTIONS_CACHE_METRIC + ".hit", 1)
+            return collection
 
+        annotate_request(None, COLLECTIONS_CACHE_METRIC + ".miss", 1)
         collection = session.query_scalar("COLLECTION_NAME", {
             "collectionid": collectionid,
         })
@@ -962,8 +2137,13 @@ class SQLStorage(SyncStorage):
                 names[id] = self._collections_by_id[id]
             except KeyError:
                 uncached_ids.append(id)
+        if names:
+            annotate_request(None, COLLECTIONS_CACHE_METRIC + ".hit",
+                             len(names))
         # Use a single query to fetch the names for all uncached collections.
         if uncached_ids:
+            annotate_request(None, COLLECTIONS_CACHE_METRIC + ".miss",
+                             len(uncached_ids))
             uncached_names = session.query_fetchall("COLLECTION_NAMES", {
                 "ids": uncached_ids,
             })
@@ -991,13 +2171,52 @@ class SQLStorage(SyncStorage):
 
     def _cache_collection_id(self, collectionid, collection):
         """Cache the given collection (id, name) pair for fast lookup."""
-        if len(self._collections_by_name) > MAX_COLLECTIONS_CACHE_SIZE:
-            msg = "More than %d collections have been created, "\
-                  "refusing to cache them all"
-            logger.warn(msg % (MAX_COLLECTIONS_CACHE_SIZE,))
-        else:
-            self._collections_by_name[collection] = collectionid
-            self._collections_by_id[collectionid] = collection
+        self._collections_by_name[collection] = collectionid
+        self._collections_by_id[collectionid] = collection
+        self._missing_collections.pop(collection)
+
+    def _cache_missing_collection(self, collection):
+        """Remember, for a short while, that the named collection is missing.
+
+        Collections are never deleted once created, so this can only become
+        stale if the collection is created by another process.  That happens
+        once for each custom collection name, and reads in other processes
+        will then fail for at most missing_collections_cache_ttl seconds.
+        """
+        if self._missing_collections_ttl > 0:
+            expiry = time.time() + self._missing_collections_ttl
+            self._missing_collections[collection] = expiry
+
+    def _is_missing_collection(self, collection):
+        """Check whether the named collection was recently found missing."""
+        expiry = self._missing_collections.get(collection)
+        if expiry is None:
+            return False
+        if expiry < time.time():
+            self._missing_collections.pop(collection)
+            return False
+        return True
+
+    def _preload_collections_cache(self):
+        """Prime the collection name cache with the most-used collections.
+
+        This uses a single query against the main database.  Errors are
+        logged rather than raised, since the cache will fill up on demand
+        anyway and a failure here should not prevent startup.
+        """
+        try:
+            with self.dbconnector.connect() as connection:
+                rows = list(connection.query_fetchall(
+                    "MOST_USED_COLLECTIONS", {
+                        "limit": self._collections_by_name.max_size,
+                    }))
+        except Exception:
+            logger.exception("Failed to preload the collection names cache")
+            return
+        # Cache the most-used collections last, so they're evicted last.
+        for collectionid, collection in reversed(rows):
+            self._cache_collection_id(collectionid, collection)
+        logger.debug("Preloaded %d collection names", len(rows))
 
 
 class SQLStorageSession(object):
@@ -1010,14 +2229,33 @@ class SQLStorageSession(object):
         * the "current time" on the server during the snapshot
         * the set of currently-locked collections
 
+    If the storage partitions its users across several databases, then the
+    session opens a connection to each partition as it's needed, based on
+    the userid of each query.  Queries without a userid go to the main
+    database.  If a partition is given then all queries go to it instead.
+
+    Every connection made by the session shares the deadline of the active
+    request, if there is one, and will fail with DeadlineExceededError rather
+    than run a query past it.
+
     """
 
-    def __init__(self, storage, timestamp=None):
+    def __init__(self, storage, timestamp=None, read_only=False,
+                 partition=None):
         self.storage = storage
-        self.connection = storage.dbconnector.connect()
+        self.partition = partition
+        self.deadline = get_request_deadline()
+        self.connection = storage.dbconnector.connect(read_only,
+                                                      partition or 0,
+                                                      self.deadline)
         self.timestamp = get_timestamp(timestamp)
         self.cache = defaultdict(SQLCachedCollectionData)
         self.locked_collections = {}
+        self.optimistic_locks = {}
+        self.written_userids = set()
+        self.user_shards = {}
+        self.user_partitions = {}
+        self._partition_connections = {}
         self._nesting_level = 0
 
     def __enter__(self):
@@ -1031,34 +2269,136 @@ class SQLStorageSession(object):
             self.rollback()
 
     @convert_db_errors
-    def insert_or_update(self, table, items, defaults=None):
+    def insert_or_update(self, table, items, defaults=None,
+                         count_created=True):
         """Do a bulk insert/update of the given items."""
         assert self._nesting_level > 0, "Session has not been started"
-        return self.connection.insert_or_update(table, items, defaults)
+        userid = items[0].get("userid") if items else None
+        if table == "bso" and items and self.storage.dbconnector.shard_lookup:
+            table = self.get_bso_table_name(userid)
+        connection = self.get_connection(userid)
+        return connection.insert_or_update(table, items, defaults,
+                                           count_created=count_created)
 
     @convert_db_errors
     def query(self, query, params={}):
         """Execute a database query, returning the rowcount."""
         assert self._nesting_level > 0, "Session has not been started"
-        return self.connection.query(query, params)
+        params = self.resolve_tables(query, params)
+        connection = self.get_connection(params.get("userid"))
+        return connection.query(query, params)
 
     @convert_db_errors
     def query_scalar(self, query, params={}, default=None):
         """Execute a database query, returning a single scalar value."""
         assert self._nesting_level > 0, "Session has not been started"
-        return self.connection.query_scalar(query, params, default)
+        params = self.resolve_tables(query, params)
+        connection = self.get_connection(params.get("userid"))
+        return connection.query_scalar(query, params, default)
 
     @convert_db_errors
     def query_fetchone(self, query, params={}):
         """Execute a database query, returning the first result."""
         assert self._nesting_level > 0, "Session has not been started"
-        return self.connection.query_fetchone(query, params)
+        params = self.resolve_tables(query, params)
+        connection = self.get_connection(params.get("userid"))
+        return connection.query_fetchone(query, params)
 
     @convert_db_errors
     def query_fetchall(self, query, params={}):
         """Execute a database query, returning iterator over the results."""
         assert self._nesting_level > 0, "Session has not been started"
-        return self.connection.query_fetchall(query, params)
+        params = self.resolve_tables(query, params)
+        connection = self.get_connection(params.get("userid"))
+        return connection.query_fetchall(query, params)
+
+    def resolve_tables(self, query, params):
+        """Fill in the name of the user's BSO table for the given query.
+
+        With per-user shard lookups, the user's BSO table can only be found
+        by asking the database.  This returns a copy of the given params with
+        the table name filled in if the query needs it, or the params
+        unchanged if there's nothing to do.
+        """
+        if "bso" in params or params.get("userid") is None:
+            return params
+        if not self.storage.dbconnector.shard_lookup:
+            return params
+        if not self.storage.dbconnector.uses_bso_table(query):
+            return params
+        return dict(params, bso=self.get_bso_table_name(params["userid"]))
+
+    def get_user_shard(self, userid):
+        """Get the index of the BSO table shard holding the user's items.
+
+        With per-user shard lookups this takes a shared lock on the user's
+        entry in the user_shards table, and so will wait for any concurrent
+        move of the user to finish.  The result is cached on the session.
+        """
+        try:
+            return self.user_shards[userid]
+        except KeyError:
+            pass
+        dbconnector = self.storage.dbconnector
+        shard = None
+        if dbconnector.shard_lookup:
+            connection = self.get_connection(userid)
+            if connection.is_replica:
+                query = "USER_SHARD"
+            else:
+                query = "LOCK_USER_SHARD_READ"
+            shard = connection.query_scalar(query, {"userid": userid})
+        if shard is None:
+            shard = dbconnector.shard_map.get_shard(userid)
+        self.user_shards[userid] = shard
+        return shard
+
+    def get_bso_table_name(self, userid):
+        """Get the name of the BSO table holding the user's items."""
+        return get_sharded_table(self.get_user_shard(userid), "bso").name
+
+    def get_connection(self, userid=None):
+        """Get the connection to use for queries about the given user.
+
+        This is the session's main connection unless users are partitioned,
+        in which case a connection to the user's partition is opened on
+        first use and kept for the rest of the session.
+        """
+        if userid is None or self.partition is not None:
+            return self.connection
+        if self.storage.dbconnector.num_partitions == 1:
+            return self.connection
+        partition = self.get_user_partition(userid)
+        if partition == self.connection.partition:
+            return self.connection
+        try:
+            return self._partition_connections[partition]
+        except KeyError:
+            connection = self.storage.dbconnector.connect(
+                partition=partition, deadline=self.deadline)
+            self._partition_connections[partition] = connection
+            return connection
+
+    def get_user_partition(self, userid):
+        """Get the index of the database partition holding the user's data.
+
+        With per-user partition lookups this checks the user_partitions table
+        in the main database.  The result is cached on the session.
+        """
+        try:
+            return self.user_partitions[userid]
+        except KeyError:
+            pass
+        dbconnector = self.storage.dbconnector
+        partition = None
+        if dbconnector.partition_lookup:
+            partition = self.connection.query_scalar("USER_PARTITION", {
+                "userid": userid,
+            })
+        if partition is None:
+            partition = dbconnector.partition_map.get_shard(userid)
+        self.user_partitions[userid] = partition
+        return partition
 
     def begin(self):
         """Enter the context of this session.
@@ -1083,9 +2423,10 @@ class SQLStorageSession(object):
         assert self._nesting_level >= 0
         if self._nesting_level == 0:
             try:
-                self.connection.commit()
+                self._end_transactions(commit=True)
             finally:
                 del self.storage._tldata.session
+            self.storage._note_recent_writers(self.written_userids)
             if self.locked_collections:
                 msg = "You must unlock all collections before ending a session"
                 raise RuntimeError(msg)
@@ -1101,20 +2442,93 @@ class SQLStorageSession(object):
         assert self._nesting_level >= 0
         if self._nesting_level == 0:
             try:
-                self.connection.rollback()
+                self._end_transactions(commit=False)
             finally:
                 del self.storage._tldata.session
             if self.locked_collections:
                 msg = "You must unlock all collections before ending a session"
                 raise RuntimeError(msg)
 
+    def _end_transactions(self, commit):
+        """Commit or rollback the transaction on each open connection.
+
+        The main connection is ended first, so that any newly-created
+        collection ids are committed before the data that refers to them.
+        If any commit fails then the remaining transactions are rolled back,
+        and the first error is re-raised.
+        """
+        connections = [self.connection]
+        connections.extend(self._partition_connections.itervalues())
+        self._partition_connections = {}
+        exc_info = None
+        for connection in connections:
+            try:
+                if commit and exc_info is None:
+                    connection.commit()
+                else:
+                    connection.rollback()
+            except Exception:
+                if exc_info is None:
+                    exc_info = sys.exc_info()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+
+class SQLItemStream(object):
+    """Lazily-produced BSOs from a streaming FIND_ITEMS query.
+
+    Iterating this object produces BSOs one at a time as the corresponding
+    rows arrive from the database.  The query runs on its own connection,
+    which is released once all the rows have been read.  If iteration is
+    abandoned part-way through, e.g. because the client disconnected, then
+    close() must be called to discard the connection; as a last resort
+    this will also happen when the object is garbage-collected.
+    """
+
+    def __init__(self, storage, connection, rows, timestamp):
+        self.storage = storage
+        self._connection = connection
+        self._rows = rows
+        self._timestamp = timestamp
+
+    def __iter__(self):
+        if self._connection is None:
+            raise RuntimeError("SQLItemStream has already been consumed")
+        try:
+            for row in self._rows:
+                yield self.storage._row_to_bso(row, self._timestamp)
+        except BaseException:
+            self.close()
+            raise
+        # All rows were read, so the connection can go back to the pool.
+        connection, self._connection = self._connection, None
+        self._rows = None
+        connection.commit()
+
+    def close(self):
+        """Stop the stream and release its database connection."""
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            # Discard rather than drain the unread remainder of the results.
+            try:
+                connection.abort()
+            finally:
+                self._rows = None
+
+    def __del__(self):
+        self.close()
+
 
 class SQLCachedCollectionData(object):
     """Object for storing cached information about a collection.
 
     The SQLStorageSession object maintains a small cache of data that has
-    already been looked up during that session.  Currently this includes only
-    the last-modified timestamp of any collections locked by that session.
+    already been looked up during that session.  Currently this includes
+    the last-modified timestamp of any collections locked by that session,
+    whether those collections exist and the tombstone covering any deleted
+    items, which lets us skip the queries to look these things up again.
     """
     def __init__(self):
         self.last_modified = None
+        self.exists = None
+        self.tombstone = None
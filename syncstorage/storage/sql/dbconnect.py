@@ -14,13 +14,23 @@ backend.  It provides three database tables:
 
 For efficiency when dealing with large datasets, this module also supports
 sharding of the BSO items into multiple tables named "bso0" through "bsoN".
-This behaviour is off by default; pass shard=True to enable it.
+This behaviour is off by default; pass shard=True to enable it.  The table
+for each user is chosen by a shard map, optionally overridden per-user by
+entries in the user_shards table; see the sharding module for details.
+
+Users can also be partitioned across several database servers, each holding
+a full set of these tables for its own users.  The "collections" table in the
+main database remains the authority for collection names and ids.
 """
 
 import os
 import re
 import sys
+import math
 import copy
+import time
+import random
+import threading
 import logging
 import urlparse
 import traceback
@@ -31,19 +41,26 @@ import sqlalchemy.event
 from sqlalchemy import create_engine
 from sqlalchemy.util.queue import Queue
 from sqlalchemy.pool import NullPool, QueuePool
-from sqlalchemy.sql import insert, update, text as sqltext
+from sqlalchemy.sql import (insert, update, select, func, and_, or_,
+                            text as sqltext)
 from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError
-from sqlalchemy import (Integer, String, Text, BigInteger,
+from sqlalchemy import (Integer, String, Text, BigInteger, LargeBinary,
                         MetaData, Column, Table, Index)
 from sqlalchemy.dialects import postgresql, mysql
 
+from pyramid.settings import aslist
+
 from mozsvc.metrics import metrics_timer, annotate_request
 from mozsvc.exceptions import BackendError
 
+from syncstorage.util import LRUCache
+from syncstorage.storage import DeadlineExceededError
 from syncstorage.storage.sql import (queries_generic,
                                      queries_sqlite,
                                      queries_postgres,
                                      queries_mysql)
+from syncstorage.storage.sql.sharding import get_shard_map
+from syncstorage.storage.sql.querystats import QueryStats, get_params_shape
 
 
 logger = logging.getLogger(__name__)
@@ -56,9 +73,37 @@ SAFE_FIELD_NAME_RE = re.compile("^[a-zA-Z0-9_]+$")
 SAFE_TO_KILL_QUERY = r"^\s*(/\*.*\*/)?\s*(SELECT|INSERT|UPDATE)\s"
 SAFE_TO_KILL_QUERY = re.compile(SAFE_TO_KILL_QUERY, re.I)
 
+# Regex to match a SELECT statement, so that a MySQL optimizer hint can be
+# inserted directly after the SELECT keyword.
+SELECT_QUERY = re.compile(r"^(\s*SELECT)\b", re.I)
+
+# Number of SQLite virtual machine instructions to execute between checks
+# of whether a statement has run past the deadline of its connection.
+SQLITE_PROGRESS_INTERVAL = 1000
+
+# Keys under which per-connection settings are remembered in the "info"
+# dict of pooled connections, so they can be reset for later users.
+STATEMENT_TIMEOUT_INFO_KEY = "syncstorage.statement_timeout"
+PROGRESS_HANDLER_INFO_KEY = "syncstorage.progress_handler"
+
 # The ttl to use for rows that are never supposed to expire.
 MAX_TTL = 2100000000
 
+# Maximum number of distinct query shapes for which to cache rendered SQL.
+MAX_QUERY_CACHE_SIZE = 1000
+
+# Maximum number of bind parameters to send in a single batch upsert query.
+# This is the default compile-time limit for older versions of SQLite.
+MAX_UPSERT_BIND_PARAMS = 999
+
+# Default size of the memory-mapped I/O region for SQLite in WAL mode, in
+# bytes, and of its page cache, where negative values are in kibibytes.
+DEFAULT_SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+DEFAULT_SQLITE_CACHE_SIZE = -64000
+
+# Permitted values of the SQLite "synchronous" pragma.
+SQLITE_SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
 metadata = MetaData()
 
 
@@ -98,7 +143,13 @@ user_collections = Table(
            autoincrement=False),
     Column("collection", Integer, primary_key=True, nullable=False,
            autoincrement=False),
-    Column("last_modified", BigInteger, nullable=False)
+    Column("last_modified", BigInteger, nullable=False),
+    # Running totals of the items in the collection, which are maintained
+    # only if the storage is configured with track_collection_usage.
+    Column("item_count", Integer, nullable=False,
+           server_default=sqltext("0")),
+    Column("total_bytes", BigInteger, nullable=False,
+           server_default=sqltext("0")),
 )
 
 
@@ -112,6 +163,10 @@ PAYLOAD_TYPE = Text()
 PAYLOAD_TYPE = PAYLOAD_TYPE.with_variant(postgresql.TEXT(), 'postgresql')
 PAYLOAD_TYPE = PAYLOAD_TYPE.with_variant(mysql.MEDIUMTEXT(), 'mysql')
 
+COMPRESSED_PAYLOAD_TYPE = LargeBinary()
+COMPRESSED_PAYLOAD_TYPE = COMPRESSED_PAYLOAD_TYPE.with_variant(
+    mysql.MEDIUMBLOB(), 'mysql')
+
 
 # Common column definitions between BSO and batch upload item tables
 
@@ -127,6 +182,9 @@ def _get_bso_columns(table_name):
         # I'd like to default this to the emptry string, but
         # MySQL doesn't let you set a default on a TEXT column.
         Column("payload", PAYLOAD_TYPE, nullable=False),
+        # Compressed payloads are stored here instead, with an empty payload.
+        # The column is only used if payload compression is configured.
+        Column("payload_compressed", COMPRESSED_PAYLOAD_TYPE, nullable=True),
         Column("payload_size", Integer, nullable=False,
                server_default=sqltext("0")),
         Column("ttl", Integer, nullable=False,
@@ -139,9 +197,11 @@ def _get_bso_columns(table_name):
         # Index on "modified" for easy filtering by timestamp.
         Index("%s_usr_col_mod_idx" % (table_name,),
               "userid", "collection", "modified"),
-        # There is intentinally no index on "sortindex".
-        # Clients almost always filter on "modified" using the above index,
-        # and cannot take advantage of a separate index for sorting.
+        # Index on "sortindex" for keyset pagination in sort=index order.
+        # It includes "id" as a tie-breaker so that each page can seek
+        # directly to the item following the previous one.
+        Index("%s_usr_col_sortidx_idx" % (table_name,),
+              "userid", "collection", "sortindex", "id"),
     )
 
 
@@ -181,6 +241,7 @@ def _get_batch_item_columns(table_name):
         # modification timestamp gets set on batch commit.
         Column("sortindex", Integer, nullable=True),
         Column("payload", PAYLOAD_TYPE, nullable=True),
+        Column("payload_compressed", COMPRESSED_PAYLOAD_TYPE, nullable=True),
         Column("payload_size", Integer, nullable=True),
         Column("ttl_offset", Integer, nullable=True)
     )
@@ -190,6 +251,67 @@ bui = Table("batch_upload_items", metadata,
             *_get_batch_item_columns("batch_upload_items"))
 
 
+# Table mapping table_name => progress of purging expired items.
+#
+# This table records, for each table that has expired items purged from it,
+# the key below which everything has already been purged along with some
+# bookkeeping to help tune the next purge of that table.
+
+purge_checkpoints = Table(
+    "purge_checkpoints",
+    metadata,
+    Column("tablename", String(64), primary_key=True, nullable=False),
+    Column("watermark", BigInteger, nullable=False),
+    Column("chunk_size", Integer, nullable=False),
+    # Number of rows purged since the table was last optimized.
+    Column("num_unoptimized", BigInteger, nullable=False,
+           server_default=sqltext("0")),
+)
+
+
+# Table mapping (user_id, collection_id) => time of deletion.
+#
+# When the storage is configured with async_deletes, deleting a collection
+# removes only its row from user_collections and records a tombstone here.
+# Items modified at or before the tombstone are treated as deleted until
+# they are removed in the background.  A collection id of zero marks the
+# deletion of the user's entire storage.
+
+collection_tombstones = Table(
+    "collection_tombstones",
+    metadata,
+    Column("userid", Integer, primary_key=True, nullable=False,
+           autoincrement=False),
+    Column("collection", Integer, primary_key=True, nullable=False,
+           autoincrement=False),
+    Column("modified", BigInteger, nullable=False),
+)
+
+
+# Per-user overrides of the shard map, used when "shard_lookup" is enabled.
+# Users without an entry here are assigned a shard by the static shard map.
+
+user_shards = Table(
+    "user_shards",
+    metadata,
+    Column("userid", Integer, primary_key=True, nullable=False,
+           autoincrement=False),
+    Column("shard", Integer, nullable=False),
+)
+
+
+# Per-user overrides of the partition map, used when "partition_lookup" is
+# enabled.  This table only exists in the main database.
+
+user_partitions = Table(
+    "user_partitions",
+    metadata,
+    Column("userid", Integer, primary_key=True, nullable=False,
+           autoincrement=False),
+    Column("partitionid", Integer, nullable=False),
+)
+
+
 #  If the storage controller is doing sharding based on userid,
 #  then it will use the below functions to select a table from "bso0"
 #  to "bsoN" for each userid.  Ditto for batch_upload_items.
@@ -226,12 +348,30 @@ def get_batch_item_table(index):
     return get_sharded_table(index, which="batch_upload_items")
 
 
+def get_bso_table_by_name(name):
+    """Get the Table object for the named bso or bso<N> table."""
+    if name == "bso":
+        return bso
+    if not name.startswith("bso") or not name[3:].isdigit():
+        raise ValueError("Invalid BSO table name: %s" % (name,))
+    return get_bso_table(int(name[3:]))
+
+
+# The deadline of the connection that each thread is currently checking out
+# of a pool, if any.  The pool can't be told about it directly, since it is
+# called from deep within SQLAlchemy.
+_checkout_deadline = threading.local()
+
+
 class _QueueWithMaxBacklog(Queue):
     """SQLAlchemy Queue subclass with a limit on the length of the backlog.
 
     This base Queue class sets no limit on the number of threads that can be
     simultaneously blocked waiting for an item on the queue.  This class
     adds a "max_backlog" parameter that can be used to bound this number.
+
+    If the calling thread is checking out a connection on behalf of a
+    request with a deadline, then it will not wait beyond that deadline.
     """
 
     def __init__(self, maxsize=0, max_backlog=-1):
@@ -249,6 +389,11 @@ class _QueueWithMaxBacklog(Queue):
                     if self.cur_backlog > self.max_backlog:
                         block = False
                         timeout = None
+                deadline = getattr(_checkout_deadline, "value", None)
+                if block and deadline is not None:
+                    remaining = max(deadline - time.time(), 0)
+                    if timeout is None or remaining < timeout:
+                        timeout = remaining
                 return Queue.get(self, block, timeout)
             finally:
                 self.cur_backlog -= 1
@@ -291,17 +436,78 @@ class DBConnector(object):
     on top of the SQLAlchemy engine/connection machinery, with the following
     additional features:
 
-        * transparent sharding of BSO storage tables
+        * transparent sharding of BSO storage tables, via a shard map
         * use pre-defined queries rather than inline construction of SQL
         * accessor methods that automatically clean up database resources
         * automatic retry of connections that are invalidated by the server
-
+        * optional routing of read-only connections to database replicas
+        * optional partitioning of users across several database servers
+        * per-query latency statistics and an optional slow-query log
+
+    Read replicas are configured by passing a list of database URIs as
+    "replica_sqluris".  Each replica gets its own connection pool, and is
+    periodically checked for health and replication lag; any replica that
+    cannot be reached or is lagging by more than "replica_max_lag" seconds
+    is ejected from service until a subsequent check finds it healthy again.
+    If no replica is available then read-only connections go to the primary.
+
+    When sharding, "shardsize" tables are created and users are assigned to
+    the first "shard_map_size" of them (by default, all of them) using the
+    static map named by "shard_map", which for a "range" map is split at
+    the userids listed in "shard_boundaries".  If "shard_lookup" is enabled
+    then the user_shards table can override that assignment for individual
+    users.
+    Such lookups need a session to be done consistently with concurrent
+    moves of the user, so get_bso_table() only reflects the static map.
+
+    Partitions are configured by passing a list of additional database URIs
+    as "partition_sqluris".  The main database is partition zero, and each
+    additional database gets its own connection pool and full set of tables.
+    Users are assigned to partitions using the static map named by
+    "partition_map", which defaults to a "range" map split at the userids
+    listed in "partition_boundaries".  If "partition_lookup" is enabled then
+    the user_partitions table in the main database can override that
+    assignment for individual users.  Partitioning cannot be combined with
+    read replicas.
+
+    The time taken and rows returned or affected by each named query are
+    aggregated in "query_stats", which is logged every "query_stats_interval"
+    seconds.  If "slow_query_time" is set then any named query that takes at
+    least that many seconds is also logged individually, along with the
+    shape of its parameters and the BSO table that it used.  On MySQL, a
+    random "slow_query_explain_rate" fraction of slow SELECTs also have their
+    query plan fetched with EXPLAIN and logged.
+
+    For a file-backed SQLite database, "sqlite_wal" switches the database to
+    write-ahead logging.  Readers then see a consistent snapshot without
+    blocking, or being blocked by, the writer.  All writes go through a pool
+    with a single connection, and take their lock with BEGIN IMMEDIATE so
+    that they queue up for it rather than failing part-way through, while
+    read-only connections come from a separate pool of "pool_size" readers.
+    Each connection is also set up with the "sqlite_synchronous" mode and
+    the "sqlite_mmap_size" and "sqlite_cache_size" pragmas.  WAL mode cannot
+    be combined with read replicas or partitioning.
+
+    If "payload_compression_threshold" is set, to any value, then the queries
+    that read or write payloads also use the "payload_compressed" column of
+    the BSO and batch upload item tables.  Existing deployments must add that
+    column to each of those tables before setting it.
     """
 
     def __init__(self, sqluri, create_tables=False, pool_size=100,
                  no_pool=False, pool_recycle=60, reset_on_return=True,
                  pool_max_overflow=10, pool_max_backlog=-1, pool_timeout=30,
-                 shard=False, shardsize=100, **kwds):
+                 shard=False, shardsize=100, shard_map="modulo",
+                 shard_map_size=None, shard_boundaries=None,
+                 shard_lookup=False, replica_sqluris=None, replica_max_lag=30,
+                 replica_check_interval=10, partition_sqluris=None,
+                 partition_map="range", partition_boundaries=None,
+                 partition_lookup=False, query_stats_interval=60,
+                 slow_query_time=0, slow_query_explain_rate=0,
+                 sqlite_wal=False, sqlite_synchronous="NORMAL",
+                 sqlite_mmap_size=DEFAULT_SQLITE_MMAP_SIZE,
+                 sqlite_cache_size=DEFAULT_SQLITE_CACHE_SIZE,
+                 payload_compression_threshold=None, **kwds):
 
         parsed_sqluri = urlparse.urlparse(sqluri)
         self.sqluri = sqluri
@@ -316,7 +522,22 @@ class DBConnector(object):
             logger.warn(msg)
 
         self.shard = shard
-        self.shardsize = shardsize
+        self.shardsize = int(shardsize)
+        if shard_map_size is None:
+            shard_map_size = self.shardsize
+        if int(shard_map_size) > self.shardsize:
+            raise ValueError("shard_map_size cannot exceed shardsize")
+        map_kwds = {}
+        if shard_boundaries is not None:
+            map_kwds["boundaries"] = shard_boundaries
+        self.shard_map = get_shard_map(shard_map, shard_map_size, **map_kwds)
+        self.shard_lookup = bool(shard and shard_lookup)
+        self._supports_on_conflict = None
+        # Whether all connections share one underlying database connection,
+        # in which case a query cannot be left open while others are made.
+        self.single_connection = False
+        self.sqlite_wal = bool(sqlite_wal and self.driver == "sqlite")
+        self.compressed_payloads = payload_compression_threshold is not None
 
         # Construct the pooling-related arguments for SQLAlchemy engine.
         sqlkw = {}
@@ -348,30 +569,107 @@ class DBConnector(object):
                     raise ValueError(msg)
                 sqlkw["pool_size"] = 1
                 sqlkw["max_overflow"] = 0
+                self.single_connection = True
+
+        # In WAL mode, writes are funnelled through a single connection and
+        # reads get a pool of their own.  SQLite only allows one writer at a
+        # time, so there's nothing to be gained from any more writers.
+        reader_sqlkw = None
+        if self.sqlite_wal:
+            if self.single_connection:
+                msg = "You cannot use sqlite_wal with a :memory: database"
+                raise ValueError(msg)
+            if replica_sqluris or partition_sqluris:
+                msg = "sqlite_wal cannot be used with replicas or partitioning"
+                raise ValueError(msg)
+            sqlite_synchronous = str(sqlite_synchronous).upper()
+            if sqlite_synchronous not in SQLITE_SYNCHRONOUS_MODES:
+                msg = "Unknown sqlite_synchronous mode: %r"
+                raise ValueError(msg % (sqlite_synchronous,))
+            reader_sqlkw = sqlkw.copy()
+            if not no_pool:
+                sqlkw["pool_size"] = 1
+                sqlkw["max_overflow"] = 0
 
-        # Create the engine.
-        # We set the umask during this call, to ensure that any sqlite
-        # databases will be created with secure permissions by default.
+        # Create the engine, and a separate engine for each replica and
+        # each additional partition.  We set the umask during this call, to
+        # ensure that any sqlite databases will be created with secure
+        # permissions by default.
+        if isinstance(replica_sqluris, basestring):
+            replica_sqluris = aslist(replica_sqluris.replace(",", " "))
+        if isinstance(partition_sqluris, basestring):
+            partition_sqluris = aslist(partition_sqluris.replace(",", " "))
+        if replica_sqluris and partition_sqluris:
+            msg = "Read replicas cannot be used with partitioning"
+            raise ValueError(msg)
+        self.replicas = []
+        self.partition_engines = []
+        self.reader_engine = None
         old_umask = os.umask(0077)
         try:
             self.engine = create_engine(sqluri, **sqlkw)
+            self.partition_engines.append(self.engine)
+            if reader_sqlkw is not None:
+                self.reader_engine = create_engine(sqluri, **reader_sqlkw)
+            for replica_sqluri in replica_sqluris or ():
+                replica_driver = urlparse.urlparse(replica_sqluri).scheme
+                if replica_driver.lower() != parsed_sqluri.scheme.lower():
+                    msg = "Replica %r does not use the same driver as %r"
+                    raise ValueError(msg % (replica_sqluri, sqluri))
+                replica_engine = create_engine(replica_sqluri, **sqlkw)
+                self.replicas.append(DBReplica(self, replica_sqluri,
+                                               replica_engine,
+                                               replica_max_lag,
+                                               replica_check_interval))
+            for partition_sqluri in partition_sqluris or ():
+                partition_driver = urlparse.urlparse(partition_sqluri).scheme
+                if partition_driver.lower() != parsed_sqluri.scheme.lower():
+                    msg = "Partition %r does not use the same driver as %r"
+                    raise ValueError(msg % (partition_sqluri, sqluri))
+                partition_engine = create_engine(partition_sqluri, **sqlkw)
+                self.partition_engines.append(partition_engine)
         finally:
             os.umask(old_umask)
 
+        # Configure each new SQLite connection for WAL mode.  The journal mode
+        # is persistent, but the other pragmas only last for the connection.
+        if self.sqlite_wal:
+            pragmas = [
+                "PRAGMA journal_mode = WAL",
+                "PRAGMA synchronous = %s" % (sqlite_synchronous,),
+                "PRAGMA mmap_size = %d" % (int(sqlite_mmap_size),),
+                "PRAGMA cache_size = %d" % (int(sqlite_cache_size),),
+            ]
+
+            def set_sqlite_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                try:
+                    for pragma in pragmas:
+                        cursor.execute(pragma)
+                finally:
+                    cursor.close()
+
+            for engine in (self.engine, self.reader_engine):
+                sqlalchemy.event.listen(engine, "connect", set_sqlite_pragmas)
+
+        # Set up the assignment of users to partitions.
+        self.num_partitions = len(self.partition_engines)
+        map_kwds = {}
+        if partition_boundaries is not None:
+            map_kwds["boundaries"] = partition_boundaries
+        self.partition_map = get_shard_map(partition_map, self.num_partitions,
+                                           **map_kwds)
+        self.partition_lookup = bool(partition_sqluris and partition_lookup)
+
+        # Set up the collection of per-query statistics.
+        self.query_stats = QueryStats(float(query_stats_interval))
+        self.slow_query_time = float(slow_query_time)
+        self.slow_query_explain_rate = float(slow_query_explain_rate)
+
         # Create the tables if necessary.
         if create_tables:
-            collections.create(self.engine, checkfirst=True)
-            user_collections.create(self.engine, checkfirst=True)
-            batch_uploads.create(self.engine, checkfirst=True)
-            if not self.shard:
-                bso.create(self.engine, checkfirst=True)
-                bui.create(self.engine, checkfirst=True)
-            else:
-                for idx in xrange(self.shardsize):
-                    bsoN = get_bso_table(idx)
-                    bsoN.create(self.engine, checkfirst=True)
-                    buiN = get_batch_item_table(idx)
-                    buiN.create(self.engine, checkfirst=True)
+            for partition, engine in enumerate(self.partition_engines):
+                self._create_tables(engine, is_main=(partition == 0))
 
         # Load the pre-built queries to use with this database backend.
         # Currently we have a generic set of queries, and some queries specific
@@ -389,6 +687,35 @@ class DBConnector(object):
                 if nm.isupper():
                     self._prebuilt_queries[nm] = getattr(queries, nm)
 
+        # In WAL mode a write lock only needs to keep out other writers.
+        if self.sqlite_wal:
+            self._prebuilt_queries["BEGIN_TRANSACTION_WRITE"] = \
+                self._prebuilt_queries["BEGIN_TRANSACTION_WRITE_WAL"]
+
+        # With payload compression, queries that read or write payloads must
+        # also carry the payload_compressed column.
+        if self.compressed_payloads:
+            for nm in list(self._prebuilt_queries):
+                if nm.endswith("_COMPRESSED"):
+                    self._prebuilt_queries[nm[:-len("_COMPRESSED")]] = \
+                        self._prebuilt_queries[nm]
+
+        # Pre-interpolate the sharded table names into string queries, so
+        # that we don't have to do it every time the query is executed.
+        self._interpolated_queries = {}
+        for nm, query in self._prebuilt_queries.iteritems():
+            if isinstance(query, basestring):
+                interpolated = self._interpolate_table_names(query)
+                if interpolated is not None:
+                    self._interpolated_queries[nm] = interpolated
+
+        # Cache of SQL strings rendered from callable queries, keyed by
+        # query name, table name and the shape of the query parameters.
+        # The least-recently-used shapes are evicted once it's full.
+        self._rendered_queries = LRUCache(MAX_QUERY_CACHE_SIZE)
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+
         # Constuct a Dialect object to use for rendering query objects.
         # This forces rendering of bindparams using the "named" style,
         # so that the resulting string is compatible with sqltext().
@@ -404,12 +731,75 @@ class DBConnector(object):
                 if conn:
                     conn._result = None
 
-            sqlalchemy.event.listen(self.engine.pool, "checkin",
-                                    clear_result_on_pool_checkin)
+            engines = self.partition_engines + [r.engine
+                                                for r in self.replicas]
+            for engine in engines:
+                sqlalchemy.event.listen(engine.pool, "checkin",
+                                        clear_result_on_pool_checkin)
 
-    def connect(self, *args, **kwds):
-        """Create a new DBConnection object from this connector."""
-        return DBConnection(self)
+    def _create_tables(self, engine, is_main=True):
+        """Create any missing tables in the given database.
+
+        Only the main database holds the user_partitions table.  Every
+        partition has a full set of the other tables.
+        """
+        collections.create(engine, checkfirst=True)
+        user_collections.create(engine, checkfirst=True)
+        batch_uploads.create(engine, checkfirst=True)
+        purge_checkpoints.create(engine, checkfirst=True)
+        collection_tombstones.create(engine, checkfirst=True)
+        if self.shard_lookup:
+            user_shards.create(engine, checkfirst=True)
+        if self.partition_lookup and is_main:
+            user_partitions.create(engine, checkfirst=True)
+        if not self.shard:
+            bso.create(engine, checkfirst=True)
+            bui.create(engine, checkfirst=True)
+        else:
+            for idx in xrange(self.shardsize):
+                bsoN = get_bso_table(idx)
+                bsoN.create(engine, checkfirst=True)
+                buiN = get_batch_item_table(idx)
+                buiN.create(engine, checkfirst=True)
+
+    def connect(self, read_only=False, partition=0, deadline=None):
+        """Create a new DBConnection object from this connector.
+
+        If read_only is True and there are healthy replicas available, the
+        connection will be made to a randomly-chosen replica.  Otherwise it
+        is made to the given partition, by default the main database, using
+        the pool of SQLite readers for read-only connections in WAL mode.
+        If a deadline is given then queries will not be allowed to run past
+        it.
+        """
+        if read_only and self.replicas:
+            replicas = [r for r in self.replicas if r.is_available()]
+            if replicas:
+                return DBConnection(self, random.choice(replicas),
+                                    deadline=deadline)
+            annotate_request(None, "syncstorage.storage.sql.replica.none", 1)
+        return DBConnection(self, partition=partition, deadline=deadline,
+                            read_only=read_only)
+
+    def get_pool_load(self):
+        """Get the fraction of pooled connections that are checked out.
+
+        This is the highest figure across the main database and any
+        partitions, counting overflow connections as a full pool.  It's
+        always zero if connection pooling is disabled.  In SQLite WAL mode
+        only the readers are counted, since the single writer is expected
+        to be busy.
+        """
+        load = 0
+        engines = self.partition_engines
+        if self.reader_engine is not None:
+            engines = [self.reader_engine]
+        for engine in engines:
+            pool = engine.pool
+            if isinstance(pool, QueuePool) and pool.size() > 0:
+                pool_load = pool.checkedout() / float(pool.size())
+                load = max(load, min(pool_load, 1))
+        return load
 
     def get_query(self, name, params):
         """Get the named pre-built query.
@@ -426,13 +816,22 @@ class DBConnector(object):
         # If it's None then just return it, indicating a no-op.
         if query is None:
             return None
+        # Expand any list of ids into individual bindparams.
+        if "ids" in params:
+            for i, id in enumerate(params["ids"]):
+                params["id%d" % (i,)] = id
         # If it's a callable, call it with the sharded bso table.
         if callable(query):
-            bso = self.get_bso_table(params.get("userid"))
-            return query(bso, params)
+            if "bso" in params:
+                bso = get_bso_table_by_name(str(params["bso"]))
+            else:
+                bso = self.get_bso_table(params.get("userid"))
+            shape = getattr(query, "shape", None)
+            if shape is None:
+                return query(bso, params)
+            return self._get_rendered_query(name, query, bso, shape(params),
+                                            params)
         # If it's a string, do some interpolation and return it.
-        # XXX TODO: we could pre-parse these queries at load time to look for
-        # string interpolation variables, saving some time on each call.
         assert isinstance(query, basestring)
         qvars = {}
         if "%(bso)s" in query:
@@ -445,21 +844,117 @@ class DBConnector(object):
                 qvars["bui"] = params["bui"]
             else:
                 qvars["bui"] = self.get_batch_item_table(params["batch"])
+        if "%(dst)s" in query:
+            qvars["dst"] = params["dst"]
         if "%(ids)s" in query:
-            bindparams = []
-            for i, id in enumerate(params["ids"]):
-                params["id%d" % (i,)] = id
-                bindparams.append(":id%d" % (i,))
+            bindparams = [":id%d" % (i,) for i in xrange(len(params["ids"]))]
             qvars["ids"] = "(" + ",".join(bindparams) + ")"
+        # Use the pre-interpolated table name if we have it.
+        if name in self._interpolated_queries:
+            var, queries_by_table = self._interpolated_queries[name]
+            table_name = str(qvars[var])
+            if table_name in queries_by_table:
+                query = queries_by_table[table_name]
+                del qvars[var]
         if qvars:
             query = query % qvars
         return query
 
+    def uses_bso_table(self, name):
+        """Check whether the named query operates on the user's BSO table."""
+        query = self._prebuilt_queries[name]
+        if query is None:
+            return False
+        if callable(query):
+            return True
+        return "%(bso)s" in query
+
+    def _interpolate_table_names(self, query):
+        """Pre-interpolate sharded table names into the given string query.
+
+        This returns a (var, queries) pair, where var is the name of an
+        interpolation variable and queries maps each possible table name for
+        that variable to the query with the name interpolated.  Any other
+        interpolation variables are left in place.  If the query does not
+        reference any sharded tables then None is returned.
+        """
+        num_tables = self.shardsize if self.shard else 1
+        if "%(bso)s" in query:
+            var = "bso"
+            tables = [self.get_bso_table(i) for i in xrange(num_tables)]
+        elif "%(bui)s" in query:
+            var = "bui"
+            tables = [self.get_batch_item_table(i) for i in xrange(num_tables)]
+        else:
+            return None
+        qvars = {"bso": "%(bso)s", "bui": "%(bui)s", "ids": "%(ids)s",
+                 "dst": "%(dst)s"}
+        queries = {}
+        for table in tables:
+            qvars[var] = table.name
+            queries[table.name] = query % qvars
+        return var, queries
+
+    def _get_rendered_query(self, name, query, bso, shape, params):
+        """Get the SQL string for a callable query, using a cache if possible.
+
+        The string is rendered once for each distinct shape of the query,
+        after which only the values of its bindparams change between calls.
+        Any constant values rendered into the query by SQLAlchemy itself are
+        cached alongside it, and filled into the given params.
+        """
+        key = (name, bso.name, shape)
+        try:
+            query_str, default_params = self._rendered_queries[key]
+        except KeyError:
+            self.query_cache_misses += 1
+            annotate_request(None, "syncstorage.storage.sql.query_cache.miss",
+                             1)
+            compiled = query(bso, params).compile(
+                dialect=self._render_query_dialect)
+            query_str = str(compiled)
+            default_params = dict((param, value) for (param, value)
+                                  in compiled.params.iteritems()
+                                  if value is not None)
+            self._rendered_queries[key] = (query_str, default_params)
+        else:
+            self.query_cache_hits += 1
+            annotate_request(None, "syncstorage.storage.sql.query_cache.hit",
+                             1)
+        for param, value in default_params.iteritems():
+            params.setdefault(param, value)
+        return query_str
+
+    def supports_on_conflict(self):
+        """Check whether the database supports INSERT ... ON CONFLICT.
+
+        This "upsert" syntax is available from SQLite 3.24 and PostgreSQL
+        9.5 onwards.  For PostgreSQL the server version is only known once
+        we've connected, so the check is done lazily and cached.
+        """
+        if self._supports_on_conflict is None:
+            if self.driver == "sqlite":
+                version = self.engine.dialect.dbapi.sqlite_version_info
+                self._supports_on_conflict = (version >= (3, 24, 0))
+            elif self.driver == "postgres":
+                if self.engine.dialect.server_version_info is None:
+                    self.engine.connect().close()
+                version = self.engine.dialect.server_version_info
+                self._supports_on_conflict = (version >= (9, 5))
+            else:
+                self._supports_on_conflict = False
+        return self._supports_on_conflict
+
     def get_bso_table(self, userid):
-        """Get the BSO table object for the given userid."""
+        """Get the BSO table object for the given userid.
+
+        This uses only the static shard map.  When "shard_lookup" is enabled
+        the caller must check for a per-user override, as is done by the
+        SQLStorageSession class.
+        """
         if not self.shard or userid is None:
             return bso
-        return get_bso_table(userid % self.shardsize)
+        return get_bso_table(self.shard_map.get_shard(userid))
 
     def get_batch_item_table(self, batchid):
         """Get the batch_upload_items table object for the given userid."""
@@ -468,6 +963,107 @@ class DBConnector(object):
         return get_batch_item_table(batchid % self.shardsize)
 
 
+class DBReplica(object):
+    """A read replica of the main database, with health tracking.
+
+    Each DBReplica holds a separate SQLAlchemy engine, and hence separate
+    connection pool, for connecting to a replica database.  Its health is
+    checked lazily, at most once every "check_interval" seconds, by running
+    the backend-specific REPLICA_LAG query.  The replica is ejected from
+    service if that query fails, if it reports a lag of more than "max_lag"
+    seconds, or if a query against the replica fails with an operational
+    error.
+    """
+
+    def __init__(self, connector, sqluri, engine, max_lag=30,
+                 check_interval=10):
+        self.connector = connector
+        self.sqluri = sqluri
+        self.engine = engine
+        self.max_lag = float(max_lag)
+        self.check_interval = float(check_interval)
+        self.healthy = True
+        self.lag = None
+        self.last_checked = None
+        self._check_lock = threading.Lock()
+
+    def is_available(self):
+        """Check whether this replica is currently fit for service.
+
+        This will run a health check if one is due.  Only one thread will
+        run the check at a time; any others see the result of the previous
+        check rather than waiting for it to complete.
+        """
+        now = time.time()
+        if self.last_checked is None or \
+           now - self.last_checked >= self.check_interval:
+            if self._check_lock.acquire(False):
+                try:
+                    self.check_health()
+                finally:
+                    self._check_lock.release()
+        return self.healthy
+
+    def _get_lag_query(self):
+        """Get the name of the query for checking this replica's lag.
+
+        PostgreSQL renamed the functions used by REPLICA_LAG in version 10,
+        so older servers need the REPLICA_LAG_XLOG query instead.  As with
+        supports_on_conflict(), we must connect to learn the server version.
+        """
+        if self.connector.driver != "postgres":
+            return "REPLICA_LAG"
+        if self.engine.dialect.server_version_info is None:
+            self.engine.connect().close()
+        if self.engine.dialect.server_version_info < (10,):
+            return "REPLICA_LAG_XLOG"
+        return "REPLICA_LAG"
+
+    def check_health(self):
+        """Check the health and replication lag of this replica."""
+        self.last_checked = time.time()
+        try:
+            query = self._get_lag_query()
+            with DBConnection(self.connector, self) as connection:
+                row = connection.query_fetchone(query, {})
+        except Exception, exc:
+            logger.error("Replica %s failed health check: %s",
+                         self.sqluri, exc)
+            self.eject()
+            return
+        # MySQL reports status via SHOW SLAVE STATUS, which returns many
+        # columns, while other backends give the lag as a single value.
+        # If there's no row then the database is not replicating, and we
+        # must assume that it's up-to-date.
+        if row is None:
+            lag = 0
+        elif "Seconds_Behind_Master" in row.keys():
+            lag = row["Seconds_Behind_Master"]
+        else:
+            lag = row[0]
+        if lag is None:
+            logger.error("Replica %s is not replicating", self.sqluri)
+            self.eject()
+            return
+        self.lag = float(lag)
+        annotate_request(None, "syncstorage.storage.sql.replica.lag",
+                         self.lag)
+        if self.lag > self.max_lag:
+            logger.warn("Replica %s is lagging by %.1f seconds",
+                        self.sqluri, self.lag)
+            self.eject()
+        else:
+            self.healthy = True
+
+    def eject(self):
+        """Take this replica out of service until its next health check."""
+        if self.healthy:
+            annotate_request(None, "syncstorage.storage.sql.replica.ejected",
+                             1)
+        self.healthy = False
+        self.last_checked = time.time()
+
+
 def is_retryable_db_error(engine, exc):
     """Check whether we can safely retry in response to the given db error."""
     # Any connection-related errors can be safely retried.
@@ -532,8 +1128,11 @@ def report_backend_errors(func):
         try:
             return func(self, *args, **kwds)
         except Exception, exc:
-            if not is_operational_db_error(self._connector.engine, exc):
+            if not is_operational_db_error(self._engine, exc):
                 raise
+            # A misbehaving replica is taken out of service.
+            if self._replica is not None:
+                self._replica.eject()
             # An unexpected database-level error.
             # Log the error, then normalize it into a BackendError instance.
             # Note that this will not catch logic errors such as e.g. an
@@ -546,6 +1145,33 @@ def report_backend_errors(func):
     return report_backend_errors_wrapper
 
 
+class _UnbufferedResult(object):
+    """Minimal stand-in for a ResultProxy over an unbuffered DBAPI cursor.
+
+    Rows are fetched from the server one at a time as they are iterated,
+    and are produced as dicts keyed by column name.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._keys = [desc[0] for desc in cursor.description]
+
+    def __iter__(self):
+        keys = self._keys
+        row = self._cursor.fetchone()
+        while row is not None:
+            yield dict(zip(keys, row))
+            row = self._cursor.fetchone()
+
+    def close(self):
+        try:
+            self._cursor.close()
+        except Exception:
+            # The connection may have been discarded part-way through the
+            # stream, in which case there are no remaining rows to drain.
+            logger.debug("error closing unbuffered cursor", exc_info=True)
+
+
 class DBConnection(object):
     """Database connection class for SQL access layer.
 
@@ -557,13 +1183,60 @@ class DBConnection(object):
     transaction.  The transaction is opened the first time a query is
     executed and is closed by calling either the commit() or rollback()
     method.
+
+    If a DBReplica object is given, the connection will be made to that
+    replica rather than to the main database.  Otherwise it is made to the
+    given partition, where partition zero is the main database.  If
+    read_only is True and the connector has a pool of SQLite readers, the
+    connection is taken from that pool instead.
+
+    If a deadline is given, as a time.time() value, then the connection will
+    fail with DeadlineExceededError rather than run any query past it.  The
+    time remaining is used to limit the wait for a connection from the pool,
+    and is passed on to the database as a time limit for each statement.
     """
 
-    def __init__(self, connector):
+    def __init__(self, connector, replica=None, partition=0, deadline=None,
+                 read_only=False):
         self._connector = connector
+        self._replica = replica
+        self.partition = partition
+        self.deadline = deadline
+        self.read_only = read_only
+        if replica is not None:
+            self._engine = replica.engine
+        elif read_only and connector.reader_engine is not None:
+            self._engine = connector.reader_engine
+        else:
+            self._engine = connector.partition_engines[partition]
         self._connection = None
         self._transaction = None
 
+    @property
+    def is_replica(self):
+        """Whether this connection is to a read replica."""
+        return self._replica is not None
+
+    def clone(self):
+        """Create a new, independent connection to the same database."""
+        return DBConnection(self._connector, self._replica, self.partition,
+                            self.deadline, self.read_only)
+
+    def clear_deadline(self):
+        """Stop limiting the statements on this connection by its deadline.
+
+        This is for streaming queries, whose rows are read at the pace of
+        the client once they have started and so may take longer than the
+        deadline to deliver.  Such queries are not given the MySQL execution
+        time hint, and here SQLite's progress handler is removed.  On other
+        databases the statement timeout applies to each fetch of rows from
+        a server-side cursor separately, so it is left in place.
+        """
+        self.deadline = None
+        if self._connection is not None:
+            if self._connector.driver == "sqlite":
+                self._set_progress_handler(self._connection)
+
     def __enter__(self):
         return self
 
@@ -598,14 +1271,55 @@ class DBConnection(object):
                 self._connection = None
 
     @report_backend_errors
-    def execute(self, query, params=None, annotations=None):
+    def abort(self):
+        """Abort the active transaction and discard the connection.
+
+        This is like rollback() except that the underlying connection is
+        invalidated rather than returned to the pool.  It's useful when the
+        connection is part-way through streaming a large result set, which
+        would otherwise have to be read in full before the connection could
+        be used again.
+        """
+        try:
+            if self._connection is not None:
+                self._connection.invalidate()
+        finally:
+            self._transaction = None
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    @report_backend_errors
+    def execute(self, query, params=None, annotations=None,
+                stream_results=False):
         """Execute a database query, with retry and exception-catching logic.
 
         This method executes the given query against the database, lazily
         establishing an actual live connection as required.  It catches
         operational database errors and normalizes them into a BackendError
         exception.
+
+        If stream_results is True then the driver is asked to use a
+        server-side cursor, so that result rows are fetched from the database
+        as they are consumed rather than all being buffered in memory.
+
+        If the connection has a deadline that has passed, either before the
+        query is started or by the time it fails, then DeadlineExceededError
+        is raised in place of any database error.
         """
+        if self.deadline is None:
+            return self._execute(query, params, annotations, stream_results)
+        self._check_deadline()
+        try:
+            return self._execute(query, params, annotations, stream_results)
+        except (DBAPIError, TimeoutError):
+            # The failure was most likely caused by the time limits that we
+            # derived from the deadline, so report it as such.
+            self._check_deadline()
+            raise
+
+    def _execute(self, query, params, annotations, stream_results):
+        """Execute a database query, without checking the deadline."""
         if params is None:
             params = {}
         if annotations is None:
@@ -615,8 +1329,7 @@ class DBConnection(object):
         connection = self._connection
         session_was_active = True
         if connection is None:
-            connection = self._connector.engine.connect()
-            transaction = connection.begin()
+            connection, transaction = self._checkout()
             session_was_active = False
         try:
             # It's possible for the backend to fail in a way that the query
@@ -625,10 +1338,14 @@ class DBConnection(object):
             # new connection, but only if the failed connection was never
             # successfully used as part of this transaction.
             try:
-                query_str = self._render_query(query, params, annotations)
-                return self._exec_with_cleanup(connection, query_str, **params)
+                if not session_was_active:
+                    self._apply_deadline(connection)
+                query_str = self._render_query(query, params, annotations,
+                                               stream_results)
+                return self._exec_with_cleanup(connection, query_str,
+                                               stream_results, **params)
             except DBAPIError, exc:
-                if not is_retryable_db_error(self._connector.engine, exc):
+                if not is_retryable_db_error(self._engine, exc):
                     raise
                 if session_was_active:
                     raise
@@ -636,11 +1353,13 @@ class DBConnection(object):
                 if not exc.connection_invalidated:
                     transaction.rollback()
                     connection.close()
-                connection = self._connector.engine.connect()
-                transaction = connection.begin()
+                connection, transaction = self._checkout()
+                self._apply_deadline(connection)
                 annotations["retry"] = "1"
-                query_str = self._render_query(query, params, annotations)
-                return self._exec_with_cleanup(connection, query_str, **params)
+                query_str = self._render_query(query, params, annotations,
+                                               stream_results)
+                return self._exec_with_cleanup(connection, query_str,
+                                               stream_results, **params)
         finally:
             # Now that the underlying connection has been used, remember it
             # so that all subsequent queries are part of the same transaction.
@@ -648,8 +1367,88 @@ class DBConnection(object):
                 self._connection = connection
                 self._transaction = transaction
 
+    def _check_deadline(self):
+        """Raise DeadlineExceededError if the deadline has passed."""
+        if time.time() >= self.deadline:
+            metric = "syncstorage.storage.sql.deadline_exceeded"
+            annotate_request(None, metric, 1)
+            raise DeadlineExceededError("Deadline exceeded")
+
+    def _checkout(self):
+        """Check out a connection from the pool and begin a transaction.
+
+        If there is a deadline then the wait for a free connection is capped
+        at the time remaining before it.
+        """
+        _checkout_deadline.value = self.deadline
+        try:
+            connection = self._engine.connect()
+        finally:
+            _checkout_deadline.value = None
+        return connection, connection.begin()
+
+    def _apply_deadline(self, connection):
+        """Limit the time that statements on a fresh connection may take.
+
+        The limit is the time remaining before the deadline, if any.  SQLite
+        gets a progress handler that aborts any statement running past the
+        deadline.  Other databases get whatever SET_STATEMENT_TIMEOUT query
+        is defined for them.  If a RESET_STATEMENT_TIMEOUT query is defined
+        then the setting outlives the transaction, so it is remembered on the
+        pooled connection and only sent when it changes.  Otherwise it is
+        sent at the start of each transaction that has a deadline.
+        """
+        if self._connector.driver == "sqlite":
+            self._set_progress_handler(connection)
+            return
+        timeout = None
+        params = {}
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            timeout = max(int(math.ceil(remaining)), 1)
+            params["timeout"] = timeout
+            params["timeout_ms"] = max(int(math.ceil(remaining * 1000)), 1)
+        if self._connector.get_query("RESET_STATEMENT_TIMEOUT", {}) is None:
+            if timeout is not None:
+                self._exec_setting(connection, "SET_STATEMENT_TIMEOUT", params)
+            return
+        if connection.info.get(STATEMENT_TIMEOUT_INFO_KEY) == timeout:
+            return
+        if timeout is None:
+            self._exec_setting(connection, "RESET_STATEMENT_TIMEOUT", params)
+            del connection.info[STATEMENT_TIMEOUT_INFO_KEY]
+        else:
+            self._exec_setting(connection, "SET_STATEMENT_TIMEOUT", params)
+            connection.info[STATEMENT_TIMEOUT_INFO_KEY] = timeout
+
+    def _set_progress_handler(self, connection):
+        """Make SQLite abort any statement that runs past the deadline."""
+        dbapi_connection = connection.connection
+        deadline = self.deadline
+        if deadline is None:
+            if connection.info.pop(PROGRESS_HANDLER_INFO_KEY, False):
+                dbapi_connection.set_progress_handler(None, 0)
+            return
+
+        def abort_after_deadline():
+            return time.time() >= deadline
+
+        dbapi_connection.set_progress_handler(abort_after_deadline,
+                                              SQLITE_PROGRESS_INTERVAL)
+        connection.info[PROGRESS_HANDLER_INFO_KEY] = True
+
+    def _exec_setting(self, connection, query_name, params):
+        """Execute a named query to change a setting on the connection."""
+        query = self._connector.get_query(query_name, params)
+        if query is None:
+            return
+        query_str = self._render_query(query, params,
+                                       {"queryName": query_name})
+        connection.execute(sqltext(query_str), **params).close()
+
     @metrics_timer("syncstorage.storage.sql.db.execute")
-    def _exec_with_cleanup(self, connection, query_str, **params):
+    def _exec_with_cleanup(self, connection, query_str, stream_results=False,
+                           **params):
         """Execution wrapper that kills queries if it is interrupted.
 
         This is a wrapper around connection.execute() that will clean up
@@ -659,8 +1458,13 @@ class DBConnection(object):
         The cleanup currently works only for the PyMySQL driver.  Other
         drivers will still execute fine, they just won't get the cleanup.
         """
+        statement = sqltext(query_str)
+        if stream_results:
+            statement = statement.execution_options(stream_results=True)
         try:
-            return connection.execute(sqltext(query_str), **params)
+            if stream_results and self._needs_unbuffered_cursor(connection):
+                return self._exec_unbuffered(connection, statement, params)
+            return connection.execute(statement, **params)
         except Exception:
             # Normal exceptions are passed straight through.
             raise
@@ -685,7 +1489,7 @@ class DBConnection(object):
                 # Use a freshly-created connection so that we don't block
                 # waiting for something from the pool.  Unfortunately this
                 # requires use of a private API and raw cursor access.
-                cleanup_conn = self._connector.engine.pool._create_connection()
+                cleanup_conn = self._engine.pool._create_connection()
                 try:
                     cleanup_cursor = cleanup_conn.connection.cursor()
                     try:
@@ -708,12 +1512,45 @@ class DBConnection(object):
                     # Always re-raise the original error.
                     raise exc, val, tb
 
-    def _render_query(self, query, params, annotations):
+    def _needs_unbuffered_cursor(self, connection):
+        """Check whether streaming requires an explicit unbuffered cursor.
+
+        Older versions of SQLAlchemy ignore the "stream_results" option for
+        MySQL drivers, which buffer the whole result set by default.  For
+        those we have to create one of the driver's unbuffered cursors
+        ourselves.
+        """
+        if self._connector.driver != "mysql":
+            return False
+        return not connection.dialect.supports_server_side_cursors
+
+    def _exec_unbuffered(self, connection, statement, params):
+        """Execute a statement using the driver's unbuffered SSCursor."""
+        dialect = connection.dialect
+        compiled = statement.compile(dialect=dialect)
+        query_str = unicode(compiled)
+        query_params = compiled.construct_params(params)
+        cursor = connection.connection.cursor(dialect.dbapi.cursors.SSCursor)
+        try:
+            cursor.execute(query_str, query_params)
+        except dialect.dbapi.Error, exc:
+            cursor.close()
+            raise DBAPIError.instance(query_str, query_params, exc,
+                                      dialect.dbapi.Error, dialect=dialect)
+        except BaseException:
+            cursor.close()
+            raise
+        return _UnbufferedResult(cursor)
+
+    def _render_query(self, query, params, annotations, stream_results=False):
         """Render a query into its final string form, to send to database.
 
         This method does any final tweaks to the string form of the query
-        immediately before it is sent to the database.  Currently its only
-        job is to add annotations in a comment on the query.
+        immediately before it is sent to the database.  This means adding
+        annotations in a comment on the query and, for SELECT queries on
+        MySQL, a hint limiting their execution time to the time remaining
+        before the deadline.  Streaming queries don't get the hint, since
+        their execution lasts until the client has read all the rows.
         """
         # Convert SQLAlchemy expression objects into a string.
         if isinstance(query, basestring):
@@ -724,6 +1561,14 @@ class DBConnection(object):
             for param, value in compiled.params.iteritems():
                 params.setdefault(param, value)
             query_str = str(compiled)
+        # Limit the execution time of SELECTs on MySQL.  Other statements
+        # are limited by the settings from SET_STATEMENT_TIMEOUT.
+        if self.deadline is not None and not stream_results and \
+           self._connector.driver == "mysql":
+            remaining = self.deadline - time.time()
+            hint = "/*+ MAX_EXECUTION_TIME(%d) */" % (
+                max(int(math.ceil(remaining * 1000)), 1),)
+            query_str = SELECT_QUERY.sub(r"\1 " + hint, query_str, count=1)
         # Join all the annotations into a comment string.
         if annotations:
             annotation_items = sorted(annotations.items())
@@ -745,11 +1590,15 @@ class DBConnection(object):
         if annotations is None:
             annotations = {}
         annotations.setdefault("queryName", query_name)
+        t_start = time.time()
         res = self.execute(query, params, annotations)
         try:
-            return res.rowcount
+            rowcount = res.rowcount
         finally:
             res.close()
+        self._record_query(query_name, query, params,
+                           time.time() - t_start, rowcount)
+        return rowcount
 
     def query_scalar(self, query_name, params=None, default=None,
                      annotations=None):
@@ -760,14 +1609,17 @@ class DBConnection(object):
         if annotations is None:
             annotations = {}
         annotations.setdefault("queryName", query_name)
+        t_start = time.time()
         res = self.execute(query, params, annotations)
         try:
             row = res.fetchone()
-            if row is None or row[0] is None:
-                return default
-            return row[0]
         finally:
             res.close()
+        self._record_query(query_name, query, params,
+                           time.time() - t_start, 0 if row is None else 1)
+        if row is None or row[0] is None:
+            return default
+        return row[0]
 
     def query_fetchone(self, query_name, params=None, annotations=None):
         """Execute a named query, returning the first result row."""
@@ -777,27 +1629,49 @@ class DBConnection(object):
         if annotations is None:
             annotations = {}
         annotations.setdefault("queryName", query_name)
+        t_start = time.time()
         res = self.execute(query, params, annotations)
         try:
-            return res.fetchone()
+            row = res.fetchone()
         finally:
             res.close()
+        self._record_query(query_name, query, params,
+                           time.time() - t_start, 0 if row is None else 1)
+        return row
 
-    def query_fetchall(self, query_name, params=None, annotations=None):
-        """Execute a named query, returning iterator over the results."""
+    def query_fetchall(self, query_name, params=None, annotations=None,
+                       stream=False):
+        """Execute a named query, returning iterator over the results.
+
+        By default the driver may buffer the entire result set in memory
+        before the first row is produced.  If stream is True then rows are
+        instead fetched incrementally using a server-side cursor, and the
+        connection remains busy until the iterator is exhausted or closed.
+
+        The time recorded for the query is the time taken to execute it, not
+        including the time spent consuming the rows.
+        """
         query = self._connector.get_query(query_name, params)
         if query is not None:
             if annotations is None:
                 annotations = {}
             annotations.setdefault("queryName", query_name)
-            res = self.execute(query, params, annotations)
+            t_start = time.time()
+            res = self.execute(query, params, annotations,
+                               stream_results=stream)
+            duration = time.time() - t_start
+            num_rows = 0
             try:
                 for row in res:
+                    num_rows += 1
                     yield row
             finally:
                 res.close()
+                self._record_query(query_name, query, params,
+                                   duration, num_rows)
 
-    def insert_or_update(self, table, items, defaults=None, annotations=None):
+    def insert_or_update(self, table, items, defaults=None, annotations=None,
+                         count_created=True):
         """Perform an efficient bulk "upsert" of the given items.
 
         Given the name of a table and a list of data dicts to insert or update,
@@ -808,16 +1682,20 @@ class DBConnection(object):
         For generic database backends, the best we can do is try each insert,
         catch any IntegrityErrors and retry as an update.  For MySQL however
         we can use the "ON DUPLICATE KEY UPDATE" syntax to do the operation
-        in a single query.
+        in a single query, and for recent versions of SQLite and PostgreSQL
+        we can do likewise with the "ON CONFLICT DO UPDATE" syntax.
 
-        The number of newly-inserted rows is returned.
+        The number of newly-inserted rows is returned, unless count_created
+        is false, in which case None is returned.  Some databases need extra
+        work to tell inserted rows from updated ones, so callers that don't
+        need the number should say so.
         """
         if annotations is None:
             annotations = {}
         annotations.setdefault("queryName", "UPSERT_%s" % (table,))
         # Inserting zero items is strange, but allowed.
         if not items:
-            return 0
+            return 0 if count_created else None
         # Find the table object into which we're inserting.
         if table == "bso":
             # To work properly with sharding, all items must have same userid
@@ -832,11 +1710,77 @@ class DBConnection(object):
         else:
             table = metadata.tables[table]
         # Dispatch to an appropriate implementation.
+        t_start = time.time()
         if self._connector.driver == "mysql":
-            return self._upsert_onduplicatekey(table, items, defaults,
+            num_created = self._upsert_onduplicatekey(table, items, defaults,
+                                                      annotations)
+        elif self._connector.supports_on_conflict():
+            num_created = self._upsert_onconflict(table, items, defaults,
+                                                  annotations, count_created)
+        else:
+            num_created = self._upsert_generic(table, items, defaults,
                                                annotations)
+        self._record_query(annotations["queryName"], None, items[0],
+                           time.time() - t_start, len(items), table.name)
+        if not count_created:
+            return None
+        return num_created
+
+    def _record_query(self, query_name, query, params, duration, rows,
+                      table=None):
+        """Record the time taken by a named query, logging it if slow.
+
+        If the table is not given then it's taken to be the BSO table, if the
+        query uses one.  If the query is given, then on MySQL a sample of slow
+        SELECTs are re-run with EXPLAIN to log their query plan.
+        """
+        connector = self._connector
+        connector.query_stats.record(query_name, duration, rows)
+        if not connector.slow_query_time:
+            return
+        if duration < connector.slow_query_time:
+            return
+        if params is None:
+            params = {}
+        if table is None:
+            if "bso" in params:
+                table = str(params["bso"])
+            elif connector.uses_bso_table(query_name):
+                table = connector.get_bso_table(params.get("userid")).name
+        logger.warn("Slow query %s took %.4f seconds (table=%s, params=%s)",
+                    query_name, duration, table, get_params_shape(params))
+        if query is None or connector.driver != "mysql":
+            return
+        if random.random() >= connector.slow_query_explain_rate:
+            return
+        try:
+            plan = self._explain(query_name, query, params)
+        except Exception:
+            logger.exception("Failed to explain slow query %s", query_name)
         else:
-            return self._upsert_generic(table, items, defaults, annotations)
+            if plan is not None:
+                logger.warn("Plan for slow query %s: %s", query_name, plan)
+
+    def _explain(self, query_name, query, params):
+        """Get the query plan for a SELECT, as a list of row dicts.
+
+        The EXPLAIN is run as part of the current transaction, so it sees
+        the same data as the query did.  None is returned if the query is
+        not a SELECT, or there is no current transaction.
+        """
+        if self._connection is None:
+            return None
+        params = params.copy()
+        annotations = {"queryName": query_name, "explain": "1"}
+        query_str = self._render_query(query, params, annotations)
+        if not SELECT_QUERY.match(query_str.split("*/", 1)[-1]):
+            return None
+        res = self._connection.execute(sqltext("EXPLAIN " + query_str),
+                                       **params)
+        try:
+            return [dict(row.items()) for row in res]
+        finally:
+            res.close()
 
     def _upsert_generic(self, table, items, defaults, annotations):
         """Upsert a batch of items one at a time, trying UPDATE then INSERT.
@@ -943,3 +1887,120 @@ class DBConnection(object):
             finally:
                 res.close()
         return num_created
+
+    def _upsert_onconflict(self, table, items, defaults, annotations,
+                           count_created=True):
+        """Upsert a batch of items using the ON CONFLICT DO UPDATE syntax.
+
+        This is the SQLite/PostgreSQL equivalent of _upsert_onduplicatekey,
+        producing a query something like the following:
+
+            INSERT INTO table (c1, ..., cM)
+            VALUES (:c11, ..., :cM1), ..., (:c1N, ... :cMN)
+            ON CONFLICT (k1, ..., kP)
+            DO UPDATE SET c1 = excluded.c1, ..., cM = excluded.cM
+
+        Unlike MySQL, the rowcount does not distinguish inserted rows from
+        updated ones.  On PostgreSQL we can ask for this information using
+        a RETURNING clause.  SQLite has no equivalent, so if the number of
+        inserted rows is wanted then a single item is written by trying an
+        UPDATE before an INSERT, which takes only one query if it exists,
+        while for several items we count the existing rows in a separate
+        query before doing the upsert.
+        """
+        is_postgres = self._connector.driver == "postgres"
+        if count_created and not is_postgres and len(items) == 1:
+            return self._upsert_generic(table, items, defaults, annotations)
+        userid = items[0].get("userid")
+        pkey_names = [key.name for key in table.primary_key]
+        assert all(SAFE_FIELD_NAME_RE.match(f) for f in pkey_names)
+        # Merge any repeated writes to the same row, since a single
+        # ON CONFLICT statement is not allowed to affect a row twice.
+        # Later writes take precedence, as if they were done one at a time.
+        merged_items = {}
+        for item in items:
+            assert item.get("userid") == userid
+            try:
+                pkey = tuple(item[name] for name in pkey_names)
+            except KeyError, e:
+                msg = "Item is missing primary key column %r"
+                raise ValueError(msg % (e.args[0],))
+            if pkey not in merged_items:
+                merged_items[pkey] = item
+            else:
+                merged_items[pkey] = merged_items[pkey].copy()
+                merged_items[pkey].update(item)
+        # Group the items to be inserted into batches that all have the same
+        # set of fields.  Each batch will have the same DO UPDATE clause and
+        # so can be sent as a single query, modulo limits on its size.
+        batches = defaultdict(list)
+        for item in merged_items.itervalues():
+            batches[frozenset(item.iterkeys())].append(item)
+        num_created = 0
+        for batch in batches.itervalues():
+            # Since we're crafting SQL by hand, assert that each field is
+            # actually a plain alphanum field name.  Can't be too careful...
+            update_fields = batch[0].keys()
+            insert_fields = batch[0].keys()
+            if defaults is not None:
+                for field in defaults:
+                    if field not in batch[0]:
+                        insert_fields.append(field)
+            assert all(SAFE_FIELD_NAME_RE.match(f) for f in update_fields)
+            assert all(SAFE_FIELD_NAME_RE.match(f) for f in insert_fields)
+            binds = [":%s%%(num)d" % field for field in insert_fields]
+            pattern = "(%s)" % ",".join(binds)
+            updates = ["%s = excluded.%s" % (f, f) for f in update_fields]
+            chunk_size = max(1, MAX_UPSERT_BIND_PARAMS // len(insert_fields))
+            for i in xrange(0, len(batch), chunk_size):
+                chunk = batch[i:i + chunk_size]
+                query = "INSERT INTO %s (%s) VALUES "\
+                        % (table.name, ",".join(insert_fields))
+                params = {}
+                vclauses = []
+                for num, item in enumerate(chunk):
+                    vclauses.append(pattern % {"num": num})
+                    for field in insert_fields:
+                        try:
+                            value = item[field]
+                        except KeyError:
+                            value = defaults[field]
+                        params["%s%d" % (field, num)] = value
+                query += ",".join(vclauses)
+                query += " ON CONFLICT (%s)" % (",".join(pkey_names),)
+                query += " DO UPDATE SET " + ",".join(updates)
+                if is_postgres:
+                    # The system column "xmax" is zero for freshly-inserted
+                    # rows, and non-zero for rows that were updated.
+                    query += " RETURNING (xmax = 0)"
+                    res = self.execute(query, params, annotations)
+                    try:
+                        num_created += sum(1 for row in res if row[0])
+                    finally:
+                        res.close()
+                elif count_created:
+                    num_existing = self._count_existing_rows(table, chunk,
+                                                             annotations)
+                    self.execute(query, params, annotations).close()
+                    num_created += len(chunk) - num_existing
+                else:
+                    self.execute(query, params, annotations).close()
+        return num_created
+
+    def _count_existing_rows(self, table, items, annotations):
+        """Count how many of the given items already exist in the table.
+
+        The items are matched by primary key, to let _upsert_onconflict
+        tell how many rows it is about to update rather than insert.
+        """
+        matches = []
+        for item in items:
+            matches.append(and_(*[key == item[key.name]
+                                  for key in table.primary_key]))
+        query = select([func.count()]).select_from(table)
+        query = query.where(or_(*matches))
+        res = self.execute(query, {}, annotations)
+        try:
+            return res.scalar()
+        finally:
+            res.close()
@@ -15,9 +15,17 @@ string interpolation variables with special meaning:
     * %(bui)s:   insert the name of the user's sharded batch_upload_items table
     * %(ids)s:   insert a list of items matching the "ids" query parameter.
 
+The "ids" query parameter is also expanded into individual bindparams named
+id0 through idN, which functions can use when building their queries.
+
+A function may also have a "shape" attribute, giving a function that maps
+the query parameters to a hashable key.  The query loader will render the
+query to a string once for each distinct key and cache the result, so the
+query must use bindparams for every value that can vary between calls.
+
 """
 
-from sqlalchemy.sql import select, bindparam
+from sqlalchemy.sql import select, bindparam, and_, or_
 
 # Queries operating on all collections in the storage.
 
@@ -38,10 +46,123 @@ COLLECTIONS_SIZES = "SELECT collection, SUM(payload_size) FROM %(bso)s "\
                     "WHERE userid=:userid AND ttl>:ttl "\
                     "GROUP BY collection"
 
+# When the storage is configured with async_deletes, the items of deleted
+# collections linger until they're removed in the background.  These versions
+# leave out any items that are covered by a tombstone.
+
+LIVE_STORAGE_SIZE = """
+    SELECT SUM(payload_size) FROM %(bso)s AS items
+    WHERE userid = :userid AND ttl > :ttl AND NOT EXISTS (
+        SELECT 1 FROM collection_tombstones AS t
+        WHERE t.userid = items.userid AND
+        t.collection IN (0, items.collection) AND
+        t.modified >= items.modified
+    )
+"""
+
+LIVE_COLLECTIONS_COUNTS = """
+    SELECT collection, COUNT(collection) FROM %(bso)s AS items
+    WHERE userid = :userid AND ttl > :ttl AND NOT EXISTS (
+        SELECT 1 FROM collection_tombstones AS t
+        WHERE t.userid = items.userid AND
+        t.collection IN (0, items.collection) AND
+        t.modified >= items.modified
+    )
+    GROUP BY collection
+"""
+
+LIVE_COLLECTIONS_SIZES = """
+    SELECT collection, SUM(payload_size) FROM %(bso)s AS items
+    WHERE userid = :userid AND ttl > :ttl AND NOT EXISTS (
+        SELECT 1 FROM collection_tombstones AS t
+        WHERE t.userid = items.userid AND
+        t.collection IN (0, items.collection) AND
+        t.modified >= items.modified
+    )
+    GROUP BY collection
+"""
+
+# These read the running totals maintained in the user_collections table,
+# for use when the storage is configured with track_collection_usage.
+
+TRACKED_STORAGE_SIZE = "SELECT SUM(total_bytes) FROM user_collections "\
+                       "WHERE userid=:userid"
+
+TRACKED_COLLECTIONS_COUNTS = "SELECT collection, item_count "\
+                             "FROM user_collections "\
+                             "WHERE userid=:userid AND item_count>0"
+
+TRACKED_COLLECTIONS_SIZES = "SELECT collection, total_bytes "\
+                            "FROM user_collections "\
+                            "WHERE userid=:userid AND item_count>0"
+
+RECALCULATE_ALL_COLLECTIONS_USAGE = """
+    UPDATE user_collections
+    SET
+        item_count = (
+            SELECT COUNT(*) FROM %(bso)s WHERE
+                userid = user_collections.userid AND
+                collection = user_collections.collection
+        ),
+        total_bytes = (
+            SELECT COALESCE(SUM(payload_size), 0) FROM %(bso)s WHERE
+                userid = user_collections.userid AND
+                collection = user_collections.collection
+        )
+    WHERE userid = :userid
+"""
+
+# With async_deletes, a recalculation must also leave out any items that are
+# covered by a tombstone, as they're no longer visible to the client.
+
+LIVE_RECALCULATE_ALL_COLLECTIONS_USAGE = """
+    UPDATE user_collections
+    SET
+        item_count = (
+            SELECT COUNT(*) FROM %(bso)s AS items WHERE
+                userid = user_collections.userid AND
+                collection = user_collections.collection AND
+                NOT EXISTS (
+                    SELECT 1 FROM collection_tombstones AS t
+                    WHERE t.userid = items.userid AND
+                    t.collection IN (0, items.collection) AND
+                    t.modified >= items.modified
+                )
+        ),
+        total_bytes = (
+            SELECT COALESCE(SUM(payload_size), 0) FROM %(bso)s AS items WHERE
+                userid = user_collections.userid AND
+                collection = user_collections.collection AND
+                NOT EXISTS (
+                    SELECT 1 FROM collection_tombstones AS t
+                    WHERE t.userid = items.userid AND
+                    t.collection IN (0, items.collection) AND
+                    t.modified >= items.modified
+                )
+        )
+    WHERE userid = :userid
+"""
+
 DELETE_ALL_BSOS = "DELETE FROM %(bso)s WHERE userid=:userid"
 
 DELETE_ALL_COLLECTIONS = "DELETE FROM user_collections WHERE userid=:userid"
 
+# Query for checking the replication lag of a read replica, in seconds.
+# Generically there's no way to tell, so we just check that it's reachable
+# and assume that it's up-to-date.
+
+REPLICA_LAG = "SELECT 0"
+
+# Queries for limiting the time taken by each statement, given the number
+# of seconds remaining before the request's deadline as :timeout, or the
+# number of milliseconds as :timeout_ms.  If there is a reset query then
+# the limit lasts for the life of the connection, otherwise it lasts until
+# the end of the transaction.  Generically there's no way to do this.
+
+SET_STATEMENT_TIMEOUT = None
+
+RESET_STATEMENT_TIMEOUT = None
+
 # Queries for locking/unlocking a collection.
 
 BEGIN_TRANSACTION_READ = None
@@ -67,6 +188,18 @@ COLLECTION_NAME = "SELECT name FROM collections "\
 COLLECTION_NAMES = "SELECT collectionid, name FROM collections "\
                    "WHERE collectionid IN %(ids)s"
 
+# Find the collections in use by the most users, for priming the cache of
+# collection names.  This scans the whole user_collections table.
+
+MOST_USED_COLLECTIONS = """
+    SELECT collections.collectionid, collections.name
+    FROM collections JOIN user_collections
+      ON user_collections.collection = collections.collectionid
+    GROUP BY collections.collectionid, collections.name
+    ORDER BY COUNT(*) DESC
+    LIMIT :limit
+"""
+
 # This adds a dummy collection at (:id - 1) so the next autoincr value is :id.
 SET_MIN_COLLECTION_ID = "INSERT INTO collections (collectionid, name) "\
                         "VALUES (:collectionid - 1, \"\")"
@@ -81,6 +214,92 @@ INIT_COLLECTION = "INSERT INTO user_collections "\
 TOUCH_COLLECTION = "UPDATE user_collections SET last_modified=:modified "\
                    "WHERE userid=:userid AND collection=:collectionid"
 
+TOUCH_COLLECTION_AND_USAGE = "UPDATE user_collections "\
+                             "SET last_modified=:modified, "\
+                             "item_count=item_count+:count_delta, "\
+                             "total_bytes=total_bytes+:bytes_delta "\
+                             "WHERE userid=:userid "\
+                             "AND collection=:collectionid"
+
+INIT_COLLECTION_AND_USAGE = "INSERT INTO user_collections "\
+                            "(userid, collection, last_modified, "\
+                            "item_count, total_bytes) "\
+                            "VALUES (:userid, :collectionid, :modified, "\
+                            ":count_delta, :bytes_delta)"
+
+# With optimistic writes, the collection is only touched if it hasn't been
+# modified at or after the time of the current write.
+
+TOUCH_COLLECTION_IF_OLDER = "UPDATE user_collections "\
+                            "SET last_modified=:modified "\
+                            "WHERE userid=:userid "\
+                            "AND collection=:collectionid "\
+                            "AND last_modified<:modified"
+
+# Where the database supports INSERT ... ON CONFLICT, the collection can be
+# touched with a single query whether or not it already exists.  These are
+# only used if the connector reports support for that syntax.
+
+UPSERT_COLLECTION = """
+    INSERT INTO user_collections
+        (userid, collection, last_modified)
+    VALUES
+        (:userid, :collectionid, :modified)
+    ON CONFLICT (userid, collection) DO UPDATE SET
+        last_modified = excluded.last_modified
+"""
+
+UPSERT_COLLECTION_AND_USAGE = """
+    INSERT INTO user_collections
+        (userid, collection, last_modified, item_count, total_bytes)
+    VALUES
+        (:userid, :collectionid, :modified, :count_delta, :bytes_delta)
+    ON CONFLICT (userid, collection) DO UPDATE SET
+        last_modified = excluded.last_modified,
+        item_count = user_collections.item_count + excluded.item_count,
+        total_bytes = user_collections.total_bytes + excluded.total_bytes
+"""
+
+RECALCULATE_COLLECTION_USAGE = """
+    UPDATE user_collections
+    SET
+        item_count = (
+            SELECT COUNT(*) FROM %(bso)s WHERE
+                userid = :userid AND collection = :collectionid
+        ),
+        total_bytes = (
+            SELECT COALESCE(SUM(payload_size), 0) FROM %(bso)s WHERE
+                userid = :userid AND collection = :collectionid
+        )
+    WHERE userid = :userid AND collection = :collectionid
+"""
+
+LIVE_RECALCULATE_COLLECTION_USAGE = """
+    UPDATE user_collections
+    SET
+        item_count = (
+            SELECT COUNT(*) FROM %(bso)s AS items WHERE
+                userid = :userid AND collection = :collectionid AND
+                NOT EXISTS (
+                    SELECT 1 FROM collection_tombstones AS t
+                    WHERE t.userid = items.userid AND
+                    t.collection IN (0, items.collection) AND
+                    t.modified >= items.modified
+                )
+        ),
+        total_bytes = (
+            SELECT COALESCE(SUM(payload_size), 0) FROM %(bso)s AS items WHERE
+                userid = :userid AND collection = :collectionid AND
+                NOT EXISTS (
+                    SELECT 1 FROM collection_tombstones AS t
+                    WHERE t.userid = items.userid AND
+                    t.collection IN (0, items.collection) AND
+                    t.modified >= items.modified
+                )
+        )
+    WHERE userid = :userid AND collection = :collectionid
+"""
+
 COLLECTION_TIMESTAMP = "SELECT last_modified FROM user_collections "\
                        "WHERE userid=:userid AND collection=:collectionid"
 
@@ -90,9 +309,52 @@ DELETE_COLLECTION_ITEMS = "DELETE FROM %(bso)s WHERE userid=:userid "\
 DELETE_COLLECTION = "DELETE FROM user_collections WHERE userid=:userid "\
                     "AND collection=:collectionid"
 
+# Deleting a collection and reading back the new storage timestamp takes
+# several queries in generic SQL.  Databases that can do it in one should
+# override this to return a (rowcount, storage_timestamp) pair.
+
+DELETE_COLLECTION_AND_ITEMS = None
+
+# Queries for the tombstones of deleted collections, when the storage is
+# configured with async_deletes.  A collection is covered both by its own
+# tombstone and by that of the user's entire storage, in collection zero.
+
+COLLECTION_TOMBSTONE = "SELECT MAX(modified) FROM collection_tombstones "\
+                       "WHERE userid=:userid "\
+                       "AND collection IN (0, :collectionid)"
+
+# Before writing to a collection with a tombstone, any deleted items that
+# are about to be written are removed so that they can't be resurrected.
+
+DELETE_TOMBSTONED_ITEMS = "DELETE FROM %(bso)s WHERE userid=:userid "\
+                          "AND collection=:collectionid AND id IN %(ids)s "\
+                          "AND modified<=:tombstone"
+
+# A collection written to in the same tick as its deletion must have its
+# items deleted immediately instead, since the tombstone would cover the
+# new items too.
+
+DELETE_TOMBSTONED_COLLECTION = "DELETE FROM %(bso)s WHERE userid=:userid "\
+                               "AND collection=:collectionid "\
+                               "AND modified<=:tombstone"
+
+DELETE_TOMBSTONED_BATCH_ITEMS = """
+    DELETE FROM %(bso)s
+    WHERE
+        userid = :userid AND
+        collection = :collection AND
+        modified <= :tombstone AND
+        id IN (
+            SELECT id FROM %(bui)s WHERE batch = :batch AND userid = :userid
+        )
+"""
+
 DELETE_ITEMS = "DELETE FROM %(bso)s WHERE userid=:userid "\
                "AND collection=:collectionid AND id IN %(ids)s"
 
+ITEMS_SIZES = "SELECT id, payload_size FROM %(bso)s WHERE userid=:userid "\
+              "AND collection=:collectionid AND id IN %(ids)s"
+
 CREATE_BATCH = "INSERT INTO batch_uploads (batch, userid, collection) "\
                      "VALUES (:batch, :userid, :collection)"
 
@@ -151,6 +413,57 @@ APPLY_BATCH_UPDATE = """
         )
 """
 
+# When payload compression is enabled, these "_COMPRESSED" variants are used
+# in place of the queries that read or write payloads, so that they also carry
+# the payload_compressed column.  An item in the batch without a payload keeps
+# the existing one, in whichever form it's stored.
+
+APPLY_BATCH_UPDATE_COMPRESSED = """
+    UPDATE %(bso)s
+    SET
+        sortindex = COALESCE(
+            (SELECT sortindex FROM %(bui)s WHERE
+                batch = :batch AND userid = :userid AND id = %(bso)s.id),
+            %(bso)s.sortindex
+        ),
+        payload = COALESCE(
+            (SELECT payload FROM %(bui)s WHERE
+                batch = :batch AND userid = :userid AND id = %(bso)s.id),
+            %(bso)s.payload,
+            ''
+        ),
+        payload_compressed = CASE
+            WHEN (SELECT payload FROM %(bui)s WHERE
+                batch = :batch AND userid = :userid AND id = %(bso)s.id)
+                IS NULL
+            THEN %(bso)s.payload_compressed
+            ELSE (SELECT payload_compressed FROM %(bui)s WHERE
+                batch = :batch AND userid = :userid AND id = %(bso)s.id)
+        END,
+        payload_size = COALESCE(
+            (SELECT payload_size FROM %(bui)s WHERE
+                batch = :batch AND userid = :userid AND id = %(bso)s.id),
+            %(bso)s.payload_size,
+            0
+        ),
+        ttl = COALESCE(
+            (SELECT ttl_offset + :ttl_base FROM %(bui)s WHERE
+                batch = :batch AND userid = :userid AND id = %(bso)s.id),
+            %(bso)s.ttl,
+            :default_ttl
+        ),
+        modified = :modified
+    WHERE
+        userid = :userid AND
+        collection = (
+            SELECT collection FROM batch_uploads
+            WHERE batch = :batch AND userid = :userid
+        ) AND
+        id IN (
+            SELECT id FROM %(bui)s WHERE batch = :batch AND userid = :userid
+        )
+"""
+
 APPLY_BATCH_INSERT = """
     INSERT INTO %(bso)s
         (userid, collection, id, sortindex, payload,
@@ -169,16 +482,76 @@ APPLY_BATCH_INSERT = """
     ON
         %(bui)s.batch = batch_uploads.batch AND
         %(bui)s.userid = batch_uploads.userid
+    LEFT OUTER JOIN %(bso)s AS existing
+    ON
+        existing.userid = batch_uploads.userid AND
+        existing.collection = batch_uploads.collection AND
+        existing.id = %(bui)s.id
     WHERE
         batch_uploads.batch = :batch AND
         batch_uploads.userid = :userid AND
-        %(bui)s.id NOT IN (
-            SELECT id
-            FROM %(bso)s
-            WHERE
-                userid = batch_uploads.userid AND
-                collection = batch_uploads.collection
-        )
+        %(bui)s.id IS NOT NULL AND
+        existing.id IS NULL
+"""
+
+APPLY_BATCH_INSERT_COMPRESSED = """
+    INSERT INTO %(bso)s
+        (userid, collection, id, sortindex, payload, payload_compressed,
+        payload_size, ttl, modified)
+    SELECT
+       batch_uploads.userid,
+       batch_uploads.collection,
+       %(bui)s.id,
+       %(bui)s.sortindex,
+       COALESCE(%(bui)s.payload, ''),
+       %(bui)s.payload_compressed,
+       COALESCE(%(bui)s.payload_size, 0),
+       COALESCE(%(bui)s.ttl_offset + :ttl_base, :default_ttl),
+       :modified
+    FROM batch_uploads
+    LEFT JOIN %(bui)s
+    ON
+        %(bui)s.batch = batch_uploads.batch AND
+        %(bui)s.userid = batch_uploads.userid
+    LEFT OUTER JOIN %(bso)s AS existing
+    ON
+        existing.userid = batch_uploads.userid AND
+        existing.collection = batch_uploads.collection AND
+        existing.id = %(bui)s.id
+    WHERE
+        batch_uploads.batch = :batch AND
+        batch_uploads.userid = :userid AND
+        %(bui)s.id IS NOT NULL AND
+        existing.id IS NULL
+"""
+
+# Databases that support INSERT ... ON CONFLICT can apply a batch in a single
+# query.  There's no generic version, so it's only used if the query for the
+# specific database is available; see SQLStorage.apply_batch().
+
+APPLY_BATCH_UPSERT = None
+
+APPLY_BATCH_UPSERT_COMPRESSED = None
+
+# Calculate how applying a batch will change the number and total size
+# of the items in the collection.
+
+APPLY_BATCH_USAGE = """
+    SELECT
+        COUNT(*) - COUNT(existing.id),
+        COALESCE(SUM(
+            COALESCE(items.payload_size, existing.payload_size, 0) -
+            COALESCE(existing.payload_size, 0)
+        ), 0)
+    FROM %(bui)s AS items
+    LEFT OUTER JOIN %(bso)s AS existing
+    ON
+        existing.userid = items.userid AND
+        existing.collection = :collection AND
+        existing.id = items.id
+    WHERE
+        items.batch = :batch AND
+        items.userid = :userid
 """
 
 CLOSE_BATCH = """
@@ -192,24 +565,30 @@ CLOSE_BATCH_ITEMS = """
 """
 
 
-def FIND_ITEMS(bso, params):
+def FIND_ITEMS(bso, params, nulls_first=False):
     """Item search query.
 
     Unlike all the other pre-built queries, this one really can't be written
     as a simple string.  We need to include/exclude various WHERE clauses
     based on the values provided at runtime.
+
+    The "nulls_first" argument says whether the database sorts null values
+    ahead of all others in a descending sort, and hence where items with
+    no sortindex fall when seeking to a keyset position in sort=index order.
     """
     fields = params.get("fields", None)
     if fields is None:
-        query = select([bso])
+        # The payload_compressed column is only present when payload
+        # compression is configured, in which case fields are always given.
+        query = select([c for c in bso.c if c.name != "payload_compressed"])
     else:
         query = select([bso.c[field] for field in fields])
     query = query.where(bso.c.userid == bindparam("userid"))
     query = query.where(bso.c.collection == bindparam("collectionid"))
     # Filter by the various query parameters.
     if "ids" in params:
-        # Sadly, we can't use a bindparam in an "IN" expression.
-        query = query.where(bso.c.id.in_(params.get("ids")))
+        ids = [bindparam("id%d" % (i,)) for i in xrange(len(params["ids"]))]
+        query = query.where(bso.c.id.in_(ids))
     if "newer" in params:
         query = query.where(bso.c.modified > bindparam("newer"))
     if "newer_eq" in params:
@@ -220,29 +599,82 @@ def FIND_ITEMS(bso, params):
         query = query.where(bso.c.modified <= bindparam("older_eq"))
     if "ttl" in params:
         query = query.where(bso.c.ttl > bindparam("ttl"))
+    if "id_bound" in params:
+        query = query.where(_sortindex_keyset(bso, params, nulls_first))
     # Sort it in the order requested.
     # We always sort by *something*, so that limit/offset work consistently.
     # The default order is by timestamp, which if efficient due to the index.
     # NOTE: ideally we would sort by "id" here as secondary column, to get a
     # consistent total ordering.  But we don't want to bloat the index, so
     # we just assume that the db gives results in a consistent order.
+    # The sortindex index does include "id", which lets us page through
+    # that ordering by keyset rather than by numeric offset.
     sort = params.get("sort", None)
     if sort == 'index':
-        query = query.order_by(bso.c.sortindex.desc())
+        query = query.order_by(bso.c.sortindex.desc(), bso.c.id.desc())
     elif sort == 'oldest':
         query = query.order_by(bso.c.modified.asc())
     else:
         query = query.order_by(bso.c.modified.desc())
     # Apply limit and/or offset.
-    limit = params.get("limit", None)
-    if limit is not None:
-        query = query.limit(limit)
-    offset = params.get("offset", None)
-    if offset is not None:
-        query = query.offset(offset)
+    if params.get("limit", None) is not None:
+        query = query.limit(bindparam("limit"))
+    if params.get("offset", None) is not None:
+        query = query.offset(bindparam("offset"))
     return query
 
 
+def _find_items_shape(params):
+    """Get a key identifying the structure of the FIND_ITEMS query.
+
+    This covers everything that FIND_ITEMS inspects when deciding what
+    query to build, but none of the values that are sent as bindparams.
+    """
+    fields = params.get("fields", None)
+    if fields is not None:
+        fields = tuple(fields)
+    ids = params.get("ids", None)
+    if ids is not None:
+        ids = len(ids)
+    filters = ("newer", "newer_eq", "older", "older_eq", "ttl", "id_bound")
+    return (
+        fields,
+        ids,
+        tuple(name in params for name in filters),
+        params.get("sortindex_bound") is None,
+        params.get("sort", None),
+        params.get("limit", None) is not None,
+        params.get("offset", None) is not None,
+    )
+
+
+FIND_ITEMS.shape = _find_items_shape
+
+
+def _sortindex_keyset(bso, params, nulls_first):
+    """Build a WHERE clause selecting items after a (sortindex, id) bound.
+
+    This matches items that come strictly after the bound item when sorting
+    by (sortindex DESC, id DESC), taking into account whether the database
+    places null sortindexes at the start or the end of that order.
+    """
+    id_after = bso.c.id < bindparam("id_bound")
+    if params.get("sortindex_bound") is None:
+        # The bound is in the run of items with a null sortindex.
+        clause = and_(bso.c.sortindex.is_(None), id_after)
+        if nulls_first:
+            clause = or_(bso.c.sortindex.isnot(None), clause)
+        return clause
+    # The bound is in the run of items with a non-null sortindex.
+    clause = or_(
+        bso.c.sortindex < bindparam("sortindex_bound"),
+        and_(bso.c.sortindex == bindparam("sortindex_bound"), id_after),
+    )
+    if not nulls_first:
+        clause = or_(clause, bso.c.sortindex.is_(None))
+    return clause
+
+
 # Queries operating on a particular item.
 
 DELETE_ITEM = "DELETE FROM %(bso)s WHERE userid=:userid AND "\
@@ -252,29 +684,275 @@ ITEM_DETAILS = "SELECT id, sortindex, modified, payload "\
                "FROM %(bso)s WHERE collection=:collectionid "\
                "AND userid=:userid AND id=:item AND ttl>:ttl"
 
+ITEM_DETAILS_COMPRESSED = "SELECT id, sortindex, modified, payload, "\
+                          "payload_compressed "\
+                          "FROM %(bso)s WHERE collection=:collectionid "\
+                          "AND userid=:userid AND id=:item AND ttl>:ttl"
+
 ITEM_TIMESTAMP = "SELECT modified FROM %(bso)s "\
                  "WHERE collection=:collectionid AND userid=:userid "\
                  "AND id=:item AND ttl>:ttl"
 
 # Administrative queries
 
-# This query nominally deletes *some* expired items, but not necessarily all.
-# The idea is to delete them in small batches to keep overhead low.
-# Unfortunately there's no generic way to achieve this in SQL so the default
-# case winds up deleting all expired items.  There is a MySQL-specific
-# version using DELETE <ttlblah> LIMIT 1000.
+# These queries page through all the items in a table, in primary key order,
+# so that their stored payloads can be re-encoded.  The update is skipped if
+# the item has been modified since it was read.
+
+ITEM_PAYLOADS_PAGE = """
+    SELECT userid, collection, id, modified, payload, payload_compressed
+    FROM %(bso)s
+    WHERE
+        userid > :userid OR
+        (userid = :userid AND collection > :collection) OR
+        (userid = :userid AND collection = :collection AND id > :id)
+    ORDER BY userid, collection, id
+    LIMIT :maxitems
+"""
+
+SET_ITEM_PAYLOAD = """
+    UPDATE %(bso)s
+    SET payload = :payload, payload_compressed = :payload_compressed
+    WHERE userid = :userid AND collection = :collection AND id = :id
+    AND modified = :modified
+"""
+
+# Expired items are purged in chunks, in increasing order of expiry time.
+# Each query covers the range of keys from :start, a checkpoint below which
+# everything has already been purged, up to the cutoff :end, so that it can
+# skip straight past the rows deleted by previous chunks.
+
+# These queries nominally delete *some* expired items, but not necessarily
+# all.  The idea is to delete them in small chunks of :maxitems to keep
+# overhead low.  Unfortunately there's no generic way to achieve this in SQL
+# so the default case winds up deleting all expired items.  There are
+# database-specific versions that limit the number of rows deleted.
+#
+# EXPIRED_ITEMS_COLLECTIONS finds the collections with items in the chunk
+# that PURGE_SOME_EXPIRED_ITEMS is about to delete, so that their running
+# totals can be recalculated once it's gone.  It must cover all those rows.
+# A limited chunk may stop part-way through a run of items with the same
+# ttl, and nothing says which of them go, so the database-specific versions
+# select up to and including the chunk's last ttl.  Recalculating a few
+# extra collections is harmless.
+
+EXPIRED_ITEMS_COLLECTIONS = """
+    SELECT DISTINCT userid, collection FROM %(bso)s
+    WHERE ttl >= :start AND ttl < :end
+"""
 
 PURGE_SOME_EXPIRED_ITEMS = """
     DELETE FROM %(bso)s
-    WHERE ttl < (:now - :grace)
+    WHERE ttl >= :start AND ttl < :end
 """
 
 PURGE_BATCHES = """
     DELETE FROM batch_uploads
-    WHERE batch < (:now - :lifetime - :grace) * 1000
+    WHERE batch >= :start AND batch < :end
 """
 
 PURGE_BATCH_CONTENTS = """
     DELETE FROM %(bui)s
-    WHERE batch < (:now - :lifetime - :grace) * 1000
+    WHERE batch >= :start AND batch < :end
+"""
+
+# These queries find the smallest key that remains to be purged after
+# deleting a chunk, to serve as the checkpoint for the next chunk.
+
+NEXT_EXPIRED_ITEM = """
+    SELECT MIN(ttl) FROM %(bso)s
+    WHERE ttl >= :start AND ttl < :end
+"""
+
+NEXT_EXPIRED_BATCH = """
+    SELECT MIN(batch) FROM batch_uploads
+    WHERE batch >= :start AND batch < :end
+"""
+
+NEXT_EXPIRED_BATCH_CONTENTS = """
+    SELECT MIN(batch) FROM %(bui)s
+    WHERE batch >= :start AND batch < :end
+"""
+
+# The items covered by tombstones are also purged in chunks of :maxitems,
+# with database-specific versions to limit the number of rows deleted.
+# Once there are none left, the tombstone itself is removed unless it
+# was replaced by a newer one in the meantime.
+
+TOMBSTONES = """
+    SELECT userid, collection, modified FROM collection_tombstones
+    ORDER BY userid, collection
+    LIMIT :maxitems
+"""
+
+PURGE_TOMBSTONED_ITEMS = """
+    DELETE FROM %(bso)s
+    WHERE userid = :userid AND collection = :collectionid AND
+    modified <= :tombstone
+"""
+
+PURGE_TOMBSTONED_STORAGE = """
+    DELETE FROM %(bso)s
+    WHERE userid = :userid AND modified <= :tombstone
+"""
+
+DELETE_TOMBSTONE = """
+    DELETE FROM collection_tombstones
+    WHERE userid = :userid AND collection = :collectionid AND
+    modified = :tombstone
+"""
+
+GET_PURGE_CHECKPOINT = """
+    SELECT watermark, chunk_size, num_unoptimized FROM purge_checkpoints
+    WHERE tablename = :tablename
+"""
+
+# Queries for looking up and moving a user's shard, when per-user shard
+# lookups are enabled.  The lookup is done with a shared lock so that it
+# waits for any concurrent move of that user to be committed.
+
+USER_SHARD = "SELECT shard FROM user_shards WHERE userid=:userid"
+
+LOCK_USER_SHARD_READ = "SELECT shard FROM user_shards WHERE userid=:userid "\
+                       "LOCK IN SHARE MODE"
+
+LOCK_USER_SHARD_WRITE = "SELECT shard FROM user_shards WHERE userid=:userid "\
+                        "FOR UPDATE"
+
+LOCK_USER_COLLECTIONS_WRITE = "SELECT collection, last_modified "\
+                              "FROM user_collections "\
+                              "WHERE userid=:userid FOR UPDATE"
+
+USER_COLLECTIONS_IN_TABLE = "SELECT DISTINCT collection FROM %(bso)s "\
+                            "WHERE userid=:userid"
+
+# When moving a user, %(bso)s is the table they're moving from and %(dst)s
+# the table they're moving to.  Items are copied in (collection, id) order,
+# skipping any that have already been copied, so that the copy can be done
+# in chunks and resumed if interrupted.
+
+NEXT_USER_ITEM_KEY = """
+    SELECT collection, id FROM %(bso)s
+    WHERE userid = :userid AND (
+        collection > :start_collection OR
+        (collection = :start_collection AND id > :start_id)
+    )
+    ORDER BY collection, id
+    LIMIT 1 OFFSET :offset
+"""
+
+
+def _copy_items(key_range, compressed=False):
+    """Build a query copying the items in the given key range to %(dst)s.
+
+    The key range is a condition on the (collection, id) of the source items
+    in "src", and the other fields are copied as-is, including the compressed
+    payloads if requested.
+    """
+    payload, src_payload = "payload", "src.payload"
+    if compressed:
+        payload += ", payload_compressed"
+        src_payload += ", src.payload_compressed"
+    return """
+    INSERT INTO %%(dst)s
+        (userid, collection, id, sortindex, modified,
+        %s, payload_size, ttl)
+    SELECT
+        src.userid, src.collection, src.id, src.sortindex, src.modified,
+        %s, src.payload_size, src.ttl
+    FROM %%(bso)s AS src
+    WHERE src.userid = :userid AND %s AND NOT EXISTS (
+        SELECT 1 FROM %%(dst)s AS copied
+        WHERE copied.userid = src.userid AND
+              copied.collection = src.collection AND
+              copied.id = src.id
+    )
+""" % (payload, src_payload, key_range)
+
+
+# Each chunk covers the keys after :start_collection and :start_id, up to and
+# including :end_collection and :end_id, or to the end of the user's items.
+
+_after_start_key = """(
+        src.collection > :start_collection OR
+        (src.collection = :start_collection AND src.id > :start_id)
+    )"""
+
+_up_to_end_key = """(
+        src.collection < :end_collection OR
+        (src.collection = :end_collection AND src.id <= :end_id)
+    )"""
+
+COPY_USER_ITEMS = _copy_items(_after_start_key + " AND " + _up_to_end_key)
+
+COPY_USER_ITEMS_COMPRESSED = _copy_items(
+    _after_start_key + " AND " + _up_to_end_key, compressed=True)
+
+COPY_REMAINING_USER_ITEMS = _copy_items(_after_start_key)
+
+COPY_REMAINING_USER_ITEMS_COMPRESSED = _copy_items(_after_start_key,
+                                                   compressed=True)
+
+# Once the user is locked, only the collections that have changed since the
+# copy began need to be brought up to date, one at a time.
+
+COPY_COLLECTION_ITEMS = _copy_items("src.collection = :collectionid")
+
+COPY_COLLECTION_ITEMS_COMPRESSED = _copy_items(
+    "src.collection = :collectionid", compressed=True)
+
+# Items may have been changed or deleted in the source table since they were
+# copied, whether by an earlier interrupted move or while the copy was in
+# progress.  Writes always update the modified timestamp, except for changes
+# to just the ttl or sortindex, so any copied item that differs from the
+# source in any of these is deleted from the destination to be re-copied.
+
+DELETE_STALE_USER_ITEMS = """
+    DELETE FROM %(dst)s
+    WHERE userid = :userid AND NOT EXISTS (
+        SELECT 1 FROM %(bso)s AS src
+        WHERE src.userid = %(dst)s.userid AND
+              src.collection = %(dst)s.collection AND
+              src.id = %(dst)s.id AND
+              src.modified = %(dst)s.modified AND
+              src.ttl = %(dst)s.ttl AND (
+                src.sortindex = %(dst)s.sortindex OR
+                (src.sortindex IS NULL AND %(dst)s.sortindex IS NULL)
+              )
+    )
+"""
+
+DELETE_STALE_COLLECTION_ITEMS = """
+    DELETE FROM %(dst)s
+    WHERE userid = :userid AND collection = :collectionid AND NOT EXISTS (
+        SELECT 1 FROM %(bso)s AS src
+        WHERE src.userid = %(dst)s.userid AND
+              src.collection = %(dst)s.collection AND
+              src.id = %(dst)s.id AND
+              src.modified = %(dst)s.modified AND
+              src.ttl = %(dst)s.ttl AND (
+                src.sortindex = %(dst)s.sortindex OR
+                (src.sortindex IS NULL AND %(dst)s.sortindex IS NULL)
+              )
+    )
+"""
+
+# Statistics for deciding how to rebalance the shards.
+
+SHARD_STATS = """
+    SELECT COUNT(*), COUNT(DISTINCT userid), COALESCE(SUM(payload_size), 0)
+    FROM %(bso)s
+"""
+
+SHARD_TOP_USERS = """
+    SELECT userid, COUNT(*), COALESCE(SUM(payload_size), 0) AS total_bytes
+    FROM %(bso)s
+    GROUP BY userid
+    ORDER BY total_bytes DESC
+    LIMIT :limit
 """
+
+# Look up a user's entry in the partition map, when per-user partition
+# lookups are enabled.  This is always run against the main database.
+
+USER_PARTITION = "SELECT partitionid FROM user_partitions WHERE userid=:userid"
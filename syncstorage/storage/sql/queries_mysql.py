@@ -8,26 +8,63 @@ This module overrides some queries from queries_generic.py with code
 tailored to MySQL.
 """
 
+# The replication lag is reported in the Seconds_Behind_Master column,
+# which will be NULL if replication is not running.
+
+REPLICA_LAG = "SHOW SLAVE STATUS"
+
+# SELECTs are limited by a MAX_EXECUTION_TIME hint on each query, but that
+# doesn't cover writes.  Waits for row locks are the main way that writes
+# get stuck, and the finest limit on those is in whole seconds.
+
+SET_STATEMENT_TIMEOUT = "SET SESSION innodb_lock_wait_timeout = :timeout"
+
+RESET_STATEMENT_TIMEOUT = "SET SESSION innodb_lock_wait_timeout = DEFAULT"
+
 # MySQL's non-standard DELETE ORDER BY LIMIT is incredibly useful here.
 
 PURGE_SOME_EXPIRED_ITEMS = """
     DELETE FROM %(bso)s
-    WHERE ttl < (:now - :grace)
+    WHERE ttl >= :start AND ttl < :end
     ORDER BY ttl LIMIT :maxitems
 """
 
+EXPIRED_ITEMS_COLLECTIONS = """
+    SELECT DISTINCT userid, collection FROM %(bso)s
+    WHERE ttl >= :start AND ttl < :end AND ttl <= (
+        SELECT MAX(ttl) FROM (
+            SELECT ttl FROM %(bso)s
+            WHERE ttl >= :start AND ttl < :end
+            ORDER BY ttl LIMIT :maxitems
+        ) AS chunk
+    )
+"""
+
 PURGE_BATCHES = """
     DELETE FROM batch_uploads
-    WHERE batch < (:now - :lifetime - :grace) * 1000
+    WHERE batch >= :start AND batch < :end
     ORDER BY batch LIMIT :maxitems
 """
 
 PURGE_BATCH_CONTENTS = """
     DELETE FROM %(bui)s
-    WHERE batch < (:now - :lifetime - :grace) * 1000
+    WHERE batch >= :start AND batch < :end
     ORDER BY batch LIMIT :maxitems
 """
 
+PURGE_TOMBSTONED_ITEMS = """
+    DELETE FROM %(bso)s
+    WHERE userid = :userid AND collection = :collectionid AND
+    modified <= :tombstone
+    ORDER BY id LIMIT :maxitems
+"""
+
+PURGE_TOMBSTONED_STORAGE = """
+    DELETE FROM %(bso)s
+    WHERE userid = :userid AND modified <= :tombstone
+    ORDER BY collection, id LIMIT :maxitems
+"""
+
 OPTIMIZE_BATCHES_TABLE = """
     OPTIMIZE TABLE batch_uploads
 """
@@ -36,8 +73,30 @@ OPTIMIZE_BUI_TABLE = """
     OPTIMIZE TABLE %(bui)s
 """
 
-# MySQL's non-standard ON DUPLICATE KEY UPDATE means we can
-# apply a batch efficiently with a single query.
+# MySQL's non-standard ON DUPLICATE KEY UPDATE means we can touch
+# a collection with a single query, whether or not it already exists.
+
+UPSERT_COLLECTION = """
+    INSERT INTO user_collections
+        (userid, collection, last_modified)
+    VALUES
+        (:userid, :collectionid, :modified)
+    ON DUPLICATE KEY UPDATE
+        last_modified = VALUES(last_modified)
+"""
+
+UPSERT_COLLECTION_AND_USAGE = """
+    INSERT INTO user_collections
+        (userid, collection, last_modified, item_count, total_bytes)
+    VALUES
+        (:userid, :collectionid, :modified, :count_delta, :bytes_delta)
+    ON DUPLICATE KEY UPDATE
+        last_modified = VALUES(last_modified),
+        item_count = item_count + VALUES(item_count),
+        total_bytes = total_bytes + VALUES(total_bytes)
+"""
+
+# Likewise, we can apply a batch efficiently with a single query.
 
 APPLY_BATCH_UPDATE = None
 
@@ -63,3 +122,32 @@ APPLY_BATCH_INSERT = """
         payload_size = COALESCE(%(bui)s.payload_size,
                                 %(bso)s.payload_size)
 """
+
+APPLY_BATCH_UPDATE_COMPRESSED = None
+
+APPLY_BATCH_INSERT_COMPRESSED = """
+    INSERT INTO %(bso)s
+        (userid, collection, id, modified, sortindex,
+        ttl, payload, payload_compressed, payload_size)
+    SELECT
+        :userid, :collection, id, :modified, sortindex,
+        COALESCE(ttl_offset + :ttl_base, :default_ttl),
+        COALESCE(payload, ''),
+        payload_compressed,
+        COALESCE(payload_size, 0)
+    FROM %(bui)s
+    WHERE batch = :batch AND userid = :userid
+    ON DUPLICATE KEY UPDATE
+        modified = :modified,
+        sortindex = COALESCE(%(bui)s.sortindex,
+                             %(bso)s.sortindex),
+        ttl = COALESCE(%(bui)s.ttl_offset + :ttl_base,
+                       %(bso)s.ttl),
+        payload_compressed = IF(%(bui)s.payload IS NULL,
+                                %(bso)s.payload_compressed,
+                                %(bui)s.payload_compressed),
+        payload = COALESCE(%(bui)s.payload,
+                           %(bso)s.payload),
+        payload_size = COALESCE(%(bui)s.payload_size,
+                                %(bso)s.payload_size)
+"""
@@ -8,6 +8,35 @@ This module overrides some queries from queries_generic.py with code
 tailored to PostgreSQL.
 """
 
+from syncstorage.storage.sql import queries_generic
+
+# The replay timestamp only advances when there are transactions to replay,
+# so a replica that has replayed everything it received counts as current.
+# On a primary these functions return NULL, which also counts as current.
+# Before PostgreSQL 10 the "wal" functions were named for the "xlog".
+
+REPLICA_LAG = """
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM
+                              now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+REPLICA_LAG_XLOG = """
+    SELECT CASE
+        WHEN pg_last_xlog_receive_location() =
+             pg_last_xlog_replay_location() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM
+                              now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+# A local setting is undone at the end of the transaction, including on
+# rollback, so there's never any need to reset it.
+
+SET_STATEMENT_TIMEOUT = "SET LOCAL statement_timeout = :timeout_ms"
+
 # Queries for locking/unlocking a collection.
 
 LOCK_COLLECTION_READ = "SELECT last_modified FROM user_collections "\
@@ -18,6 +47,9 @@ LOCK_COLLECTION_WRITE = "SELECT last_modified FROM user_collections "\
                         "WHERE userid=:userid AND collection=:collectionid "\
                         "FOR UPDATE"
 
+LOCK_USER_SHARD_READ = "SELECT shard FROM user_shards WHERE userid=:userid "\
+                       "FOR SHARE"
+
 # Postgres aborts the active transaction when it hits a constraint error.
 # The app expects to be able to execute these queries, catch an IntegrityError,
 # and keep running.  Since Postgres can't do that, we have to try to ensure
@@ -35,6 +67,38 @@ INIT_COLLECTION = "INSERT INTO user_collections "\
                   "    (SELECT 1 FROM user_collections "\
                   "     WHERE userid=:userid AND collection=:collectionid)"
 
+INIT_COLLECTION_AND_USAGE = "INSERT INTO user_collections "\
+                            "(userid, collection, last_modified, "\
+                            "item_count, total_bytes) "\
+                            "  SELECT :userid, :collectionid, :modified, "\
+                            "         :count_delta, :bytes_delta "\
+                            "  WHERE NOT EXISTS "\
+                            "    (SELECT 1 FROM user_collections "\
+                            "     WHERE userid=:userid "\
+                            "     AND collection=:collectionid)"
+
+# Data-modifying statements in a WITH clause let us delete a collection and
+# read back the new storage timestamp in a single round-trip.  The outer
+# SELECT sees the data as it was before the deletes, so it must explicitly
+# exclude the deleted collection.
+
+DELETE_COLLECTION_AND_ITEMS = """
+    WITH deleted_items AS (
+        DELETE FROM %(bso)s
+        WHERE userid = :userid AND collection = :collectionid
+        RETURNING 1
+    ), deleted_collection AS (
+        DELETE FROM user_collections
+        WHERE userid = :userid AND collection = :collectionid
+        RETURNING 1
+    )
+    SELECT
+        (SELECT COUNT(*) FROM deleted_items) +
+        (SELECT COUNT(*) FROM deleted_collection),
+        (SELECT MAX(last_modified) FROM user_collections
+         WHERE userid = :userid AND collection <> :collectionid)
+"""
+
 # Postgres uses a special sequence thingamabob to handle auto-increment
 # columns, so we need a special way to pin its minimum value.
 
@@ -54,15 +118,139 @@ END;
 $do$;
 """.strip()
 
-# Postgres seems to want to do 32-bit integer math by default,
-# so coerce things into bigints to avoid overflow.
+# From PostgreSQL 9.5 we can use ON CONFLICT DO UPDATE to apply a batch in
+# a single query.  Unlike MySQL's ON DUPLICATE KEY UPDATE, the update clause
+# can't refer back to the batch item that caused the conflict, so we join
+# onto the original table in the SELECT clause and coalesce with the existing
+# values there, as for SQLite's INSERT OR REPLACE.
+
+APPLY_BATCH_UPSERT = """
+    INSERT INTO %(bso)s
+        (userid, collection, id, sortindex, payload,
+        payload_size, ttl, modified)
+    SELECT
+       :userid,
+       :collection,
+       items.id,
+       COALESCE(items.sortindex, existing.sortindex),
+       COALESCE(items.payload, existing.payload, ''),
+       COALESCE(items.payload_size, existing.payload_size, 0),
+       COALESCE(items.ttl_offset + :ttl_base, existing.ttl, :default_ttl),
+       :modified
+    FROM %(bui)s AS items
+    LEFT OUTER JOIN %(bso)s AS existing
+    ON
+        existing.userid = items.userid AND
+        existing.collection = :collection AND
+        existing.id = items.id
+    WHERE
+        items.batch = :batch AND
+        items.userid = :userid
+    ON CONFLICT (userid, collection, id) DO UPDATE SET
+        sortindex = excluded.sortindex,
+        payload = excluded.payload,
+        payload_size = excluded.payload_size,
+        ttl = excluded.ttl,
+        modified = excluded.modified
+"""
+
+APPLY_BATCH_UPSERT_COMPRESSED = """
+    INSERT INTO %(bso)s
+        (userid, collection, id, sortindex, payload, payload_compressed,
+        payload_size, ttl, modified)
+    SELECT
+       :userid,
+       :collection,
+       items.id,
+       COALESCE(items.sortindex, existing.sortindex),
+       COALESCE(items.payload, existing.payload, ''),
+       CASE WHEN items.payload IS NULL
+            THEN existing.payload_compressed
+            ELSE items.payload_compressed END,
+       COALESCE(items.payload_size, existing.payload_size, 0),
+       COALESCE(items.ttl_offset + :ttl_base, existing.ttl, :default_ttl),
+       :modified
+    FROM %(bui)s AS items
+    LEFT OUTER JOIN %(bso)s AS existing
+    ON
+        existing.userid = items.userid AND
+        existing.collection = :collection AND
+        existing.id = items.id
+    WHERE
+        items.batch = :batch AND
+        items.userid = :userid
+    ON CONFLICT (userid, collection, id) DO UPDATE SET
+        sortindex = excluded.sortindex,
+        payload = excluded.payload,
+        payload_compressed = excluded.payload_compressed,
+        payload_size = excluded.payload_size,
+        ttl = excluded.ttl,
+        modified = excluded.modified
+"""
+
+# PostgreSQL has no DELETE LIMIT, but we can delete a limited chunk
+# of rows by selecting their physical row ids in a subquery.
+
+PURGE_SOME_EXPIRED_ITEMS = """
+    DELETE FROM %(bso)s WHERE ctid IN (
+        SELECT ctid FROM %(bso)s
+        WHERE ttl >= :start AND ttl < :end
+        ORDER BY ttl LIMIT :maxitems
+    )
+"""
+
+EXPIRED_ITEMS_COLLECTIONS = """
+    SELECT DISTINCT userid, collection FROM %(bso)s
+    WHERE ttl >= :start AND ttl < :end AND ttl <= (
+        SELECT MAX(ttl) FROM (
+            SELECT ttl FROM %(bso)s
+            WHERE ttl >= :start AND ttl < :end
+            ORDER BY ttl LIMIT :maxitems
+        ) AS chunk
+    )
+"""
 
 PURGE_BATCHES = """
-    DELETE FROM batch_uploads
-    WHERE batch < (:now - :lifetime - :grace)::BIGINT * 1000
+    DELETE FROM batch_uploads WHERE ctid IN (
+        SELECT ctid FROM batch_uploads
+        WHERE batch >= :start AND batch < :end
+        ORDER BY batch LIMIT :maxitems
+    )
 """
 
 PURGE_BATCH_CONTENTS = """
-    DELETE FROM %(bui)s
-    WHERE batch < (:now - :lifetime - :grace)::BIGINT * 1000
+    DELETE FROM %(bui)s WHERE ctid IN (
+        SELECT ctid FROM %(bui)s
+        WHERE batch >= :start AND batch < :end
+        ORDER BY batch LIMIT :maxitems
+    )
+"""
+
+PURGE_TOMBSTONED_ITEMS = """
+    DELETE FROM %(bso)s WHERE ctid IN (
+        SELECT ctid FROM %(bso)s
+        WHERE userid = :userid AND collection = :collectionid AND
+        modified <= :tombstone
+        LIMIT :maxitems
+    )
+"""
+
+PURGE_TOMBSTONED_STORAGE = """
+    DELETE FROM %(bso)s WHERE ctid IN (
+        SELECT ctid FROM %(bso)s
+        WHERE userid = :userid AND modified <= :tombstone
+        LIMIT :maxitems
+    )
 """
+
+
+def FIND_ITEMS(bso, params):
+    """Item search query.
+
+    PostgreSQL treats null values as larger than all others, so they come
+    first in a descending sort.  Adjust the keyset seek to match.
+    """
+    return queries_generic.FIND_ITEMS(bso, params, nulls_first=True)
+
+
+FIND_ITEMS.shape = queries_generic.FIND_ITEMS.shape
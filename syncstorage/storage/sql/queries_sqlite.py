@@ -14,12 +14,24 @@ BEGIN_TRANSACTION_READ = "BEGIN DEFERRED TRANSACTION"
 
 BEGIN_TRANSACTION_WRITE = "BEGIN EXCLUSIVE TRANSACTION"
 
+# In WAL mode readers don't conflict with the writer, so writes need only
+# keep other writers out.  This replaces BEGIN_TRANSACTION_WRITE there.
+
+BEGIN_TRANSACTION_WRITE_WAL = "BEGIN IMMEDIATE TRANSACTION"
+
 LOCK_COLLECTION_READ = "SELECT last_modified FROM user_collections "\
                        "WHERE userid=:userid AND collection=:collectionid"
 
 LOCK_COLLECTION_WRITE = "SELECT last_modified FROM user_collections "\
                         "WHERE userid=:userid AND collection=:collectionid"
 
+LOCK_USER_SHARD_READ = "SELECT shard FROM user_shards WHERE userid=:userid"
+
+LOCK_USER_SHARD_WRITE = "SELECT shard FROM user_shards WHERE userid=:userid"
+
+LOCK_USER_COLLECTIONS_WRITE = "SELECT collection, last_modified "\
+                              "FROM user_collections WHERE userid=:userid"
+
 # We can use INSERT OR REPLACE to apply a batch in a single query.
 # However, to correctly cope with with partial data udpates, we need
 # to join onto the original table in the SELECT clause so that we
@@ -52,5 +64,95 @@ APPLY_BATCH_INSERT = """
         existing.id = %(bui)s.id
     WHERE
         batch_uploads.batch = :batch AND
-        batch_uploads.userid = :userid
+        batch_uploads.userid = :userid AND
+        %(bui)s.id IS NOT NULL
+"""
+
+APPLY_BATCH_UPDATE_COMPRESSED = None
+
+APPLY_BATCH_INSERT_COMPRESSED = """
+    INSERT OR REPLACE INTO %(bso)s
+        (userid, collection, id, sortindex, payload, payload_compressed,
+        payload_size, ttl, modified)
+    SELECT
+       batch_uploads.userid,
+       batch_uploads.collection,
+       %(bui)s.id,
+       COALESCE(%(bui)s.sortindex, existing.sortindex),
+       COALESCE(%(bui)s.payload, existing.payload, ''),
+       CASE WHEN %(bui)s.payload IS NULL
+            THEN existing.payload_compressed
+            ELSE %(bui)s.payload_compressed END,
+       COALESCE(%(bui)s.payload_size, existing.payload_size, 0),
+       COALESCE(%(bui)s.ttl_offset + :ttl_base, existing.ttl, :default_ttl),
+       :modified
+    FROM batch_uploads
+    LEFT JOIN %(bui)s
+    ON
+        %(bui)s.batch = batch_uploads.batch AND
+        %(bui)s.userid = batch_uploads.userid
+    LEFT OUTER JOIN %(bso)s AS existing
+    ON
+        existing.userid = batch_uploads.userid AND
+        existing.collection = batch_uploads.collection AND
+        existing.id = %(bui)s.id
+    WHERE
+        batch_uploads.batch = :batch AND
+        batch_uploads.userid = :userid AND
+        %(bui)s.id IS NOT NULL
+"""
+
+# SQLite only supports DELETE LIMIT if compiled with a special option,
+# but we can delete a limited chunk of rows by selecting their rowids.
+
+PURGE_SOME_EXPIRED_ITEMS = """
+    DELETE FROM %(bso)s WHERE rowid IN (
+        SELECT rowid FROM %(bso)s
+        WHERE ttl >= :start AND ttl < :end
+        ORDER BY ttl LIMIT :maxitems
+    )
+"""
+
+EXPIRED_ITEMS_COLLECTIONS = """
+    SELECT DISTINCT userid, collection FROM %(bso)s
+    WHERE ttl >= :start AND ttl < :end AND ttl <= (
+        SELECT MAX(ttl) FROM (
+            SELECT ttl FROM %(bso)s
+            WHERE ttl >= :start AND ttl < :end
+            ORDER BY ttl LIMIT :maxitems
+        ) AS chunk
+    )
+"""
+
+PURGE_BATCHES = """
+    DELETE FROM batch_uploads WHERE rowid IN (
+        SELECT rowid FROM batch_uploads
+        WHERE batch >= :start AND batch < :end
+        ORDER BY batch LIMIT :maxitems
+    )
+"""
+
+PURGE_BATCH_CONTENTS = """
+    DELETE FROM %(bui)s WHERE rowid IN (
+        SELECT rowid FROM %(bui)s
+        WHERE batch >= :start AND batch < :end
+        ORDER BY batch LIMIT :maxitems
+    )
+"""
+
+PURGE_TOMBSTONED_ITEMS = """
+    DELETE FROM %(bso)s WHERE rowid IN (
+        SELECT rowid FROM %(bso)s
+        WHERE userid = :userid AND collection = :collectionid AND
+        modified <= :tombstone
+        LIMIT :maxitems
+    )
+"""
+
+PURGE_TOMBSTONED_STORAGE = """
+    DELETE FROM %(bso)s WHERE rowid IN (
+        SELECT rowid FROM %(bso)s
+        WHERE userid = :userid AND modified <= :tombstone
+        LIMIT :maxitems
+    )
 """
@@ -0,0 +1,164 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+In-process statistics for the named queries run against the database.
+
+Each named query run by a DBConnection is recorded here along with the time
+it took and the number of rows that it returned or affected.  The figures
+are aggregated per query name, and every "query_stats_interval" seconds a
+summary is written to the "syncstorage.storage.sql.querystats" logger.  As
+with the per-request metrics, the figures are attached to the log record as
+extra fields named "syncstorage.storage.sql.query.<NAME>.<stat>", so they
+can be shipped on to statsd by the same log processing.
+
+Latency percentiles are calculated from a random sample of at most
+MAX_SAMPLES timings per query name in each interval, so that the memory
+used stays bounded no matter how busy the server is.
+"""
+
+import time
+import random
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of timings to keep per query name in each interval.
+MAX_SAMPLES = 1000
+
+# Latency percentiles to report for each query name.
+PERCENTILES = (50, 95, 99)
+
+# Prefix for the names of the metrics reported for each query.
+QUERY_METRIC_PREFIX = "syncstorage.storage.sql.query"
+
+
+class QueryHistogram(object):
+    """Latency and row-count figures for a single named query."""
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.count = 0
+        self.total_time = 0
+        self.max_time = 0
+        self.total_rows = 0
+        self.samples = []
+
+    def add(self, duration, rows=None):
+        """Add one run of the query, with its duration in seconds."""
+        self.count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        if rows is not None and rows > 0:
+            self.total_rows += rows
+        # Once the sample is full, each new timing replaces a random one with
+        # decreasing probability, so that all of them are equally likely to
+        # be included.
+        if len(self.samples) < self.max_samples:
+            self.samples.append(duration)
+        else:
+            idx = random.randrange(self.count)
+            if idx < self.max_samples:
+                self.samples[idx] = duration
+
+    def percentile(self, pct):
+        """Get the given percentile of the sampled durations, in seconds."""
+        if not self.samples:
+            return 0
+        samples = sorted(self.samples)
+        idx = int(round(pct / 100.0 * (len(samples) - 1)))
+        return samples[idx]
+
+    def summary(self):
+        """Get a dict summarizing the figures, with times in milliseconds."""
+        summary = {
+            "count": self.count,
+            "mean": self.total_time * 1000 / max(self.count, 1),
+            "max": self.max_time * 1000,
+            "rows": self.total_rows,
+        }
+        for pct in PERCENTILES:
+            summary["p%d" % (pct,)] = self.percentile(pct) * 1000
+        return summary
+
+
+class QueryStats(object):
+    """Per-query-name statistics, periodically flushed to the log.
+
+    Recording is safe to do from multiple threads.  The flush is done by
+    whichever thread first records a query after the interval has passed,
+    so no background thread is needed.  An interval of zero disables the
+    automatic flush.
+    """
+
+    def __init__(self, flush_interval=60):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._last_flush = time.time()
+
+    def record(self, query_name, duration, rows=None):
+        """Record one run of the named query."""
+        histograms = None
+        with self._lock:
+            try:
+                histogram = self._histograms[query_name]
+            except KeyError:
+                histogram = self._histograms[query_name] = QueryHistogram()
+            histogram.add(duration, rows)
+            if self.flush_interval:
+                now = time.time()
+                if now - self._last_flush >= self.flush_interval:
+                    histograms = self._swap_histograms(now)
+        if histograms:
+            self._log_summaries(histograms)
+
+    def flush(self):
+        """Log the figures collected so far, and start afresh.
+
+        This returns a dict mapping each query name to its summary.
+        """
+        with self._lock:
+            histograms = self._swap_histograms(time.time())
+        return self._log_summaries(histograms)
+
+    def _swap_histograms(self, now):
+        """Take the current histograms, replacing them with a fresh set."""
+        histograms = self._histograms
+        self._histograms = {}
+        self._last_flush = now
+        return histograms
+
+    def _log_summaries(self, histograms):
+        """Write a summary of the given histograms to the log."""
+        summaries = {}
+        metrics = {}
+        for query_name, histogram in histograms.iteritems():
+            summary = summaries[query_name] = histogram.summary()
+            for stat, value in summary.iteritems():
+                metric = "%s.%s.%s" % (QUERY_METRIC_PREFIX, query_name, stat)
+                metrics[metric] = value
+        if summaries:
+            logger.info("Statistics for %d named queries", len(summaries),
+                        extra=metrics)
+        return summaries
+
+
+def get_params_shape(params):
+    """Describe the shape of some query parameters, without their values.
+
+    This lists the names of the parameters, along with the length of any
+    lists.  The individual "idN" parameters that are expanded from a list of
+    "ids" are left out, since the length of that list covers them.
+    """
+    shape = []
+    for name, value in sorted(params.iteritems()):
+        if isinstance(value, (list, tuple)):
+            shape.append("%s[%d]" % (name, len(value)))
+        elif "ids" in params and name[:2] == "id" and name[2:].isdigit():
+            continue
+        else:
+            shape.append(name)
+    return ",".join(shape)
@@ -0,0 +1,135 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Shard maps for assigning users to sharded BSO tables or database partitions.
+
+When sharding is enabled, each user's items are stored in one of the tables
+"bso0" through "bsoN".  A shard map is the function that picks the table for
+each userid.  The following maps are available, selected by name via the
+"shard_map" setting:
+
+    * modulo:           use (userid % size), as in the original scheme
+    * consistent_hash:  place users on a consistent-hash ring of shards, so
+                        that adding a shard moves only about 1/N of them
+    * range:            assign contiguous ranges of userids to each shard,
+                        split at the list of boundaries given by the
+                        "shard_boundaries" setting
+
+The same maps are used to assign users to database partitions, i.e. to
+separate database servers, via the "partition_map" setting.
+
+Independently of the map in use, the "shard_lookup" setting enables a table
+of per-user overrides.  Users with an entry in that table are stored in the
+shard it names, and all others fall back to the static map.  This allows
+individual users to be moved between shards, and lets more shards be added
+without moving everyone: increase "shardsize" to create the new tables while
+keeping "shard_map_size" at its previous value, then move users across.
+"""
+
+import bisect
+import hashlib
+
+
+# Number of points that each shard gets on the consistent-hash ring.
+# More points give a more even distribution at the cost of a larger ring.
+DEFAULT_POINTS_PER_SHARD = 100
+
+
+class ShardMap(object):
+    """Base class for static maps from userids to shard indexes."""
+
+    def __init__(self, size):
+        self.size = int(size)
+        if self.size < 1:
+            raise ValueError("Shard map must have at least one shard")
+
+    def get_shard(self, userid):
+        """Get the index of the shard for the given userid."""
+        raise NotImplementedError
+
+
+class ModuloShardMap(ShardMap):
+    """Shard map that assigns users to shards by simple modulo."""
+
+    def get_shard(self, userid):
+        return userid % self.size
+
+
+class ConsistentHashShardMap(ShardMap):
+    """Shard map that places users on a consistent-hash ring of shards.
+
+    Each shard owns several points on a hash ring, and each user belongs to
+    the shard owning the first point at or after the hash of their userid.
+    Growing the ring by one shard only moves the users whose hashes fall
+    just before the new shard's points.
+    """
+
+    def __init__(self, size, points_per_shard=DEFAULT_POINTS_PER_SHARD):
+        super(ConsistentHashShardMap, self).__init__(size)
+        ring = []
+        for shard in xrange(self.size):
+            for point in xrange(int(points_per_shard)):
+                ring.append((_hash("%d-%d" % (shard, point)), shard))
+        ring.sort()
+        self._hashes = [h for (h, _) in ring]
+        self._shards = [shard for (_, shard) in ring]
+
+    def get_shard(self, userid):
+        idx = bisect.bisect_left(self._hashes, _hash(str(userid)))
+        if idx == len(self._hashes):
+            idx = 0
+        return self._shards[idx]
+
+
+class RangeShardMap(ShardMap):
+    """Shard map that assigns contiguous ranges of userids to each shard.
+
+    The boundaries are the smallest userid in each shard after the first,
+    so there must be one fewer boundary than there are shards.  Since new
+    userids are allocated in increasing order, this lets new users be sent
+    to a new shard by adding a boundary above the current maximum userid.
+    They may be given as a list, a single integer, or a string of values
+    separated by commas or whitespace, as read from a config file.
+    """
+
+    def __init__(self, size, boundaries=()):
+        super(RangeShardMap, self).__init__(size)
+        if isinstance(boundaries, (int, long)):
+            boundaries = [boundaries]
+        elif isinstance(boundaries, basestring):
+            boundaries = boundaries.replace(",", " ").split()
+        self.boundaries = [int(b) for b in boundaries]
+        if len(self.boundaries) != self.size - 1:
+            msg = "Range shard map needs %d boundaries, got %d"
+            raise ValueError(msg % (self.size - 1, len(self.boundaries)))
+        if self.boundaries != sorted(self.boundaries):
+            raise ValueError("Range shard map boundaries must be sorted")
+
+    def get_shard(self, userid):
+        return bisect.bisect_right(self.boundaries, userid)
+
+
+SHARD_MAPS = {
+    "modulo": ModuloShardMap,
+    "consistent_hash": ConsistentHashShardMap,
+    "range": RangeShardMap,
+}
+
+
+def get_shard_map(name, size, **kwds):
+    """Create the named shard map, with the given number of shards.
+
+    Any additional keyword arguments are passed on to the map's constructor,
+    e.g. the "boundaries" of a range map.
+    """
+    try:
+        shard_map_class = SHARD_MAPS[name]
+    except KeyError:
+        raise ValueError("Unknown shard map: %r" % (name,))
+    return shard_map_class(size, **kwds)
+
+
+def _hash(value):
+    """Hash a string to a large integer, stable across processes."""
+    return int(hashlib.md5(value).hexdigest()[:16], 16)
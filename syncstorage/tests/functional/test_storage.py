@@ -35,9 +35,9 @@ from syncstorage.tests.functional.support import StorageFunctionalTestCase
 from syncstorage.tests.functional.support import run_live_functional_tests
 from syncstorage.util import json_loads, json_dumps
 from syncstorage.tweens import WEAVE_INVALID_WBO, WEAVE_SIZE_LIMIT_EXCEEDED
-from syncstorage.storage import ConflictError
+from syncstorage.storage import ConflictError, get_client_known_timestamp
 from syncstorage.views.validators import BATCH_MAX_IDS
-from syncstorage.views.util import get_limit_config
+from syncstorage.views.util import get_limit_config, PageSizer
 
 from mozsvc.exceptions import BackendError
 
@@ -73,6 +73,9 @@ class TestStorage(StorageFunctionalTestCase):
         finally:
             self.root = orig_root
 
+    def _assert_weave_records(self, resp, count):
+        self.assertEquals(int(resp.headers['X-Weave-Records']), count)
+
     def test_get_info_collections(self):
         # col1 gets 3 items, col2 gets 5 items.
         bsos = [{"id": str(i), "payload": "xxx"} for i in xrange(3)]
@@ -145,7 +148,7 @@ class TestStorage(StorageFunctionalTestCase):
         res = resp.json
         res.sort()
         self.assertEquals(res, ['0', '1', '2', '3', '4'])
-        self.assertEquals(int(resp.headers['X-Weave-Records']), 5)
+        self._assert_weave_records(resp, 5)
 
         # trying various filters
 
@@ -1421,6 +1424,43 @@ class TestStorage(StorageFunctionalTestCase):
                 self.assertEquals(sorted(int(item['id']) for item in items),
                                   range(0, start))
 
+    def test_pagination_with_sort_by_index(self):
+        # Fourteen bsos sharing a handful of sortindexes, some with none
+        # at all, and with ids that contain the token separator character.
+        bsos = []
+        for i in range(14):
+            bso = {'id': 'item:%02d' % (i,), 'payload': 'x'}
+            if i % 5 != 4:
+                bso['sortindex'] = i % 3
+            bsos.append(bso)
+        self.app.post_json(self.root + '/storage/col2', bsos)
+
+        query_url = self.root + '/storage/col2?full=true&sort=index'
+        expected = [item['id'] for item in self.app.get(query_url).json]
+        self.assertEquals(sorted(expected), sorted(b['id'] for b in bsos))
+
+        # Try with several different pagination sizes,
+        # to hit various boundary conditions.
+        for limit in (1, 2, 3, 4, 5, 13):
+            items = []
+            res = self.app.get(query_url + '&limit=%s' % (limit,))
+            items.extend(item['id'] for item in res.json)
+            next_offset = res.headers.get('X-Weave-Next-Offset')
+            while next_offset is not None:
+                res = self.app.get(query_url + '&limit=%s&offset=%s'
+                                   % (limit, next_offset))
+                self.assertTrue(len(res.json) <= limit)
+                items.extend(item['id'] for item in res.json)
+                next_offset = res.headers.get('X-Weave-Next-Offset')
+            self.assertEquals(items, expected)
+
+        # Plain numeric offsets issued by older servers are still accepted.
+        res = self.app.get(query_url + '&limit=4&offset=8')
+        self.assertEquals([item['id'] for item in res.json], expected[8:12])
+
+        # Garbage offsets are rejected.
+        self.app.get(query_url + '&offset=x:aXRlbQ', status=400)
+
     def assertCloseEnough(self, val1, val2, delta=0.05):
         if abs(val1 - val2) < delta:
             return True
@@ -1474,7 +1514,7 @@ class TestStorage(StorageFunctionalTestCase):
         res = resp.json
         res.sort()
         self.assertEquals(res, ['12', '13', '14', 'a', 'b', 'c'])
-        self.assertEquals(int(resp.headers['X-Weave-Records']), 6)
+        self._assert_weave_records(resp, 6)
         resp = self.app.get(endpoint + '/13')
         self.assertEquals(resp.json['payload'], 'portnoy')
         self.assertEquals(committed, float(resp.headers['X-Last-Modified']))
@@ -2138,6 +2178,116 @@ class TestStoragePaginated(TestStorage):
     TEST_INI_FILE = "tests-paginated.ini"
 
 
+class TestStorageAdaptivePagination(TestStorage):
+    """Storage testcases run using internal pages of varying size."""
+
+    TEST_INI_FILE = "tests-adaptive-pagination.ini"
+
+    def test_page_size_adapts_to_page_time_and_load(self):
+        sizer = PageSizer(4, min_size=2, max_size=16, target_time=1)
+        # Fast pages on an idle backend grow up to the max size.
+        self.assertEquals(sizer.update(0.1), 8)
+        self.assertEquals(sizer.update(0.1, load=0.1), 16)
+        self.assertEquals(sizer.update(0.1), 16)
+        # Moderate page times or load leave it unchanged.
+        self.assertEquals(sizer.update(0.7), 16)
+        self.assertEquals(sizer.update(0.1, load=0.6), 16)
+        # Slow pages or a busy backend shrink it down to the min size.
+        self.assertEquals(sizer.update(1.5), 8)
+        self.assertEquals(sizer.update(0.1, load=0.9), 4)
+        self.assertEquals(sizer.update(2), 2)
+        self.assertEquals(sizer.update(2), 2)
+        # Without a min or max, the size is fixed.
+        sizer = PageSizer(4)
+        self.assertEquals(sizer.update(0), 4)
+        self.assertEquals(sizer.update(10), 4)
+
+    def test_adaptive_pages_fetch_every_item(self):
+        bsos = [{"id": str(i), "payload": "x"} for i in xrange(50)]
+        self.app.post_json(self.root + "/storage/col1", bsos)
+        resp = self.app.get(self.root + "/storage/col1?full=1")
+        self.assertEquals(sorted(int(bso["id"]) for bso in resp.json),
+                          range(50))
+        resp = self.app.get(self.root + "/storage/col1?limit=30&sort=index")
+        self.assertEquals(len(resp.json), 30)
+        self.assertTrue("X-Weave-Next-Offset" in resp.headers)
+
+
+class TestStorageStreaming(TestStorage):
+    """Storage testcases run using internal pagination with streaming."""
+
+    TEST_INI_FILE = "tests-streaming.ini"
+
+    def _assert_weave_records(self, resp, count):
+        # Responses that span several internal pages are streamed out,
+        # and so cannot report the number of records up front.
+        if count > 4:
+            self.assertTrue("X-Weave-Records" not in resp.headers)
+        else:
+            super(TestStorageStreaming, self)._assert_weave_records(resp,
+                                                                    count)
+
+    def test_streaming_of_multi_page_responses(self):
+        bsos = [{"id": str(i), "payload": "x\ny"} for i in xrange(10)]
+        self.app.post_json(self.root + "/storage/col1", bsos)
+        # The json-formatted response should be a single well-formed list.
+        resp = self.app.get(self.root + "/storage/col1?full=1")
+        self.assertTrue("X-Weave-Records" not in resp.headers)
+        self.assertTrue("X-Weave-Next-Offset" not in resp.headers)
+        res = sorted(resp.json, key=lambda bso: int(bso["id"]))
+        self.assertEquals([bso["id"] for bso in res], map(str, xrange(10)))
+        self.assertEquals([bso["payload"] for bso in res], ["x\ny"] * 10)
+        # The newlines-formatted response should have one line per item.
+        headers = {"Accept": "application/newlines"}
+        resp = self.app.get(self.root + "/storage/col1", headers=headers)
+        lines = resp.body.strip().split("\n")
+        self.assertEquals(sorted(lines, key=lambda id: int(json.loads(id))),
+                          ['"%d"' % (i,) for i in xrange(10)])
+        # Explicitly-limited requests are not streamed.
+        resp = self.app.get(self.root + "/storage/col1?limit=6")
+        self.assertEquals(int(resp.headers["X-Weave-Records"]), 6)
+        self.assertTrue("X-Weave-Next-Offset" in resp.headers)
+
+
+class TestStorageStreamingWithReplicas(TestStorageStreaming):
+    """Storage testcases run using streamed pages read from a replica."""
+
+    TEST_INI_FILE = "tests-streaming-replicas.ini"
+
+    def test_streamed_pages_check_replica_freshness(self):
+        # This can't be run against a live server.
+        if self.distant:
+            raise unittest2.SkipTest
+        storage = self.config.registry["syncstorage:storage:default"]
+        known_timestamps = []
+        orig_replica_is_fresh = storage._replica_is_fresh
+
+        def replica_is_fresh(session, userid):
+            known_timestamps.append(get_client_known_timestamp())
+            return orig_replica_is_fresh(session, userid)
+
+        storage._replica_is_fresh = replica_is_fresh
+        self.addCleanup(delattr, storage, "_replica_is_fresh")
+        resp = self.app.post_json(self.root + "/storage/col1",
+                                  [{"id": "old", "payload": "x"}])
+        newer = resp.json["modified"]
+        bsos = [{"id": str(i), "payload": "x"} for i in xrange(10)]
+        resp = self.app.post_json(self.root + "/storage/col1", bsos)
+        last_modified = resp.json["modified"]
+        del known_timestamps[:]
+        resp = self.app.get(self.root + "/storage/col1?full=1&newer=%.2f"
+                            % (newer,))
+        self.assertEquals(sorted(int(bso["id"]) for bso in resp.json),
+                          range(10))
+        # Every page, including those fetched while the response body was
+        # being sent, was read with the client's known timestamp in hand.
+        # Later pages also know the collection's timestamp from the first.
+        self.assertTrue(len(known_timestamps) >= 3)
+        self.assertEquals(map(float, known_timestamps),
+                          [newer] + [last_modified] *
+                          (len(known_timestamps) - 1))
+
+
 class TestStorageWithBatchUploadDisabled(TestStorage):
     """Storage testcases run with batch uploads disabled via feature flag."""
 
@@ -103,19 +103,37 @@ class StorageTestCase(TestCase):
             while hasattr(storage, "storage"):
                 storage = storage.storage
             # For server-based dbs, drop the tables to clear them.
-            if storage.dbconnector.driver in ("mysql", "postgres"):
-                with storage.dbconnector.connect() as c:
-                    c.execute('DROP TABLE bso')
-                    c.execute('DROP TABLE user_collections')
-                    c.execute('DROP TABLE collections')
-                    c.execute('DROP TABLE batch_uploads')
-                    c.execute('DROP TABLE batch_upload_items')
+            dbconnector = storage.dbconnector
+            if dbconnector.driver in ("mysql", "postgres"):
+                for partition in xrange(dbconnector.num_partitions):
+                    with dbconnector.connect(partition=partition) as c:
+                        c.execute('DROP TABLE bso')
+                        c.execute('DROP TABLE user_collections')
+                        c.execute('DROP TABLE collections')
+                        c.execute('DROP TABLE batch_uploads')
+                        c.execute('DROP TABLE batch_upload_items')
+                        c.execute('DROP TABLE purge_checkpoints')
             # Explicitly free any pooled connections.
-            storage.dbconnector.engine.dispose()
+            for engine in dbconnector.partition_engines:
+                engine.dispose()
         # Find any sqlite database files and delete them.
         for key, value in self.config.registry.settings.iteritems():
             if key.endswith(".sqluri"):
-                sqluri = urlparse.urlparse(value)
-                if sqluri.scheme == 'sqlite' and ":memory:" not in value:
-                    if os.path.isfile(sqluri.path):
-                        os.remove(sqluri.path)
+                remove_sqlite_files(value)
+            elif key.endswith(".partition_sqluris"):
+                if isinstance(value, basestring):
+                    value = value.replace(",", " ").split()
+                remove_sqlite_files(*value)
+
+
+def remove_sqlite_files(*sqluris):
+    """Delete the files of any on-disk sqlite databases in the given URIs.
+
+    This includes the log and shared-memory files of databases in WAL mode.
+    """
+    for value in sqluris:
+        sqluri = urlparse.urlparse(value)
+        if sqluri.scheme == 'sqlite' and ":memory:" not in value:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.isfile(sqluri.path + suffix):
+                    os.remove(sqluri.path + suffix)
@@ -0,0 +1,189 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import threading
+
+from syncstorage.tests.support import StorageTestCase
+from syncstorage.tests.test_storage import StorageTestsMixin
+
+from syncstorage.storage import (load_storage_from_settings,
+                                 DeadlineExceededError)
+
+_UID = 1
+_PLD = '*' * 500
+
+
+class TestCoalescingSQLStorage(StorageTestCase, StorageTestsMixin):
+
+    TEST_INI_FILE = "tests-coalescing.ini"
+
+    def setUp(self):
+        super(TestCoalescingSQLStorage, self).setUp()
+        settings = self.config.registry.settings
+        self.storage = load_storage_from_settings("storage", settings)
+
+    def _block_get_item(self):
+        # Make calls to the underlying get_item() wait until released.
+        calls = []
+        release = threading.Event()
+        orig_get_item = self.storage.storage.get_item
+
+        def get_item(*args):
+            calls.append(args)
+            release.wait()
+            return orig_get_item(*args)
+
+        self.storage.storage.get_item = get_item
+        self.addCleanup(release.set)
+        return calls, release
+
+    def _start_read(self, results):
+        def read_item():
+            results.append(self.storage.get_item(_UID, "col", "a"))
+        reader = threading.Thread(target=read_item)
+        reader.start()
+        return reader
+
+    def _wait_for(self, condition):
+        for _ in xrange(500):
+            if condition():
+                return
+            time.sleep(0.01)
+        assert False, "timed out waiting for condition"
+
+    def test_concurrent_identical_reads_are_shared(self):
+        self.storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        calls, release = self._block_get_item()
+        results = []
+        readers = [self._start_read(results)]
+        self._wait_for(lambda: len(calls) == 1)
+        readers.append(self._start_read(results))
+        self._wait_for(lambda: self.storage.flights.shared == 1)
+        release.set()
+        for reader in readers:
+            reader.join()
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(len(results), 2)
+        self.assertEquals(results[0], results[1])
+        self.assertFalse(results[0] is results[1])
+
+    def test_callers_cannot_change_each_others_results(self):
+        self.storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        calls, release = self._block_get_item()
+        orig_get_item = self.storage.storage.get_item
+        returned = []
+
+        def get_item(*args):
+            returned.append(orig_get_item(*args))
+            return returned[-1]
+
+        self.storage.storage.get_item = get_item
+        results = []
+
+        def read_and_change_item():
+            item = self.storage.get_item(_UID, "col", "a")
+            item["payload"] = "changed"
+            results.append(item)
+
+        readers = [threading.Thread(target=read_and_change_item)]
+        readers[0].start()
+        self._wait_for(lambda: len(calls) == 1)
+        readers.append(self._start_read(results))
+        self._wait_for(lambda: self.storage.flights.shared == 1)
+        release.set()
+        for reader in readers:
+            reader.join()
+        # Neither caller was given the object returned by the backend,
+        # and the one that changed its result didn't change the other's.
+        self.assertEquals(len(returned), 1)
+        self.assertFalse(any(item is returned[0] for item in results))
+        self.assertEquals(sorted(item["payload"] for item in results),
+                          [_PLD, "changed"])
+
+    def test_reads_are_not_shared_after_a_write(self):
+        self.storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        calls, release = self._block_get_item()
+        results = []
+        readers = [self._start_read(results)]
+        self._wait_for(lambda: len(calls) == 1)
+        # A read that starts after the write has finished must see it,
+        # so it can't share the result of the read already in progress.
+        self.storage.set_item(_UID, "col", "a", {"payload": "changed"})
+        readers.append(self._start_read(results))
+        self._wait_for(lambda: len(calls) == 2)
+        release.set()
+        for reader in readers:
+            reader.join()
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(self.storage.flights.shared, 0)
+        self.assertEquals([item["payload"] for item in results],
+                          ["changed", "changed"])
+
+    def test_reads_are_not_shared_after_a_write_by_another_process(self):
+        self.storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        calls, release = self._block_get_item()
+        results = []
+        readers = [self._start_read(results)]
+        self._wait_for(lambda: len(calls) == 1)
+        # A write through the underlying storage isn't seen by this layer,
+        # but it still changes the collection timestamp.
+        time.sleep(0.02)
+        self.storage.storage.set_item(_UID, "col", "a",
+                                      {"payload": "changed"})
+        readers.append(self._start_read(results))
+        self._wait_for(lambda: len(calls) == 2)
+        release.set()
+        for reader in readers:
+            reader.join()
+        self.assertEquals(self.storage.flights.shared, 0)
+        self.assertEquals([item["payload"] for item in results],
+                          ["changed", "changed"])
+
+    def test_unshared_results_are_not_copied(self):
+        self.storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        orig_get_item = self.storage.storage.get_item
+        returned = []
+
+        def get_item(*args):
+            returned.append(orig_get_item(*args))
+            return returned[-1]
+
+        self.storage.storage.get_item = get_item
+        item = self.storage.get_item(_UID, "col", "a")
+        self.assertTrue(item is returned[0])
+
+    def test_deadline_errors_are_not_shared(self):
+        self.storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        calls, release = self._block_get_item()
+        orig_get_item = self.storage.storage.get_item
+
+        def get_item(*args):
+            item = orig_get_item(*args)
+            if len(calls) == 1:
+                raise DeadlineExceededError
+            return item
+
+        self.storage.storage.get_item = get_item
+        errors = []
+        results = []
+
+        def read_item_past_deadline():
+            try:
+                self.storage.get_item(_UID, "col", "a")
+            except DeadlineExceededError:
+                errors.append(True)
+
+        readers = [threading.Thread(target=read_item_past_deadline)]
+        readers[0].start()
+        self._wait_for(lambda: len(calls) == 1)
+        readers.append(self._start_read(results))
+        self._wait_for(lambda: self.storage.flights.shared == 1)
+        release.set()
+        for reader in readers:
+            reader.join()
+        # The waiting reader made its own call rather than failing too.
+        self.assertEquals(errors, [True])
+        self.assertEquals(len(calls), 2)
+        self.assertEquals([item["payload"] for item in results], [_PLD])
@@ -8,12 +8,15 @@ import time
 try:
     from syncstorage.storage.memcached import MemcachedStorage  # NOQA
     from syncstorage.storage.memcached import SIZE_RECALCULATION_PERIOD
+    from syncstorage.storage.memcached import (CacheValueCodec,
+                                               FLAG_BINARY, FLAG_ZLIB)
     MEMCACHED = True
 except ImportError:
     MEMCACHED = False
 
 from mozsvc.exceptions import BackendError
 
+from syncstorage.util import get_timestamp
 from syncstorage.tests.support import StorageTestCase
 from syncstorage.tests.test_storage import StorageTestsMixin
 
@@ -44,6 +47,18 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         except BackendError:
             raise unittest2.SkipTest
 
+    def _get_cached_collection(self, collection):
+        # Read the collection's cached data, with payloads, in either layout.
+        colmgr = self.storage._get_collection_manager(collection)
+        if not colmgr.per_item:
+            return self.storage.cache.get(colmgr.get_key(_UID))
+        data = self.storage.cache.get(colmgr.get_index_key(_UID))
+        if data is not None:
+            for bso in data["items"].itervalues():
+                key = colmgr.get_payload_key(_UID, bso)
+                bso["payload"] = self.storage.cache.get(key)
+        return data
+
     def test_basic(self):
         # just make sure calls goes through
         self.storage.set_item(_UID, 'col1', '1', {'payload': _PLD})
@@ -66,7 +81,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         self.assertEquals(res['payload'], _PLD)
 
         # That should have populated some cache entries.
-        collection = self.storage.cache.get('1:c:meta')
+        collection = self._get_cached_collection('meta')
         self.assertEquals(collection["items"].keys(), ["global"])
         metadata = self.storage.cache.get('1:metadata')
         self.assertTrue(metadata['collections']['meta'])
@@ -80,7 +95,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         time.sleep(0.01)
         self.storage.delete_item(_UID, 'meta', 'global')
 
-        collection = self.storage.cache.get('1:c:meta')
+        collection = self._get_cached_collection('meta')
         self.assertEquals(collection["items"].keys(), [])
         metadata = self.storage.cache.get('1:metadata')
         self.assertEquals(metadata['size'], len(_PLD))
@@ -96,7 +111,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
                  {'id': 'other', 'payload': 'xxx'}]
         self.storage.set_items(_UID, 'meta', items)
 
-        collection = self.storage.cache.get('1:c:meta')
+        collection = self._get_cached_collection('meta')
         self.assertEquals(sorted(collection["items"].keys()),
                           ['global', 'other'])
 
@@ -108,7 +123,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         self.assertRaises(CollectionNotFoundError,
                           sqlstorage.get_items, _UID, 'meta')
 
-        collection = self.storage.cache.get('1:c:meta')
+        collection = self._get_cached_collection('meta')
         self.assertEquals(collection, None)
 
     def test_tabs(self):
@@ -118,7 +133,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         # these calls should be cached
         res = self.storage.get_item(_UID, 'tabs', '1')
         self.assertEquals(res['payload'], _PLD)
-        collection = self.storage.cache.get('1:c:tabs')
+        collection = self._get_cached_collection('tabs')
         self.assertEquals(collection['items']['1']['payload'], _PLD)
 
         # it should not exist in the underlying store
@@ -128,7 +143,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         # this should remove the cache
         time.sleep(0.01)
         self.storage.delete_item(_UID, 'tabs', '1')
-        collection = self.storage.cache.get('1:c:tabs')
+        collection = self._get_cached_collection('tabs')
         self.assertEquals(collection['items'].keys(), [])
 
         #  adding some stuff
@@ -136,7 +151,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
                  {'id': '2', 'payload': 'xxx'}]
         time.sleep(0.01)
         self.storage.set_items(_UID, 'tabs', items)
-        collection = self.storage.cache.get('1:c:tabs')
+        collection = self._get_cached_collection('tabs')
         self.assertEquals(len(collection['items']), 2)
 
         # this should remove the cache
@@ -144,7 +159,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         self.storage.delete_collection(_UID, 'tabs')
         self.assertRaises(CollectionNotFoundError,
                           self.storage.get_items, _UID, 'tabs')
-        collection = self.storage.cache.get('1:c:tabs')
+        collection = self._get_cached_collection('tabs')
         self.assertEquals(collection, None)
 
     def test_size(self):
@@ -293,10 +308,105 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         self.assertEquals(storage.get_total_size(_UID, True), 0)
 
 
+class TestMemcachedSQLStorageWithItemsLayout(TestMemcachedSQLStorage):
+
+    TEST_INI_FILE = "tests-memcached-items.ini"
+
+    def test_writes_only_store_the_changed_payloads(self):
+        self.storage.set_items(_UID, 'tabs', [{'id': '1', 'payload': 'one'},
+                                              {'id': '2', 'payload': 'two'}])
+        colmgr = self.storage._get_collection_manager('tabs')
+        index = self.storage.cache.get(colmgr.get_index_key(_UID))
+        self.assertFalse('payload' in index['items']['1'])
+        key1 = colmgr.get_payload_key(_UID, index['items']['1'])
+        key2 = colmgr.get_payload_key(_UID, index['items']['2'])
+        self.assertEquals(self.storage.cache.get(key1), 'one')
+        # Updating one item's payload writes it under a new key.
+        time.sleep(0.01)
+        self.storage.set_item(_UID, 'tabs', '1', {'payload': 'uno'})
+        index = self.storage.cache.get(colmgr.get_index_key(_UID))
+        new_key1 = colmgr.get_payload_key(_UID, index['items']['1'])
+        self.assertNotEquals(new_key1, key1)
+        self.assertEquals(self.storage.cache.get(new_key1), 'uno')
+        # The old payload is left for memcache to evict, so that a reader
+        # still holding the old index can load it.
+        self.assertEquals(self.storage.cache.get(key1), 'one')
+        self.assertEquals(colmgr.get_payload_key(_UID, index['items']['2']),
+                          key2)
+        # Updating only the sortindex doesn't touch the payload.
+        time.sleep(0.01)
+        self.storage.set_item(_UID, 'tabs', '2', {'sortindex': 3})
+        index = self.storage.cache.get(colmgr.get_index_key(_UID))
+        self.assertEquals(index['items']['2']['sortindex'], 3)
+        self.assertEquals(self.storage.cache.get(key2), 'two')
+        self.assertEquals(self.storage.get_item(_UID, 'tabs', '2')['payload'],
+                          'two')
+
+    def test_collections_cached_as_one_key_are_converted(self):
+        tabs = {
+            'modified': 1299142695.76,
+            'items': {
+                'a': {'id': 'a', 'payload': 'xxx', 'modified': 1299142695.76},
+            }
+        }
+        self.storage.cache.set('1:c:tabs', tabs)
+        res = self.storage.get_item(_UID, 'tabs', 'a')
+        self.assertEquals(res['payload'], 'xxx')
+        self.assertEquals(self.storage.cache.get('1:c:tabs'), None)
+        collection = self._get_cached_collection('tabs')
+        self.assertEquals(collection['items']['a']['payload'], 'xxx')
+
+    def test_evicted_payloads_are_refetched_from_the_store(self):
+        self.storage.set_item(_UID, 'meta', 'global', {'payload': _PLD})
+        colmgr = self.storage._get_collection_manager('meta')
+        index = self.storage.cache.get(colmgr.get_index_key(_UID))
+        key = colmgr.get_payload_key(_UID, index['items']['global'])
+        self.storage.cache.delete(key)
+        res = self.storage.get_item(_UID, 'meta', 'global')
+        self.assertEquals(res['payload'], _PLD)
+        self.assertEquals(self.storage.cache.get(key), _PLD)
+
+
+class TestMemcachedSQLStorageWithBinaryValues(TestMemcachedSQLStorage):
+
+    TEST_INI_FILE = "tests-memcached-binary.ini"
+
+    def test_values_are_binary_and_compressed(self):
+        codec = self.storage.cache.codec
+        modified = get_timestamp()
+        value = {"modified": modified, "items": {"a": {"payload": _PLD}}}
+        data, flags = codec.encode(value)
+        self.assertEquals(flags, FLAG_BINARY | FLAG_ZLIB)
+        self.assertTrue(len(data) < len(_PLD))
+        decoded = codec.decode(data, flags)
+        self.assertEquals(decoded, value)
+        self.assertEquals(str(decoded["modified"]), str(modified))
+        data, flags = codec.encode({"modified": modified})
+        self.assertEquals(flags, FLAG_BINARY)
+
+    def test_json_values_can_still_be_read(self):
+        self.storage.set_item(_UID, 'meta', 'global', {'payload': _PLD})
+        data = self.storage.cache.get('1:c:meta')
+        # Write it back as JSON, as earlier versions would have.
+        codec = self.storage.cache.codec
+        self.storage.cache.codec = CacheValueCodec()
+        try:
+            self.storage.cache.set('1:c:meta', data)
+        finally:
+            self.storage.cache.codec = codec
+        self.assertEquals(self.storage.cache.get('1:c:meta'), data)
+        res = self.storage.get_item(_UID, 'meta', 'global')
+        self.assertEquals(res['payload'], _PLD)
+
+
 def test_suite():
     suite = unittest2.TestSuite()
     if MEMCACHED:
         suite.addTest(unittest2.makeSuite(TestMemcachedSQLStorage))
+        suite.addTest(
+            unittest2.makeSuite(TestMemcachedSQLStorageWithItemsLayout))
+        suite.addTest(
+            unittest2.makeSuite(TestMemcachedSQLStorageWithBinaryValues))
     return suite
 
 
@@ -187,6 +187,7 @@ class TestPurgeTTLScript(StorageTestCase):
                             "--oneshot",
                             "--backend-interval=0",
                             "--grace-period=0",
+                            "--max-concurrency=4",
                             ini_file)
         assert proc.wait() == 0
         self.assertEquals(count_bso_items(), 1)
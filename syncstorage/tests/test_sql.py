@@ -2,16 +2,32 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
 import time
+import logging
 import threading
 
+import sqlalchemy.event
+import testfixtures
+from pyramid.testing import DummyRequest
+
 from mozsvc.plugin import load_and_register
 from mozsvc.tests.support import get_test_configurator
 
-from syncstorage.tests.support import StorageTestCase
-from syncstorage.storage import load_storage_from_settings
+from syncstorage.tests.support import StorageTestCase, remove_sqlite_files
+from syncstorage.storage import (load_storage_from_settings,
+                                 ConflictError,
+                                 CollectionNotFoundError,
+                                 ItemNotFoundError,
+                                 DeadlineExceededError)
+from syncstorage.storage.sql import SQLStorage, ts2bigint
 from syncstorage.storage.sql.dbconnect import (create_engine,
+                                               DBConnector,
+                                               MAX_TTL,
                                                QueuePoolWithMaxBacklog)
+from syncstorage.storage.sql.sharding import (ModuloShardMap,
+                                              ConsistentHashShardMap,
+                                              RangeShardMap)
 
 from syncstorage.tests.test_storage import StorageTestsMixin
 
@@ -193,3 +209,1258 @@ class TestSQLStorage(StorageTestCase, StorageTestsMixin):
         self.assertEquals(res["num_bso_rows_purged"], 2000)
         self.assertEquals(count_items(), 5)
         self.assertEquals(len(self.storage.get_items(_UID, "col")["items"]), 5)
+
+    def test_parallel_purging_of_sharded_tables(self):
+        config = get_test_configurator(__file__, 'tests-shard.ini')
+        storage = load_and_register("storage", config)
+        for userid in xrange(10):
+            storage.set_items(userid, "col", [
+                {"id": "SHORT", "payload": _PLD, "ttl": 0},
+                {"id": "LONG", "payload": _PLD},
+            ])
+        time.sleep(1)
+        res = storage.purge_expired_items(grace_period=0, max_concurrency=4)
+        self.assertEquals(res["num_bso_rows_purged"], 10)
+        self.assertTrue(res["is_complete"])
+        # There's a progress report for every table that was purged.
+        shardsize = storage.dbconnector.shardsize
+        self.assertEquals(len(res["tables"]), 2 * shardsize + 1)
+        self.assertEquals(res["tables"]["bso3"]["num_purged"], 1)
+        self.assertEquals(res["tables"]["bso42"]["num_purged"], 0)
+        for userid in xrange(10):
+            items = storage.get_items(userid, "col")["items"]
+            self.assertEquals([item["id"] for item in items], ["LONG"])
+
+    def test_purging_can_be_throttled(self):
+        items = [{"id": str(i), "payload": _PLD, "ttl": 0}
+                 for i in xrange(40)]
+        self.storage.set_items(_UID, "col", items)
+        time.sleep(1)
+        t_start = time.time()
+        res = self.storage.purge_expired_items(grace_period=0,
+                                               max_per_loop=10,
+                                               max_rows_per_second=100)
+        self.assertEquals(res["num_bso_rows_purged"], 40)
+        # Each batch of ten deletes must be followed by a pause.
+        self.assertTrue(time.time() - t_start >= 0.4)
+        self.assertTrue(res["tables"]["bso"]["duration"] >= 0.4)
+
+    def test_purging_resumes_from_checkpoint(self):
+        items = [{"id": str(i), "payload": _PLD, "ttl": 0}
+                 for i in xrange(40)]
+        self.storage.set_items(_UID, "col", items)
+        time.sleep(1)
+        # Bail out after two chunks, leaving some items behind.
+        res = self.storage.purge_expired_items(grace_period=0,
+                                               max_per_loop=10,
+                                               max_iters=2)
+        self.assertEquals(res["num_bso_rows_purged"], 20)
+        self.assertFalse(res["is_complete"])
+        # The next purge picks up where that one left off.
+        res = self.storage.purge_expired_items(grace_period=0,
+                                               max_per_loop=10,
+                                               max_iters=2)
+        self.assertEquals(res["num_bso_rows_purged"], 20)
+        self.assertTrue(res["is_complete"])
+        # Once complete, the checkpoint skips over all purged items.
+        checkpoint = self.storage._get_purge_checkpoint("bso", {
+            "max_per_loop": 10,
+        })
+        self.assertTrue(checkpoint["watermark"] > time.time() - 10)
+        self.assertEquals(checkpoint["num_unoptimized"], 40)
+
+    def test_purge_chunk_size_adapts_to_target_latency(self):
+        items = [{"id": str(i), "payload": _PLD, "ttl": 0}
+                 for i in xrange(100)]
+        self.storage.set_items(_UID, "col", items)
+        time.sleep(1)
+        # The deletes are much faster than the target, so each full
+        # chunk doubles in size: 10, 20, 40 and then the final 30.
+        res = self.storage.purge_expired_items(grace_period=0,
+                                               max_per_loop=10,
+                                               target_latency=100)
+        self.assertEquals(res["num_bso_rows_purged"], 100)
+        self.assertEquals(res["tables"]["bso"]["chunk_size"], 80)
+        # The tuned chunk size is remembered for the next purge.
+        checkpoint = self.storage._get_purge_checkpoint("bso", {
+            "max_per_loop": 10,
+            "target_latency": 100,
+        })
+        self.assertEquals(checkpoint["chunk_size"], 80)
+
+    def test_batch_upsert_counts_created_items(self):
+        dbconnector = self.storage.dbconnector
+        defaults = {"modified": 1000, "payload": "", "payload_size": 0}
+
+        def upsert(items):
+            with dbconnector.connect() as c:
+                return c.insert_or_update("bso", items, defaults)
+
+        def make_item(id, **kwds):
+            item = {"userid": _UID, "collection": 1, "id": id}
+            item.update(kwds)
+            return item
+
+        def read_items():
+            QUERY = "select id, sortindex, payload from bso "\
+                    "/* queryName=READ_ITEMS */"
+            with dbconnector.connect() as c:
+                return sorted(tuple(row) for row in c.execute(QUERY))
+
+        # Check both the native batch upsert and the generic fallback,
+        # which should produce exactly the same results.
+        results = []
+        for supports_on_conflict in (dbconnector.supports_on_conflict(),
+                                     False):
+            dbconnector._supports_on_conflict = supports_on_conflict
+            with dbconnector.connect() as c:
+                c.execute("delete from bso /* queryName=DELETE_ITEMS */")
+            self.assertEquals(upsert([]), 0)
+            self.assertEquals(upsert([make_item("a", payload="A")]), 1)
+            self.assertEquals(upsert([make_item("a", sortindex=1)]), 0)
+            # A mix of new and existing items, with different sets of fields
+            # and with repeated writes to the same item.
+            self.assertEquals(upsert([
+                make_item("a", payload="AA"),
+                make_item("b", payload="B"),
+                make_item("c", sortindex=3),
+                make_item("b", sortindex=2),
+            ]), 2)
+            # Enough items that the query must be split into several chunks.
+            items = [make_item("x%d" % (i,), payload="x") for i in xrange(500)]
+            self.assertEquals(upsert(items), 500)
+            items = [make_item("x%d" % (i,), payload="y") for i in xrange(550)]
+            self.assertEquals(upsert(items), 50)
+            results.append(read_items())
+        self.assertEquals(results[0], results[1])
+        self.assertEquals(results[0][:3], [
+            ("a", 1, "AA"),
+            ("b", 2, "B"),
+            ("c", 3, ""),
+        ])
+
+    def test_apply_batch_merges_partial_updates(self):
+        storage = self.storage
+        dbconnector = storage.dbconnector
+
+        def read_items(userid):
+            QUERY = "select id, sortindex, payload, payload_size, ttl, "\
+                    "modified from bso where userid = :userid "\
+                    "/* queryName=READ_ITEMS */"
+            with dbconnector.connect() as c:
+                rows = c.execute(QUERY, {"userid": userid})
+                return sorted(tuple(row) for row in rows)
+
+        # Check both the single-query batch upsert, where available, and
+        # the generic fallback, which should produce the same results.
+        results = []
+        for userid, supports_on_conflict in enumerate((
+                dbconnector.supports_on_conflict(), False), 1):
+            dbconnector._supports_on_conflict = supports_on_conflict
+            storage.set_items(userid, "col", [
+                {"id": "a", "payload": "A", "sortindex": 1, "ttl": 1000},
+                {"id": "b", "payload": "B", "sortindex": 2},
+            ])
+            batchid = storage.create_batch(userid, "col")
+            storage.append_items_to_batch(userid, "col", batchid, [
+                {"id": "a", "sortindex": 5},
+                {"id": "b", "payload": "BB", "ttl": 2000},
+                {"id": "c", "payload": "C"},
+            ])
+            ts = storage.apply_batch(userid, "col", batchid)
+            items = read_items(userid)
+            # Every item is stamped with the new modification time.
+            self.assertEquals(set(item[5] for item in items),
+                              set([int(ts * 1000)]))
+            results.append([item[:4] for item in items])
+            ttls = dict((item[0], item[4]) for item in items)
+            self.assertTrue(900 < ttls["a"] - ts <= 1000)
+            self.assertTrue(1900 < ttls["b"] - ts <= 2000)
+            self.assertEquals(ttls["c"], MAX_TTL)
+        self.assertEquals(results[0], results[1])
+        self.assertEquals(results[0], [
+            ("a", 5, "A", 1),
+            ("b", 2, "BB", 2),
+            ("c", None, "C", 1),
+        ])
+
+    def test_apply_empty_batch_to_existing_collection(self):
+        compressing = SQLStorage(self.storage.sqluri,
+                                 standard_collections=True,
+                                 payload_compression_threshold=0)
+        for userid, storage in enumerate((self.storage, compressing), 1):
+            storage.set_items(userid, "col", [
+                {"id": "a", "payload": "A", "sortindex": 1},
+                {"id": "b", "payload": "B"},
+            ])
+            batchid = storage.create_batch(userid, "col")
+            ts = storage.apply_batch(userid, "col", batchid)
+            self.assertEquals(storage.get_collection_timestamp(userid, "col"),
+                              ts)
+            items = storage.get_items(userid, "col")["items"]
+            self.assertEquals(sorted(item["id"] for item in items),
+                              ["a", "b"])
+            self.assertEquals(storage.get_item(userid, "col", "a")["payload"],
+                              "A")
+
+    def test_payload_compression_is_transparent(self):
+        storage = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             payload_compression_threshold=100)
+        small = u"small payload"
+        big = u'{"ciphertext": "%s"}' % ("abc" * 100,)
+
+        def read_payloads():
+            QUERY = "select id, payload, payload_compressed, payload_size "\
+                    "from bso /* queryName=READ_PAYLOADS */"
+            with storage.dbconnector.connect() as c:
+                return dict((row[0], row[1:]) for row in c.execute(QUERY))
+
+        storage.set_items(_UID, "col", [
+            {"id": "small", "payload": small},
+            {"id": "big", "payload": big},
+            {"id": "touched", "payload": big},
+        ])
+        batchid = storage.create_batch(_UID, "col")
+        storage.append_items_to_batch(_UID, "col", batchid, [
+            {"id": "batched", "payload": big},
+            {"id": "touched", "sortindex": 3},
+        ])
+        storage.apply_batch(_UID, "col", batchid)
+        stored = read_payloads()
+        # Only the big payloads are compressed, but sizes are unchanged.
+        self.assertEquals(stored["small"], (small, None, len(small)))
+        for id in ("big", "batched", "touched"):
+            self.assertEquals(stored[id][0], "")
+            self.assertTrue(len(stored[id][1]) < len(big) / 2)
+            self.assertEquals(stored[id][2], len(big))
+        # They're all decompressed when read back, even with the threshold
+        # set to zero, which stops any more from being compressed.
+        storage = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             payload_compression_threshold=0)
+        storage.set_item(_UID, "col", "uncompressed", {"payload": big})
+        self.assertEquals(read_payloads()["uncompressed"],
+                          (big, None, len(big)))
+        items = storage.get_items(_UID, "col")["items"]
+        payloads = dict((item["id"], item["payload"]) for item in items)
+        self.assertEquals(payloads, {
+            "small": small,
+            "big": big,
+            "batched": big,
+            "touched": big,
+            "uncompressed": big,
+        })
+        self.assertEquals(storage.get_item(_UID, "col", "big")["payload"],
+                          big)
+        self.assertEquals(storage.get_collection_sizes(_UID)["col"],
+                          4 * len(big) + len(small))
+
+    def test_recompress_payloads(self):
+        big = u'{"ciphertext": "%s"}' % ("abc" * 100,)
+        self.storage.set_items(_UID, "col", [{"id": str(i), "payload": big}
+                                             for i in xrange(5)])
+        self.storage.set_item(_UID, "col", "small", {"payload": u"small"})
+        # Recompressing needs the compressed payload column to be in use.
+        self.assertRaises(ValueError, self.storage.recompress_payloads)
+        # Turning on compression has no effect on existing items,
+        # until they're recompressed.
+        storage = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             payload_compression_threshold=100)
+        self.assertEquals(storage.get_total_size(_UID), 5 * len(big) + 5)
+        res = storage.recompress_payloads(max_per_loop=2)
+        self.assertEquals(res["num_checked"], 6)
+        self.assertEquals(res["num_recompressed"], 5)
+        res = storage.recompress_payloads(max_per_loop=2)
+        self.assertEquals(res["num_recompressed"], 0)
+        # Setting the threshold to zero lets them be decompressed.
+        storage = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             payload_compression_threshold=0)
+        res = storage.recompress_payloads()
+        self.assertEquals(res["num_recompressed"], 5)
+        items = self.storage.get_items(_UID, "col")["items"]
+        self.assertEquals(sorted(item["payload"] for item in items),
+                          [u"small"] + [big] * 5)
+
+    def test_find_items_query_cache(self):
+        dbconnector = self.storage.dbconnector
+        bsos = [{"id": str(i), "payload": _PLD, "sortindex": i}
+                for i in xrange(10)]
+        self.storage.set_items(_UID, "col", bsos)
+        misses = dbconnector.query_cache_misses
+        hits = dbconnector.query_cache_hits
+
+        # Queries with the same shape share a single rendered query,
+        # even if the values of their parameters are different.
+        res = self.storage.get_items(_UID, "col", sort="index", limit=2)
+        self.assertEquals([b["id"] for b in res["items"]], ["9", "8"])
+        res = self.storage.get_items(_UID, "col", sort="index", limit=3)
+        self.assertEquals([b["id"] for b in res["items"]], ["9", "8", "7"])
+        self.assertEquals(dbconnector.query_cache_misses, misses + 1)
+        self.assertEquals(dbconnector.query_cache_hits, hits + 1)
+
+        # Queries with a different shape are rendered separately.
+        res = self.storage.get_items(_UID, "col", sort="index", limit=2,
+                                     offset=res["next_offset"])
+        self.assertEquals([b["id"] for b in res["items"]], ["6", "5"])
+        res = self.storage.get_items(_UID, "col", sort="index", limit=2,
+                                     offset=res["next_offset"])
+        self.assertEquals([b["id"] for b in res["items"]], ["4", "3"])
+        self.assertEquals(dbconnector.query_cache_misses, misses + 2)
+        self.assertEquals(dbconnector.query_cache_hits, hits + 2)
+
+        # Lists of ids are sent as bindparams, not rendered into the query.
+        res = self.storage.get_items(_UID, "col", ids=["1", "2"])
+        self.assertEquals(sorted(b["id"] for b in res["items"]), ["1", "2"])
+        res = self.storage.get_items(_UID, "col", ids=["3", "X"])
+        self.assertEquals(sorted(b["id"] for b in res["items"]), ["3"])
+        self.assertEquals(dbconnector.query_cache_misses, misses + 3)
+        self.assertEquals(dbconnector.query_cache_hits, hits + 3)
+
+    def test_find_items_query_cache_evicts_least_recently_used(self):
+        dbconnector = self.storage.dbconnector
+        self.addCleanup(setattr, dbconnector._rendered_queries, "max_size",
+                        dbconnector._rendered_queries.max_size)
+        dbconnector._rendered_queries.max_size = 2
+        self.storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        shapes = [{"ids": ["a"]}, {"ids": ["a", "b"]},
+                  {"ids": ["a", "b", "c"]}]
+        for params in shapes:
+            self.storage.get_items(_UID, "col", **params)
+        misses = dbconnector.query_cache_misses
+        hits = dbconnector.query_cache_hits
+        # The two most recent shapes are still cached.
+        self.storage.get_items(_UID, "col", **shapes[2])
+        self.storage.get_items(_UID, "col", **shapes[1])
+        self.assertEquals(dbconnector.query_cache_misses, misses)
+        self.assertEquals(dbconnector.query_cache_hits, hits + 2)
+        # The oldest was evicted to make room, and is rendered again.
+        self.storage.get_items(_UID, "col", **shapes[0])
+        self.assertEquals(dbconnector.query_cache_misses, misses + 1)
+        self.assertEquals(len(dbconnector._rendered_queries), 2)
+
+    def test_streamed_reads_release_their_connection(self):
+        dbconnector = self.storage.dbconnector
+        pools = [dbconnector.engine.pool]
+        pools.extend(replica.engine.pool for replica in dbconnector.replicas)
+        if dbconnector.reader_engine is not None:
+            pools.append(dbconnector.reader_engine.pool)
+
+        def num_checked_out():
+            return sum(pool.checkedout() for pool in pools)
+
+        bsos = [{"id": str(i), "payload": _PLD} for i in xrange(10)]
+        self.storage.set_items(_UID, "col", bsos)
+        num_idle = num_checked_out()
+
+        # The query is issued under the lock, but read after it's released.
+        # Reading it in full returns the connection to the pool.
+        with self.storage.lock_for_read(_UID, "col"):
+            res = self.storage.get_items(_UID, "col", stream=True)
+        self.assertFalse(isinstance(res["items"], list))
+        self.assertEquals(res["next_offset"], None)
+        self.assertEquals(num_checked_out(), num_idle + 1)
+        self.assertEquals(sorted(int(bso["id"]) for bso in res["items"]),
+                          range(10))
+        self.assertEquals(num_checked_out(), num_idle)
+
+        # Abandoning the stream part-way through discards the connection,
+        # and leaves the collection available for writing.
+        res = self.storage.get_items(_UID, "col", stream=True)
+        self.assertEquals(next(iter(res["items"]))["payload"], _PLD)
+        res["items"].close()
+        self.assertEquals(num_checked_out(), num_idle)
+        self.storage.set_item(_UID, "col", "0", {"payload": "updated"})
+
+        # Limited reads are not streamed, and missing collections still
+        # raise an error up front.
+        res = self.storage.get_items(_UID, "col", limit=5, stream=True)
+        self.assertEquals(len(res["items"]), 5)
+        self.assertRaises(CollectionNotFoundError, self.storage.get_items,
+                          _UID, "nonexistent", stream=True)
+        self.assertEquals(num_checked_out(), num_idle)
+
+    def test_number_of_queries_per_api_call(self):
+        storage = self.storage
+        dbconnector = storage.dbconnector
+        engines = [dbconnector.engine]
+        engines.extend(replica.engine for replica in dbconnector.replicas)
+        if dbconnector.reader_engine is not None:
+            engines.append(dbconnector.reader_engine)
+        queries = []
+
+        def record_query(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        for engine in engines:
+            sqlalchemy.event.listen(engine, "before_cursor_execute",
+                                    record_query)
+            self.addCleanup(sqlalchemy.event.remove, engine,
+                            "before_cursor_execute", record_query)
+
+        def count_queries(lock, collection, func, *args):
+            # Wait for the clock to tick, so that write locks are allowed.
+            time.sleep(0.02)
+            with lock(_UID, collection):
+                del queries[:]
+                try:
+                    func(_UID, collection, *args)
+                except CollectionNotFoundError:
+                    pass
+                return len(queries)
+
+        # Usage tracking needs an extra query to size the affected items,
+        # and without an upsert a new item takes both UPDATE and INSERT.
+        sizing = 1 if storage._track_collection_usage else 0
+        new_item = 1 if storage._can_upsert_collection() else 2
+        # SQLite can't tell whether an upsert inserted or updated the item,
+        # so writing a single new item there takes an extra query.
+        new_bso = 2 if dbconnector.driver == "sqlite" else 1
+        if dbconnector.driver == "postgres":
+            delete_collection = 1
+        else:
+            delete_collection = 3
+        # Async deletes need an extra query to find the tombstone of an
+        # existing collection, and another to clear out deleted items before
+        # writing to a deleted one.  But reads can skip a deleted collection.
+        tombstone = 1 if storage._async_deletes else 0
+        if storage._async_deletes:
+            delete_collection = 3
+        # Optimistic writes only need an INSERT to create a collection, but
+        # must take the row lock before deleting one.
+        if storage._optimistic_writes:
+            new_item = 1
+            delete_collection += 1
+
+        storage.set_item(_UID, "bookmarks", "a", {"payload": _PLD})
+        storage.set_item(_UID, "history", "a", {"payload": _PLD})
+        storage.delete_collection(_UID, "history")
+
+        read, write = storage.lock_for_read, storage.lock_for_write
+        self.assertEquals(count_queries(read, "bookmarks", storage.get_items),
+                          tombstone + 1)
+        self.assertEquals(count_queries(read, "history", storage.get_items),
+                          1 - tombstone)
+        self.assertEquals(count_queries(write, "bookmarks", storage.set_item,
+                                        "a", {"payload": _PLD}),
+                          tombstone + sizing + 2)
+        self.assertEquals(count_queries(write, "history", storage.set_item,
+                                        "a", {"payload": _PLD}),
+                          2 * tombstone + sizing + new_item + new_bso)
+        self.assertEquals(count_queries(write, "history",
+                                        storage.delete_collection),
+                          delete_collection)
+
+    def test_collection_names_cache(self):
+        storage = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             collections_cache_size=2)
+        for collection in ("col1", "col2", "col3"):
+            storage.set_item(_UID, collection, "a", {"payload": _PLD})
+        storage.set_item(_UID + 1, "col3", "a", {"payload": _PLD})
+        # Only the most recently used custom collections are cached,
+        # but the standard collections are always available.
+        self.assertEquals(len(storage._collections_by_name), 2 + 13)
+        self.assertFalse("col1" in storage._collections_by_name)
+        self.assertTrue("col3" in storage._collections_by_name)
+        self.assertTrue("bookmarks" in storage._collections_by_name)
+        self.assertEquals(storage._collections_by_id[7], "bookmarks")
+        # Evicted collections are reloaded from the database on demand.
+        self.assertEquals(len(storage.get_items(_UID, "col1")["items"]), 1)
+        self.assertTrue("col1" in storage._collections_by_name)
+        self.assertFalse("col2" in storage._collections_by_name)
+        self.assertEquals(sorted(storage.get_collection_timestamps(_UID)),
+                          ["col1", "col2", "col3"])
+
+        # Reads remember that a collection doesn't exist, for a while.
+        hits = storage._missing_collections.hits
+        for _ in xrange(3):
+            self.assertRaises(CollectionNotFoundError,
+                              storage.get_collection_timestamp,
+                              _UID, "col4")
+        self.assertEquals(storage._missing_collections.hits, hits + 2)
+        self.assertTrue("col4" in storage._missing_collections)
+        # But writes can still create it, and it's immediately readable.
+        storage.set_item(_UID, "col4", "a", {"payload": _PLD})
+        self.assertFalse("col4" in storage._missing_collections)
+        storage.get_collection_timestamp(_UID, "col4")
+
+        # Deletes never trust that cache, so they can't report success
+        # for a collection that another process has since created.
+        self.assertRaises(CollectionNotFoundError,
+                          storage.get_collection_timestamp, _UID, "col5")
+        other = SQLStorage(self.storage.sqluri, standard_collections=True)
+        other.set_item(_UID, "col5", "a", {"payload": _PLD})
+        other.set_item(_UID, "col5", "b", {"payload": _PLD})
+        storage.delete_item(_UID, "col5", "a")
+        storage.delete_items(_UID, "col5", ["b"])
+        self.assertEquals(other.get_items(_UID, "col5")["items"], [])
+        other.set_item(_UID, "col5", "c", {"payload": _PLD})
+        storage.delete_collection(_UID, "col5")
+        self.assertRaises(CollectionNotFoundError,
+                          other.get_collection_timestamp, _UID, "col5")
+        # Failed writes don't populate it either.
+        self.assertRaises(CollectionNotFoundError,
+                          storage.delete_collection, _UID, "col6")
+        self.assertFalse("col6" in storage._missing_collections)
+
+        # The cache can be primed with the most-used collections.
+        storage = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             collections_cache_size=1,
+                             collections_cache_preload=True)
+        self.assertTrue("col3" in storage._collections_by_name)
+        self.assertFalse("col1" in storage._collections_by_name)
+
+    def test_moving_users_between_shards(self):
+        config = get_test_configurator(__file__, "tests-shard-lookup.ini")
+        storage = load_and_register("storage", config)
+        src = storage.get_user_shard(_UID)
+        dst = (src + 1) % storage.dbconnector.shardsize
+        bsos = [{"id": str(i), "payload": _PLD, "sortindex": i}
+                for i in xrange(25)]
+        storage.set_items(_UID, "col1", bsos)
+        storage.set_items(_UID, "col2", bsos[:5])
+        # Simulate an interrupted earlier move, which left behind one item
+        # that has since been changed and one that has since been deleted.
+        collectionid = storage._collections_by_name["col1"]
+        with storage.dbconnector.connect() as c:
+            for id in ("0", "deleted"):
+                c.execute("INSERT INTO bso%d (userid, collection, id, "
+                          "modified, payload, payload_size, ttl) "
+                          "VALUES (%d, %d, '%s', 0, 'old', 3, %d) "
+                          "/* queryName=INSERT_STALE_ITEM */"
+                          % (dst, _UID, collectionid, id, MAX_TTL))
+
+        # Change some already-copied items while the copy is in progress.
+        def change_items():
+            time.sleep(0.02)
+            storage.set_item(_UID, "col1", "1", {"payload": "changed"})
+            storage.set_item(_UID, "col1", "10", {"sortindex": 99})
+            storage.delete_item(_UID, "col1", "11")
+            storage.set_item(_UID, "col1", "new", {"payload": _PLD})
+
+        class ChangeItemsAfterFirstChunk(logging.Handler):
+            def emit(self, record):
+                if record.getMessage().startswith("Copied 10 items"):
+                    change_items()
+
+        sql_logger = logging.getLogger("syncstorage.storage.sql")
+        handler = ChangeItemsAfterFirstChunk()
+        sql_logger.addHandler(handler)
+        self.addCleanup(sql_logger.removeHandler, handler)
+        self.addCleanup(sql_logger.setLevel, sql_logger.level)
+        sql_logger.setLevel(logging.DEBUG)
+        # Only the changed collection is caught up while the user is locked.
+        queries = []
+
+        def record_query(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        engine = storage.dbconnector.engine
+        sqlalchemy.event.listen(engine, "before_cursor_execute", record_query)
+        self.addCleanup(sqlalchemy.event.remove, engine,
+                        "before_cursor_execute", record_query)
+
+        res = storage.move_user(_UID, dst, max_per_loop=10)
+        self.assertEquals(res["from_shard"], src)
+        self.assertEquals(res["num_copied"], 33)
+        self.assertEquals(res["num_deleted"], 30)
+        self.assertEquals(storage.get_user_shard(_UID), dst)
+        self.assertEquals(len([q for q in queries if
+                               "DELETE_STALE_COLLECTION_ITEMS" in q]), 1)
+        items = storage.get_items(_UID, "col1", sort="index")["items"]
+        self.assertEquals([item["id"] for item in items],
+                          ["10"] + [str(i) for i in reversed(xrange(25))
+                                    if i not in (10, 11)] + ["new"])
+        self.assertEquals(items[0]["sortindex"], 99)
+        self.assertEquals([item["id"] for item in items
+                           if item["payload"] != _PLD], ["1"])
+
+        # New writes go to the new shard, and show up in the stats.
+        storage.set_item(_UID, "col2", "new", {"payload": "x"})
+        stats = storage.get_shard_stats(num_top_users=1)
+        self.assertEquals(stats[src]["num_rows"], 0)
+        self.assertEquals(stats[dst]["num_rows"], 31)
+        self.assertEquals(stats[dst]["num_users"], 1)
+        self.assertEquals(stats[dst]["top_users"],
+                          [(_UID, 31, 29 * len(_PLD) + len("changed") + 1)])
+
+        # Moving to the current shard does nothing.
+        res = storage.move_user(_UID, dst)
+        self.assertEquals(res["num_copied"], 0)
+        self.assertRaises(ValueError, storage.move_user, _UID, 99)
+
+    def test_shard_maps(self):
+        modulo = ModuloShardMap(10)
+        self.assertEquals(modulo.get_shard(1234), 4)
+        # Growing a consistent-hash map should move only a few users,
+        # and only onto the new shard.
+        old_map = ConsistentHashShardMap(10)
+        new_map = ConsistentHashShardMap(11)
+        moved = 0
+        for userid in xrange(10000):
+            self.assertTrue(0 <= old_map.get_shard(userid) < 10)
+            if old_map.get_shard(userid) != new_map.get_shard(userid):
+                self.assertEquals(new_map.get_shard(userid), 10)
+                moved += 1
+        self.assertTrue(500 < moved < 1500)
+        # Range maps split the userids at the given boundaries.
+        ranges = RangeShardMap(3, boundaries=[10, 20])
+        self.assertEquals([ranges.get_shard(userid) for userid in
+                           (0, 9, 10, 19, 20, 1000)], [0, 0, 1, 1, 2, 2])
+        self.assertRaises(ValueError, RangeShardMap, 3, [10])
+        # Boundaries read from a config file may be an int or a string.
+        self.assertEquals(RangeShardMap(2, boundaries=10).boundaries, [10])
+        self.assertEquals(RangeShardMap(3, boundaries="10, 20").boundaries,
+                          [10, 20])
+        self.assertRaises(ValueError, RangeShardMap, 3, [20, 10])
+
+    def test_range_shard_map_uses_configured_boundaries(self):
+        dbconnector = DBConnector("sqlite:///:memory:", shard=True,
+                                  shardsize=2, shard_map="range",
+                                  shard_boundaries="10")
+        self.addCleanup(dbconnector.engine.dispose)
+        self.assertEquals(dbconnector.get_bso_table(9).name, "bso0")
+        self.assertEquals(dbconnector.get_bso_table(10).name, "bso1")
+        self.assertRaises(ValueError, DBConnector, "sqlite:///:memory:",
+                          shard=True, shardsize=2, shard_map="range")
+
+    def test_partition_boundaries_from_config(self):
+        # A single boundary is read from a config file as an int.
+        for boundaries in (10, "10", [10]):
+            dbconnector = DBConnector("sqlite:///:memory:",
+                                      partition_sqluris="sqlite:///:memory:",
+                                      partition_boundaries=boundaries)
+            self.addCleanup(dbconnector.engine.dispose)
+            self.assertEquals(dbconnector.partition_map.get_shard(9), 0)
+            self.assertEquals(dbconnector.partition_map.get_shard(10), 1)
+
+    def test_partitioning_users_across_databases(self):
+        config = get_test_configurator(__file__, "tests-partitions.ini")
+        storage = load_and_register("storage", config)
+        dbconnector = storage.dbconnector
+        self.addCleanup(remove_sqlite_files, *[
+            str(engine.url) for engine in dbconnector.partition_engines[1:]
+        ])
+        self.assertEquals(dbconnector.num_partitions, 2)
+        # Users are assigned partitions by range, unless pinned to one.
+        with dbconnector.connect() as c:
+            c.insert_or_update("user_partitions", [{
+                "userid": 2,
+                "partitionid": 1,
+            }])
+        bsos = [{"id": str(i), "payload": _PLD} for i in xrange(5)]
+        for userid in (1, 2, 20):
+            storage.set_items(userid, "custom", bsos)
+
+        def count_items(partition, userid):
+            with dbconnector.connect(partition=partition) as c:
+                rows = c.query_fetchall("COLLECTIONS_COUNTS", {
+                    "userid": userid,
+                    "ttl": 0,
+                })
+                return sum(row[1] for row in rows)
+
+        self.assertEquals(count_items(0, 1), 5)
+        self.assertEquals(count_items(1, 1), 0)
+        for userid in (2, 20):
+            self.assertEquals(count_items(0, userid), 0)
+            self.assertEquals(count_items(1, userid), 5)
+            items = storage.get_items(userid, "custom")["items"]
+            self.assertEquals(len(items), 5)
+            self.assertEquals(storage.get_collection_counts(userid),
+                              {"custom": 5})
+
+        # Custom collection names are only kept in the main database.
+        for partition, expected in ((0, True), (1, False)):
+            with dbconnector.connect(partition=partition) as c:
+                collectionid = c.query_scalar("COLLECTION_ID", {
+                    "name": "custom",
+                })
+                self.assertEquals(collectionid is not None, expected)
+
+        # Maintenance tasks fan out to all the partitions.
+        res = storage.purge_expired_items()
+        self.assertTrue(res["is_complete"])
+        self.assertTrue("0/bso" in res["tables"])
+        self.assertTrue("1/bso" in res["tables"])
+        stats = storage.get_shard_stats()
+        self.assertEquals([(s["partition"], s["num_rows"]) for s in stats],
+                          [(0, 5), (1, 10)])
+
+        storage.delete_storage(20)
+        self.assertEquals(count_items(1, 20), 0)
+        self.assertEquals(count_items(1, 2), 5)
+
+    def test_shard_table_names_are_pre_interpolated(self):
+        config = get_test_configurator(__file__, 'tests-shard.ini')
+        storage = load_and_register("storage", config)
+        dbconnector = storage.dbconnector
+        query = dbconnector.get_query("DELETE_ALL_BSOS", {"userid": 42})
+        self.assertTrue(" bso42 " in query)
+        query = dbconnector.get_query("DELETE_ALL_BSOS", {"bso": "bso7"})
+        self.assertTrue(" bso7 " in query)
+        # Queries using several tables have the rest interpolated per-call.
+        query = dbconnector.get_query("APPLY_BATCH_INSERT", {
+            "userid": 42,
+            "batch": 1234,
+        })
+        self.assertTrue(" bso42" in query)
+        self.assertTrue(" batch_upload_items34" in query)
+
+    def test_streamed_reads_outlive_the_request_deadline(self):
+        bsos = [{"id": str(i), "payload": _PLD} for i in xrange(500)]
+        self.storage.set_items(_UID, "col", bsos)
+        request = DummyRequest()
+        self.config.begin(request=request)
+        self.addCleanup(self.config.end)
+        # The deadline bounds starting the query, but once the response is
+        # under way its rows are read at the pace of the client.
+        request.deadline = time.time() + 0.5
+        res = self.storage.get_items(_UID, "col", stream=True)
+        self.assertFalse(isinstance(res["items"], list))
+        items = iter(res["items"])
+        self.assertEquals(next(items)["payload"], _PLD)
+        time.sleep(max(request.deadline - time.time(), 0) + 0.1)
+        self.assertEquals(len(list(items)), 499)
+
+    def test_queries_are_bounded_by_the_request_deadline(self):
+        storage = self.storage
+        storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        request = DummyRequest()
+        self.config.begin(request=request)
+        self.addCleanup(self.config.end)
+        # Without a deadline, queries run as normal.
+        self.assertEquals(storage.get_item(_UID, "col", "a")["payload"], _PLD)
+        # Once the deadline has passed, they fail without being run.
+        request.deadline = time.time() - 1
+        self.assertRaises(DeadlineExceededError,
+                          storage.get_item, _UID, "col", "a")
+        # A statement that is still running at the deadline is aborted.
+        # Other databases cap the depth of recursive queries, so can't run
+        # this one for long enough to test it.
+        if storage.dbconnector.driver == "sqlite":
+            deadline = time.time() + 0.1
+            connection = storage.dbconnector.connect(deadline=deadline)
+            query = "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL "\
+                    "SELECT x + 1 FROM n) SELECT COUNT(*) FROM n"
+            self.assertRaises(DeadlineExceededError, connection.execute,
+                              query, annotations={"queryName": "FOREVER"})
+            connection.rollback()
+            self.assertTrue(time.time() - deadline < 1)
+        # The pooled connections are left without any limits.
+        request.deadline = None
+        self.assertEquals(storage.get_item(_UID, "col", "a")["payload"], _PLD)
+
+    def test_query_stats_and_slow_query_log(self):
+        storage = self.storage
+        dbconnector = storage.dbconnector
+        dbconnector.query_stats.flush()
+        storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        for _ in xrange(3):
+            storage.get_item(_UID, "col", "a")
+        self.assertRaises(ItemNotFoundError,
+                          storage.get_item, _UID, "col", "b")
+        with testfixtures.LogCapture() as logs:
+            summaries = dbconnector.query_stats.flush()
+        summary = summaries["ITEM_DETAILS"]
+        self.assertEquals(summary["count"], 4)
+        self.assertEquals(summary["rows"], 3)
+        self.assertTrue(summary["p50"] <= summary["p95"] <= summary["p99"])
+        self.assertTrue(summary["p99"] <= summary["max"])
+        # The figures are logged as metrics, then reset.
+        metric = "syncstorage.storage.sql.query.ITEM_DETAILS.count"
+        self.assertEquals(logs.records[-1].__dict__[metric], 4)
+        self.assertEquals(dbconnector.query_stats.flush(), {})
+        # Queries taking longer than the slow query time are logged.
+        dbconnector.slow_query_time = 1e-9
+        with testfixtures.LogCapture() as logs:
+            storage.get_item(_UID, "col", "a")
+        messages = [r.getMessage() for r in logs.records]
+        messages = [m for m in messages if "Slow query ITEM_DETAILS" in m]
+        self.assertEquals(len(messages), 1)
+        self.assertTrue("collectionid,item,ttl,userid" in messages[0])
+
+
+class TestSQLStorageWithUsageTracking(TestSQLStorage):
+
+    TEST_INI_FILE = "tests-usage-tracking.ini"
+
+    def test_usage_tracking_of_writes_and_deletes(self):
+        storage = self.storage
+        storage.set_items(_UID, "col1", [
+            {"id": "a", "payload": "x" * 10},
+            {"id": "b", "payload": "x" * 20},
+            {"id": "c", "sortindex": 1},
+        ])
+        storage.set_item(_UID, "col2", "a", {"payload": "x" * 5})
+        self.assertEquals(storage.get_collection_counts(_UID),
+                          {"col1": 3, "col2": 1})
+        self.assertEquals(storage.get_collection_sizes(_UID),
+                          {"col1": 30, "col2": 5})
+        self.assertEquals(storage.get_total_size(_UID), 35)
+
+        # Updates change the size but not the count.
+        storage.set_items(_UID, "col1", [
+            {"id": "a", "payload": "x" * 15},
+            {"id": "b", "sortindex": 2},
+            {"id": "d", "payload": "x" * 3},
+            {"id": "d", "payload": "x" * 4},
+        ])
+        storage.set_item(_UID, "col2", "a", {"payload": "x" * 7})
+        self.assertEquals(storage.get_collection_counts(_UID),
+                          {"col1": 4, "col2": 1})
+        self.assertEquals(storage.get_collection_sizes(_UID),
+                          {"col1": 39, "col2": 7})
+
+        # Batch uploads are counted when the batch is applied.
+        batchid = storage.create_batch(_UID, "col2")
+        storage.append_items_to_batch(_UID, "col2", batchid, [
+            {"id": "a", "sortindex": 3},
+            {"id": "b", "payload": "x" * 8},
+        ])
+        storage.apply_batch(_UID, "col2", batchid)
+        self.assertEquals(storage.get_collection_counts(_UID),
+                          {"col1": 4, "col2": 2})
+        self.assertEquals(storage.get_collection_sizes(_UID),
+                          {"col1": 39, "col2": 15})
+
+        # Deletes reduce both count and size.
+        storage.delete_item(_UID, "col1", "a")
+        storage.delete_items(_UID, "col1", ["b", "c", "missing"])
+        self.assertEquals(storage.get_collection_counts(_UID),
+                          {"col1": 1, "col2": 2})
+        self.assertEquals(storage.get_collection_sizes(_UID),
+                          {"col1": 4, "col2": 15})
+        storage.delete_items(_UID, "col1", ["d"])
+        self.assertEquals(storage.get_collection_counts(_UID), {"col2": 2})
+        storage.delete_collection(_UID, "col2")
+        self.assertEquals(storage.get_collection_counts(_UID), {})
+        self.assertEquals(storage.get_total_size(_UID), 0)
+
+    def test_usage_tracking_is_reconciled_by_purge(self):
+        storage = self.storage
+        storage.set_items(_UID, "col", [
+            {"id": "short", "payload": "x" * 10, "ttl": 0},
+            {"id": "long", "payload": "x" * 20},
+        ])
+        time.sleep(1)
+        # The expired item is still included in the running totals.
+        self.assertEquals(storage.get_collection_counts(_UID), {"col": 2})
+        self.assertEquals(storage.get_total_size(_UID), 30)
+        # Purging it from the database removes it from the totals.
+        storage.purge_expired_items(grace_period=0)
+        self.assertEquals(storage.get_collection_counts(_UID), {"col": 1})
+        self.assertEquals(storage.get_total_size(_UID), 20)
+
+    def test_usage_tracking_is_reconciled_per_purged_chunk(self):
+        storage = self.storage
+        storage.set_item(_UID, "col1", "a", {"payload": "x" * 10, "ttl": 1})
+        storage.set_item(_UID, "col2", "a", {"payload": "x" * 20, "ttl": 2})
+        storage.set_item(_UID, "col2", "b", {"payload": "x" * 5})
+        time.sleep(3)
+        # A purge that stops early only removes the items it deleted.
+        res = storage.purge_expired_items(grace_period=0, max_per_loop=1,
+                                          max_iters=1)
+        self.assertFalse(res["is_complete"])
+        self.assertEquals(storage.get_collection_counts(_UID), {"col2": 2})
+        self.assertEquals(storage.get_total_size(_UID), 25)
+        res = storage.purge_expired_items(grace_period=0, max_per_loop=1)
+        self.assertTrue(res["is_complete"])
+        self.assertEquals(storage.get_collection_counts(_UID), {"col2": 1})
+        self.assertEquals(storage.get_total_size(_UID), 5)
+
+    def test_usage_tracking_is_reconciled_across_tied_ttls(self):
+        storage = self.storage
+        for collection in ("col1", "col2", "col3"):
+            storage.set_item(_UID, collection, "a", {"payload": "x" * 10})
+        # Give every item the same expiry, so the chunk boundary falls
+        # between items that the database may delete in any order.
+        with storage.dbconnector.connect() as c:
+            c.execute("UPDATE bso SET ttl = %d "
+                      "/* queryName=EXPIRE_ITEMS */" % (time.time() - 1,))
+        recalculated = []
+        recalculate = storage._recalculate_collection_usage
+
+        def record_recalculation(userid, collectionid):
+            recalculated.append(collectionid)
+            return recalculate(userid, collectionid)
+
+        storage._recalculate_collection_usage = record_recalculation
+        res = storage.purge_expired_items(grace_period=0, max_per_loop=1,
+                                          max_iters=1)
+        self.assertFalse(res["is_complete"])
+        self.assertEquals(res["num_bso_rows_purged"], 1)
+        # Whichever item went, its collection was recalculated.
+        self.assertEquals(len(recalculated), 3)
+        self.assertEquals(sum(storage.get_collection_counts(_UID).values()),
+                          2)
+        self.assertEquals(storage.get_total_size(_UID), 20)
+
+    def test_usage_tracking_of_writes_to_expired_items(self):
+        storage = self.storage
+        storage.set_item(_UID, "col", "a", {"payload": "xxx", "ttl": 1})
+        storage.set_item(_UID, "col", "b", {"payload": "xxxxx", "ttl": 1})
+        time.sleep(2)
+        # Overwriting or deleting an expired item replaces its usage.
+        storage.set_item(_UID, "col", "a", {"payload": "x" * 10, "ttl": 100})
+        storage.delete_items(_UID, "col", ["b"])
+        self.assertEquals(storage.get_collection_counts(_UID), {"col": 1})
+        self.assertEquals(storage.get_total_size(_UID), 10)
+        batchid = storage.create_batch(_UID, "col")
+        storage.append_items_to_batch(_UID, "col", batchid, [
+            {"id": "a", "payload": "x" * 4},
+        ])
+        storage.apply_batch(_UID, "col", batchid)
+        self.assertEquals(storage.get_collection_counts(_UID), {"col": 1})
+        self.assertEquals(storage.get_total_size(_UID), 4)
+
+    def test_usage_tracking_recalculates_expired_items(self):
+        storage = self.storage
+        storage.set_item(_UID, "col", "a", {"payload": "x" * 10, "ttl": 1})
+        storage.set_item(_UID, "col", "b", {"payload": "x" * 7})
+        time.sleep(2)
+        # Expired items count until they are purged, even when recalculated.
+        self.assertEquals(storage.get_total_size(_UID, recalculate=True), 17)
+        storage.set_item(_UID, "col", "a", {"payload": "x" * 3, "ttl": 100})
+        self.assertEquals(storage.get_collection_counts(_UID), {"col": 2})
+        self.assertEquals(storage.get_total_size(_UID), 10)
+        storage.delete_items(_UID, "col", ["a"])
+        self.assertEquals(storage.get_collection_counts(_UID), {"col": 1})
+        self.assertEquals(storage.get_total_size(_UID), 7)
+
+    def test_usage_tracking_can_be_recalculated(self):
+        storage = self.storage
+        storage.set_items(_UID, "col", [
+            {"id": "a", "payload": "x" * 10},
+            {"id": "b", "payload": "x" * 20},
+        ])
+        # Simulate totals that are out of date, e.g. from before
+        # usage tracking was enabled.
+        with storage.dbconnector.connect() as c:
+            c.execute("UPDATE user_collections SET item_count = 0, "
+                      "total_bytes = 0 /* queryName=RESET_USAGE */")
+        self.assertEquals(storage.get_total_size(_UID), 0)
+        self.assertEquals(storage.get_total_size(_UID, recalculate=True), 30)
+        self.assertEquals(storage.get_collection_counts(_UID), {"col": 2})
+
+
+class TestSQLStorageWithAsyncDeletes(TestSQLStorage):
+
+    TEST_INI_FILE = "tests-async-deletes.ini"
+
+    def count_rows(self, table):
+        QUERY = "SELECT COUNT(*) FROM %s /* queryName=COUNT_ROWS */" % table
+        with self.storage.dbconnector.connect() as c:
+            return c.execute(QUERY).fetchall()[0][0]
+
+    def test_deleted_collection_is_hidden_until_purged(self):
+        storage = self.storage
+        storage.set_items(_UID, "col1", [
+            {"id": "a", "payload": "x" * 10, "sortindex": 1},
+            {"id": "b", "payload": "x" * 20},
+        ])
+        storage.set_item(_UID, "col2", "a", {"payload": "x" * 5})
+        storage.delete_collection(_UID, "col1")
+        # The items are still in the database, but can't be seen.
+        self.assertEquals(self.count_rows("bso"), 3)
+        self.assertEquals(storage.get_collection_counts(_UID), {"col2": 1})
+        self.assertEquals(storage.get_collection_sizes(_UID), {"col2": 5})
+        self.assertEquals(storage.get_total_size(_UID), 5)
+        self.assertRaises(CollectionNotFoundError,
+                          storage.get_items, _UID, "col1")
+        self.assertRaises(ItemNotFoundError, storage.get_item,
+                          _UID, "col1", "a")
+
+        # Writing to the collection again doesn't resurrect old items.
+        time.sleep(0.02)
+        storage.set_item(_UID, "col1", "a", {"payload": "y" * 3})
+        self.assertEquals(storage.get_item(_UID, "col1", "a").get("sortindex"),
+                          None)
+        self.assertRaises(ItemNotFoundError, storage.get_item,
+                          _UID, "col1", "b")
+        items = storage.get_items(_UID, "col1")["items"]
+        self.assertEquals([item["id"] for item in items], ["a"])
+        self.assertEquals(storage.get_collection_counts(_UID),
+                          {"col1": 1, "col2": 1})
+
+        # Purging removes the remaining items, and then the tombstone.
+        res = storage.purge_expired_items(max_per_loop=1)
+        self.assertTrue(res["is_complete"])
+        self.assertEquals(res["num_tombstoned_rows_purged"], 1)
+        self.assertEquals(self.count_rows("bso"), 2)
+        self.assertEquals(self.count_rows("collection_tombstones"), 0)
+        self.assertEquals(storage.get_item(_UID, "col1", "a")["payload"],
+                          "y" * 3)
+
+    def test_writing_in_the_same_tick_as_a_delete(self):
+        storage = self.storage
+        storage.set_items(_UID, "col1", [
+            {"id": "a", "payload": "x" * 10},
+            {"id": "b", "payload": "x" * 20},
+        ])
+        storage.delete_collection(_UID, "col1")
+        # Move the tombstone forward, as if the clock hadn't yet ticked.
+        with storage.dbconnector.connect() as c:
+            c.execute("UPDATE collection_tombstones "
+                      "SET modified = modified + 60000 "
+                      "/* queryName=MOVE_TOMBSTONE */")
+        # The write finishes off the delete, rather than being hidden by it.
+        storage.set_item(_UID, "col1", "a", {"payload": "y" * 3})
+        self.assertEquals(self.count_rows("bso"), 1)
+        self.assertEquals(self.count_rows("collection_tombstones"), 0)
+        items = storage.get_items(_UID, "col1")["items"]
+        self.assertEquals([item["payload"] for item in items], ["y" * 3])
+
+    def test_deleted_storage_is_purged_in_chunks(self):
+        storage = self.storage
+        for collection in ("col1", "col2"):
+            storage.set_items(_UID, collection, [
+                {"id": str(i), "payload": _PLD} for i in xrange(5)
+            ])
+        storage.set_item(_UID + 1, "col1", "a", {"payload": _PLD})
+        storage.delete_storage(_UID)
+        self.assertEquals(storage.get_collection_timestamps(_UID), {})
+        self.assertEquals(storage.get_collection_counts(_UID), {})
+        self.assertEquals(storage.get_total_size(_UID), 0)
+        self.assertEquals(storage.get_collection_counts(_UID + 1),
+                          {"col1": 1})
+
+        # The deleter gives up after max_iters chunks, and picks up
+        # where it left off on the next run.
+        res = storage.purge_expired_items(max_per_loop=3, max_iters=2)
+        self.assertFalse(res["is_complete"])
+        self.assertEquals(res["num_tombstoned_rows_purged"], 6)
+        res = storage.purge_expired_items(max_per_loop=3, max_iters=10)
+        self.assertTrue(res["is_complete"])
+        self.assertEquals(res["num_tombstoned_rows_purged"], 4)
+        self.assertEquals(self.count_rows("bso"), 1)
+        self.assertEquals(self.count_rows("collection_tombstones"), 0)
+
+    def test_recalculated_usage_leaves_out_deleted_items(self):
+        sqluri = self.config.registry.settings["storage.sqluri"]
+        storage = SQLStorage(sqluri, standard_collections=True,
+                             async_deletes=True, track_collection_usage=True)
+        storage.set_items(_UID, "col", [
+            {"id": str(i), "payload": "x" * 10} for i in xrange(5)
+        ])
+        storage.delete_collection(_UID, "col")
+        time.sleep(0.02)
+        storage.set_item(_UID, "col", "a", {"payload": "x" * 10})
+        self.assertEquals(storage.get_total_size(_UID, recalculate=True), 10)
+        self.assertEquals(storage.get_collection_counts(_UID), {"col": 1})
+        self.assertEquals(storage.get_collection_sizes(_UID), {"col": 10})
+        # Purging the deleted items leaves the totals unchanged.
+        res = storage.purge_expired_items(grace_period=0)
+        self.assertTrue(res["is_complete"])
+        self.assertEquals(storage.get_collection_counts(_UID), {"col": 1})
+        self.assertEquals(storage.get_total_size(_UID), 10)
+
+
+class TestSQLStorageWithOptimisticWrites(TestSQLStorage):
+
+    TEST_INI_FILE = "tests-optimistic-writes.ini"
+
+    def write_after_concurrent_write(self, offset, func, *args):
+        storage = self.storage
+        with storage.lock_for_write(_UID, "col"):
+            # Simulate a write committed after the lock was taken, with
+            # a timestamp offset from that of this session.
+            session = storage._tldata.session
+            session.query("TOUCH_COLLECTION", {
+                "userid": _UID,
+                "collectionid": storage._get_collection_id(session, "col"),
+                "modified": ts2bigint(session.timestamp) + offset,
+            })
+            return func(_UID, "col", *args)
+
+    def test_single_item_writes_detect_conflicts(self):
+        storage = self.storage
+        storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        time.sleep(0.02)
+        # The lock doesn't hold the row until the collection is touched.
+        with storage.lock_for_write(_UID, "col"):
+            session = storage._tldata.session
+            self.assertEquals(len(session.optimistic_locks), 1)
+            storage.set_item(_UID, "col", "b", {"payload": _PLD})
+            self.assertEquals(len(session.optimistic_locks), 0)
+
+        # Single-item writes conflict with newer concurrent writes.
+        time.sleep(0.02)
+        self.assertRaises(ConflictError, self.write_after_concurrent_write,
+                          10, storage.set_item, "c", {"payload": _PLD})
+        self.assertRaises(ConflictError, self.write_after_concurrent_write,
+                          0, storage.delete_item, "a")
+        self.assertRaises(ItemNotFoundError, storage.get_item,
+                          _UID, "col", "c")
+        storage.get_item(_UID, "col", "a")
+        # But not with older ones, which they would have waited for.
+        self.write_after_concurrent_write(-10, storage.set_item, "c",
+                                          {"payload": _PLD})
+        storage.get_item(_UID, "col", "c")
+
+        # Other writes conflict with any concurrent write.
+        time.sleep(0.02)
+        self.assertRaises(ConflictError, self.write_after_concurrent_write,
+                          -10, storage.set_items, [{"id": "d"}])
+        self.assertRaises(ConflictError, self.write_after_concurrent_write,
+                          -10, storage.delete_collection)
+        storage.get_item(_UID, "col", "a")
+        self.assertRaises(ItemNotFoundError, storage.get_item,
+                          _UID, "col", "d")
+
+
+class TestSQLStorageWithSQLiteWAL(TestSQLStorage):
+
+    TEST_INI_FILE = "tests-sqlite-wal.ini"
+
+    def test_writes_and_reads_use_separate_pools(self):
+        dbconnector = self.storage.dbconnector
+        self.assertEquals(dbconnector.engine.pool.size(), 1)
+        self.assertEquals(dbconnector.reader_engine.pool.size(), 100)
+        for engine in (dbconnector.engine, dbconnector.reader_engine):
+            mode = engine.execute("PRAGMA journal_mode").scalar()
+            self.assertEquals(mode.lower(), "wal")
+        query = dbconnector._prebuilt_queries["BEGIN_TRANSACTION_WRITE"]
+        self.assertEquals(query, "BEGIN IMMEDIATE TRANSACTION")
+
+    def test_readers_are_not_blocked_by_writer(self):
+        storage = self.storage
+        ts = storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        ts = ts["modified"]
+        results = []
+
+        def read_items():
+            with storage.lock_for_read(_UID, "col"):
+                results.append(storage.get_collection_timestamp(_UID, "col"))
+                items = storage.get_items(_UID, "col")["items"]
+                results.append([item["id"] for item in items])
+
+        # Wait for the clock to tick, so that the write lock is allowed.
+        time.sleep(0.02)
+        with storage.lock_for_write(_UID, "col"):
+            storage.set_item(_UID, "col", "b", {"payload": _PLD})
+            # A concurrent reader sees the last committed data straight away,
+            # rather than waiting for the writer to finish.
+            reader = threading.Thread(target=read_items)
+            reader.start()
+            reader.join(2)
+            self.assertFalse(reader.is_alive())
+        self.assertEquals(results, [ts, ["a"]])
+        items = storage.get_items(_UID, "col")["items"]
+        self.assertEquals(sorted(item["id"] for item in items), ["a", "b"])
+
+    def test_wal_mode_requires_a_file_backed_database(self):
+        self.assertRaises(ValueError, DBConnector, "sqlite:///:memory:",
+                          sqlite_wal=True)
+        self.assertRaises(ValueError, DBConnector, "sqlite:////tmp/a.db",
+                          sqlite_wal=True, sqlite_synchronous="SOMETIMES")
+
+
+class TestSQLStorageWithReplicas(TestSQLStorage):
+
+    # This uses the main database as its own replica, so that all of
+    # the standard storage tests can be run with replica routing enabled.
+    TEST_INI_FILE = "tests-replicas.ini"
+
+    def _make_stale_replica_storage(self, replica_stickiness=0):
+        # Make a storage whose replica is a separate, empty database,
+        # as if it had not yet received any writes from the primary.
+        # By default reads don't stick to the primary after a write.
+        replica_path = "/tmp/tests-sync-replica-%s.db"
+        replica_path %= (os.environ["MOZSVC_UUID"],)
+        self.addCleanup(os.unlink, replica_path)
+        replica_sqluri = "sqlite:///" + replica_path
+        DBConnector(replica_sqluri, create_tables=True).engine.dispose()
+        sqluri = self.config.registry.settings["storage.sqluri"]
+        return SQLStorage(sqluri, standard_collections=True,
+                          replica_sqluris=replica_sqluri,
+                          replica_stickiness=replica_stickiness)
+
+    def test_reads_are_routed_to_replica(self):
+        storage = self._make_stale_replica_storage()
+        ts = storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        ts = ts["modified"]
+        # Lock-free reads and read-locked reads go to the stale replica.
+        self.assertEquals(storage.get_collection_timestamps(_UID), {})
+        self.assertEquals(storage.get_storage_timestamp(_UID), 0)
+        with storage.lock_for_read(_UID, "col"):
+            self.assertRaises(CollectionNotFoundError,
+                              storage.get_collection_timestamp, _UID, "col")
+        # Write-locked reads always go to the primary.
+        # Wait for the clock to tick, so that the lock is allowed.
+        time.sleep(0.02)
+        with storage.lock_for_write(_UID, "col"):
+            self.assertEquals(storage.get_collection_timestamp(_UID, "col"),
+                              ts)
+
+    def test_replica_is_bypassed_if_client_has_seen_newer_data(self):
+        storage = self._make_stale_replica_storage()
+        ts = storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        ts = ts["modified"]
+        request = DummyRequest()
+        request.validated = {"if_modified_since": ts}
+        self.config.begin(request=request)
+        self.addCleanup(self.config.end)
+        self.assertEquals(storage.get_collection_timestamps(_UID),
+                          {"col": ts})
+        with storage.lock_for_read(_UID, "col"):
+            self.assertEquals(storage.get_collection_timestamp(_UID, "col"),
+                              ts)
+        # A client that hasn't seen the write may read from the replica.
+        request.validated = {"newer": 0}
+        self.assertEquals(storage.get_collection_timestamps(_UID), {})
+
+    def test_reads_stick_to_primary_after_a_write(self):
+        storage = self._make_stale_replica_storage(replica_stickiness=60)
+        ts = storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        ts = ts["modified"]
+        # A read that doesn't say what the client has seen goes to the
+        # primary, and so sees the write.
+        self.assertEquals(storage.get_collection_timestamps(_UID),
+                          {"col": ts})
+        # Once the window has passed, the replica is used again.
+        storage._recent_writers[_UID] = time.time() - 1
+        self.assertEquals(storage.get_collection_timestamps(_UID), {})
+
+    def test_unreachable_replica_is_ejected(self):
+        sqluri = self.config.registry.settings["storage.sqluri"]
+        storage = SQLStorage(sqluri, replica_sqluris=[
+            "sqlite:////no/such/directory/replica.db",
+        ])
+        replica = storage.dbconnector.replicas[0]
+        ts = storage.set_item(_UID, "col", "a", {"payload": _PLD})
+        ts = ts["modified"]
+        self.assertEquals(storage.get_collection_timestamps(_UID),
+                          {"col": ts})
+        self.assertFalse(replica.healthy)
+        self.assertFalse(storage.dbconnector.connect(read_only=True)
+                         .is_replica)
+
+    def test_lagging_replica_is_ejected(self):
+        dbconnector = self.storage.dbconnector
+        replica = dbconnector.replicas[0]
+        replica.check_health()
+        self.assertTrue(replica.healthy)
+        self.assertEquals(replica.lag, 0)
+        dbconnector._prebuilt_queries["REPLICA_LAG"] = "SELECT 100"
+        replica.check_health()
+        self.assertFalse(replica.healthy)
+        self.assertEquals(replica.lag, 100)
+        # It stays out of service until the next health check is due.
+        dbconnector._prebuilt_queries["REPLICA_LAG"] = "SELECT 0"
+        self.assertFalse(replica.is_available())
+        replica.last_checked -= replica.check_interval
+        self.assertTrue(replica.is_available())
+
+    def test_replica_lag_query_depends_on_postgres_version(self):
+        replica = self.storage.dbconnector.replicas[0]
+        self.assertEquals(replica._get_lag_query(), "REPLICA_LAG")
+        # Pretend that the replica is an old, then a new, PostgreSQL server.
+        dialect = replica.engine.dialect
+        self.addCleanup(setattr, replica.connector, "driver",
+                        replica.connector.driver)
+        self.addCleanup(setattr, dialect, "server_version_info",
+                        dialect.server_version_info)
+        replica.connector.driver = "postgres"
+        dialect.server_version_info = (9, 6, 3)
+        self.assertEquals(replica._get_lag_query(), "REPLICA_LAG_XLOG")
+        dialect.server_version_info = (10, 1)
+        self.assertEquals(replica._get_lag_query(), "REPLICA_LAG")
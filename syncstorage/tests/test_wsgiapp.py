@@ -132,3 +132,31 @@ class TestWSGIApp(StorageTestCase):
                 break
         else:
             assert False, "timer metrics were not emitted"
+
+    def test_requests_are_shed_when_backend_is_saturated(self):
+        settings = self.config.registry.settings
+        settings["storage.max_concurrent_requests"] = "1"
+        settings["storage.max_queued_requests"] = "0"
+        app = self._make_test_app()
+        req = self.make_request(environ={"HTTP_HOST": "localhost"})
+        storage = get_storage(req)
+        orig_get_collection_timestamps = storage.get_collection_timestamps
+        responses = []
+
+        def get_collection_timestamps(*args, **kwds):
+            # A request arriving while this one holds the only slot, with
+            # no room to queue, is turned away before reaching the storage.
+            res = app.get("/1.5/42/info/collections", status=503)
+            responses.append(res)
+            return orig_get_collection_timestamps(*args, **kwds)
+
+        storage.get_collection_timestamps = get_collection_timestamps
+        try:
+            app.get("/1.5/42/info/collections")
+        finally:
+            del storage.get_collection_timestamps
+        self.assertEquals(len(responses), 1)
+        self.assertTrue("Retry-After" in responses[0].headers)
+
+        # The slot is released once the request has finished.
+        app.get("/1.5/42/info/collections")
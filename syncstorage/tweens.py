@@ -3,10 +3,15 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import json
+import time
 
-from pyramid.httpexceptions import HTTPException
+from pyramid.httpexceptions import HTTPException, HTTPServiceUnavailable
 
-from syncstorage.util import get_timestamp
+from mozsvc.metrics import annotate_request
+
+from syncstorage.util import get_timestamp, ConcurrencyLimiter
+from syncstorage.storage import get_storage
+from syncstorage.views.decorators import RETRY_AFTER
 
 try:
     from mozsvc.storage.mcclient import MemcachedClient
@@ -21,6 +26,9 @@ WEAVE_INVALID_WBO = 8               # Invalid Weave Basic Object
 WEAVE_OVER_QUOTA = 14               # User over quota
 WEAVE_SIZE_LIMIT_EXCEEDED = 17      # Size limit exceeded
 
+# Prefix for the names of the metrics reported by the concurrency limiter.
+LIMITER_METRIC = __name__ + ".limiter"
+
 
 def set_x_timestamp_header(handler, registry):
     """Tween to set the X-Weave-Timestamp header on all responses."""
@@ -37,6 +45,109 @@ def set_x_timestamp_header(handler, registry):
     return set_x_timestamp_header_tween
 
 
+def set_request_deadline(handler, registry):
+    """Tween to give each request a deadline for its storage operations.
+
+    If the "storage.request_timeout" setting is non-zero, this tween sets a
+    "deadline" attribute on each request, that many seconds after it starts.
+    The SQL storage backend won't run any queries past this deadline, and
+    fails fast with a "503 Service Unavailable" response once it's passed.
+    """
+    timeout = float(registry.settings.get("storage.request_timeout", 0))
+    if not timeout:
+        return handler
+
+    def set_request_deadline_tween(request):
+        request.deadline = time.time() + timeout
+        return handler(request)
+
+    return set_request_deadline_tween
+
+
+def limit_concurrent_requests(handler, registry):
+    """Tween to limit the number of requests in progress for each backend.
+
+    If the "storage.max_concurrent_requests" setting is non-zero, each storage
+    backend admits at most that many requests at once.  This is checked
+    before the request is authenticated or its body is parsed, so that an
+    overloaded backend turns requests away cheaply, rather than after doing
+    that work only to queue up for a database connection.
+
+    Up to "storage.max_queued_requests" further requests may wait for a slot,
+    by default as many as are allowed to run.  A waiting request is turned
+    away if it hasn't got a slot within "storage.max_queue_time" seconds,
+    or by its deadline.  Requests that are turned away get a "503 Service
+    Unavailable" response with a Retry-After header.  The queue depth seen by
+    each request, and the time it spent waiting, are reported as metrics.
+    """
+    settings = registry.settings
+    max_concurrency = int(settings.get("storage.max_concurrent_requests", 0))
+    if not max_concurrency:
+        return handler
+    max_queue = int(settings.get("storage.max_queued_requests",
+                                 max_concurrency))
+    max_queue_time = float(settings.get("storage.max_queue_time", 0))
+    limiters = {}
+
+    def get_limiter(storage):
+        limiter = limiters.get(storage)
+        if limiter is None:
+            limiter = ConcurrencyLimiter(max_concurrency, max_queue)
+            limiter = limiters.setdefault(storage, limiter)
+        return limiter
+
+    def limit_concurrent_requests_tween(request):
+        limiter = get_limiter(get_storage(request))
+        annotate_request(request, LIMITER_METRIC + ".queue_depth",
+                         limiter.queue_depth)
+        timeout = max_queue_time or None
+        deadline = getattr(request, "deadline", None)
+        if deadline is not None:
+            remaining = max(deadline - time.time(), 0)
+            timeout = min(timeout or remaining, remaining)
+        t_start = time.time()
+        if not limiter.acquire(timeout):
+            annotate_request(request, LIMITER_METRIC + ".shed", 1)
+            headers = {"Retry-After": str(RETRY_AFTER)}
+            return HTTPServiceUnavailable(headers=headers)
+        annotate_request(request, LIMITER_METRIC + ".queue_time",
+                         time.time() - t_start)
+        release = True
+        try:
+            response = handler(request)
+            # A streamed response keeps hold of its slot until it's sent.
+            if not isinstance(response.app_iter, (list, tuple)):
+                response.app_iter = _ReleasingAppIter(response.app_iter,
+                                                      limiter.release)
+                release = False
+            return response
+        finally:
+            if release:
+                limiter.release()
+
+    return limit_concurrent_requests_tween
+
+
+class _ReleasingAppIter(object):
+    """Wrapper for a response app_iter that calls a function once closed."""
+
+    def __init__(self, app_iter, on_close):
+        self.app_iter = app_iter
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, "close"):
+                self.app_iter.close()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+                self.on_close = None
+
+
 def set_default_accept_header(handler, registry):
     """Tween to set a default Accept header on incoming requests.
 
@@ -140,7 +251,11 @@ def convert_non_json_responses(handler, registry):
 
 def includeme(config):
     """Include all the SyncServer tweens into the given config."""
+    # Tweens added first are called last, so that the limit is applied
+    # just before the request is handed over to the view.
+    config.add_tween("syncstorage.tweens.limit_concurrent_requests")
     config.add_tween("syncstorage.tweens.set_x_timestamp_header")
     config.add_tween("syncstorage.tweens.set_default_accept_header")
+    config.add_tween("syncstorage.tweens.set_request_deadline")
     config.add_tween("syncstorage.tweens.convert_cornice_errors_to_respcodes")
     config.add_tween("syncstorage.tweens.convert_non_json_responses")
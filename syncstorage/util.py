@@ -2,9 +2,13 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import sys
 import time
+import Queue
 import decimal
+import threading
 import simplejson
+from collections import OrderedDict, deque
 
 
 TWO_DECIMAL_PLACES = decimal.Decimal("1.00")
@@ -30,3 +34,277 @@ def json_dumps(value):
 def json_loads(value):
     """Decimal-aware version of json.loads()."""
     return simplejson.loads(value, use_decimal=True)
+
+
+def run_concurrently(funcs, max_concurrency=1, slots=None):
+    """Call each of the given functions, using a pool of worker threads.
+
+    At most max_concurrency of the functions will be running at any one time.
+    If a semaphore is given as "slots" then each call will also hold it while
+    running, so that a single semaphore can cap the total concurrency of
+    several pools.  The results are returned in the same order as the given
+    functions.  If any of them raises an error then no further calls will
+    be started, and the first such error is re-raised.
+    """
+    funcs = list(funcs)
+    results = [None] * len(funcs)
+    errors = []
+    pending = Queue.Queue()
+    for i, func in enumerate(funcs):
+        pending.put((i, func))
+
+    def worker():
+        while not errors:
+            try:
+                i, func = pending.get_nowait()
+            except Queue.Empty:
+                break
+            if slots is not None:
+                slots.acquire()
+            try:
+                results[i] = func()
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                if slots is not None:
+                    slots.release()
+
+    num_workers = min(int(max_concurrency), len(funcs))
+    if num_workers <= 1:
+        worker()
+    else:
+        workers = [threading.Thread(target=worker)
+                   for _ in xrange(num_workers)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    if errors:
+        exc_type, exc_val, exc_tb = errors[0]
+        raise exc_type, exc_val, exc_tb
+    return results
+
+
+class RateLimiter(object):
+    """Thread-safe limiter for the rate at which some work is done.
+
+    Each unit of work is assigned a slot in a schedule that runs at the given
+    rate per second.  Calling consume() after doing some work will sleep until
+    the schedule has caught up with it.  Unused capacity is not carried over,
+    so the work can never burst above the given rate.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._next_time = None
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """Record that the given amount of work was done, sleeping if needed.
+
+        This returns the number of seconds spent sleeping.
+        """
+        with self._lock:
+            now = time.time()
+            if self._next_time is None or self._next_time < now:
+                self._next_time = now
+            self._next_time += amount / self.rate
+            delay = self._next_time - now
+        if delay > 0:
+            time.sleep(delay)
+            return delay
+        return 0
+
+
+class ConcurrencyLimiter(object):
+    """Thread-safe limit on the number of concurrent holders of a resource.
+
+    At most max_concurrency callers can hold a slot at any one time.  Others
+    wait in a first-come, first-served queue of at most max_queue callers,
+    and any beyond that are turned away immediately.  Each waiting caller
+    gives up if a slot hasn't been handed to it within its timeout.
+
+    The waits use the primitives from the threading module, so they yield
+    to other greenlets when that module has been monkey-patched by gevent.
+    """
+
+    def __init__(self, max_concurrency, max_queue=0):
+        self.max_concurrency = int(max_concurrency)
+        self.max_queue = int(max_queue)
+        self.active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self):
+        """The number of callers currently waiting for a slot."""
+        return len(self._waiters)
+
+    def acquire(self, timeout=None):
+        """Acquire a slot, waiting up to the given timeout in seconds.
+
+        This returns True if a slot was acquired, and False if the queue was
+        full or the timeout expired first.
+        """
+        with self._lock:
+            if self.active < self.max_concurrency and not self._waiters:
+                self.active += 1
+                return True
+            if len(self._waiters) >= self.max_queue:
+                return False
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        waiter.wait(timeout)
+        with self._lock:
+            # The slot may have been handed over just after the timeout.
+            if waiter.is_set():
+                return True
+            self._waiters.remove(waiter)
+        return False
+
+    def release(self):
+        """Release a slot, handing it directly to the first waiter if any."""
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self.active -= 1
+
+
+class SingleFlight(object):
+    """Thread-safe sharing of the results of concurrent identical calls.
+
+    The first caller to do() with a given key runs the function.  Any others
+    that arrive with the same key while it's still running wait for it to
+    finish, and get the same result or exception rather than running the
+    function again.  The number of calls that were shared this way is
+    counted in "shared".
+
+    Exceptions of the types given as "private_errors" are not shared, since
+    they may be particular to the caller that hit them.  Anyone waiting on
+    a call that fails with one of them makes a fresh call of their own.
+    """
+
+    def __init__(self, private_errors=()):
+        self.shared = 0
+        self.private_errors = tuple(private_errors)
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwds):
+        """Call the function, or wait for an identical call in progress.
+
+        This returns a (result, shared) pair, where shared is True if the
+        same result object was also given to any other caller.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _SharedCall()
+            else:
+                call.num_followers += 1
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                exc_type, exc_val, exc_tb = call.exc_info
+                raise exc_type, exc_val, exc_tb
+            if not call.succeeded:
+                # The call was interrupted without an error that can be
+                # shared, e.g. by the greenlet being killed.
+                return func(*args, **kwds), False
+            return call.result, True
+        try:
+            call.result = func(*args, **kwds)
+            call.succeeded = True
+        except self.private_errors:
+            raise
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+        # No more callers can join once the call has been forgotten.
+        return call.result, call.num_followers > 0
+
+    def forget(self, match):
+        """Stop sharing the calls in progress whose keys match a predicate.
+
+        Any later callers with those keys will make a fresh call, while those
+        already waiting still get the original result.
+        """
+        with self._lock:
+            for key in [key for key in self._calls if match(key)]:
+                del self._calls[key]
+
+
+class _SharedCall(object):
+    """The state of a call that's being shared by SingleFlight."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.succeeded = False
+        self.exc_info = None
+        self.num_followers = 0
+
+
+class LRUCache(object):
+    """Thread-safe mapping that evicts its least-recently-used entries.
+
+    At most max_size entries are kept.  Any entries given as "permanent" are
+    always available, are never evicted, and don't count towards the limit.
+    Reading an entry marks it as recently used.  The number of lookups that
+    found or failed to find an entry are counted as "hits" and "misses".
+    """
+
+    def __init__(self, max_size, permanent=None):
+        self.max_size = int(max_size)
+        self.hits = 0
+        self.misses = 0
+        self._permanent = dict(permanent or {})
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._permanent) + len(self._items)
+
+    def __contains__(self, key):
+        return key in self._permanent or key in self._items
+
+    def __getitem__(self, key):
+        try:
+            value = self._permanent[key]
+        except KeyError:
+            with self._lock:
+                try:
+                    value = self._items.pop(key)
+                except KeyError:
+                    self.misses += 1
+                    raise
+                self._items[key] = value
+        self.hits += 1
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key in self._permanent:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
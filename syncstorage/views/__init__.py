@@ -2,14 +2,18 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import time
 import logging
 
 from base64 import b64encode
 
 from pyramid.security import Allow
+from pyramid.threadlocal import manager as threadlocal_manager
 
 from cornice import Service
 
+from mozsvc.metrics import annotate_request
+
 from syncstorage.bso import VALID_ID_REGEX
 from syncstorage.util import get_timestamp
 from syncstorage.storage import (ConflictError,
@@ -28,7 +32,11 @@ from syncstorage.views.decorators import (convert_storage_errors,
                                           with_collection_lock,
                                           check_precondition_headers,
                                           check_storage_quota)
-from syncstorage.views.util import get_resource_timestamp, get_limit_config
+from syncstorage.views.util import (get_resource_timestamp,
+                                    get_limit_config,
+                                    ItemStream,
+                                    PageSizer,
+                                    DEFAULT_PAGE_TARGET_TIME)
 
 
 logger = logging.getLogger(__name__)
@@ -65,6 +73,10 @@ COLLECTION_ID_REGEX = "[a-zA-Z0-9._-]{1,32}"
 
 ONE_KB = 1024.0
 
+# Number of items per chunk when streaming a collection straight from the
+# database, if not otherwise given by the internal pagination batch size.
+DEFAULT_STREAM_BATCH_SIZE = 100
+
 
 def default_acl(request):
     """Default ACL: only the owner is allowed access.
@@ -252,52 +264,189 @@ def get_collection_with_internal_pagination(request):
 
     This wrapper view breaks up such requests so that they use the
     pagination API internally, which is more respectful of server
-    resources and avoids bogging down queries from other users.
+    resources and avoids bogging down queries from other users.  The
+    size of the pages is adapted as they are fetched, see get_page_sizer().
     """
     try:
         settings = request.registry.settings
         batch_size = settings.get("storage.pagination_batch_size")
+        limit = request.validated.get("limit", None)
+        # If there's no limit on a request for full items, we may be able
+        # to stream them out directly from a single database query.
+        if limit is None and request.validated.get("full", False):
+            if settings.get("storage.stream_unbuffered_reads", False):
+                return stream_collection_items(request, batch_size)
         # If we're not doing internal pagination, fulfill it directly.
         if batch_size is None:
             return get_collection(request)
         # If the request is already limited, fulfill it directly.
-        limit = request.validated.get("limit", None)
         if limit is not None and limit < batch_size:
             return get_collection(request)
+        # If there's no limit at all, we may be able to stream the pages
+        # out to the client as they're fetched rather than buffering them.
+        if limit is None:
+            if settings.get("storage.stream_paginated_responses", False):
+                return stream_collection_pages(request, batch_size)
         # Otherwise, we'll have to paginate internally for reduce db load.
         items = []
-        request.validated["limit"] = batch_size
+        sizer = get_page_sizer(request, batch_size)
+        request.validated["limit"] = sizer.size
         while True:
             # Do the actual fetch, knowing it won't be too big.
-            res = get_collection(request)
+            res = get_collection_page(request, sizer)
             items.extend(res)
+            request.validated["limit"] = sizer.size
             if limit is not None:
                 max_left = limit - len(items)
                 # If we've fetched up to the requested limit then stop,
                 # leaving the X-Weave-Next-Offset header intact.
                 if max_left <= 0:
                     break
-                request.validated["limit"] = min(max_left, batch_size)
+                request.validated["limit"] = min(max_left, sizer.size)
             # Check Next-Offset to see if we've fetched all available items.
             try:
                 offset = request.response.headers.pop("X-Weave-Next-Offset")
             except KeyError:
                 break
-            # Fetch again, using the given offset token and sanity-checking
-            # that the collection has not been concurrently modified.
-            # Taking a collection lock here would defeat the point of this
-            # pagination, which is to free up db resources.
-            request.validated["offset"] = offset
-            if "if_unmodified_since" not in request.validated:
-                last_modified = request.response.headers["X-Last-Modified"]
-                last_modified = get_timestamp(last_modified)
-                request.validated["if_unmodified_since"] = last_modified
+            prepare_next_page(request, offset)
         return items
     except NotFoundError:
         # For b/w compat, non-existent collections must return an empty list.
         return []
 
 
+def stream_collection_pages(request, batch_size):
+    """Get the contents of a collection as a stream of internal pages.
+
+    This is a variant of internal pagination that avoids holding the entire
+    result set in memory.  The first page is fetched immediately, so that
+    any errors or precondition failures are reported in the usual way.  If
+    there are more items to come, the remaining pages are fetched lazily
+    as the response body is being sent to the client.
+
+    Since the response status and headers will already have been sent by
+    the time the later pages are fetched, any error while fetching them
+    will abort the response.  The client will see a truncated body rather
+    than a well-formed but incomplete list of items.
+
+    Pyramid will also have popped the request threadlocals by then, so they
+    are pushed again around the fetching of each later page.  This lets the
+    storage backend see the request's deadline, metrics and known timestamp
+    just as it did for the first page.
+    """
+    sizer = get_page_sizer(request, batch_size)
+    request.validated["limit"] = sizer.size
+    first_page = get_collection_page(request, sizer)
+    offset = request.response.headers.pop("X-Weave-Next-Offset", None)
+    # If everything fit in a single page, there's nothing to stream.
+    if offset is None:
+        return first_page
+
+    def iter_pages(offset):
+        yield first_page
+        while offset is not None:
+            threadlocal_manager.push({
+                "request": request,
+                "registry": request.registry,
+            })
+            try:
+                prepare_next_page(request, offset)
+                request.validated["limit"] = sizer.size
+                page = get_collection_page(request, sizer)
+            finally:
+                threadlocal_manager.pop()
+            yield page
+            offset = request.response.headers.pop("X-Weave-Next-Offset", None)
+
+    return ItemStream(iter_pages(offset))
+
+
+def stream_collection_items(request, batch_size=None):
+    """Get the full contents of a collection as a stream of items.
+
+    This asks the storage backend to read the items using an unbuffered
+    database cursor, so that they can be sent to the client as they arrive
+    from the database without ever holding the full result set in memory.
+    The query is issued while the collection lock is held, and thus sees
+    a consistent snapshot, but the rows are only read from the database
+    as the response body is being sent.
+
+    As with stream_collection_pages, any error while reading the rows will
+    result in a truncated response body.  If the client disconnects before
+    the response is complete, the renderer will close the stream and the
+    database connection will be released.
+    """
+    if batch_size is None:
+        batch_size = DEFAULT_STREAM_BATCH_SIZE
+    request.validated["stream"] = True
+    items = get_collection(request)
+    # The backend is free to return a plain list instead.
+    if isinstance(items, list):
+        return items
+
+    def iter_batches():
+        batch = []
+        for bso in items:
+            bso.pop("ttl", None)
+            batch.append(bso)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    return ItemStream(iter_batches(), close=items.close)
+
+
+def get_page_sizer(request, batch_size):
+    """Get a PageSizer for internal pagination, starting at the given size.
+
+    The page size is allowed to range between the "pagination_min_batch_size"
+    and "pagination_max_batch_size" settings, aiming for each page to take
+    no more than "pagination_target_time" seconds to fetch.  By default the
+    range is just the initial size, so it never changes.
+    """
+    settings = request.registry.settings
+    target_time = settings.get("storage.pagination_target_time",
+                               DEFAULT_PAGE_TARGET_TIME)
+    return PageSizer(batch_size,
+                     settings.get("storage.pagination_min_batch_size"),
+                     settings.get("storage.pagination_max_batch_size"),
+                     float(target_time))
+
+
+def get_collection_page(request, sizer):
+    """Fetch one internal page of a collection, adapting the page size.
+
+    The time taken to fetch the page and the current load on the storage
+    backend are fed into the given PageSizer, and any change in its size is
+    counted in the request metrics.
+    """
+    t_start = time.time()
+    res = get_collection(request)
+    old_size = sizer.size
+    storage = request.validated["storage"]
+    new_size = sizer.update(time.time() - t_start, storage.get_load())
+    if new_size > old_size:
+        annotate_request(request, __name__ + ".page_size.grow", 1)
+    elif new_size < old_size:
+        annotate_request(request, __name__ + ".page_size.shrink", 1)
+    return res
+
+
+def prepare_next_page(request, offset):
+    """Adjust the request to fetch the next internal page of a collection."""
+    # Fetch again, using the given offset token and sanity-checking
+    # that the collection has not been concurrently modified.
+    # Taking a collection lock here would defeat the point of this
+    # pagination, which is to free up db resources.
+    request.validated["offset"] = offset
+    if "if_unmodified_since" not in request.validated:
+        last_modified = request.response.headers["X-Last-Modified"]
+        last_modified = get_timestamp(last_modified)
+        request.validated["if_unmodified_since"] = last_modified
+
+
 @sleep_and_retry_on_conflict
 @with_collection_lock
 @check_precondition_headers
@@ -314,9 +463,12 @@ def get_collection(request):
             filters[name] = request.validated[name]
 
     if request.validated.get("full", False):
-        res = storage.get_items(userid, collection, **filters)
-        for bso in res["items"]:
-            bso.pop("ttl", None)
+        stream = request.validated.get("stream", False)
+        res = storage.get_items(userid, collection, stream=stream, **filters)
+        # Streamed items are cleaned up by the caller as they're consumed.
+        if isinstance(res["items"], list):
+            for bso in res["items"]:
+                bso.pop("ttl", None)
     else:
         res = storage.get_item_ids(userid, collection, **filters)
     next_offset = res.get("next_offset")
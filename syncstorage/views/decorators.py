@@ -12,6 +12,7 @@ from pyramid.httpexceptions import (HTTPNotFound,
                                     HTTPBadRequest)
 
 from syncstorage.storage import (ConflictError,
+                                 DeadlineExceededError,
                                  NotFoundError,
                                  InvalidOffsetError,
                                  InvalidBatch)
@@ -25,7 +26,8 @@ logger = logging.getLogger(__name__)
 ONE_KB = 1024
 ONE_MB = 1024 * 1024
 
-# How long the client should wait before retrying a conflicting write.
+# How long the client should wait before retrying a conflicting write,
+# or a request that ran out of time.
 RETRY_AFTER = 10
 
 
@@ -46,6 +48,9 @@ def convert_storage_errors(viewfunc, request):
         #   * android bug: https://bugzilla.mozilla.org/show_bug.cgi?id=959032
         headers = {"Retry-After": str(RETRY_AFTER)}
         raise HTTPServiceUnavailable(headers=headers)
+    except DeadlineExceededError:
+        headers = {"Retry-After": str(RETRY_AFTER)}
+        raise HTTPServiceUnavailable(headers=headers)
     except NotFoundError:
         raise HTTPNotFound
     except InvalidOffsetError:
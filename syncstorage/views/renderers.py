@@ -4,7 +4,7 @@
 
 
 from syncstorage.util import json_dumps
-from syncstorage.views.util import get_resource_timestamp
+from syncstorage.views.util import get_resource_timestamp, ItemStream
 
 
 class SyncStorageRenderer(object):
@@ -45,8 +45,23 @@ class JsonRenderer(SyncStorageRenderer):
             response.headers["X-Weave-Records"] = str(len(value))
 
     def render_value(self, value):
+        if isinstance(value, ItemStream):
+            return self.render_stream(value)
         return json_dumps(value)
 
+    def render_stream(self, stream):
+        """Render an ItemStream as a JSON list, one chunk per batch."""
+        try:
+            yield "["
+            separator = ""
+            for batch in stream.iter_batches():
+                if batch:
+                    yield separator + ",".join(json_dumps(v) for v in batch)
+                    separator = ","
+            yield "]"
+        finally:
+            stream.close()
+
 
 class NewlinesRenderer(SyncStorageRenderer):
     """Pyramid renderer producing lists in application/newlines format."""
@@ -55,9 +70,24 @@ class NewlinesRenderer(SyncStorageRenderer):
         super(NewlinesRenderer, self).adjust_response(value, request, response)
         if response.content_type == response.default_content_type:
             response.content_type = "application/newlines"
-        response.headers["X-Weave-Records"] = str(len(value))
+        if not isinstance(value, ItemStream):
+            response.headers["X-Weave-Records"] = str(len(value))
 
     def render_value(self, value):
+        if isinstance(value, ItemStream):
+            return self.render_stream(value)
+        return self.render_lines(value)
+
+    def render_stream(self, stream):
+        """Render an ItemStream as newline-separated lines, one per batch."""
+        try:
+            for batch in stream.iter_batches():
+                if batch:
+                    yield self.render_lines(batch)
+        finally:
+            stream.close()
+
+    def render_lines(self, value):
         data = []
         for line in value:
             line = json_dumps(line)
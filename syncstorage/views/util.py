@@ -10,6 +10,15 @@ from pyramid.httpexceptions import HTTPError
 from syncstorage.storage import NotFoundError
 from syncstorage.bso import MAX_PAYLOAD_SIZE
 
+# Default number of seconds that each internal page should take to fetch,
+# when the page size is being adapted.
+DEFAULT_PAGE_TARGET_TIME = 0.5
+
+# Storage load above which internal pages are made smaller, and below which
+# they are allowed to grow.
+HIGH_STORAGE_LOAD = 0.8
+LOW_STORAGE_LOAD = 0.5
+
 
 def json_error(status_code=400, status_message="error", errors=()):
     """Construct a cornice-format JSON error response."""
@@ -89,6 +98,72 @@ def get_resource_timestamp(request):
         return 0
 
 
+class ItemStream(object):
+    """A lazily-produced list of items, to be streamed in the response body.
+
+    Views can return an ItemStream instead of a list when the full set of
+    items would be too large to comfortably hold in memory.  It wraps an
+    iterator that produces the items in successive batches, and the renderers
+    will serialize and send each batch as it arrives rather than building the
+    entire response body as a single string.
+
+    Since the total number of items is not known until the stream has been
+    consumed, responses containing an ItemStream do not report it in the
+    X-Weave-Records header.
+
+    If the stream holds resources that must be released when it is no longer
+    needed, a "close" callback can be provided.  The renderers will call
+    close() once the stream has been sent or the response is abandoned.
+    """
+
+    def __init__(self, batches, close=None):
+        self._batches = batches
+        self._close = close
+
+    def close(self):
+        """Release any resources held by the stream."""
+        close, self._close = self._close, None
+        if close is not None:
+            close()
+
+    def iter_batches(self):
+        """Iterator over the successive batches of items in the stream."""
+        return iter(self._batches)
+
+    def __iter__(self):
+        for batch in self.iter_batches():
+            for item in batch:
+                yield item
+
+
+class PageSizer(object):
+    """Adaptive choice of the page size for internal pagination.
+
+    Rather than fetching every page of a large collection with the same
+    fixed size, this class adjusts the size after each page based on how
+    long that page took and how heavily loaded the storage backend is.  The
+    size doubles while pages take less than half the target time and the
+    load is low, and halves whenever a page takes longer than the target
+    time or the load is high.  It always stays between the min and max size,
+    which default to the initial size, i.e. to no adaptation at all.
+    """
+
+    def __init__(self, size, min_size=None, max_size=None,
+                 target_time=DEFAULT_PAGE_TARGET_TIME):
+        self.min_size = size if min_size is None else int(min_size)
+        self.max_size = size if max_size is None else int(max_size)
+        self.size = max(self.min_size, min(size, self.max_size))
+        self.target_time = float(target_time)
+
+    def update(self, page_time, load=0):
+        """Adjust the page size after a page was fetched, returning it."""
+        if page_time > self.target_time or load >= HIGH_STORAGE_LOAD:
+            self.size = max(self.size // 2, self.min_size)
+        elif page_time < self.target_time / 2 and load < LOW_STORAGE_LOAD:
+            self.size = min(self.size * 2, self.max_size)
+        return self.size
+
+
 DEFAULT_LIMITS = {}
 DEFAULT_LIMITS["max_record_payload_bytes"] = MAX_PAYLOAD_SIZE
 DEFAULT_LIMITS["max_post_records"] = 100